@@ -0,0 +1,85 @@
+# Copyright (c) Sebastian Scholz
+# See LICENSE for details.
+#
+# Measures the memory footprint per token of the DictTokenStorage compared to
+# the previous layout, which stored a dict with a fresh scope list for every token.
+# Run with: python -m benchmarks.tokenStorageMemory [numberOfTokens]
+import sys
+import time
+import tracemalloc
+
+from uuid import uuid4
+
+from txoauth2.clients import PublicClient
+from txoauth2.imp import DictTokenStorage
+
+
+def _storeDictOfDicts(tokens, clients, scopes):
+    """
+    Store the tokens in the dict of dicts layout that was used before the compact records.
+    :param tokens: The tokens to store.
+    :param clients: The clients to assign to the tokens.
+    :param scopes: The scopes to assign to the tokens.
+    :return: The dict of dicts holding the tokens.
+    """
+    storage = {}
+    for index, token in enumerate(tokens):
+        storage[token] = {
+            'data': None,
+            'birthTime': int(time.time()),
+            'expireTime': time.time() + 3600,
+            'scope': scopes[index % len(scopes)].split(),
+            'client': clients[index % len(clients)].id
+        }
+    return storage
+
+
+def _storeDictTokenStorage(tokens, clients, scopes):
+    """
+    Store the tokens in a DictTokenStorage.
+    :param tokens: The tokens to store.
+    :param clients: The clients to assign to the tokens.
+    :param scopes: The scopes to assign to the tokens.
+    :return: The DictTokenStorage holding the tokens.
+    """
+    storage = DictTokenStorage()
+    for index, token in enumerate(tokens):
+        storage.store(token, clients[index % len(clients)], scopes[index % len(scopes)].split(),
+                      expireTime=time.time() + 3600)
+    return storage
+
+
+def measure(storeFunction, tokens, clients, scopes):
+    """
+    :param storeFunction: A function that stores the tokens.
+    :param tokens: The tokens to store.
+    :param clients: The clients to assign to the tokens.
+    :param scopes: The scopes to assign to the tokens.
+    :return: The number of bytes allocated per token, excluding the token strings.
+    """
+    tracemalloc.start()
+    storage = storeFunction(tokens, clients, scopes)
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del storage
+    return allocated / float(len(tokens))
+
+
+def main(numTokens):
+    """
+    Print the memory footprint per token for both layouts.
+    :param numTokens: The number of tokens to store.
+    """
+    tokens = [str(uuid4()) for _ in range(numTokens)]
+    clients = [PublicClient('client' + str(index), ['https://client.example/return'],
+                            ['authorization_code']) for index in range(100)]
+    scopes = ['read', 'read write', 'read write admin', 'profile email']
+    dictOfDicts = measure(_storeDictOfDicts, tokens, clients, scopes)
+    records = measure(_storeDictTokenStorage, tokens, clients, scopes)
+    print('{num} tokens'.format(num=numTokens))
+    print('dict of dicts:    {size:7.1f} bytes per token'.format(size=dictOfDicts))
+    print('DictTokenStorage: {size:7.1f} bytes per token'.format(size=records))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
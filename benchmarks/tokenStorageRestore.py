@@ -0,0 +1,60 @@
+# Copyright (c) Sebastian Scholz
+# See LICENSE for details.
+#
+# Measures how long the SnapshotTokenStorage needs to write a snapshot
+# and to restore all tokens from it on startup.
+# Run with: python -m benchmarks.tokenStorageRestore [numberOfTokens]
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from uuid import uuid4
+
+from twisted.internet.task import Clock
+
+from txoauth2.clients import PublicClient
+from txoauth2.imp import SnapshotTokenStorage
+
+
+def main(numTokens):
+    """
+    Print the time needed to write and restore a snapshot of numTokens tokens.
+    :param numTokens: The number of tokens to store.
+    """
+    clients = [PublicClient('client' + str(index), ['https://client.example/return'],
+                            ['authorization_code']) for index in range(100)]
+    scopes = [scope.split() for scope in
+              ['read', 'read write', 'read write admin', 'profile email']]
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'tokens')
+    try:
+        # The clock is never advanced, so the snapshot is written synchronously below.
+        tokenStorage = SnapshotTokenStorage(path, reactor=Clock())
+        expireTime = time.time() + 3600
+        for index in range(numTokens):
+            tokenStorage.store(str(uuid4()), clients[index % len(clients)],
+                               scopes[index % len(scopes)], expireTime=expireTime)
+        items = list(tokenStorage._tokens.items())  # pylint: disable=protected-access
+        del tokenStorage
+        start = time.time()
+        SnapshotTokenStorage._writeSnapshot(  # pylint: disable=protected-access
+            SnapshotTokenStorage(path, reactor=Clock()), items)
+        writeTime = time.time() - start
+        del items
+        start = time.time()
+        tokenStorage = SnapshotTokenStorage(path, reactor=Clock())
+        restoreTime = time.time() - start
+        numRestored = tokenStorage.getStatistics()['live_tokens']
+        print('{num} tokens, snapshot size {size:.1f} MB'.format(
+            num=numTokens, size=os.path.getsize(path + '.snapshot') / 1024.0 / 1024.0))
+        print('write snapshot: {time:6.2f} s'.format(time=writeTime))
+        print('restore:        {time:6.2f} s ({rate:.0f} tokens per second)'.format(
+            time=restoreTime, rate=numRestored / restoreTime))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
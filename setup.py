@@ -11,7 +11,7 @@ setup(
     license='MIT',
     keywords=['OAuth2', 'twisted'],
     url='https://github.com/Abestanis/TxOauth2',
-    packages=['txoauth2'],
+    packages=['txoauth2', 'txoauth2.storage'],
     install_requires=['twisted'],
     classifiers=[
         'Development Status :: 5 - Production/Stable',
@@ -1,3 +1,4 @@
+import json
 import time
 
 from uuid import uuid4
@@ -12,13 +13,14 @@ except ImportError:
     from base64 import encodestring as encodeBase64
 
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import succeed, inlineCallbacks, returnValue
+from twisted.internet.defer import Deferred, succeed, inlineCallbacks, returnValue, maybeDeferred
 from twisted.web import server
 from twisted.web.test.test_web import DummyRequest
 
 from txoauth2 import GrantTypes
 from txoauth2.token import TokenFactory, UserPasswordManager, PersistentStorage
-from txoauth2.clients import ClientStorage, PasswordClient
+from txoauth2.clients import ClientStorage, PasswordClient, getClientAttributes
+from txoauth2.resource import OAuth2
 
 
 class classProperty(object):
@@ -335,6 +337,50 @@ class TestPersistentStorage(PersistentStorage):
         self._data[key] = dict(data)
 
 
+class DeferredWrapper(object):
+    """
+    A wrapper that returns a Deferred for each method call on the wrapped object.
+    The Deferreds only fire after flush was called, which simulates a slow backend.
+    """
+    def __init__(self, wrapped):
+        self._wrapped = wrapped
+        self._pendingCalls = []
+
+    def __getattr__(self, name):
+        attribute = getattr(self._wrapped, name)
+        if not callable(attribute):
+            return attribute
+
+        def wrapper(*args, **kwargs):
+            deferred = Deferred()
+            self._pendingCalls.append((deferred, attribute, args, kwargs))
+            return deferred
+        return wrapper
+
+    def hasPendingCalls(self):
+        """
+        :return: Whether or not there are method calls that have not been executed yet.
+        """
+        return len(self._pendingCalls) != 0
+
+    def flush(self):
+        """ Execute all pending method calls and fire the corresponding Deferreds. """
+        pendingCalls = self._pendingCalls
+        self._pendingCalls = []
+        for deferred, method, args, kwargs in pendingCalls:
+            maybeDeferred(method, *args, **kwargs).chainDeferred(deferred)
+
+
+def flushDeferredWrappers(*wrappers):
+    """
+    Flush the wrappers until none of them has any pending calls left.
+    :param wrappers: The DeferredWrappers to flush.
+    """
+    while any(wrapper.hasPendingCalls() for wrapper in wrappers):
+        for wrapper in wrappers:
+            wrapper.flush()
+
+
 def getTestPasswordClient(clientId=None, authorizedGrantTypes=None):
     """
     :param clientId: The client id or None for a random client id.
@@ -351,6 +397,61 @@ def getTestPasswordClient(clientId=None, authorizedGrantTypes=None):
         clientId, ['https://return.nonexistent'], authorizedGrantTypes, secret='ClientSecret')
 
 
+class _CodeGrantOAuth2(OAuth2):
+    """ An OAuth2 resource which grants every authorization request immediately. """
+    def onAuthenticate(self, request, client, responseType, scope, redirectUri, state, dataKey):
+        return self.grantAccess(request, dataKey, scope=scope)
+
+
+def runAuthorizationCodeGrant(testCase, tokenFactory, scope=None):
+    """
+    Run the authorization code grant flow with an OAuth2 resource that was initialized
+    from a token resource which uses the given token factory. The code is exchanged
+    for an access token at the token resource.
+    :param testCase: The current test case.
+    :param tokenFactory: The token factory to generate the code and the tokens with.
+    :param scope: The scope to request, defaults to ['All'].
+    :return: A tuple of the client, the authorization code and the token response.
+    """
+    from txoauth2.imp import DictTokenStorage
+    from txoauth2.token import TokenResource
+    if scope is None:
+        scope = ['All']
+    client = getTestPasswordClient()
+    clientStorage = TestClientStorage()
+    clientStorage.addClient(client)
+    tokenResource = TokenResource(
+        tokenFactory, TestPersistentStorage(), DictTokenStorage(), DictTokenStorage(),
+        clientStorage, grantTypes=[GrantTypes.AuthorizationCode])
+    testCase.addCleanup(setattr, TokenResource, '_OAuthTokenStorage', None)
+    authResource = _CodeGrantOAuth2.initFromTokenResource(tokenResource)
+    redirectUri = client.redirectUris[0]
+    request = MockRequest('GET', 'oauth2', arguments={
+        'response_type': 'code',
+        'client_id': client.id,
+        'redirect_uri': redirectUri,
+        'scope': ' '.join(scope),
+    })
+    authResource.render_GET(request)
+    testCase.assertEqual(302, request.responseCode,
+                         msg='Expected the OAuth2 resource to redirect to the client.')
+    parameter = parse_qs(urlparse(request.getResponseHeader(b'location')).query)
+    testCase.assertIn(b'code', parameter,
+                      msg='Expected the OAuth2 resource to send a code to the client.')
+    code = parameter[b'code'][0].decode('utf-8')
+    request = MockRequest('POST', 'token', arguments={
+        'grant_type': GrantTypes.AuthorizationCode.value,
+        'code': code,
+        'redirect_uri': redirectUri,
+    })
+    request.setRequestHeader('Content-Type', 'application/x-www-form-urlencoded')
+    request.addAuthorization(client.id, client.secret)
+    result = tokenResource.render_POST(request)
+    testCase.assertEqual(200, request.responseCode,
+                         msg='Expected the token resource to accept the authorization code.')
+    return client, code, json.loads(result.decode('utf-8'))
+
+
 def assertClientEquals(testCase, client, expectedClient, message):
     """
     Assert that the client equals the expected client.
@@ -361,7 +462,13 @@ def assertClientEquals(testCase, client, expectedClient, message):
     """
     if message.endswith('.'):
         message = message[:-1]
-    for name, value in expectedClient.__dict__.items():
+    attributes = getClientAttributes(expectedClient)
+    attributes.update({
+        'id': expectedClient.id,
+        'redirectUris': expectedClient.redirectUris,
+        'authorizedGrantTypes': expectedClient.authorizedGrantTypes
+    })
+    for name, value in attributes.items():
         testCase.assertTrue(hasattr(client, name),
                             msg=message + ': Missing attribute "{name}"'.format(name=name))
         testCase.assertEquals(
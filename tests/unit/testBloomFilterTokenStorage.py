@@ -0,0 +1,102 @@
+import time
+
+from txoauth2 import isAuthorized
+from txoauth2.errors import InvalidTokenRequestError
+from txoauth2.imp import BloomFilterTokenStorage, BucketedTokenStorage
+from txoauth2.token import TokenResource, TokenAccess
+
+from tests import TwistedTestCase, MockRequest, getTestPasswordClient, DeferredWrapper
+
+
+class TestBloomFilterRejection(TwistedTestCase):
+    """ Test that the BloomFilterTokenStorage answers lookups of unknown tokens itself. """
+    _CLIENT = getTestPasswordClient()
+
+    def setUp(self):
+        super(TestBloomFilterRejection, self).setUp()
+        self._backend = DeferredWrapper(BucketedTokenStorage())
+        self._tokenStorage = BloomFilterTokenStorage(self._backend, capacity=1000)
+        self._tokenStorage.store('validToken', self._CLIENT, ['All'])
+        self._backend.flush()
+
+    def tearDown(self):
+        setattr(TokenResource, '_OAuthTokenStorage', None)
+        super(TestBloomFilterRejection, self).tearDown()
+
+    def testRejectUnknownTokens(self):
+        """ Test that unknown tokens are rejected without accessing the wrapped storage. """
+        for index in range(100):
+            token = 'unknownToken' + str(index)
+            self.assertFalse(self._tokenStorage.contains(token),
+                             msg='Expected contains to return False for an unknown token.')
+            self.assertEqual(TokenAccess.Invalid, self._tokenStorage.checkAccess(token, ['All']))
+            self.assertRaises(KeyError, self._tokenStorage.getTokenScope, token)
+        self.assertFalse(self._backend.hasPendingCalls(),
+                         msg='Expected the wrapped token storage to not be accessed.')
+        statistics = self._tokenStorage.getStatistics()
+        self.assertEqual(300, statistics['rejected_lookups'])
+        self.assertEqual(0, statistics['passed_lookups'])
+        self.assertEqual(1, statistics['stored_tokens'])
+        self.assertLess(statistics['expected_false_positive_rate'], 0.001)
+
+    def testPassKnownTokens(self):
+        """ Test that stored tokens are looked up in the wrapped storage. """
+        result = self._tokenStorage.checkAccess('validToken', ['All'])
+        self.assertTrue(self._backend.hasPendingCalls(),
+                        msg='Expected a stored token to be looked up in the wrapped storage.')
+        self._backend.flush()
+        self.assertEqual(TokenAccess.Granted, self.successResultOf(result))
+        self.assertEqual(1, self._tokenStorage.getStatistics()['passed_lookups'])
+
+    def testFalsePositiveMetric(self):
+        """ Test that lookups which pass the filter but miss the wrapped storage are counted. """
+        self._tokenStorage.addKnownToken('removedToken')
+        result = self._tokenStorage.checkAccess('removedToken', ['All'])
+        self._backend.flush()
+        self.assertEqual(TokenAccess.Invalid, self.successResultOf(result))
+        self.assertEqual(1, self._tokenStorage.getStatistics()['false_positives'])
+
+    def testExpiredGeneration(self):
+        """ Test that the filters of expired tokens are dropped. """
+        tokenStorage = BloomFilterTokenStorage(BucketedTokenStorage(), generationLifetime=0.1)
+        tokenStorage.store('expiringToken', self._CLIENT, ['All'], expireTime=time.time() + 0.05)
+        self.assertEqual(1, tokenStorage.getStatistics()['filters'])
+        time.sleep(0.25)
+        self.assertFalse(tokenStorage.contains('expiringToken'),
+                         msg='Expected an expired token to be rejected.')
+        self.assertEqual(0, tokenStorage.getStatistics()['filters'],
+                         msg='Expected the filter of the expired tokens to be dropped.')
+
+    def testIsAuthorized(self):
+        """ Test that isAuthorized rejects unknown tokens without a storage lookup. """
+        setattr(TokenResource, '_OAuthTokenStorage', self._tokenStorage)
+        request = MockRequest('GET', 'protectedResource', headers={
+            'Authorization': 'Bearer unknownToken'
+        })
+        self.assertFalse(isAuthorized(request, 'All'),
+                         msg='Expected isAuthorized to reject an unknown token.')
+        self.assertEqual(InvalidTokenRequestError(['All']).code, request.responseCode)
+        self.assertFalse(self._backend.hasPendingCalls(),
+                         msg='Expected the wrapped token storage to not be accessed.')
+
+    def testSaturatedPermanentFilter(self):
+        """ Test that a saturated permanent filter passes all lookups until it is rebuilt. """
+        tokenStorage = BloomFilterTokenStorage(self._backend, capacity=10)
+        for index in range(100):
+            tokenStorage.addKnownToken('permanentToken' + str(index))
+        self.assertTrue(tokenStorage.getStatistics()['saturated'],
+                        msg='Expected the overfilled permanent filter to be saturated.')
+        result = tokenStorage.checkAccess('unknownToken', ['All'])
+        self.assertTrue(self._backend.hasPendingCalls(),
+                        msg='Expected the lookup to be passed to the wrapped storage.')
+        self._backend.flush()
+        self.assertEqual(TokenAccess.Invalid, self.successResultOf(result))
+        tokenStorage.rebuildPermanentFilter(['validToken'])
+        statistics = tokenStorage.getStatistics()
+        self.assertFalse(statistics['saturated'],
+                         msg='Expected the rebuilt permanent filter to not be saturated.')
+        self.assertEqual(1, statistics['stored_tokens'])
+        self.assertFalse(tokenStorage.contains('unknownToken'),
+                         msg='Expected the rebuilt filter to reject an unknown token.')
+        self.assertFalse(self._backend.hasPendingCalls(),
+                         msg='Expected the wrapped token storage to not be accessed.')
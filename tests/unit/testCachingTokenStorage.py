@@ -0,0 +1,158 @@
+import time
+
+from txoauth2 import isAuthorized
+from txoauth2.imp import CachingTokenStorage, BucketedTokenStorage
+from txoauth2.token import TokenResource, TokenAccess
+
+from tests import TwistedTestCase, MockRequest, getTestPasswordClient, DeferredWrapper
+
+
+class TestCachingTokenStorage(TwistedTestCase):
+    """ Test that the CachingTokenStorage answers lookups of cached tokens itself. """
+    _CLIENT = getTestPasswordClient()
+
+    def setUp(self):
+        super(TestCachingTokenStorage, self).setUp()
+        self._backend = DeferredWrapper(BucketedTokenStorage())
+        self._tokenStorage = CachingTokenStorage(self._backend, maxSize=2)
+        self._tokenStorage.store('validToken', self._CLIENT, ['All'])
+        self._backend.flush()
+
+    def tearDown(self):
+        setattr(TokenResource, '_OAuthTokenStorage', None)
+        super(TestCachingTokenStorage, self).tearDown()
+
+    def testReadThrough(self):
+        """ Test that a token is looked up in the wrapped storage only once. """
+        result = self._tokenStorage.checkAccess('validToken', ['All'])
+        self.assertTrue(self._backend.hasPendingCalls(),
+                        msg='Expected an uncached token to be looked up in the wrapped storage.')
+        self._backend.flush()
+        self.assertEqual(TokenAccess.Granted, self.successResultOf(result))
+        self.assertEqual(TokenAccess.InsufficientScope,
+                         self._tokenStorage.checkAccess('validToken', ['admin']))
+        self.assertTrue(self._tokenStorage.contains('validToken'),
+                        msg='Expected contains to return True for a cached token.')
+        self.assertEqual(self._CLIENT.id, self._tokenStorage.getTokenClient('validToken'))
+        self.assertFalse(self._backend.hasPendingCalls(),
+                         msg='Expected a cached token to not be looked up in the wrapped storage.')
+        statistics = self._tokenStorage.getStatistics()
+        self.assertEqual(3, statistics['hits'])
+        self.assertEqual(1, statistics['misses'])
+
+    def testConcurrentLookups(self):
+        """ Test that concurrent lookups of a token share one lookup in the wrapped storage. """
+        results = [self._tokenStorage.getTokenScope('validToken') for _ in range(3)]
+        results.append(self._tokenStorage.contains('unknownToken'))
+        self._backend.flush()
+        for result in results[:3]:
+            self.assertListEqual(['All'], self.successResultOf(result))
+        self.assertFalse(self.successResultOf(results[3]),
+                         msg='Expected contains to return False for an unknown token.')
+        self.assertEqual(1, self._tokenStorage.getStatistics()['cached_tokens'],
+                         msg='Expected unknown tokens to not be cached.')
+
+    def testRemove(self):
+        """ Test that a removed token is dropped from the cache. """
+        self._tokenStorage.getTokenInfo('validToken')
+        self._backend.flush()
+        self._tokenStorage.remove('validToken')
+        self._backend.flush()
+        result = self._tokenStorage.checkAccess('validToken', ['All'])
+        self._backend.flush()
+        self.assertEqual(TokenAccess.Invalid, self.successResultOf(result))
+
+    def testRemoveByClient(self):
+        """ Test that the tokens removed by client are dropped from the cache. """
+        self._tokenStorage.getTokenInfo('validToken')
+        self._backend.flush()
+        result = self._tokenStorage.removeByClient(self._CLIENT.id)
+        self._backend.flush()
+        self.assertListEqual(['validToken'], self.successResultOf(result))
+        self.assertEqual(0, self._tokenStorage.getStatistics()['cached_tokens'],
+                         msg='Expected the removed tokens to be dropped from the cache.')
+
+    def testRemoveDuringLookup(self):
+        """ Test that a token which is removed during its lookup is not cached. """
+        result = self._tokenStorage.getTokenInfo('validToken')
+        self._tokenStorage.remove('validToken')
+        self._backend.flush()
+        self.assertEqual(self._CLIENT.id, self.successResultOf(result)['client_id'])
+        self.assertEqual(0, self._tokenStorage.getStatistics()['cached_tokens'],
+                         msg='Expected a token removed during its lookup to not be cached.')
+
+    def testExpiry(self):
+        """ Test that a token is not served from the cache after it expires. """
+        tokenStorage = CachingTokenStorage(BucketedTokenStorage(), timeToLive=60)
+        tokenStorage.store('expiringToken', self._CLIENT, ['All'], expireTime=time.time() + 0.1)
+        self.assertTrue(tokenStorage.contains('expiringToken'),
+                        msg='Expected contains to return True for a valid token.')
+        time.sleep(0.15)
+        self.assertFalse(tokenStorage.contains('expiringToken'),
+                         msg='Expected an expired token to not be served from the cache.')
+        tokenStorage = CachingTokenStorage(BucketedTokenStorage(), timeToLive=0.1)
+        tokenStorage.store('token', self._CLIENT, ['All'])
+        tokenStorage.contains('token')
+        time.sleep(0.15)
+        tokenStorage.contains('token')
+        self.assertEqual(2, tokenStorage.getStatistics()['misses'],
+                         msg='Expected a token to be looked up again after its time to live.')
+
+    def testEviction(self):
+        """ Test that the least recently used token is evicted if the cache is full. """
+        tokenStorage = CachingTokenStorage(BucketedTokenStorage(), maxSize=2)
+        for token in ['token1', 'token2', 'token3']:
+            tokenStorage.store(token, self._CLIENT, ['All'])
+        tokenStorage.contains('token1')
+        tokenStorage.contains('token2')
+        tokenStorage.contains('token1')
+        tokenStorage.contains('token3')
+        statistics = tokenStorage.getStatistics()
+        self.assertEqual(2, statistics['cached_tokens'])
+        self.assertEqual(1, statistics['evictions'])
+        tokenStorage.contains('token1')
+        self.assertEqual(2, tokenStorage.getStatistics()['hits'],
+                         msg='Expected the recently used token to stay in the cache.')
+
+    def testReturnsCopies(self):
+        """ Test that changing a returned value does not change the cached token. """
+        tokenStorage = CachingTokenStorage(BucketedTokenStorage())
+        tokenStorage.store('token', self._CLIENT, ['All'], additionalData={'user': ['someUser']})
+        tokenStorage.getTokenInfo('token')['scope'].append('admin')
+        tokenStorage.getTokenScope('token').append('admin')
+        tokenStorage.getTokenAdditionalData('token')['user'].append('otherUser')
+        tokenInfo = tokenStorage.getTokenInfo('token')
+        self.assertEqual(['All'], tokenInfo['scope'])
+        self.assertEqual({'user': ['someUser']}, tokenInfo['additional_data'])
+        self.assertEqual(TokenAccess.InsufficientScope,
+                         tokenStorage.checkAccess('token', ['admin']))
+        self.assertEqual(4, tokenStorage.getStatistics()['hits'])
+
+    def testPassThrough(self):
+        """ Test that calls to a storage without getTokenInfo are not counted as misses. """
+        class NoTokenInfoStorage(BucketedTokenStorage):
+            def getTokenInfo(self, token):
+                raise NotImplementedError()
+
+        tokenStorage = CachingTokenStorage(NoTokenInfoStorage())
+        tokenStorage.store('token', self._CLIENT, ['All'])
+        self.assertTrue(tokenStorage.contains('token'),
+                        msg='Expected contains to be answered by the wrapped storage.')
+        self.assertEqual(['All'], tokenStorage.getTokenScope('token'))
+        statistics = tokenStorage.getStatistics()
+        self.assertEqual(2, statistics['pass_throughs'])
+        self.assertEqual(0, statistics['misses'])
+        self.assertEqual(0, statistics['cached_tokens'])
+
+    def testIsAuthorized(self):
+        """ Test that isAuthorized serves cached tokens without a storage lookup. """
+        setattr(TokenResource, '_OAuthTokenStorage', self._tokenStorage)
+        self._tokenStorage.getTokenInfo('validToken')
+        self._backend.flush()
+        request = MockRequest('GET', 'protectedResource', headers={
+            'Authorization': 'Bearer validToken'
+        })
+        self.assertTrue(isAuthorized(request, 'All'),
+                        msg='Expected isAuthorized to accept a cached token.')
+        self.assertFalse(self._backend.hasPendingCalls(),
+                         msg='Expected the wrapped token storage to not be accessed.')
@@ -1,4 +1,11 @@
-from txoauth2.clients import Client, PasswordClient
+from txoauth2.clients import Client, PublicClient, PasswordClient, compileClient, \
+    getClientAttributes, getClientClass
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from urllib.parse import urlparse
 
 from tests import TwistedTestCase
 from txoauth2.util import isAnyStr
@@ -47,3 +54,83 @@ class ClientTest(TwistedTestCase):
         self.assertRaises(ValueError, Client, 'clientId', ['/relative'], [])
         self.assertRaises(ValueError, Client, 'clientId',
                           ['https://valid.nonexistent', '/test?q=1'], [])
+
+
+class CompiledClientTest(TwistedTestCase):
+    """ Tests the compiled form of a client. """
+    _CLIENT = PasswordClient('clientId', ['https://valid.nonexistent/path?query=1',
+                                          'http://valid.nonexistent'],
+                             ['password', 'refresh_token'], 'secret')
+
+    def testDropInReplacement(self):
+        """ Test that the compiled client has the attributes and the class of the client. """
+        compiledClient = compileClient(self._CLIENT)
+        self.assertIsInstance(compiledClient, PasswordClient,
+                              'Expected the compiled client to be an instance of the client class.')
+        self.assertIs(PasswordClient, getClientClass(compiledClient))
+        self.assertIs(PasswordClient, getClientClass(self._CLIENT))
+        self.assertEqual(self._CLIENT.id, compiledClient.id)
+        self.assertEqual(self._CLIENT.secret, compiledClient.secret)
+        self.assertEqual(tuple(self._CLIENT.redirectUris), compiledClient.redirectUris)
+        self.assertEqual(tuple(self._CLIENT.authorizedGrantTypes),
+                         compiledClient.authorizedGrantTypes)
+        self.assertEqual({'secret': 'secret'}, getClientAttributes(compiledClient))
+        self.assertEqual({'secret': 'secret'}, getClientAttributes(self._CLIENT))
+        self.assertIs(compiledClient, compileClient(compiledClient),
+                      msg='Expected a compiled client not to be compiled again.')
+        self.assertIs(type(compiledClient), type(compileClient(PasswordClient(
+            'otherClientId', ['https://valid.nonexistent'], [], 'otherSecret'))),
+                      msg='Expected the compiled client class to be reused.')
+        self.assertIsInstance(compileClient(PublicClient('publicClientId', [], [])), PublicClient)
+
+    def testLookups(self):
+        """ Test that the compiled client answers the same lookups as the client. """
+        compiledClient = compileClient(self._CLIENT)
+        for client in [self._CLIENT, compiledClient]:
+            for uri in self._CLIENT.redirectUris:
+                self.assertTrue(client.hasRedirectUri(uri))
+                self.assertEqual(urlparse(uri), client.getParsedRedirectUri(uri))
+            self.assertFalse(client.hasRedirectUri('https://valid.nonexistent'))
+            self.assertEqual('https', client.getParsedRedirectUri(
+                'https://other.nonexistent').scheme)
+            for grantType in self._CLIENT.authorizedGrantTypes:
+                self.assertTrue(client.isGrantTypeAuthorized(grantType))
+            self.assertFalse(client.isGrantTypeAuthorized('implicit'))
+
+    def testImmutable(self):
+        """ Test that the compiled client can not be changed and has no instance dict. """
+        compiledClient = compileClient(self._CLIENT)
+        self.assertFalse(hasattr(compiledClient, '__dict__'),
+                         msg='Expected all attributes of the compiled client to be slots.')
+        for name in ['id', 'secret', 'newAttribute']:
+            self.assertRaises(AttributeError, setattr, compiledClient, name, 'value')
+        self.assertRaises(AttributeError, delattr, compiledClient, 'secret')
+        self.assertEqual('secret', compiledClient.secret)
+
+    def testClientSubclass(self):
+        """ Test that the attributes of client subclasses with and without slots are kept. """
+        class SlotsClient(PasswordClient):
+            """ A client which stores its additional attribute in a slot. """
+            __slots__ = ('owner',)
+
+            def __init__(self, clientId, redirectUris, authorizedGrantTypes, secret, owner):
+                super(SlotsClient, self).__init__(
+                    clientId, redirectUris, authorizedGrantTypes, secret)
+                self.owner = owner
+
+        class DictClient(PublicClient):
+            """ A client which stores its additional attribute in the instance dict. """
+            def __init__(self, clientId, redirectUris, authorizedGrantTypes, owner):
+                super(DictClient, self).__init__(clientId, redirectUris, authorizedGrantTypes)
+                self.owner = owner
+
+        slotsClient = SlotsClient('slotsClientId', [], [], 'secret', 'me')
+        dictClient = DictClient('dictClientId', [], [], 'me')
+        self.assertEqual({'secret': 'secret', 'owner': 'me'}, getClientAttributes(slotsClient))
+        self.assertEqual({'owner': 'me'}, getClientAttributes(dictClient))
+        compiledClient = compileClient(slotsClient)
+        self.assertFalse(hasattr(compiledClient, '__dict__'),
+                         msg='Expected all attributes of the compiled client to be slots.')
+        self.assertEqual({'secret': 'secret', 'owner': 'me'},
+                         getClientAttributes(compiledClient))
+        self.assertEqual('me', compileClient(dictClient).owner)
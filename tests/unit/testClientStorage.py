@@ -1,10 +1,15 @@
 import os
+import shutil
+import tempfile
 
 from tempfile import NamedTemporaryFile
 
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
 from txoauth2 import GrantTypes
-from txoauth2.clients import Client, PublicClient, PasswordClient
-from txoauth2.imp import ConfigParserClientStorage
+from txoauth2.clients import Client, PublicClient, PasswordClient, compileClient
+from txoauth2.imp import ConfigParserClientStorage, JournalClientStorage
 
 from tests import TwistedTestCase, getTestPasswordClient, assertClientEquals
 
@@ -96,3 +101,233 @@ class ConfigParserClientStorageTest(AbstractClientStorageTest):
         self.assertEquals(
             self._CLIENT_STORAGE.getClient(client.id).secret, client.secret,
             msg='Expected the client storage to contain a client after adding him.')
+
+
+class ConfigParserClientStorageCacheTest(TwistedTestCase):
+    """ Test the client cache of the ConfigParserClientStorage. """
+    _CLIENT_ID = 'cachedClient'
+
+    def setUp(self):
+        super(ConfigParserClientStorageCacheTest, self).setUp()
+        with NamedTemporaryFile(prefix='.ini', delete=False) as tempFile:
+            self._path = tempFile.name
+        self._clock = Clock()
+        self._clientStorage = ConfigParserClientStorage(
+            self._path, reloadInterval=10, reactor=self._clock)
+        self._clientStorage.addClient(self._getClient())
+
+    def tearDown(self):
+        self._clientStorage.close()
+        os.unlink(self._path)
+        super(ConfigParserClientStorageCacheTest, self).tearDown()
+
+    def _getClient(self, secret='secret'):
+        """
+        :param secret: The secret of the client.
+        :return: A password client with the test client id.
+        """
+        return PasswordClient(self._CLIENT_ID, ['https://return.nonexistent'],
+                              ['client_credentials'], secret)
+
+    def _editExternally(self, client):
+        """
+        Add the client to the config file with a different client storage.
+        :param client: The client to add.
+        """
+        ConfigParserClientStorage(self._path).addClient(client)
+        modificationTime = os.stat(self._path).st_mtime + 10
+        os.utime(self._path, (modificationTime, modificationTime))
+
+    def testCachedClient(self):
+        """ Test that the parsed client is cached until it is changed with addClient. """
+        clientId = self._CLIENT_ID
+        client = self._clientStorage.getClient(clientId)
+        self.assertIs(client, self._clientStorage.getClient(clientId),
+                      msg='Expected the client storage to return the cached client.')
+        self._clientStorage.addClient(self._getClient(secret='newSecret'))
+        self.assertEqual('newSecret', self._clientStorage.getClient(clientId).secret,
+                         msg='Expected addClient to invalidate the cached client.')
+        self.assertFalse(self._clientStorage.reload(),
+                         msg='Expected changes by addClient to not trigger a reload.')
+
+    def testReload(self):
+        """ Test that external changes to the config file are picked up. """
+        clientId = self._CLIENT_ID
+        self._clientStorage.getClient(clientId)
+        self._editExternally(self._getClient(secret='externalSecret'))
+        self._editExternally(PublicClient('externalClient', ['https://return.nonexistent'], []))
+        self.assertNotEqual('externalSecret', self._clientStorage.getClient(clientId).secret,
+                            msg='Expected the cached client to be used before the reload.')
+        self._clock.advance(10)
+        self.assertEqual('externalSecret', self._clientStorage.getClient(clientId).secret,
+                         msg='Expected the reload to invalidate the cached client.')
+        self.assertIsInstance(self._clientStorage.getClient('externalClient'), PublicClient,
+                              'Expected the reload to pick up new clients.')
+        self.assertEqual(1, len(self._clock.getDelayedCalls()),
+                         msg='Expected the next reload to be scheduled.')
+
+
+class JournalClientStorageTest(AbstractClientStorageTest):
+    """ Test the JournalClientStorage. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls._directory = tempfile.mkdtemp()
+        clientStorage = JournalClientStorage(os.path.join(cls._directory, 'clients'))
+        cls.setupClientStorage(clientStorage)
+        for client in cls._VALID_CLIENTS:
+            clientStorage.addClient(client)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls._directory)
+
+    def tearDown(self):
+        super(JournalClientStorageTest, self).tearDown()
+        return self._CLIENT_STORAGE.close()
+
+
+class JournalClientStorageRestoreTest(TwistedTestCase):
+    """ Test that the JournalClientStorage restores its clients from the disk. """
+
+    def setUp(self):
+        super(JournalClientStorageRestoreTest, self).setUp()
+        self._directory = tempfile.mkdtemp()
+        self._path = os.path.join(self._directory, 'clients')
+        self._clientStorage = JournalClientStorage(self._path, compactThreshold=5)
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield self._clientStorage.close()
+        shutil.rmtree(self._directory)
+        yield super(JournalClientStorageRestoreTest, self).tearDown()
+
+    @inlineCallbacks
+    def _reopen(self):
+        """ Close the client storage and restore it from its files. """
+        yield self._clientStorage.close()
+        self._clientStorage = JournalClientStorage(self._path, compactThreshold=5)
+
+    @inlineCallbacks
+    def testRestoreFromJournal(self):
+        """ Test that added, updated and removed clients are restored from the journal. """
+        self._clientStorage.addClient(getTestPasswordClient('client1'))
+        self._clientStorage.addClient(PasswordClient(
+            'client1', ['https://return.nonexistent'], ['client_credentials'], 'newSecret'))
+        self._clientStorage.addClient(PublicClient(
+            'removedClient', ['https://return.nonexistent'], []))
+        self._clientStorage.removeClient('removedClient')
+        self.assertRaises(KeyError, self._clientStorage.removeClient, 'removedClient')
+        self.assertFalse(os.path.exists(self._path + '.snapshot'),
+                         msg='Expected no snapshot below the compact threshold.')
+        yield self._reopen()
+        client = self._clientStorage.getClient('client1')
+        self.assertIsInstance(client, PasswordClient,
+                              'Expected the class of the client to be restored.')
+        self.assertEqual('newSecret', client.secret,
+                         msg='Expected the latest version of the client to be restored.')
+        self.assertRaises(KeyError, self._clientStorage.getClient, 'removedClient')
+
+    @inlineCallbacks
+    def testCompactWithPendingChanges(self):
+        """ Test that compacting with pending changes writes a single snapshot. """
+        snapshots = []
+        writeSnapshot = self._clientStorage._writeSnapshot
+
+        def countingWriteSnapshot(records):
+            snapshots.append(records)
+            writeSnapshot(records)
+        self._clientStorage._writeSnapshot = countingWriteSnapshot
+        for index in range(6):
+            self._clientStorage.addClient(getTestPasswordClient('client' + str(index)))
+        yield self._clientStorage.compact()
+        self.assertEqual(1, len(snapshots), msg='Expected exactly one snapshot to be written.')
+        yield self._reopen()
+        for index in range(6):
+            self._clientStorage.getClient('client' + str(index))
+
+    @inlineCallbacks
+    def testCompaction(self):
+        """ Test that the journal is compacted into a snapshot. """
+        for index in range(6):
+            self._clientStorage.addClient(getTestPasswordClient('client' + str(index)))
+        self._clientStorage.removeClient('client0')
+        yield self._clientStorage.flush()
+        self.assertTrue(os.path.exists(self._path + '.snapshot'),
+                        msg='Expected a snapshot once the compact threshold is reached.')
+        self.assertEqual(0, os.path.getsize(self._path + '.journal'),
+                         msg='Expected the journal to be truncated after the snapshot.')
+        self._clientStorage.addClient(getTestPasswordClient('client6'))
+        yield self._reopen()
+        self.assertRaises(KeyError, self._clientStorage.getClient, 'client0')
+        for index in range(1, 7):
+            self.assertEqual('client' + str(index),
+                             self._clientStorage.getClient('client' + str(index)).id)
+
+    @inlineCallbacks
+    def testIncompleteJournal(self):
+        """ Test that an incomplete record at the end of the journal is ignored and removed. """
+        self._clientStorage.addClient(getTestPasswordClient('client1'))
+        yield self._clientStorage.close()
+        validSize = os.path.getsize(self._path + '.journal')
+        with open(self._path + '.journal', 'ab') as journalFile:
+            journalFile.write(b'{"id":"client2","type":"Passw')
+        self._clientStorage = JournalClientStorage(self._path)
+        self.assertEqual('client1', self._clientStorage.getClient('client1').id)
+        self.assertRaises(KeyError, self._clientStorage.getClient, 'client2')
+        self.assertEqual(validSize, os.path.getsize(self._path + '.journal'),
+                         msg='Expected the incomplete record to be removed.')
+
+
+class CompiledClientStorageTest(TwistedTestCase):
+    """ Test the client storages that return the compiled form of their clients. """
+
+    def setUp(self):
+        super(CompiledClientStorageTest, self).setUp()
+        self._directory = tempfile.mkdtemp()
+        self._path = os.path.join(self._directory, 'clients')
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+        super(CompiledClientStorageTest, self).tearDown()
+
+    def _assertCompiledClient(self, client, expectedClient):
+        """
+        Assert that the client is the compiled form of the expected client.
+        :param client: The client returned by a client storage.
+        :param expectedClient: The client that was added to the client storage.
+        """
+        self.assertIsInstance(client, expectedClient.__class__,
+                              'Expected the client storage to return a client object '
+                              'of the same subclass as the original client.')
+        self.assertFalse(hasattr(client, '__dict__'),
+                         msg='Expected the client storage to return a compiled client.')
+        self.assertEqual(tuple(expectedClient.redirectUris), client.redirectUris)
+        self.assertEqual(tuple(expectedClient.authorizedGrantTypes), client.authorizedGrantTypes)
+        self.assertEqual(expectedClient.secret, client.secret)
+
+    def testConfigParserClientStorage(self):
+        """ Test that the ConfigParserClientStorage can store and return compiled clients. """
+        client = getTestPasswordClient('client1')
+        clientStorage = ConfigParserClientStorage(self._path, compileClients=True)
+        clientStorage.addClient(compileClient(client))
+        self._assertCompiledClient(clientStorage.getClient('client1'), client)
+        clientStorage = ConfigParserClientStorage(self._path)
+        self.assertEqual(client.redirectUris, clientStorage.getClient('client1').redirectUris)
+        self.assertEqual(client.secret, clientStorage.getClient('client1').secret)
+
+    @inlineCallbacks
+    def testJournalClientStorage(self):
+        """ Test that the JournalClientStorage can store and return compiled clients. """
+        client = getTestPasswordClient('client1')
+        clientStorage = JournalClientStorage(self._path, compileClients=True)
+        clientStorage.addClient(client)
+        self._assertCompiledClient(clientStorage.getClient('client1'), client)
+        yield clientStorage.close()
+        clientStorage = JournalClientStorage(self._path, compileClients=True)
+        self._assertCompiledClient(clientStorage.getClient('client1'), client)
+        clientStorage.addClient(clientStorage.getClient('client1'))
+        yield clientStorage.close()
+        clientStorage = JournalClientStorage(self._path)
+        self.assertEqual(client.secret, clientStorage.getClient('client1').secret)
+        yield clientStorage.close()
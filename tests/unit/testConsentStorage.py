@@ -0,0 +1,179 @@
+try:
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from urllib.parse import urlparse, parse_qs
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.web.server import NOT_DONE_YET
+
+from txoauth2 import GrantTypes
+from txoauth2.clients import PasswordClient
+from txoauth2.imp import DictTokenStorage, DictConsentStorage, SQLiteConsentStorage
+from txoauth2.resource import OAuth2
+
+from tests import TwistedTestCase, MockRequest, TestTokenFactory, TestPersistentStorage, \
+    TestClientStorage
+
+
+class AbstractConsentStorageTest(TwistedTestCase):
+    """ Abstract base class for tests of ConsentStorage implementations. """
+    _consentStorage = None
+
+    @inlineCallbacks
+    def testAddAndRemoveConsent(self):
+        """ Test that the consent of a user is accumulated per client and can be removed. """
+        self.assertEqual([], (yield self._consentStorage.getConsent('user', 'client1')),
+                         msg='Expected no consent for an unknown user.')
+        yield self._consentStorage.addConsent('user', 'client1', ['write', 'read'])
+        yield self._consentStorage.addConsent('user', 'client1', ['write', 'admin'])
+        yield self._consentStorage.addConsent('user', 'client2', ['read'])
+        yield self._consentStorage.addConsent('otherUser', 'client1', ['read'])
+        self.assertEqual(['admin', 'read', 'write'],
+                         (yield self._consentStorage.getConsent('user', 'client1')),
+                         msg='Expected the consent to be combined and sorted.')
+        yield self._consentStorage.removeConsent('user', 'client1')
+        self.assertEqual([], (yield self._consentStorage.getConsent('user', 'client1')),
+                         msg='Expected the consent for the client to be removed.')
+        self.assertEqual(['read'], (yield self._consentStorage.getConsent('user', 'client2')),
+                         msg='Expected the consent for other clients to remain.')
+        yield self._consentStorage.removeConsent('user')
+        self.assertEqual([], (yield self._consentStorage.getConsent('user', 'client2')),
+                         msg='Expected the consent for all clients to be removed.')
+        self.assertEqual(['read'], (yield self._consentStorage.getConsent('otherUser', 'client1')),
+                         msg='Expected the consent of other users to remain.')
+
+
+class DictConsentStorageTest(AbstractConsentStorageTest):
+    """ Test the DictConsentStorage. """
+
+    def setUp(self):
+        super(DictConsentStorageTest, self).setUp()
+        self._consentStorage = DictConsentStorage()
+
+
+class SQLiteConsentStorageTest(AbstractConsentStorageTest):
+    """ Test the SQLiteConsentStorage. """
+
+    def setUp(self):
+        super(SQLiteConsentStorageTest, self).setUp()
+        self._consentStorage = SQLiteConsentStorage(self.mktemp())
+
+    def tearDown(self):
+        super(SQLiteConsentStorageTest, self).tearDown()
+        return self._consentStorage.close()
+
+
+class TestPriorConsent(TwistedTestCase):
+    """ Test that the OAuth2 resource skips onAuthenticate if the user already consented. """
+    # noinspection PyTypeChecker
+    _VALID_CLIENT = PasswordClient('consentClientId',
+                                   ['https://return.nonexistent', 'http://return.nonexistent'],
+                                   list(GrantTypes), secret='ClientSecret')
+
+    class TestOAuth2Resource(OAuth2):
+        """ A test OAuth2 resource that identifies the user by a header. """
+        _AUTHENTICATE_RESPONSE = b'consentPage'
+
+        def getConsentUserId(self, request):
+            return request.getHeader(b'x-user')
+
+        def onAuthenticate(self, request, client, responseType, scope, redirectUri, state, dataKey):
+            self.lastDataKey = dataKey
+            return self._AUTHENTICATE_RESPONSE
+
+        def onPriorConsent(self, request, client, responseType, scope, redirectUri, state,
+                           dataKey, userId):
+            return self.grantAccess(request, dataKey, additionalData={'user': userId})
+
+    def setUp(self):
+        super(TestPriorConsent, self).setUp()
+        TestTokenFactory().reset(self)
+        self._consentStorage = DictConsentStorage()
+        self._tokenStorage = DictTokenStorage()
+        clientStorage = TestClientStorage()
+        clientStorage.addClient(self._VALID_CLIENT)
+        self._authResource = self.TestOAuth2Resource(
+            TestTokenFactory(), TestPersistentStorage(), clientStorage,
+            authTokenStorage=self._tokenStorage, consentStorage=self._consentStorage)
+
+    def _authorize(self, scope, user=b'user', redirectUri=None):
+        """
+        Send an authorization request for an implicit grant.
+        :param scope: The requested scope.
+        :param user: The id of the logged in user.
+        :param redirectUri: The redirect uri.
+        :return: The request and the result of render_GET.
+        """
+        request = MockRequest('GET', 'oauth2', arguments={
+            'response_type': 'token',
+            'client_id': self._VALID_CLIENT.id,
+            'redirect_uri': redirectUri or self._VALID_CLIENT.redirectUris[0],
+            'scope': scope,
+            'state': b'state'
+        }, headers={'X-User': user})
+        return request, self._authResource.render_GET(request)
+
+    def testSkipOnAuthenticate(self):
+        """ Test that a request for a scope the user has consented to is granted directly. """
+        request, result = self._authorize('read write')
+        self.assertEqual(TestPriorConsent.TestOAuth2Resource._AUTHENTICATE_RESPONSE, result,
+                         msg='Expected onAuthenticate to be called without prior consent.')
+        self.assertEqual(NOT_DONE_YET, self._authResource.grantAccess(
+            MockRequest('GET', 'some/path'), self._authResource.lastDataKey,
+            additionalData={'user': b'user'}, consentUserId=b'user'))
+        self.assertEqual(['read', 'write'], self._consentStorage.getConsent(
+            b'user', self._VALID_CLIENT.id), msg='Expected the consent to be stored by name.')
+        request, result = self._authorize('write')
+        self.assertEqual(NOT_DONE_YET, result,
+                         msg='Expected the request to be granted without onAuthenticate.')
+        self.assertTrue(request.finished, msg='Expected the request to be finished.')
+        self.assertEqual(302, request.responseCode,
+                         msg='Expected the user to be redirected to the client.')
+        location = urlparse(request.getResponseHeader(b'location').decode('utf-8'))
+        token = parse_qs(location.fragment)['access_token'][0]
+        self.assertEqual({'user': b'user'}, self._tokenStorage.getTokenAdditionalData(token),
+                         msg='Expected the token to be bound to the user.')
+        for scope, user in [('read write admin', b'user'), ('read', b'otherUser')]:
+            request, result = self._authorize(scope, user=user)
+            self.assertEqual(TestPriorConsent.TestOAuth2Resource._AUTHENTICATE_RESPONSE, result,
+                             msg='Expected onAuthenticate to be called if the user '
+                                 'did not consent to the scope.')
+
+    def testNoPriorConsent(self):
+        """ Test that a user who never consented is not granted a request for an empty scope. """
+        for scope in ['', 'read']:
+            request, result = self._authorize(scope, user=b'newUser')
+            self.assertEqual(TestPriorConsent.TestOAuth2Resource._AUTHENTICATE_RESPONSE, result,
+                             msg='Expected onAuthenticate to be called for a user '
+                                 'who never consented.')
+        self._consentStorage.addConsent(b'user', self._VALID_CLIENT.id, ['read'])
+        request, result = self._authorize('', user=b'user')
+        self.assertEqual(TestPriorConsent.TestOAuth2Resource._AUTHENTICATE_RESPONSE, result,
+                         msg='Expected onAuthenticate to be called for an empty scope.')
+
+    def testInsecureRedirectUri(self):
+        """ Test that a prior consent does not skip the warning about insecure redirect uris. """
+        self._consentStorage.addConsent(b'user', self._VALID_CLIENT.id, ['read'])
+        request, result = self._authorize(
+            'read', redirectUri=self._VALID_CLIENT.redirectUris[1])
+        self.assertEqual(TestPriorConsent.TestOAuth2Resource._AUTHENTICATE_RESPONSE, result,
+                         msg='Expected onAuthenticate to be called for an insecure redirect uri.')
+        self.assertEqual(NOT_DONE_YET, self._authResource.grantAccess(
+            MockRequest('GET', 'some/path'), self._authResource.lastDataKey,
+            allowInsecureRedirectUri=True))
+
+    def testRequiresOnPriorConsent(self):
+        """ Test that a consent storage can not be used without overriding onPriorConsent. """
+        class NoPriorConsentOAuth2Resource(OAuth2):
+            """ An OAuth2 resource that does not bind prior consent tokens to a user. """
+
+            def onAuthenticate(self, request, client, responseType, scope, redirectUri, state,
+                               dataKey):
+                return None
+        self.assertRaises(ValueError, NoPriorConsentOAuth2Resource, TestTokenFactory(),
+                          TestPersistentStorage(), TestClientStorage(),
+                          authTokenStorage=DictTokenStorage(),
+                          consentStorage=DictConsentStorage())
+        NoPriorConsentOAuth2Resource(TestTokenFactory(), TestPersistentStorage(),
+                                     TestClientStorage(), authTokenStorage=DictTokenStorage())
@@ -0,0 +1,92 @@
+from twisted.internet.task import Clock
+
+from txoauth2.imp import DictPersistentStorage
+
+from tests import TwistedTestCase
+
+
+class TestDictPersistentStorage(TwistedTestCase):
+    """ Test the DictPersistentStorage and its timing wheel. """
+
+    def setUp(self):
+        super(TestDictPersistentStorage, self).setUp()
+        self._clock = Clock()
+        self._clock.advance(1000)
+        self._storage = DictPersistentStorage(wheelSize=4, numLevels=2, reactor=self._clock)
+
+    def _advanceTo(self, seconds):
+        """
+        Advance the clock one second at a time.
+        :param seconds: The time to advance the clock to.
+        """
+        while self._clock.seconds() < seconds:
+            self._clock.advance(1)
+
+    def testPutAndPop(self):
+        """ Test that data can be popped exactly once. """
+        self._storage.put('key', {'data': 1})
+        self._storage.put('expiringKey', 'data', expireTime=self._clock.seconds() + 10)
+        self.assertEqual({'data': 1}, self._storage.pop('key'))
+        self.assertEqual('data', self._storage.pop('expiringKey'))
+        self.assertRaises(KeyError, self._storage.pop, 'key')
+        self.assertRaises(KeyError, self._storage.pop, 'expiringKey')
+        self.assertRaises(KeyError, self._storage.pop, 'unknownKey')
+        statistics = self._storage.getStatistics()
+        self.assertEqual(0, statistics['live_entries'])
+        self.assertEqual(0, statistics['expiring_entries'])
+        self.assertEqual(2, statistics['popped_entries'])
+        self.assertEqual([], self._clock.getDelayedCalls(),
+                         msg='Expected the wheel to stop when it contains no entries.')
+        self.assertRaises(ValueError, DictPersistentStorage, tickDuration=0)
+        self.assertRaises(ValueError, DictPersistentStorage, wheelSize=1)
+
+    def testExpiredDataIsReclaimed(self):
+        """ Test that expired data is removed without being popped. """
+        now = self._clock.seconds()
+        expireOffsets = [1, 3, 4, 7, 10, 16, 17, 40, 100]
+        for offset in expireOffsets:
+            self._storage.put('key' + str(offset), offset, expireTime=now + offset)
+        self._storage.put('permanentKey', 'data')
+        self._storage.put('expiredKey', 'data', expireTime=now - 1)
+        for index, offset in enumerate(expireOffsets):
+            self._advanceTo(now + offset)
+            self.assertEqual(len(expireOffsets) - index + 1,
+                             self._storage.getStatistics()['live_entries'],
+                             msg='Expected the data to be kept until it expires.')
+            self._advanceTo(now + offset + 1)
+            self.assertEqual(len(expireOffsets) - index,
+                             self._storage.getStatistics()['live_entries'],
+                             msg='Expected the data to be reclaimed one tick after it expires.')
+            self.assertRaises(KeyError, self._storage.pop, 'key' + str(offset))
+        statistics = self._storage.getStatistics()
+        self.assertEqual(1, statistics['live_entries'])
+        self.assertEqual(0, statistics['expiring_entries'])
+        self.assertEqual(len(expireOffsets) + 1, statistics['expired_entries'])
+        self.assertEqual([], self._clock.getDelayedCalls(),
+                         msg='Expected the wheel to stop when it contains no expiring entries.')
+        self.assertEqual('data', self._storage.pop('permanentKey'))
+
+    def testPopExpiredBeforeTick(self):
+        """ Test that data that expired before the wheel reclaimed it can not be popped. """
+        self._storage.put('key', 'data', expireTime=self._clock.seconds() + 0.5)
+        self._clock.pump([0.75])
+        self.assertRaises(KeyError, self._storage.pop, 'key')
+
+    def testOverwrite(self):
+        """ Test that overwriting data reschedules its expiration. """
+        now = self._clock.seconds()
+        self._storage.put('key', 'oldData', expireTime=now + 2)
+        self._storage.put('key', 'newData', expireTime=now + 30)
+        self._advanceTo(now + 10)
+        self.assertEqual(1, self._storage.getStatistics()['live_entries'])
+        self.assertEqual('newData', self._storage.pop('key'))
+        self._storage.put('key', 'data', expireTime=now + 20)
+        self._storage.put('key', 'data')
+        self._advanceTo(now + 30)
+        self.assertEqual('data', self._storage.pop('key'))
+
+    def testClose(self):
+        """ Test that closing the storage stops the wheel. """
+        self._storage.put('key', 'data', expireTime=self._clock.seconds() + 10)
+        self._storage.close()
+        self.assertEqual([], self._clock.getDelayedCalls())
@@ -35,6 +35,13 @@ class FullExampleTestCase(TwistedTestCase):
     def tearDownClass(cls):
         setattr(TokenResource, '_OAuthTokenStorage', None)
 
+    def tearDown(self):
+        # Stop the timing wheel of the persistent storage, which runs on the global reactor.
+        # noinspection PyProtectedMember
+        self._SERVER.resource.getStaticEntity(
+            b'oauth2')._persistentStorage.close()  # pylint: disable=protected-access
+        super(FullExampleTestCase, self).tearDown()
+
     def _testValidAccessRequest(self, token=_VALID_TOKEN):
         """
         Test that a request to the protected resource with the given token is accepted.
@@ -0,0 +1,164 @@
+from twisted.internet.defer import Deferred
+
+from txoauth2 import isAuthorized
+from txoauth2.imp import HMACTokenFactory, HMACTokenStorage, DictTokenStorage
+from txoauth2.token import TokenResource, TokenAccess
+
+from tests import TwistedTestCase, MockRequest, getTestPasswordClient, runAuthorizationCodeGrant
+
+
+class TestHMACTokenFactory(TwistedTestCase):
+    """ Test the HMACTokenFactory. """
+    _CLIENT = getTestPasswordClient()
+    _SCOPE = ['All', 'scope1']
+
+    def setUp(self):
+        super(TestHMACTokenFactory, self).setUp()
+        self._tokenFactory = HMACTokenFactory(b'secret')
+
+    def testDecodeToken(self):
+        """ Test that a generated token can be decoded. """
+        token = self._tokenFactory.generateToken(10, self._CLIENT, self._SCOPE, {'user': 'me'})
+        self.assertTrue(TokenResource.isValidToken(token),
+                        msg='Expected the token factory to generate valid tokens.')
+        tokenInfo = self._tokenFactory.decodeToken(token)
+        self.assertEqual(self._CLIENT.id, tokenInfo['client_id'],
+                         msg='Expected the token to contain the client id.')
+        self.assertListEqual(self._SCOPE, tokenInfo['scope'],
+                             msg='Expected the token to contain the scope.')
+        self.assertEqual({'user': 'me'}, tokenInfo['additional_data'],
+                         msg='Expected the token to contain the additional data.')
+        self.assertEqual(tokenInfo['birth_time'] + 10, tokenInfo['expire_time'],
+                         msg='Expected the token to contain the expire time.')
+        tokenInfo = self._tokenFactory.decodeToken(
+            self._tokenFactory.generateToken(None, self._CLIENT, self._SCOPE))
+        self.assertIsNone(tokenInfo['expire_time'],
+                          msg='Expected a token without a lifetime to never expire.')
+        self.assertIsNone(tokenInfo['additional_data'],
+                          msg='Expected a token without additional data to contain none.')
+
+    def testInvalidToken(self):
+        """ Test that tampered, foreign, malformed and expired tokens are rejected. """
+        token = self._tokenFactory.generateToken(10, self._CLIENT, self._SCOPE)
+        payload, signature = token.split('.')
+        otherPayload = self._tokenFactory.generateToken(
+            10, self._CLIENT, self._SCOPE + ['admin']).split('.')[0]
+        self.assertRaises(KeyError, self._tokenFactory.decodeToken,
+                          otherPayload + '.' + signature)
+        self.assertRaises(KeyError, HMACTokenFactory(b'otherSecret').decodeToken, token)
+        self.assertRaises(KeyError, self._tokenFactory.decodeToken, payload)
+        self.assertRaises(KeyError, self._tokenFactory.decodeToken, payload + '.%%%')
+        self.assertRaises(KeyError, self._tokenFactory.decodeToken, u'\xe4.' + signature)
+        expiredToken = self._tokenFactory.generateToken(-1, self._CLIENT, self._SCOPE)
+        self.assertRaises(KeyError, self._tokenFactory.decodeToken, expiredToken)
+
+    def testEmptySecret(self):
+        """ Test that an empty secret is rejected. """
+        self.assertRaises(ValueError, HMACTokenFactory, b'')
+
+    def testAuthorizationCodeGrant(self):
+        """ Test that the factory generates codes for the authorization code grant flow. """
+        client, code, response = runAuthorizationCodeGrant(self, self._tokenFactory)
+        codeInfo = self._tokenFactory.decodeToken(code)
+        self.assertEqual(client.id, codeInfo['client_id'],
+                         msg='Expected the code to contain the client id.')
+        self.assertListEqual(['All'], codeInfo['scope'],
+                             msg='Expected the code to contain the scope.')
+        self.assertEqual(codeInfo['birth_time'] + 120, codeInfo['expire_time'],
+                         msg='Expected the code to expire after the code lifetime.')
+        tokenInfo = self._tokenFactory.decodeToken(response['access_token'])
+        self.assertEqual(client.id, tokenInfo['client_id'],
+                         msg='Expected the access token to contain the client id.')
+
+
+class TestHMACTokenStorage(TwistedTestCase):
+    """ Test the HMACTokenStorage. """
+    _CLIENT = getTestPasswordClient()
+    _SCOPE = ['All', 'scope1']
+
+    def setUp(self):
+        super(TestHMACTokenStorage, self).setUp()
+        self._tokenFactory = HMACTokenFactory(b'secret')
+        self._revocationStorage = DictTokenStorage()
+        self._tokenStorage = HMACTokenStorage(self._tokenFactory, self._revocationStorage)
+        self._token = self._tokenFactory.generateToken(10, self._CLIENT, self._SCOPE)
+
+    def tearDown(self):
+        setattr(TokenResource, '_OAuthTokenStorage', None)
+        super(TestHMACTokenStorage, self).tearDown()
+
+    def testCheckAccess(self):
+        """ Test that the access is checked without storing the token. """
+        tokenStorage = HMACTokenStorage(self._tokenFactory)
+        self.assertEqual(TokenAccess.Granted, tokenStorage.checkAccess(self._token, ['All']))
+        self.assertEqual(TokenAccess.InsufficientScope,
+                         tokenStorage.checkAccess(self._token, ['admin']))
+        self.assertEqual(TokenAccess.Invalid, tokenStorage.checkAccess('invalid.token', ['All']))
+        self.assertTrue(tokenStorage.contains(self._token),
+                        msg='Expected contains to return True for a valid token.')
+        self.assertTrue(tokenStorage.hasAccess(self._token, self._SCOPE),
+                        msg='Expected hasAccess to return True for the scope of the token.')
+        self.assertEqual(self._CLIENT.id, tokenStorage.getTokenClient(self._token),
+                         msg='Expected getTokenClient to return the client of the token.')
+        self.assertRaises(NotImplementedError, tokenStorage.remove, self._token)
+
+    def testStore(self):
+        """ Test that only tokens generated for the client and scope can be stored. """
+        self._tokenStorage.store(self._token, self._CLIENT, self._SCOPE)
+        self.assertRaises(ValueError, self._tokenStorage.store,
+                          self._token, self._CLIENT, ['admin'])
+        self.assertRaises(ValueError, self._tokenStorage.store,
+                          'someToken', self._CLIENT, self._SCOPE)
+
+    def testRevocation(self):
+        """ Test that a removed token is rejected until it expires. """
+        self.assertEqual(TokenAccess.Granted, self.successResultOf(
+            self._tokenStorage.checkAccess(self._token, self._SCOPE)))
+        self._tokenStorage.remove(self._token)
+        self.assertTrue(self._revocationStorage.contains(self._token),
+                        msg='Expected the removed token to be stored in the revocation storage.')
+        self.assertEqual(TokenAccess.Invalid, self.successResultOf(
+            self._tokenStorage.checkAccess(self._token, self._SCOPE)))
+        self.assertFalse(self.successResultOf(self._tokenStorage.contains(self._token)),
+                         msg='Expected contains to return False for a revoked token.')
+        self.failureResultOf(self._tokenStorage.getTokenScope(self._token), KeyError)
+
+    def testIsAuthorized(self):
+        """ Test that isAuthorized validates the tokens with the HMACTokenStorage. """
+        setattr(TokenResource, '_OAuthTokenStorage', HMACTokenStorage(self._tokenFactory))
+        request = MockRequest('GET', 'protectedResource', headers={
+            'Authorization': 'Bearer ' + self._token
+        })
+        self.assertTrue(isAuthorized(request, 'All'),
+                        msg='Expected isAuthorized to accept a valid signed token.')
+        otherToken = HMACTokenFactory(b'otherSecret').generateToken(
+            10, self._CLIENT, self._SCOPE)
+        request = MockRequest('GET', 'protectedResource', headers={
+            'Authorization': 'Bearer ' + otherToken
+        })
+        self.assertFalse(isAuthorized(request, 'All'),
+                         msg='Expected isAuthorized to reject a token with an invalid signature.')
+        self.assertEqual(401, request.responseCode)
+
+    def testIsAuthorizedRevocationStorage(self):
+        """ Test that isAuthorized consults an asynchronous revocation storage. """
+        revocationResult = Deferred()
+
+        class AsyncRevocationStorage(DictTokenStorage):
+            def contains(self, token):
+                del token  # Unused
+                return revocationResult
+        setattr(TokenResource, '_OAuthTokenStorage',
+                HMACTokenStorage(self._tokenFactory, AsyncRevocationStorage()))
+        request = MockRequest('GET', 'protectedResource', headers={
+            'Authorization': 'Bearer ' + self._token
+        })
+        result = isAuthorized(request, 'All')
+        self.assertIsInstance(result, Deferred, 'Expected isAuthorized to return a Deferred '
+                                                'while waiting for the revocation storage.')
+        revocationResult.callback(True)
+        self.assertFalse(self.successResultOf(result),
+                         msg='Expected isAuthorized to reject a revoked token.')
+        self.assertTrue(request.finished,
+                        msg='Expected isAuthorized to finish the request for a revoked token.')
+        self.assertEqual(401, request.responseCode)
@@ -1,10 +1,13 @@
+from twisted.internet.defer import Deferred
+from twisted.web.server import NOT_DONE_YET
+
 from txoauth2 import isAuthorized, oauth2
 from txoauth2.imp import DictTokenStorage
 from txoauth2.token import TokenResource
 from txoauth2.errors import MissingTokenError, InvalidTokenRequestError, \
-    InsufficientScopeRequestError, MultipleTokensError
+    InsufficientScopeRequestError, MultipleTokensError, ServerError
 
-from tests import MockRequest, TwistedTestCase, getTestPasswordClient
+from tests import MockRequest, TwistedTestCase, getTestPasswordClient, DeferredWrapper
 
 
 class TestIsAuthorized(TwistedTestCase):
@@ -199,6 +202,31 @@ class TestIsAuthorized(TwistedTestCase):
             msg='The HTTP response code should be {code}, if a protected resource receives a '
                 'request over an insecure channel.'.format(code=400))
 
+    def testCheckAccessFallback(self):
+        """ Test that isAuthorized works with token storages that do not support checkAccess. """
+        class NoCheckAccessTokenStorage(DictTokenStorage):
+            def checkAccess(self, token, scope):
+                raise NotImplementedError()
+        tokenStorage = TokenResource.getTokenStorageSingleton()
+        noCheckAccessTokenStorage = NoCheckAccessTokenStorage()
+        noCheckAccessTokenStorage.store(
+            self.VALID_TOKEN, getTestPasswordClient(), self.VALID_TOKEN_SCOPE)
+        setattr(TokenResource, '_OAuthTokenStorage', noCheckAccessTokenStorage)
+        try:
+            request = MockRequest('GET', 'protectedResource')
+            request.setRequestHeader(b'Authorization', 'Bearer ' + self.VALID_TOKEN)
+            self.assertTrue(isAuthorized(request, self.VALID_TOKEN_SCOPE[0]),
+                            msg='Expected isAuthorized to accept a request with a valid token.')
+            request = MockRequest('GET', 'protectedResource')
+            request.setRequestHeader(b'Authorization', 'Bearer ' + self.VALID_TOKEN)
+            self.assertFalse(isAuthorized(request, 'someOtherScope'),
+                             msg='Expected isAuthorized to reject a request with token '
+                                 'that does not allow access to the given scope.')
+            self.assertFailedProtectedResourceRequest(
+                request, InsufficientScopeRequestError(['someOtherScope']))
+        finally:
+            setattr(TokenResource, '_OAuthTokenStorage', tokenStorage)
+
     def testDecorator(self):
         """ Test that the oauth2 functions as expected. """
         protectedContent = b'protectedContent'
@@ -224,3 +252,121 @@ class TestIsAuthorized(TwistedTestCase):
             return protectedContent
         self.assertNotEqual(protectedContent, render2(self, request),
                             msg='Expected oauth2 to reject a request with an invalid scope.')
+
+
+class TestIsAuthorizedDeferred(TwistedTestCase):
+    """ Test isAuthorized and the oauth2 decorator with a token storage returning Deferreds. """
+    VALID_TOKEN = 'valid_token'
+    VALID_TOKEN_SCOPE = ['All', 'scope1']
+
+    @classmethod
+    def setUpClass(cls):
+        tokenStorage = DictTokenStorage()
+        tokenStorage.store(cls.VALID_TOKEN, getTestPasswordClient(), cls.VALID_TOKEN_SCOPE)
+        cls.TOKEN_STORAGE = DeferredWrapper(tokenStorage)
+        setattr(TokenResource, '_OAuthTokenStorage', cls.TOKEN_STORAGE)
+
+    @classmethod
+    def tearDownClass(cls):
+        setattr(TokenResource, '_OAuthTokenStorage', None)
+
+    def _isAuthorized(self, token, scope):
+        """
+        Call isAuthorized with the token and flush the token storage.
+        :param token: The token to send with the request.
+        :param scope: The scope to pass to isAuthorized.
+        :return: The request and the result of the Deferred returned by isAuthorized.
+        """
+        request = MockRequest('GET', 'protectedResource')
+        request.setRequestHeader(b'Authorization', 'Bearer ' + token)
+        result = isAuthorized(request, scope)
+        self.assertIsInstance(result, Deferred, 'Expected isAuthorized to return a Deferred '
+                                                'if the token storage returns Deferreds.')
+        self.assertFalse(request.finished, msg='Expected isAuthorized to not finish the request '
+                                               'before the token storage returned a result.')
+        results = []
+        result.addCallback(results.append)
+        while self.TOKEN_STORAGE.hasPendingCalls():
+            self.TOKEN_STORAGE.flush()
+        self.assertEqual(1, len(results), msg='Expected the Deferred returned by isAuthorized '
+                                              'to fire once the token storage returned.')
+        return request, results[0]
+
+    def testValidToken(self):
+        """ Test that a valid token is accepted asynchronously. """
+        request, result = self._isAuthorized(self.VALID_TOKEN, self.VALID_TOKEN_SCOPE[0])
+        self.assertTrue(result, msg='Expected isAuthorized to accept a request with a valid token.')
+        self.assertFalse(request.finished,
+                         msg='isAuthorized should not finish the request if it\'s valid.')
+
+    def testInvalidToken(self):
+        """ Test that an invalid token is rejected asynchronously. """
+        request, result = self._isAuthorized('invalidToken', 'scope')
+        self.assertFalse(result,
+                         msg='Expected isAuthorized to reject a request with an invalid token.')
+        self.assertTrue(request.finished, msg='Expected the request to be closed '
+                                              'after it has been rejected.')
+        self.assertEqual(InvalidTokenRequestError(['scope']).code, request.responseCode)
+
+    def testInvalidScope(self):
+        """ Test that a token without access to the scope is rejected asynchronously. """
+        request, result = self._isAuthorized(self.VALID_TOKEN, 'someOtherScope')
+        self.assertFalse(result, msg='Expected isAuthorized to reject a request with token '
+                                     'that does not allow access to the given scope.')
+        self.assertTrue(request.finished, msg='Expected the request to be closed '
+                                              'after it has been rejected.')
+        self.assertEqual(InsufficientScopeRequestError(['someOtherScope']).code,
+                         request.responseCode)
+
+    def testStorageFailure(self):
+        """ Test that a failing token storage results in a server error. """
+        containsResult = Deferred()
+
+        class FailingTokenStorage(object):
+            @staticmethod
+            def contains(token):
+                del token  # Unused
+                return containsResult
+        setattr(TokenResource, '_OAuthTokenStorage', FailingTokenStorage())
+        try:
+            request = MockRequest('GET', 'protectedResource')
+            request.setRequestHeader(b'Authorization', 'Bearer ' + self.VALID_TOKEN)
+            results = []
+            isAuthorized(request, 'scope').addCallback(results.append)
+            containsResult.errback(RuntimeError('Storage is unavailable'))
+            self.assertEqual([False], results, msg='Expected isAuthorized to reject a request '
+                                                   'if the token storage failed.')
+            self.assertTrue(request.finished, msg='Expected the request to be closed '
+                                                  'after it has been rejected.')
+            self.assertEqual(ServerError().code, request.responseCode)
+        finally:
+            setattr(TokenResource, '_OAuthTokenStorage', self.TOKEN_STORAGE)
+
+    def testDecorator(self):
+        """ Test that the oauth2 decorator renders the protected content once authorized. """
+        protectedContent = b'protectedContent'
+
+        @oauth2(self.VALID_TOKEN_SCOPE)
+        def render(selfArg, requestArg):
+            del selfArg, requestArg  # Unused
+            return protectedContent
+        request = MockRequest('GET', 'protectedResource')
+        request.setRequestHeader(b'Authorization', 'Bearer ' + self.VALID_TOKEN)
+        self.assertEqual(NOT_DONE_YET, render(self, request),
+                         msg='Expected oauth2 to return NOT_DONE_YET while validating the token.')
+        while self.TOKEN_STORAGE.hasPendingCalls():
+            self.TOKEN_STORAGE.flush()
+        self.assertTrue(request.finished, msg='Expected the request to be closed '
+                                              'after the protected content was written.')
+        self.assertEqual(protectedContent, request.getResponse(),
+                         msg='Expected oauth2 to write the protected content to the request.')
+        request = MockRequest('GET', 'protectedResource')
+        request.setRequestHeader(b'Authorization', 'Bearer invalidToken')
+        self.assertEqual(NOT_DONE_YET, render(self, request),
+                         msg='Expected oauth2 to return NOT_DONE_YET while validating the token.')
+        while self.TOKEN_STORAGE.hasPendingCalls():
+            self.TOKEN_STORAGE.flush()
+        self.assertTrue(request.finished, msg='Expected the request to be closed '
+                                              'after it has been rejected.')
+        self.assertNotEqual(protectedContent, request.getResponse(),
+                            msg='Expected oauth2 to reject a request with an invalid token.')
@@ -0,0 +1,27 @@
+from txoauth2.imp import JSONCodec
+
+from tests import TwistedTestCase
+
+
+class TestJSONCodec(TwistedTestCase):
+    """ Test the JSONCodec. """
+
+    def testRoundTrip(self):
+        """ Test that decoding an encoded value returns the value. """
+        codec = JSONCodec()
+        value = {'user': b'someUser', 'scope': ['All', 'Scope1'], 'count': 1, 'other': None,
+                 'nested': {'data': b'\x00\xff'}}
+        data = codec.encode(value)
+        self.assertIsInstance(data, bytes, 'Expected the encoded value to be bytes.')
+        self.assertEqual(value, codec.decode(data),
+                         msg='Expected decode to return the encoded value.')
+        self.assertEqual(['a', 'b'], codec.decode(codec.encode(('a', 'b'))),
+                         msg='Expected a tuple to be decoded as a list.')
+
+    def testUnsupportedValue(self):
+        """ Test that values which are not supported by JSON are rejected. """
+        self.assertRaises(TypeError, JSONCodec().encode, object())
+
+    def testInvalidData(self):
+        """ Test that data which is not JSON is rejected. """
+        self.assertRaises(ValueError, JSONCodec().decode, b'\x80\x02}q\x00.')
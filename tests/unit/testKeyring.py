@@ -0,0 +1,147 @@
+import json
+import base64
+
+from txoauth2 import isAuthorized
+from txoauth2.imp import JWTTokenFactory, HMACTokenStorage
+from txoauth2.keyring import Keyring, InvalidJWTError
+from txoauth2.token import TokenResource
+
+from tests import TwistedTestCase, MockRequest, getTestPasswordClient, runAuthorizationCodeGrant
+
+
+class TestKeyring(TwistedTestCase):
+    """ Test the Keyring. """
+
+    def setUp(self):
+        super(TestKeyring, self).setUp()
+        self._keyring = Keyring()
+        self._keyring.addKey('key1', b'secret1')
+
+    def _getHeader(self, token):
+        """
+        :param token: A JSON Web Token.
+        :return: The decoded header of the token.
+        """
+        header = token.split('.')[0]
+        return json.loads(base64.urlsafe_b64decode(
+            header.encode('ascii') + b'=' * (-len(header) % 4)).decode('utf-8'))
+
+    def testSignAndVerify(self):
+        """ Test that a signed token can be verified and contains the claims. """
+        for algorithm in ['HS256', 'HS512']:
+            self._keyring.addKey(algorithm, b'secret', algorithm=algorithm)
+            token = self._keyring.sign({'sub': 'user'})
+            self.assertTrue(TokenResource.isValidToken(token),
+                            msg='Expected the keyring to generate valid tokens.')
+            self.assertEqual({'alg': algorithm, 'typ': 'JWT', 'kid': algorithm},
+                             self._getHeader(token),
+                             msg='Expected the header to contain the algorithm and key id.')
+            self.assertEqual({'sub': 'user'}, self._keyring.verify(token),
+                             msg='Expected verify to return the claims of the token.')
+        self.assertRaises(ValueError, self._keyring.addKey, 'key', b'secret', algorithm='none')
+        self.assertRaises(ValueError, self._keyring.addKey, 'key', b'')
+
+    def testRotation(self):
+        """ Test that tokens signed with an old key stay valid until the key is removed. """
+        oldToken = self._keyring.sign({'sub': 'user'})
+        self._keyring.addKey('key2', b'secret2')
+        self.assertEqual('key2', self._keyring.signingKeyId,
+                         msg='Expected a new key to be used for signing.')
+        newToken = self._keyring.sign({'sub': 'user'})
+        self.assertEqual('key2', self._getHeader(newToken)['kid'],
+                         msg='Expected new tokens to be signed with the new key.')
+        self.assertEqual({'sub': 'user'}, self._keyring.verify(oldToken),
+                         msg='Expected tokens signed with the old key to remain valid.')
+        self._keyring.removeKey('key1')
+        self.assertRaises(InvalidJWTError, self._keyring.verify, oldToken)
+        self.assertEqual({'sub': 'user'}, self._keyring.verify(newToken))
+        self.assertRaises(ValueError, self._keyring.removeKey, 'key2')
+        self._keyring.addKey('key3', b'secret3', sign=False)
+        self.assertEqual('key2', self._keyring.signingKeyId,
+                         msg='Expected a key added with sign=False to not be used for signing.')
+
+    def testInvalidTokens(self):
+        """ Test that tampered, expired and foreign tokens are rejected. """
+        token = self._keyring.sign({'sub': 'user'})
+        header, payload, signature = token.split('.')
+        otherPayload = self._keyring.sign({'sub': 'admin'}).split('.')[1]
+        for invalidToken in [header + '.' + otherPayload + '.' + signature,
+                             header + '.' + payload, 'a.b.c', u'\xe4.b.c']:
+            self.assertRaises(InvalidJWTError, self._keyring.verify, invalidToken)
+        otherKeyring = Keyring()
+        otherKeyring.addKey('key1', b'otherSecret')
+        self.assertRaises(InvalidJWTError, otherKeyring.verify, token)
+        otherKeyring.addKey('key1', b'secret1', algorithm='HS512')
+        self.assertRaises(InvalidJWTError, otherKeyring.verify, token)
+        expiredToken = self._keyring.sign({'exp': 1})
+        self.assertRaises(InvalidJWTError, self._keyring.verify, expiredToken)
+
+    def testAudienceAndIssuer(self):
+        """ Test that the audience and issuer are checked. """
+        token = self._keyring.sign({'aud': ['api', 'web'], 'iss': 'auth'})
+        self.assertEqual('auth', self._keyring.verify(token, audience='api', issuer='auth')['iss'])
+        self.assertRaises(InvalidJWTError, self._keyring.verify, token, audience='other')
+        self.assertRaises(InvalidJWTError, self._keyring.verify, token, issuer='other')
+        token = self._keyring.sign({'aud': 'api'})
+        self.assertRaises(InvalidJWTError, self._keyring.verify, token, audience='a')
+
+
+class TestJWTTokenFactory(TwistedTestCase):
+    """ Test the JWTTokenFactory. """
+    _CLIENT = getTestPasswordClient()
+    _SCOPE = ['All', 'scope1']
+
+    def setUp(self):
+        super(TestJWTTokenFactory, self).setUp()
+        self._keyring = Keyring()
+        self._keyring.addKey('key1', b'secret1', algorithm='HS512')
+        self._tokenFactory = JWTTokenFactory(self._keyring, issuer='auth', audience='api')
+
+    def tearDown(self):
+        setattr(TokenResource, '_OAuthTokenStorage', None)
+        super(TestJWTTokenFactory, self).tearDown()
+
+    def testDecodeToken(self):
+        """ Test that a generated token contains the expected claims. """
+        token = self._tokenFactory.generateToken(10, self._CLIENT, self._SCOPE, {'user': 'me'})
+        claims = self._keyring.verify(token, audience='api', issuer='auth')
+        self.assertEqual(self._CLIENT.id, claims['client_id'])
+        self.assertEqual(' '.join(self._SCOPE), claims['scope'])
+        self.assertEqual(claims['iat'] + 10, claims['exp'])
+        tokenInfo = self._tokenFactory.decodeToken(token)
+        self.assertListEqual(self._SCOPE, tokenInfo['scope'])
+        self.assertEqual({'user': 'me'}, tokenInfo['additional_data'])
+        self.assertNotEqual(token, self._tokenFactory.generateToken(
+            10, self._CLIENT, self._SCOPE, {'user': 'me'}),
+            msg='Expected the token factory to generate unique tokens.')
+        otherFactory = JWTTokenFactory(self._keyring, issuer='auth', audience='otherApi')
+        self.assertRaises(KeyError, otherFactory.decodeToken, token)
+
+    def testAuthorizationCodeGrant(self):
+        """ Test that the factory generates codes for the authorization code grant flow. """
+        client, code, response = runAuthorizationCodeGrant(self, self._tokenFactory)
+        claims = self._keyring.verify(code, audience='api', issuer='auth')
+        self.assertEqual(client.id, claims['client_id'],
+                         msg='Expected the code to contain the client id.')
+        self.assertEqual('All', claims['scope'], msg='Expected the code to contain the scope.')
+        self.assertEqual(claims['iat'] + 120, claims['exp'],
+                         msg='Expected the code to expire after the code lifetime.')
+        tokenInfo = self._tokenFactory.decodeToken(response['access_token'])
+        self.assertEqual(client.id, tokenInfo['client_id'],
+                         msg='Expected the access token to contain the client id.')
+
+    def testIsAuthorized(self):
+        """ Test that isAuthorized validates the JSON Web Tokens with a HMACTokenStorage. """
+        setattr(TokenResource, '_OAuthTokenStorage', HMACTokenStorage(self._tokenFactory))
+        token = self._tokenFactory.generateToken(10, self._CLIENT, self._SCOPE)
+        request = MockRequest('GET', 'protectedResource', headers={
+            'Authorization': 'Bearer ' + token
+        })
+        self.assertTrue(isAuthorized(request, 'scope1'),
+                        msg='Expected isAuthorized to accept a valid JSON Web Token.')
+        request = MockRequest('GET', 'protectedResource', headers={
+            'Authorization': 'Bearer ' + token
+        })
+        self.assertFalse(isAuthorized(request, 'admin'),
+                         msg='Expected isAuthorized to reject a token without the scope.')
+        self.assertEqual(403, request.responseCode)
@@ -0,0 +1,129 @@
+try:
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from urllib.parse import urlparse, parse_qs
+
+from twisted.internet.defer import Deferred, succeed
+from twisted.web.server import NOT_DONE_YET
+
+from txoauth2 import GrantTypes
+from txoauth2.clients import PasswordClient
+from txoauth2.imp import DictTokenStorage
+from txoauth2.resource import OAuth2, InvalidDataKeyError
+
+from tests import TwistedTestCase, MockRequest, TestTokenFactory, TestPersistentStorage, \
+    TestClientStorage, DeferredWrapper, flushDeferredWrappers
+
+
+class TestOAuth2ResourceDeferred(TwistedTestCase):
+    """ Test the OAuth2 resource with storages and a token factory that return Deferreds. """
+    # noinspection PyTypeChecker
+    _VALID_CLIENT = PasswordClient('deferredAuthResourceClientId', ['https://return.nonexistent'],
+                                   list(GrantTypes), secret='ClientSecret')
+    _AUTHENTICATE_RESPONSE = b'authenticatePage'
+
+    class TestOAuth2Resource(OAuth2):
+        """ A test OAuth2 resource whose onAuthenticate returns a Deferred. """
+        authenticateResult = None
+
+        def onAuthenticate(self, request, client, responseType, scope, redirectUri, state, dataKey):
+            return self.authenticateResult
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestOAuth2ResourceDeferred, cls).setUpClass()
+        cls._TOKEN_FACTORY = TestTokenFactory()
+        cls._TOKEN_STORAGE = DictTokenStorage()
+        cls._PERSISTENT_STORAGE = TestPersistentStorage()
+        cls._CLIENT_STORAGE = TestClientStorage()
+        cls._CLIENT_STORAGE.addClient(cls._VALID_CLIENT)
+        cls._WRAPPERS = [DeferredWrapper(wrapped) for wrapped in [
+            cls._TOKEN_FACTORY, cls._PERSISTENT_STORAGE, cls._CLIENT_STORAGE, cls._TOKEN_STORAGE]]
+        tokenFactory, persistentStorage, clientStorage, tokenStorage = cls._WRAPPERS
+        cls._AUTH_RESOURCE = cls.TestOAuth2Resource(
+            tokenFactory, persistentStorage, clientStorage, authTokenStorage=tokenStorage)
+
+    def setUp(self):
+        super(TestOAuth2ResourceDeferred, self).setUp()
+        self._TOKEN_FACTORY.reset(self)
+
+    def _createAuthRequest(self):
+        """
+        :return: A valid GET request to the OAuth2 resource.
+        """
+        return MockRequest('GET', 'oauth2', arguments={
+            'response_type': 'code',
+            'client_id': self._VALID_CLIENT.id,
+            'scope': 'All',
+            'state': b'state'
+        })
+
+    def testOnAuthenticateDeferred(self):
+        """ Test that render_GET writes the result of onAuthenticate once it fires. """
+        self._AUTH_RESOURCE.authenticateResult = succeed(self._AUTHENTICATE_RESPONSE)
+        request = self._createAuthRequest()
+        self.assertEqual(NOT_DONE_YET, self._AUTH_RESOURCE.render_GET(request),
+                         msg='Expected the auth resource to return NOT_DONE_YET '
+                             'while waiting for the storages.')
+        flushDeferredWrappers(*self._WRAPPERS)
+        self.assertTrue(request.finished, msg='Expected the auth resource to finish the '
+                                              'request once onAuthenticate returned.')
+        self.assertEqual(self._AUTHENTICATE_RESPONSE, request.getResponse(),
+                         msg='Expected the auth resource to write the result of onAuthenticate.')
+
+    def testOnAuthenticateFailure(self):
+        """ Test that a failing onAuthenticate Deferred results in a server error redirect. """
+        self._AUTH_RESOURCE.authenticateResult = Deferred()
+        request = self._createAuthRequest()
+        self.assertEqual(NOT_DONE_YET, self._AUTH_RESOURCE.render_GET(request),
+                         msg='Expected the auth resource to return NOT_DONE_YET '
+                             'while waiting for the storages.')
+        flushDeferredWrappers(*self._WRAPPERS)
+        self.assertFalse(request.finished, msg='Expected the auth resource to not finish the '
+                                               'request before onAuthenticate returned.')
+        self._AUTH_RESOURCE.authenticateResult.errback(RuntimeError('Expected error'))
+        self.assertTrue(request.finished, msg='Expected the auth resource to finish the '
+                                              'request once onAuthenticate failed.')
+        self.assertEqual(302, request.responseCode,
+                         msg='Expected the auth resource to redirect the user.')
+        location = request.getResponseHeader(b'location').decode('utf-8')
+        self.assertEqual(['server_error'], parse_qs(urlparse(location).query)['error'],
+                         msg='Expected the auth resource to redirect with a server error.')
+
+    def testGrantAccess(self):
+        """ Test that grantAccess stores the token and redirects once the storages returned. """
+        dataKey = 'deferredDataKey'
+        token = 'deferredImplicitToken'
+        self._PERSISTENT_STORAGE.put(dataKey, {
+            'response_type': GrantTypes.Implicit.value,
+            'redirect_uri': None,
+            'client_id': self._VALID_CLIENT.id,
+            'scope': ['All'],
+            'state': b'state'
+        })
+        self._TOKEN_FACTORY.expectTokenRequest(
+            token, self._AUTH_RESOURCE.authTokenLifeTime, self._VALID_CLIENT, ['All'])
+        request = MockRequest('GET', 'some/path')
+        result = self._AUTH_RESOURCE.grantAccess(request, dataKey)
+        self.assertIsInstance(result, Deferred, 'Expected grantAccess to return a Deferred '
+                                                'if the storages return Deferreds.')
+        results = []
+        result.addCallback(results.append)
+        flushDeferredWrappers(*self._WRAPPERS)
+        self._TOKEN_FACTORY.assertAllTokensRequested()
+        self.assertEqual([NOT_DONE_YET], results,
+                         msg='Expected the Deferred returned by grantAccess '
+                             'to fire with NOT_DONE_YET.')
+        self.assertTrue(request.finished, msg='Expected grantAccess to finish the request.')
+        self.assertTrue(self._TOKEN_STORAGE.contains(token),
+                        msg='Expected grantAccess to store the new token.')
+
+    def testDenyAccessInvalidDataKey(self):
+        """ Test that denyAccess fails the returned Deferred for an invalid data key. """
+        request = MockRequest('GET', 'some/path')
+        result = self._AUTH_RESOURCE.denyAccess(request, 'invalidDataKey')
+        self.assertIsInstance(result, Deferred, 'Expected denyAccess to return a Deferred '
+                                                'if the storages return Deferreds.')
+        flushDeferredWrappers(*self._WRAPPERS)
+        self.failureResultOf(result, InvalidDataKeyError)
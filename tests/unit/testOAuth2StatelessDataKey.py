@@ -0,0 +1,117 @@
+try:
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from urllib.parse import urlparse, parse_qs
+
+from twisted.web.server import NOT_DONE_YET
+
+from txoauth2 import GrantTypes
+from txoauth2.clients import PasswordClient
+from txoauth2.imp import DictTokenStorage
+from txoauth2.keyring import Keyring
+from txoauth2.resource import OAuth2, InvalidDataKeyError, InsecureRedirectUriError
+
+from tests import TwistedTestCase, MockRequest, TestTokenFactory, TestClientStorage, \
+    DeferredWrapper
+
+
+class TestOAuth2StatelessDataKey(TwistedTestCase):
+    """ Test the OAuth2 resource with data keys that are signed instead of stored. """
+    # noinspection PyTypeChecker
+    _VALID_CLIENT = PasswordClient('statelessAuthResourceClientId',
+                                   ['https://return.nonexistent', 'http://return.nonexistent'],
+                                   list(GrantTypes), secret='ClientSecret')
+
+    class TestOAuth2Resource(OAuth2):
+        """ A test OAuth2 resource that returns the data key given to onAuthenticate. """
+
+        def onAuthenticate(self, request, client, responseType, scope, redirectUri, state, dataKey):
+            return dataKey
+
+    def setUp(self):
+        super(TestOAuth2StatelessDataKey, self).setUp()
+        self._tokenFactory = TestTokenFactory()
+        self._tokenFactory.reset(self)
+        self._keyring = Keyring()
+        self._keyring.addKey('key', b'secret')
+        self._persistentStorage = DeferredWrapper(object())
+        clientStorage = TestClientStorage()
+        clientStorage.addClient(self._VALID_CLIENT)
+        self._authResource = self.TestOAuth2Resource(
+            self._tokenFactory, self._persistentStorage, clientStorage,
+            authTokenStorage=DictTokenStorage(), dataKeyKeyring=self._keyring)
+
+    def _getDataKey(self, redirectUri):
+        """
+        :param redirectUri: The redirect uri to send with the authorization request.
+        :return: The data key of a valid authorization request.
+        """
+        dataKey = self._authResource.render_GET(MockRequest('GET', 'oauth2', arguments={
+            'response_type': 'token',
+            'client_id': self._VALID_CLIENT.id,
+            'redirect_uri': redirectUri,
+            'scope': 'All',
+            'state': b'state'
+        }))
+        self.assertFalse(self._persistentStorage.hasPendingCalls(),
+                         msg='Expected the auth resource to not access the persistent storage.')
+        return dataKey
+
+    def testGrantAccess(self):
+        """ Test that grantAccess decodes the data key and accepts it only once. """
+        dataKey = self._getDataKey(self._VALID_CLIENT.redirectUris[0])
+        self._tokenFactory.expectTokenRequest(
+            'statelessToken', self._authResource.authTokenLifeTime, self._VALID_CLIENT, ['All'])
+        request = MockRequest('GET', 'some/path')
+        self.assertEqual(NOT_DONE_YET, self._authResource.grantAccess(request, dataKey))
+        self._tokenFactory.assertAllTokensRequested()
+        location = urlparse(request.getResponseHeader(b'location').decode('utf-8'))
+        self.assertEqual('return.nonexistent', location.netloc)
+        parameters = parse_qs(location.fragment)
+        self.assertEqual(['statelessToken'], parameters['access_token'])
+        self.assertEqual(['state'], parameters['state'])
+        self.assertRaises(InvalidDataKeyError, self._authResource.grantAccess,
+                          MockRequest('GET', 'some/path'), dataKey)
+        self.assertRaises(InvalidDataKeyError, self._authResource.denyAccess,
+                          MockRequest('GET', 'some/path'), dataKey)
+        self.assertFalse(self._persistentStorage.hasPendingCalls(),
+                         msg='Expected the auth resource to not access the persistent storage.')
+
+    def testDenyAccess(self):
+        """ Test that denyAccess decodes the data key and accepts it only once. """
+        dataKey = self._getDataKey(self._VALID_CLIENT.redirectUris[0])
+        request = MockRequest('GET', 'some/path')
+        self.assertEqual(NOT_DONE_YET, self._authResource.denyAccess(request, dataKey))
+        location = urlparse(request.getResponseHeader(b'location').decode('utf-8'))
+        self.assertEqual(['access_denied'], parse_qs(location.fragment)['error'])
+        self.assertRaises(InvalidDataKeyError, self._authResource.denyAccess,
+                          MockRequest('GET', 'some/path'), dataKey)
+
+    def testInvalidDataKeys(self):
+        """ Test that forged, expired and foreign data keys are rejected. """
+        dataKey = self._getDataKey(self._VALID_CLIENT.redirectUris[0])
+        header, payload, signature = dataKey.split('.')
+        forgedKey = '.'.join([header, payload, signature[::-1]])
+        otherKeyring = Keyring()
+        otherKeyring.addKey('key', b'otherSecret')
+        otherKey = otherKeyring.sign(self._keyring.verify(dataKey))
+        for invalidKey in [forgedKey, self._keyring.sign({'sub': 'user'}), None, 'noJWT',
+                           otherKey, self._keyring.sign({
+                               'use': OAuth2._DATA_KEY_USE,  # pylint: disable=protected-access
+                               'jti': 'expired', 'exp': 1, 'state': None})]:
+            self.assertRaises(InvalidDataKeyError, self._authResource.denyAccess,
+                              MockRequest('GET', 'some/path'), invalidKey)
+        self.assertEqual(NOT_DONE_YET, self._authResource.denyAccess(
+            MockRequest('GET', 'some/path'), dataKey))
+
+    def testReuseAfterInsecureRedirectUri(self):
+        """ Test that a data key can be used again if grantAccess raised an error. """
+        dataKey = self._getDataKey(self._VALID_CLIENT.redirectUris[1])
+        self.assertRaises(InsecureRedirectUriError, self._authResource.grantAccess,
+                          MockRequest('GET', 'some/path'), dataKey)
+        self._tokenFactory.expectTokenRequest(
+            'insecureToken', self._authResource.authTokenLifeTime, self._VALID_CLIENT, ['All'])
+        self.assertEqual(NOT_DONE_YET, self._authResource.grantAccess(
+            MockRequest('GET', 'some/path'), dataKey, allowInsecureRedirectUri=True))
+        self._tokenFactory.assertAllTokensRequested()
@@ -0,0 +1,65 @@
+from twisted.internet.task import Clock
+
+from txoauth2.imp import PooledTokenFactory, DictTokenStorage
+from txoauth2.token import TokenResource, TokenFactory
+
+from tests import TwistedTestCase, TestPersistentStorage, TestClientStorage, \
+    getTestPasswordClient
+
+
+class TestPooledTokenFactory(TwistedTestCase):
+    """ Test the PooledTokenFactory. """
+    _CLIENT = getTestPasswordClient()
+
+    def testValidTokens(self):
+        """ Test that the token factory generates unique and valid tokens. """
+        tokenFactory = PooledTokenFactory(tokenLength=20, poolSize=50, reactor=Clock())
+        tokens = [tokenFactory.generateToken(None, self._CLIENT, ['All']) for _ in range(120)]
+        self.assertEqual(len(tokens), len(set(tokens)),
+                         msg='Expected the token factory to generate unique tokens.')
+        for token in tokens:
+            self.assertEqual(20, len(token),
+                             msg='Expected the tokens to have the configured length.')
+            self.assertTrue(TokenResource.isValidToken(token),
+                            msg='Expected the token factory to generate valid tokens.')
+        self.assertRaises(ValueError, PooledTokenFactory, tokenLength=0)
+
+    def testRefill(self):
+        """ Test that the pool is refilled by the reactor when it runs low. """
+        clock = Clock()
+        tokenFactory = PooledTokenFactory(poolSize=8, refillThreshold=2, reactor=clock)
+        for _ in range(5):
+            tokenFactory.generateToken(None, self._CLIENT, ['All'])
+        self.assertEqual([], clock.getDelayedCalls(),
+                         msg='Expected no refill while the pool contains enough tokens.')
+        tokenFactory.generateToken(None, self._CLIENT, ['All'])
+        self.assertEqual(1, len(clock.getDelayedCalls()),
+                         msg='Expected a refill to be scheduled when the pool runs low.')
+        tokenFactory.generateToken(None, self._CLIENT, ['All'])
+        self.assertEqual(1, len(clock.getDelayedCalls()),
+                         msg='Expected only one refill to be scheduled.')
+        clock.advance(0)
+        # noinspection PyProtectedMember
+        self.assertEqual(9, len(tokenFactory._pool),  # pylint: disable=protected-access
+                         msg='Expected the refill to add poolSize tokens to the pool.')
+
+    def testSkipValidation(self):
+        """ Test that the token resource does not validate tokens of pre-validated factories. """
+        class PreValidatedTokenFactory(TokenFactory):
+            generatesValidTokens = True
+
+            def generateToken(self, lifetime, client, scope, additionalData=None):
+                return 'token which is not validated'
+        tokenStorage = DictTokenStorage()
+        tokenResource = TokenResource(
+            PreValidatedTokenFactory(), TestPersistentStorage(), DictTokenStorage(),
+            tokenStorage, TestClientStorage(), passwordManager=object())
+        try:
+            # noinspection PyProtectedMember
+            token = self.successResultOf(
+                tokenResource._storeNewAccessToken(  # pylint: disable=protected-access
+                    self._CLIENT, ['All'], None))
+        finally:
+            setattr(TokenResource, '_OAuthTokenStorage', None)
+        self.assertTrue(tokenStorage.contains(token),
+                        msg='Expected the token resource to store the pre-validated token.')
@@ -0,0 +1,354 @@
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, gatherResults
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.protocol import Protocol, Factory
+
+from txoauth2.imp import RedisTokenStorage, RedisPersistentStorage, RedisError
+from txoauth2.token import TokenAccess
+
+from tests import TwistedTestCase, getTestPasswordClient
+
+
+class FakeRedisProtocol(Protocol):
+    """ A connection to the FakeRedisServer. """
+
+    def __init__(self, server):
+        self._server = server
+        self._buffer = b''
+        self._transaction = None
+
+    def connectionMade(self):
+        self._server.numConnections += 1
+
+    def dataReceived(self, data):
+        self._buffer += data
+        replies = []
+        while True:
+            command = self._parseCommand()
+            if command is None:
+                break
+            replies.append(self._handleCommand(command))
+        if replies:
+            self.transport.write(b''.join(replies))
+
+    def _parseCommand(self):
+        """
+        :return: The next complete command from the buffer or None.
+        """
+        headerEnd = self._buffer.find(b'\r\n')
+        if headerEnd == -1:
+            return None
+        command = []
+        offset = headerEnd + 2
+        for _ in range(int(self._buffer[1:headerEnd])):
+            lengthEnd = self._buffer.find(b'\r\n', offset)
+            if lengthEnd == -1:
+                return None
+            length = int(self._buffer[offset + 1:lengthEnd])
+            if len(self._buffer) < lengthEnd + 2 + length + 2:
+                return None
+            command.append(self._buffer[lengthEnd + 2:lengthEnd + 2 + length])
+            offset = lengthEnd + 2 + length + 2
+        self._buffer = self._buffer[offset:]
+        return command
+
+    def _handleCommand(self, command):
+        """
+        :param command: The command and its arguments.
+        :return: The encoded reply.
+        """
+        name = command[0].upper()
+        if self._transaction is not None and name not in [b'EXEC', b'MULTI']:
+            self._transaction.append(command)
+            return b'+QUEUED\r\n'
+        if name == b'MULTI':
+            self._transaction = []
+            return b'+OK\r\n'
+        if name == b'EXEC':
+            transaction, self._transaction = self._transaction, None
+            return b'*' + str(len(transaction)).encode('ascii') + b'\r\n' + \
+                   b''.join(self._server.execute(queued) for queued in transaction)
+        return self._server.execute(command)
+
+
+class FakeRedisServer(Factory):
+    """ An in-process server that implements the subset of Redis used by the storages. """
+
+    def __init__(self):
+        self.numConnections = 0
+        self._data = {}
+        self._expireTimes = {}
+
+    def buildProtocol(self, addr):
+        return FakeRedisProtocol(self)
+
+    def execute(self, command):
+        """
+        :param command: The command and its arguments.
+        :return: The encoded reply.
+        """
+        name, args = command[0].upper(), command[1:]
+        for key in list(self._expireTimes.keys()):
+            if self._expireTimes[key] <= time.time() * 1000:
+                del self._expireTimes[key]
+                self._data.pop(key, None)
+        if name == b'EXISTS':
+            return self._encodeInt(1 if args[0] in self._data else 0)
+        if name == b'DEL':
+            self._expireTimes.pop(args[0], None)
+            return self._encodeInt(0 if self._data.pop(args[0], None) is None else 1)
+        if name == b'HSET':
+            self._data.setdefault(args[0], {}).update(zip(args[1::2], args[2::2]))
+            return self._encodeInt(len(args) // 2)
+        if name == b'HGET':
+            return self._encodeBulk(self._data.get(args[0], {}).get(args[1]))
+        if name == b'HMGET':
+            fields = self._data.get(args[0], {})
+            return b'*' + str(len(args) - 1).encode('ascii') + b'\r\n' + \
+                b''.join(self._encodeBulk(fields.get(field)) for field in args[1:])
+        if name == b'ZADD':
+            self._data.setdefault(args[0], {})[args[2]] = self._parseScore(args[1])
+            return self._encodeInt(1)
+        if name == b'ZREM':
+            members = self._data.get(args[0], {})
+            return self._encodeInt(sum(members.pop(member, None) is not None
+                                       for member in args[1:]))
+        if name in [b'ZRANGEBYSCORE', b'ZREMRANGEBYSCORE']:
+            minScore, maxScore = args[1], args[2]
+            isExclusive = minScore.startswith(b'(')
+            minScore = self._parseScore(minScore.lstrip(b'('))
+            maxScore = self._parseScore(maxScore)
+            members = self._data.get(args[0], {})
+            matches = [member for member, score in sorted(members.items(), key=lambda i: i[1])
+                       if (score > minScore if isExclusive else score >= minScore)
+                       and score <= maxScore]
+            if name == b'ZREMRANGEBYSCORE':
+                for member in matches:
+                    del members[member]
+                return self._encodeInt(len(matches))
+            return b'*' + str(len(matches)).encode('ascii') + b'\r\n' + \
+                b''.join(self._encodeBulk(member) for member in matches)
+        if name == b'HGETALL':
+            items = [item for pair in self._data.get(args[0], {}).items() for item in pair]
+            return b'*' + str(len(items)).encode('ascii') + b'\r\n' + \
+                b''.join(self._encodeBulk(item) for item in items)
+        if name == b'SET':
+            self._data[args[0]] = args[1]
+            self._expireTimes.pop(args[0], None)
+            return b'+OK\r\n'
+        if name == b'GET':
+            return self._encodeBulk(self._data.get(args[0]))
+        if name == b'PEXPIREAT':
+            if args[0] not in self._data:
+                return self._encodeInt(0)
+            self._expireTimes[args[0]] = int(args[1])
+            return self._encodeInt(1)
+        if name == b'PERSIST':
+            return self._encodeInt(0 if self._expireTimes.pop(args[0], None) is None else 1)
+        return b'-ERR unknown command\r\n'
+
+    @staticmethod
+    def _parseScore(score):
+        return float(score.replace(b'inf', b'Infinity').decode('ascii'))
+
+    @staticmethod
+    def _encodeInt(value):
+        return b':' + str(value).encode('ascii') + b'\r\n'
+
+    @staticmethod
+    def _encodeBulk(value):
+        if value is None:
+            return b'$-1\r\n'
+        return b'$' + str(len(value)).encode('ascii') + b'\r\n' + value + b'\r\n'
+
+
+class AbstractRedisTest(TwistedTestCase):
+    """ An abstract test case that starts a FakeRedisServer for each test. """
+
+    def setUp(self):
+        super(AbstractRedisTest, self).setUp()
+        self._server = FakeRedisServer()
+        self._port = reactor.listenTCP(0, self._server, interface='127.0.0.1')
+        self._endpoint = TCP4ClientEndpoint(reactor, '127.0.0.1', self._port.getHost().port)
+
+    def tearDown(self):
+        super(AbstractRedisTest, self).tearDown()
+        return self._port.stopListening()
+
+
+class RedisTokenStorageTest(AbstractRedisTest):
+    """ Test the RedisTokenStorage. """
+    _VALID_TOKEN = 'ValidToken'
+    _VALID_SCOPE = ['All', 'Scope1']
+    _VALID_ADDITIONAL_DATA = {'user': b'someUser'}
+    _DUMMY_CLIENT = getTestPasswordClient()
+
+    @inlineCallbacks
+    def setUp(self):
+        super(RedisTokenStorageTest, self).setUp()
+        self._tokenStorage = RedisTokenStorage(self._endpoint, poolSize=2)
+        yield self._tokenStorage.store(self._VALID_TOKEN, self._DUMMY_CLIENT, self._VALID_SCOPE,
+                                       self._VALID_ADDITIONAL_DATA)
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield self._tokenStorage.close()
+        yield super(RedisTokenStorageTest, self).tearDown()
+
+    @inlineCallbacks
+    def testLookup(self):
+        """ Test that the token storage returns the data that was stored with a token. """
+        self.assertTrue((yield self._tokenStorage.contains(self._VALID_TOKEN)),
+                        msg='Expected contains to return True for a stored token.')
+        self.assertFalse((yield self._tokenStorage.contains('invalidToken')),
+                         msg='Expected contains to return False for an unknown token.')
+        self.assertListEqual(self._VALID_SCOPE,
+                             (yield self._tokenStorage.getTokenScope(self._VALID_TOKEN)),
+                             msg='Expected getTokenScope to return the stored scope.')
+        self.assertEqual(self._DUMMY_CLIENT.id,
+                         (yield self._tokenStorage.getTokenClient(self._VALID_TOKEN)),
+                         msg='Expected getTokenClient to return the id of the stored client.')
+        self.assertEqual(self._VALID_ADDITIONAL_DATA,
+                         (yield self._tokenStorage.getTokenAdditionalData(self._VALID_TOKEN)),
+                         msg='Expected getTokenAdditionalData to return the stored data.')
+        tokenInfo = yield self._tokenStorage.getTokenInfo(self._VALID_TOKEN)
+        self.assertIsNone(tokenInfo['expire_time'],
+                          msg='Expected getTokenInfo to return no expire time for a token '
+                              'that was stored without one.')
+        yield self.assertFailure(self._tokenStorage.getTokenInfo('invalidToken'), KeyError)
+        yield self.assertFailure(self._tokenStorage.getTokenScope('invalidToken'), KeyError)
+
+    @inlineCallbacks
+    def testAccess(self):
+        """ Test that hasAccess and checkAccess only grant access within the stored scope. """
+        self.assertTrue((yield self._tokenStorage.hasAccess(
+            self._VALID_TOKEN, self._VALID_SCOPE[0:1])),
+            msg='Expected hasAccess to return True for a subset of the valid scope.')
+        self.assertFalse((yield self._tokenStorage.hasAccess(
+            self._VALID_TOKEN, self._VALID_SCOPE + ['invalidScope'])),
+            msg='Expected hasAccess to return False for an invalid scope.')
+        yield self.assertFailure(
+            self._tokenStorage.hasAccess('invalidToken', self._VALID_SCOPE), KeyError)
+        self.assertEqual(TokenAccess.Granted, (yield self._tokenStorage.checkAccess(
+            self._VALID_TOKEN, self._VALID_SCOPE)))
+        self.assertEqual(TokenAccess.InsufficientScope, (yield self._tokenStorage.checkAccess(
+            self._VALID_TOKEN, ['invalidScope'])))
+        self.assertEqual(TokenAccess.Invalid, (yield self._tokenStorage.checkAccess(
+            'invalidToken', self._VALID_SCOPE)))
+
+    @inlineCallbacks
+    def testRemoveAndExpire(self):
+        """ Test that removed and expired tokens are no longer in the token storage. """
+        expireTime = time.time() + 0.1
+        yield self._tokenStorage.store('expiringToken', self._DUMMY_CLIENT, self._VALID_SCOPE,
+                                       expireTime=expireTime)
+        self.assertEqual(expireTime,
+                         (yield self._tokenStorage.getTokenInfo('expiringToken'))['expire_time'],
+                         msg='Expected getTokenInfo to return the expire time of the token.')
+        yield self._tokenStorage.remove(self._VALID_TOKEN)
+        self.assertFalse((yield self._tokenStorage.contains(self._VALID_TOKEN)),
+                         msg='Expected contains to return False for a removed token.')
+        yield self.assertFailure(self._tokenStorage.remove(self._VALID_TOKEN), KeyError)
+        time.sleep(0.15)
+        self.assertFalse((yield self._tokenStorage.contains('expiringToken')),
+                         msg='Expected the Redis server to expire the token.')
+
+    @inlineCallbacks
+    def testRemoveByClientAndUser(self):
+        """ Test that all tokens of a client or a user can be removed. """
+        tokenStorage = RedisTokenStorage(
+            self._endpoint, keyPrefix='indexed:', getUserId=lambda data: data['user'])
+        try:
+            otherClient = getTestPasswordClient('otherClient')
+            for token, client, user in [('token1', self._DUMMY_CLIENT, 'user1'),
+                                        ('token2', self._DUMMY_CLIENT, 'user2'),
+                                        ('token3', otherClient, 'user1'),
+                                        ('token4', otherClient, 'user2')]:
+                yield tokenStorage.store(token, client, self._VALID_SCOPE, {'user': user})
+            yield tokenStorage.store('expiredToken', otherClient, self._VALID_SCOPE,
+                                     {'user': 'user2'}, expireTime=time.time() + 0.05)
+            yield tokenStorage.remove('token2')
+            time.sleep(0.1)
+            self.assertListEqual(['token1'], (yield tokenStorage.removeByClient(
+                self._DUMMY_CLIENT.id)), msg='Expected removeByClient to remove the tokens of '
+                                             'the client that were not removed before.')
+            self.assertListEqual(['token4'], (yield tokenStorage.removeByUser('user2')),
+                                 msg='Expected removeByUser to remove the live tokens '
+                                     'of the user.')
+            self.assertTrue((yield tokenStorage.contains('token3')),
+                            msg='Expected the tokens of other clients and users to remain.')
+            self.assertListEqual([], (yield tokenStorage.removeByClient('unknownClient')))
+            self.assertRaises(NotImplementedError, self._tokenStorage.removeByUser, 'user1')
+        finally:
+            yield tokenStorage.close()
+
+    @inlineCallbacks
+    def testIntegerUserId(self):
+        """ Test that the tokens of a user with an integer id can be removed. """
+        tokenStorage = RedisTokenStorage(
+            self._endpoint, keyPrefix='indexedInt:', getUserId=lambda data: data['user'])
+        try:
+            yield tokenStorage.store('token1', self._DUMMY_CLIENT, self._VALID_SCOPE, {'user': 42})
+            yield tokenStorage.store('token2', self._DUMMY_CLIENT, self._VALID_SCOPE, {'user': 42})
+            yield tokenStorage.store('token3', self._DUMMY_CLIENT, self._VALID_SCOPE, {'user': 7})
+            yield tokenStorage.remove('token2')
+            self.assertListEqual(['token1'], (yield tokenStorage.removeByUser(42)),
+                                 msg='Expected removeByUser to remove the tokens of a user '
+                                     'with an integer id.')
+            self.assertTrue((yield tokenStorage.contains('token3')),
+                            msg='Expected the tokens of other users to remain.')
+        finally:
+            yield tokenStorage.close()
+
+    @inlineCallbacks
+    def testPooling(self):
+        """ Test that concurrent commands are pipelined over at most poolSize connections. """
+        tokens = ['pooledToken' + str(index) for index in range(20)]
+        yield gatherResults([self._tokenStorage.store(token, self._DUMMY_CLIENT, self._VALID_SCOPE)
+                             for token in tokens])
+        results = yield gatherResults([self._tokenStorage.contains(token) for token in tokens])
+        self.assertEqual([True] * len(tokens), results,
+                         msg='Expected the token storage to contain all stored tokens.')
+        self.assertEqual(2, self._server.numConnections,
+                         msg='Expected the token storage to open no more than poolSize '
+                             'connections.')
+
+    @inlineCallbacks
+    def testErrorReply(self):
+        """ Test that an error reply of the server fails the command. """
+        # noinspection PyProtectedMember
+        yield self.assertFailure(
+            self._tokenStorage._pool.execute(b'UNKNOWN'), RedisError)  # pylint: disable=W0212
+        self.assertTrue((yield self._tokenStorage.contains(self._VALID_TOKEN)),
+                        msg='Expected the connection to remain usable after an error reply.')
+
+
+class RedisPersistentStorageTest(AbstractRedisTest):
+    """ Test the RedisPersistentStorage. """
+
+    def setUp(self):
+        super(RedisPersistentStorageTest, self).setUp()
+        self._persistentStorage = RedisPersistentStorage(self._endpoint)
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield self._persistentStorage.close()
+        yield super(RedisPersistentStorageTest, self).tearDown()
+
+    @inlineCallbacks
+    def testPutAndPop(self):
+        """ Test that data can be popped exactly once. """
+        data = {'scope': ['All'], 'state': b'state'}
+        yield self._persistentStorage.put('key', data)
+        self.assertEqual(data, (yield self._persistentStorage.pop('key')),
+                         msg='Expected pop to return the stored data.')
+        yield self.assertFailure(self._persistentStorage.pop('key'), KeyError)
+
+    @inlineCallbacks
+    def testExpire(self):
+        """ Test that expired data can not be popped. """
+        yield self._persistentStorage.put('expiringKey', 'data', expireTime=time.time() + 0.1)
+        time.sleep(0.15)
+        yield self.assertFailure(self._persistentStorage.pop('expiringKey'), KeyError)
@@ -0,0 +1,253 @@
+import time
+import threading
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, gatherResults
+from twisted.internet.task import deferLater
+
+from txoauth2.imp import SQLiteTokenStorage, SQLitePersistentStorage, SQLiteCodeStorage, \
+    ReplayedKeyError, JSONCodec
+from txoauth2.token import TokenAccess
+
+from tests import TwistedTestCase, getTestPasswordClient
+
+
+class SQLiteTokenStorageTest(TwistedTestCase):
+    """ Test the SQLiteTokenStorage. """
+    _VALID_TOKEN = 'ValidToken'
+    _VALID_SCOPE = ['All', 'Scope1']
+    _VALID_ADDITIONAL_DATA = {'user': b'someUser'}
+    _DUMMY_CLIENT = getTestPasswordClient()
+
+    @inlineCallbacks
+    def setUp(self):
+        super(SQLiteTokenStorageTest, self).setUp()
+        self._path = self.mktemp()
+        self._tokenStorage = SQLiteTokenStorage(self._path)
+        yield self._tokenStorage.store(self._VALID_TOKEN, self._DUMMY_CLIENT, self._VALID_SCOPE,
+                                       self._VALID_ADDITIONAL_DATA)
+
+    def tearDown(self):
+        super(SQLiteTokenStorageTest, self).tearDown()
+        return self._tokenStorage.close()
+
+    @inlineCallbacks
+    def testLookup(self):
+        """ Test that the token storage returns the data that was stored with a token. """
+        self.assertTrue((yield self._tokenStorage.contains(self._VALID_TOKEN)),
+                        msg='Expected contains to return True for a stored token.')
+        self.assertFalse((yield self._tokenStorage.contains('invalidToken')),
+                         msg='Expected contains to return False for an unknown token.')
+        self.assertListEqual(self._VALID_SCOPE,
+                             (yield self._tokenStorage.getTokenScope(self._VALID_TOKEN)),
+                             msg='Expected getTokenScope to return the stored scope.')
+        self.assertEqual(self._DUMMY_CLIENT.id,
+                         (yield self._tokenStorage.getTokenClient(self._VALID_TOKEN)),
+                         msg='Expected getTokenClient to return the id of the stored client.')
+        self.assertEqual(self._VALID_ADDITIONAL_DATA,
+                         (yield self._tokenStorage.getTokenAdditionalData(self._VALID_TOKEN)),
+                         msg='Expected getTokenAdditionalData to return the stored data.')
+        self.assertEqual(0, (yield self._tokenStorage.getTokenLifetime(self._VALID_TOKEN)),
+                         msg='Expected getTokenLifetime to return the lifetime of the token.')
+        yield self.assertFailure(self._tokenStorage.getTokenInfo('invalidToken'), KeyError)
+
+    @inlineCallbacks
+    def testAccess(self):
+        """ Test that hasAccess and checkAccess only grant access within the stored scope. """
+        self.assertTrue((yield self._tokenStorage.hasAccess(
+            self._VALID_TOKEN, self._VALID_SCOPE[0:1])),
+            msg='Expected hasAccess to return True for a subset of the valid scope.')
+        self.assertFalse((yield self._tokenStorage.hasAccess(
+            self._VALID_TOKEN, self._VALID_SCOPE + ['invalidScope'])),
+            msg='Expected hasAccess to return False for an invalid scope.')
+        yield self.assertFailure(
+            self._tokenStorage.hasAccess('invalidToken', self._VALID_SCOPE), KeyError)
+        self.assertEqual(TokenAccess.Granted, (yield self._tokenStorage.checkAccess(
+            self._VALID_TOKEN, self._VALID_SCOPE)))
+        self.assertEqual(TokenAccess.InsufficientScope, (yield self._tokenStorage.checkAccess(
+            self._VALID_TOKEN, ['invalidScope'])))
+        self.assertEqual(TokenAccess.Invalid, (yield self._tokenStorage.checkAccess(
+            'invalidToken', self._VALID_SCOPE)))
+
+    @inlineCallbacks
+    def testRemoveAndExpire(self):
+        """ Test that removed and expired tokens are no longer in the token storage. """
+        yield self._tokenStorage.store('expiringToken', self._DUMMY_CLIENT, self._VALID_SCOPE,
+                                       expireTime=time.time() + 0.1)
+        yield self._tokenStorage.remove(self._VALID_TOKEN)
+        self.assertFalse((yield self._tokenStorage.contains(self._VALID_TOKEN)),
+                         msg='Expected contains to return False for a removed token.')
+        yield self.assertFailure(self._tokenStorage.remove(self._VALID_TOKEN), KeyError)
+        self.assertTrue((yield self._tokenStorage.contains('expiringToken')),
+                        msg='Expected contains to return True for a token before it expires.')
+        time.sleep(0.15)
+        self.assertFalse((yield self._tokenStorage.contains('expiringToken')),
+                         msg='Expected contains to return False for an expired token.')
+
+    @inlineCallbacks
+    def testGroupCommit(self):
+        """ Test that tokens which are stored at the same time are committed together. """
+        batches = []
+        database = self._tokenStorage._database  # pylint: disable=protected-access
+        executeBatch = database._executeBatch  # pylint: disable=protected-access
+
+        def countingExecuteBatch(batch):
+            batches.append(len(batch))
+            return executeBatch(batch)
+        database._executeBatch = countingExecuteBatch  # pylint: disable=protected-access
+        tokens = ['groupCommitToken' + str(index) for index in range(50)]
+        yield gatherResults([self._tokenStorage.store(token, self._DUMMY_CLIENT, self._VALID_SCOPE)
+                             for token in tokens])
+        self.assertEqual([50], batches,
+                         msg='Expected all tokens to be committed in a single transaction.')
+        for token in tokens:
+            self.assertTrue((yield self._tokenStorage.contains(token)),
+                            msg='Expected the token storage to contain all stored tokens.')
+
+    @inlineCallbacks
+    def testReadsDoNotWaitForWrites(self):
+        """ Test that reads are answered while the writer thread is busy. """
+        writeStarted = threading.Event()
+        releaseWrite = threading.Event()
+
+        def blockingWrite(cursor):
+            del cursor  # Unused
+            writeStarted.set()
+            releaseWrite.wait(5)
+        # noinspection PyProtectedMember
+        writeDeferred = self._tokenStorage._database.runWrite(  # pylint: disable=protected-access
+            blockingWrite)
+        while not writeStarted.is_set():
+            yield deferLater(reactor, 0.01, lambda: None)
+        try:
+            self.assertTrue((yield self._tokenStorage.contains(self._VALID_TOKEN)))
+            self.assertFalse(writeDeferred.called,
+                             msg='Expected the read to not wait for the pending write.')
+        finally:
+            releaseWrite.set()
+        yield writeDeferred
+
+    @inlineCallbacks
+    def testPersistence(self):
+        """ Test that the tokens are still available after reopening the database. """
+        yield self._tokenStorage.close()
+        self._tokenStorage = SQLiteTokenStorage(self._path)
+        self.assertListEqual(self._VALID_SCOPE,
+                             (yield self._tokenStorage.getTokenScope(self._VALID_TOKEN)),
+                             msg='Expected the token to survive reopening the database.')
+
+    @inlineCallbacks
+    def testRemoveByClientAndUser(self):
+        """ Test that all tokens of a client or a user can be removed. """
+        self.assertRaises(NotImplementedError, self._tokenStorage.removeByUser, 'user1')
+        yield self._tokenStorage.close()
+        self._tokenStorage = SQLiteTokenStorage(
+            self._path, tableName='indexedTokens', getUserId=lambda data: data['user'])
+        otherClient = getTestPasswordClient('otherClient')
+        for token, client, user in [('token1', self._DUMMY_CLIENT, 'user1'),
+                                    ('token2', self._DUMMY_CLIENT, 'user2'),
+                                    ('token3', otherClient, 'user1'),
+                                    ('token4', otherClient, 'user2')]:
+            yield self._tokenStorage.store(token, client, self._VALID_SCOPE, {'user': user})
+        self.assertListEqual(['token1', 'token2'], sorted((
+            yield self._tokenStorage.removeByClient(self._DUMMY_CLIENT.id))),
+            msg='Expected removeByClient to remove all tokens of the client.')
+        self.assertListEqual(['token4'], (yield self._tokenStorage.removeByUser('user2')),
+                             msg='Expected removeByUser to remove the remaining tokens '
+                                 'of the user.')
+        self.assertTrue((yield self._tokenStorage.contains('token3')),
+                        msg='Expected the tokens of other clients and users to remain.')
+
+    def testInvalidTableName(self):
+        """ Test that an invalid table name is rejected. """
+        self.assertRaises(ValueError, SQLiteTokenStorage, self._path, tableName='tokens; --')
+
+
+class SQLitePersistentStorageTest(TwistedTestCase):
+    """ Test the SQLitePersistentStorage. """
+
+    def setUp(self):
+        super(SQLitePersistentStorageTest, self).setUp()
+        self._persistentStorage = SQLitePersistentStorage(self.mktemp())
+
+    def tearDown(self):
+        super(SQLitePersistentStorageTest, self).tearDown()
+        return self._persistentStorage.close()
+
+    @inlineCallbacks
+    def testPutAndPop(self):
+        """ Test that data can be popped exactly once. """
+        data = {'scope': ['All'], 'state': b'state'}
+        yield self._persistentStorage.put('key', data)
+        self.assertEqual(data, (yield self._persistentStorage.pop('key')),
+                         msg='Expected pop to return the stored data.')
+        yield self.assertFailure(self._persistentStorage.pop('key'), KeyError)
+
+    @inlineCallbacks
+    def testExpire(self):
+        """ Test that expired data can not be popped. """
+        yield self._persistentStorage.put('expiringKey', 'data', expireTime=time.time() + 0.1)
+        time.sleep(0.15)
+        yield self.assertFailure(self._persistentStorage.pop('expiringKey'), KeyError)
+
+    @inlineCallbacks
+    def testCustomCodec(self):
+        """ Test that the data is encoded with the given codec. """
+        class ReversingCodec(JSONCodec):
+            def encode(self, value):
+                return super(ReversingCodec, self).encode(value)[::-1]
+
+            def decode(self, data):
+                return super(ReversingCodec, self).decode(bytes(data)[::-1])
+
+        persistentStorage = SQLitePersistentStorage(self.mktemp(), codec=ReversingCodec())
+        try:
+            yield persistentStorage.put('key', {'state': b'state'})
+            self.assertEqual({'state': b'state'}, (yield persistentStorage.pop('key')),
+                             msg='Expected pop to return the data decoded with the codec.')
+        finally:
+            yield persistentStorage.close()
+
+
+class SQLiteCodeStorageTest(TwistedTestCase):
+    """ Test the SQLiteCodeStorage. """
+
+    def setUp(self):
+        super(SQLiteCodeStorageTest, self).setUp()
+        self._path = self.mktemp()
+        self._codeStorages = [SQLiteCodeStorage(self._path, replayLogLifetime=0.2)
+                              for _ in range(2)]
+
+    def tearDown(self):
+        super(SQLiteCodeStorageTest, self).tearDown()
+        return gatherResults([codeStorage.close() for codeStorage in self._codeStorages])
+
+    @inlineCallbacks
+    def testSingleUsePop(self):
+        """ Test that concurrent pops of the same code from two storages succeed only once. """
+        data = {'client_id': 'clientId', 'scope': ['All']}
+        yield self._codeStorages[0].put('codeKey', data, expireTime=time.time() + 60)
+        results = yield gatherResults([codeStorage.pop('codeKey').addErrback(
+            lambda failure: failure.trap(ReplayedKeyError)) for codeStorage in self._codeStorages])
+        self.assertIn(data, results, msg='Expected one pop to return the stored data.')
+        self.assertIn(ReplayedKeyError, results,
+                      msg='Expected the other pop to fail with a ReplayedKeyError.')
+        yield self.assertFailure(self._codeStorages[1].pop('unknownKey'), KeyError)
+
+    @inlineCallbacks
+    def testReplayLogExpire(self):
+        """ Test that keys are removed from the replay log after its lifetime. """
+        yield self._codeStorages[0].put('codeKey', 'data')
+        self.assertEqual('data', (yield self._codeStorages[0].pop('codeKey')))
+        yield self.assertFailure(self._codeStorages[1].pop('codeKey'), ReplayedKeyError)
+        time.sleep(0.25)
+        failure = yield self.assertFailure(self._codeStorages[1].pop('codeKey'), KeyError)
+        self.assertFalse(isinstance(failure, ReplayedKeyError),
+                         msg='Expected the key to be removed from the replay log.')
+
+    @inlineCallbacks
+    def testExpire(self):
+        """ Test that expired codes can not be popped. """
+        yield self._codeStorages[0].put('expiringKey', 'data', expireTime=time.time() + 0.1)
+        time.sleep(0.15)
+        yield self.assertFailure(self._codeStorages[1].pop('expiringKey'), KeyError)
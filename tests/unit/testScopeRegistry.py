@@ -0,0 +1,70 @@
+from txoauth2.scope import ScopeRegistry, isScopeSubset
+
+from tests import TwistedTestCase
+
+
+class TestScopeRegistry(TwistedTestCase):
+    """ Test the ScopeRegistry. """
+
+    def testRegister(self):
+        """ Test that each scope name is assigned its own bit. """
+        registry = ScopeRegistry(['read', 'write'])
+        self.assertEqual(1, registry.register('read'),
+                         msg='Expected the first scope name to be assigned the first bit.')
+        self.assertEqual(2, registry.register('write'),
+                         msg='Expected the second scope name to be assigned the second bit.')
+        self.assertEqual(4, registry.register('admin'),
+                         msg='Expected a new scope name to be assigned the next bit.')
+        self.assertEqual(4, registry.register('admin'),
+                         msg='Expected a scope name to keep its bit when registered again.')
+
+    def testMaskConversion(self):
+        """ Test the conversion between scopes and bitmasks. """
+        registry = ScopeRegistry(['read', 'write'])
+        self.assertEqual(3, registry.toMask(['write', 'read']),
+                         msg='Expected toMask to combine the bits of all scope names.')
+        self.assertIsNone(registry.lookupMask(['read', 'unknown']),
+                          msg='Expected lookupMask to return None for an unknown scope name.')
+        self.assertIsNone(registry.lookupMask(['unknown']),
+                          msg='Expected lookupMask to not register unknown scope names.')
+        self.assertEqual(4, registry.toMask(['unknown']),
+                         msg='Expected toMask to register unknown scope names.')
+        self.assertListEqual(['read', 'unknown'], registry.toScope(5),
+                             msg='Expected toScope to return the scope names '
+                                 'in the order of their registration.')
+        self.assertListEqual([], registry.toScope(0),
+                             msg='Expected toScope to return an empty scope for an empty mask.')
+
+    def testFrozen(self):
+        """ Test that a frozen registry rejects unknown scope names. """
+        registry = ScopeRegistry(['read', 'write'], frozen=True)
+        self.assertTrue(registry.frozen)
+        self.assertEqual(3, registry.toMask(['read', 'write']),
+                         msg='Expected a frozen registry to convert registered scope names.')
+        self.assertRaises(ValueError, registry.toMask, ['read', 'unknown'])
+        self.assertRaises(ValueError, registry.register, 'unknown')
+        self.assertIsNone(registry.lookupMask(['unknown']),
+                          msg='Expected a frozen registry to not register unknown scope names.')
+        registry = ScopeRegistry(['read'])
+        self.assertFalse(registry.frozen)
+        registry.freeze()
+        self.assertRaises(ValueError, registry.register, 'write')
+
+    def testSubset(self):
+        """ Test that the subset check is correct with and without a registry. """
+        for registry in [ScopeRegistry(), None]:
+            self.assertTrue(isScopeSubset(['read'], ['read', 'write'], registry),
+                            msg='Expected a subset of the scope to be accepted.')
+            self.assertTrue(isScopeSubset(['write', 'read'], ['read', 'write'], registry),
+                            msg='Expected the same scope in a different order to be accepted.')
+            self.assertFalse(isScopeSubset(['read', 'admin'], ['read', 'write'], registry),
+                             msg='Expected a scope with an additional scope name to be rejected.')
+            self.assertFalse(isScopeSubset(['Read'], ['read'], registry),
+                             msg='Expected the scope names to be case sensitive.')
+        registry = ScopeRegistry(['read'])
+        self.assertTrue(registry.isSubset(['unknown'], ['read', 'unknown']),
+                        msg='Expected unregistered scope names to be compared by name.')
+        self.assertIsNone(registry.lookupMask(['unknown']),
+                          msg='Expected isSubset to not register unknown scope names.')
+        self.assertFalse(ScopeRegistry.grantsAccess(3, None),
+                         msg='Expected an unknown requested scope to never be granted.')
@@ -0,0 +1,174 @@
+import gc
+import os
+import time
+import shutil
+import logging
+import tempfile
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import inlineCallbacks
+
+from txoauth2.imp import SnapshotTokenStorage
+
+from tests import TwistedTestCase, getTestPasswordClient
+
+
+class SnapshotTokenStorageTest(TwistedTestCase):
+    """ Test the SnapshotTokenStorage. """
+    _VALID_SCOPE = ['All', 'scope1']
+    _CLIENT = getTestPasswordClient()
+
+    def setUp(self):
+        super(SnapshotTokenStorageTest, self).setUp()
+        self._directory = tempfile.mkdtemp()
+        self._path = os.path.join(self._directory, 'tokens')
+        self._tokenStorage = SnapshotTokenStorage(self._path)
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield self._tokenStorage.close()
+        shutil.rmtree(self._directory)
+        yield super(SnapshotTokenStorageTest, self).tearDown()
+
+    @inlineCallbacks
+    def _reopen(self):
+        """ Close the token storage and restore it from its files. """
+        yield self._tokenStorage.close()
+        self._tokenStorage = SnapshotTokenStorage(self._path)
+
+    @inlineCallbacks
+    def testRestoreFromLog(self):
+        """ Test that stored and removed tokens are restored from the change log. """
+        self._tokenStorage.store('token1', self._CLIENT, self._VALID_SCOPE, {'user': 'me'},
+                                 expireTime=time.time() + 60)
+        self._tokenStorage.store('token2', self._CLIENT, self._VALID_SCOPE)
+        self._tokenStorage.store('removedToken', self._CLIENT, self._VALID_SCOPE)
+        self._tokenStorage.remove('removedToken')
+        self._tokenStorage.store('expiredToken', self._CLIENT, self._VALID_SCOPE)
+        self._tokenStorage.store('expiredToken', self._CLIENT, self._VALID_SCOPE,
+                                 expireTime=time.time() - 1)
+        birthTime = self._tokenStorage.getTokenInfo('token1')['birth_time']
+        yield self._reopen()
+        tokenInfo = self._tokenStorage.getTokenInfo('token1')
+        self.assertEqual(self._CLIENT.id, tokenInfo['client_id'])
+        self.assertListEqual(self._VALID_SCOPE, tokenInfo['scope'])
+        self.assertEqual({'user': 'me'}, tokenInfo['additional_data'])
+        self.assertEqual(birthTime, tokenInfo['birth_time'],
+                         msg='Expected the birth time to be restored.')
+        self.assertIsNotNone(tokenInfo['expire_time'])
+        self.assertTrue(self._tokenStorage.contains('token2'),
+                        msg='Expected a token without an expire time to be restored.')
+        self.assertFalse(self._tokenStorage.contains('removedToken'),
+                         msg='Expected a removed token to not be restored.')
+        self.assertFalse(self._tokenStorage.contains('expiredToken'),
+                         msg='Expected a token overwritten with an expired token '
+                             'to not be restored.')
+
+    @inlineCallbacks
+    def testRestoreFromSnapshot(self):
+        """ Test that a snapshot truncates the change log and is restored with later changes. """
+        self._tokenStorage.store('token1', self._CLIENT, self._VALID_SCOPE)
+        self._tokenStorage.store('token2', self._CLIENT, self._VALID_SCOPE)
+        self._tokenStorage.store('expiringToken', self._CLIENT, self._VALID_SCOPE,
+                                 expireTime=time.time() + 0.1)
+        yield self._tokenStorage.snapshot()
+        self.assertTrue(os.path.exists(self._path + '.snapshot'),
+                        msg='Expected the snapshot to be written.')
+        self.assertEqual(8, os.path.getsize(self._path + '.log'),
+                         msg='Expected the change log to be truncated after the snapshot.')
+        self._tokenStorage.remove('token1')
+        self._tokenStorage.store('token3', self._CLIENT, ['scope1'])
+        time.sleep(0.15)
+        yield self._reopen()
+        self.assertFalse(self._tokenStorage.contains('token1'),
+                         msg='Expected a token removed after the snapshot to not be restored.')
+        self.assertTrue(self._tokenStorage.contains('token2'),
+                        msg='Expected the tokens in the snapshot to be restored.')
+        self.assertListEqual(['scope1'], self._tokenStorage.getTokenScope('token3'),
+                             msg='Expected a token stored after the snapshot to be restored.')
+        self.assertEqual(2, self._tokenStorage.getStatistics()['live_tokens'],
+                         msg='Expected expired tokens to not be restored.')
+
+    @inlineCallbacks
+    def testLargeScope(self):
+        """ Test that a token with a scope that is longer than 65535 bytes is restored. """
+        scope = ['scope{index}'.format(index=index) for index in range(10000)]
+        self._tokenStorage.store('token1', self._CLIENT, scope)
+        yield self._reopen()
+        self.assertListEqual(scope, self._tokenStorage.getTokenScope('token1'),
+                             msg='Expected a token with a large scope to be restored '
+                                 'from the change log.')
+        yield self._tokenStorage.snapshot()
+        yield self._reopen()
+        self.assertListEqual(scope, self._tokenStorage.getTokenScope('token1'),
+                             msg='Expected a token with a large scope to be restored '
+                                 'from the snapshot.')
+
+    @inlineCallbacks
+    def testFlushInterval(self):
+        """ Test that the changes are appended to the change log after the flush interval. """
+        yield self._tokenStorage.close()
+        self._tokenStorage = SnapshotTokenStorage(self._path, flushInterval=0.05)
+        self._tokenStorage.store('token1', self._CLIENT, self._VALID_SCOPE)
+        self.assertFalse(os.path.exists(self._path + '.log'),
+                         msg='Expected the change to not be written before the flush interval.')
+        yield task.deferLater(reactor, 0.2, lambda: None)
+        self.assertTrue(os.path.getsize(self._path + '.log') > 8,
+                        msg='Expected the change to be written after the flush interval.')
+
+    @inlineCallbacks
+    def testFlushIntervalFailure(self):
+        """ Test that a failure to append the changes after the flush interval is logged. """
+        yield self._tokenStorage.close()
+        self._tokenStorage = SnapshotTokenStorage(self._path, flushInterval=0.05)
+
+        def appendToLog(changes):
+            if changes:
+                raise IOError('Disk full')
+        self._tokenStorage._appendToLog = appendToLog
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('txOauth2')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        self._tokenStorage.store('token1', self._CLIENT, self._VALID_SCOPE)
+        yield task.deferLater(reactor, 0.2, lambda: None)
+        gc.collect()
+        self.assertEqual(1, len(records), msg='Expected the failed write to be logged.')
+        self.assertIn('Disk full', records[0].getMessage(),
+                      msg='Expected the log message to contain the error.')
+
+    @inlineCallbacks
+    def testIncompleteLogRecord(self):
+        """ Test that an incomplete record at the end of the change log is discarded. """
+        self._tokenStorage.store('token1', self._CLIENT, self._VALID_SCOPE)
+        yield self._tokenStorage.close()
+        validSize = os.path.getsize(self._path + '.log')
+        with open(self._path + '.log', 'ab') as logFile:
+            logFile.write(b'\x01\x10\x00')
+        self._tokenStorage = SnapshotTokenStorage(self._path)
+        self.assertTrue(self._tokenStorage.contains('token1'),
+                        msg='Expected the complete records to be restored.')
+        self.assertEqual(validSize, os.path.getsize(self._path + '.log'),
+                         msg='Expected the incomplete record to be removed from the change log.')
+
+    @inlineCallbacks
+    def testEmptyLog(self):
+        """ Test that a change log which is shorter than its header is treated as empty. """
+        for content in [b'', b'TXO']:
+            yield self._tokenStorage.close()
+            with open(self._path + '.log', 'wb') as logFile:
+                logFile.write(content)
+            self._tokenStorage = SnapshotTokenStorage(self._path)
+            self._tokenStorage.store('token', self._CLIENT, self._VALID_SCOPE)
+            yield self._reopen()
+            self.assertTrue(self._tokenStorage.contains('token'),
+                            msg='Expected changes after an empty change log to be restored.')
+            self._tokenStorage.remove('token')
+
+    def testCorruptedFile(self):
+        """ Test that a file which is not a change log is rejected. """
+        with open(self._path + '.log', 'wb') as logFile:
+            logFile.write(b'no token log')
+        self.assertRaises(ValueError, SnapshotTokenStorage, self._path)
@@ -1,6 +1,7 @@
 from itertools import combinations
 
 from txoauth2 import GrantTypes
+from txoauth2.imp import DictTokenStorage
 from txoauth2.token import TokenResource
 from txoauth2.errors import MissingParameterError, MultipleParameterError, InvalidTokenError, \
     InvalidScopeError, UnauthorizedClientError
@@ -234,3 +235,57 @@ class TestTokenRefresh(AbstractTokenResourceTest):
             request, result, newAuthToken, tokenResource.authTokenLifeTime,
             expectedRefreshToken=newRefreshToken, expectedScope=self._VALID_SCOPE,
             expectedAdditionalData=additionalData)
+
+    def _assertRefreshLookups(self, refreshTokenStorage, refreshToken):
+        """
+        Make a valid refresh request with the given refresh token storage.
+        :param refreshTokenStorage: The refresh token storage to use.
+        :param refreshToken: A valid refresh token stored in the refresh token storage.
+        """
+        newAuthToken = 'newAuthToken' + refreshToken
+        tokenResource = TokenResource(
+            self._TOKEN_FACTORY, self._PERSISTENT_STORAGE, refreshTokenStorage,
+            self._AUTH_TOKEN_STORAGE, self._CLIENT_STORAGE, passwordManager=self._PASSWORD_MANAGER)
+        request = self.generateValidTokenRequest(arguments={
+            'grant_type': 'refresh_token',
+            'refresh_token': refreshToken
+        }, authentication=self._VALID_CLIENT)
+        self._TOKEN_FACTORY.expectTokenRequest(
+            newAuthToken, tokenResource.authTokenLifeTime, self._VALID_CLIENT, self._VALID_SCOPE)
+        tokenResource.render_POST(request)
+        self._TOKEN_FACTORY.assertAllTokensRequested()
+        self.assertEqual(200, request.responseCode,
+                         msg='Expected the token resource to accept a valid refresh request.')
+        self.assertTrue(self._AUTH_TOKEN_STORAGE.contains(newAuthToken),
+                        msg='Expected the token storage to contain the new access token.')
+
+    def testSingleTokenInfoLookup(self):
+        """ Test that the refresh token is looked up with a single getTokenInfo call. """
+        class SingleLookupTokenStorage(DictTokenStorage):
+            lookups = []
+
+            def getTokenInfo(self, token):
+                self.lookups.append(token)
+                return super(SingleLookupTokenStorage, self).getTokenInfo(token)
+
+            def _checkExpire(self, token):
+                if token not in self.lookups:
+                    raise AssertionError('Unexpected individual lookup of the token')
+                return super(SingleLookupTokenStorage, self)._checkExpire(token)
+        refreshToken = 'singleLookupRefreshToken'
+        refreshTokenStorage = SingleLookupTokenStorage()
+        refreshTokenStorage.store(refreshToken, self._VALID_CLIENT, self._VALID_SCOPE)
+        self._assertRefreshLookups(refreshTokenStorage, refreshToken)
+        self.assertEqual([refreshToken], refreshTokenStorage.lookups,
+                         msg='Expected the token resource to look up '
+                             'the refresh token with a single call.')
+
+    def testTokenInfoNotImplemented(self):
+        """ Test the fallback to the individual lookups if getTokenInfo is not supported. """
+        class NoTokenInfoStorage(DictTokenStorage):
+            def getTokenInfo(self, token):
+                raise NotImplementedError()
+        refreshToken = 'noTokenInfoRefreshToken'
+        refreshTokenStorage = NoTokenInfoStorage()
+        refreshTokenStorage.store(refreshToken, self._VALID_CLIENT, self._VALID_SCOPE)
+        self._assertRefreshLookups(refreshTokenStorage, refreshToken)
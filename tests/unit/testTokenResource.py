@@ -8,7 +8,7 @@ from txoauth2.errors import InsecureConnectionError, UnsupportedGrantTypeError,
     MalformedRequestError, NoClientAuthenticationError, MultipleClientAuthenticationError, \
     MultipleClientCredentialsError, InvalidClientIdError, InvalidClientAuthenticationError, \
     MalformedParameterError, MultipleParameterError
-from txoauth2.imp import DictTokenStorage
+from txoauth2.imp import DictTokenStorage, BucketedTokenStorage
 from txoauth2.token import TokenResource
 
 from tests import TwistedTestCase, TestTokenFactory, getTestPasswordClient, TestClientStorage, \
@@ -151,7 +151,7 @@ class AbstractTokenResourceTest(TwistedTestCase):
                 msg='Expected the refresh token to have access to the expected scope.')
             self.assertEquals(
                 expectedAdditionalData,
-                self._REFRESH_TOKEN_STORAGE.getTokenAdditionalData(expectedAccessToken),
+                self._AUTH_TOKEN_STORAGE.getTokenAdditionalData(expectedAccessToken),
                 msg='Expected the new refresh token to have the expected additional data.')
 
     def assertFailedTokenRequest(self, request, result, expectedError, msg):
@@ -318,6 +318,38 @@ class TestTokenResource(AbstractTokenResourceTest):
         self.assertFalse(TokenResource.isValidToken('an invalid Token'),
                          msg='Expected isValidToken to accept an invalid token.')
 
+    def testRevokeTokens(self):
+        """ Test that the tokens of a client or user are revoked in both token storages. """
+        authTokenStorage = BucketedTokenStorage(getUserId=lambda data: data)
+        refreshTokenStorage = BucketedTokenStorage(getUserId=lambda data: data)
+        otherClient = getTestPasswordClient()
+        for tokenStorage in [authTokenStorage, refreshTokenStorage]:
+            for index, client, user in [(1, self._VALID_CLIENT, 'user1'),
+                                        (2, otherClient, 'user1'), (3, otherClient, 'user2')]:
+                tokenStorage.store(('authToken' if tokenStorage is authTokenStorage
+                                    else 'refreshToken') + str(index),
+                                   client, self._VALID_SCOPE, additionalData=user)
+        try:
+            tokenResource = TokenResource(
+                self._TOKEN_FACTORY, self._PERSISTENT_STORAGE, refreshTokenStorage,
+                authTokenStorage, self._CLIENT_STORAGE, passwordManager=self._PASSWORD_MANAGER)
+            self.assertListEqual(['refreshToken1', 'authToken1'], self.successResultOf(
+                tokenResource.revokeClientTokens(self._VALID_CLIENT.id)),
+                msg='Expected the refresh and access tokens of the client to be revoked.')
+            self.assertListEqual(['refreshToken2', 'authToken2'], self.successResultOf(
+                tokenResource.revokeUserTokens('user1')),
+                msg='Expected the remaining tokens of the user to be revoked.')
+            self.assertTrue(authTokenStorage.contains('authToken3'),
+                            msg='Expected the tokens of other clients and users to remain.')
+            self.assertTrue(refreshTokenStorage.contains('refreshToken3'),
+                            msg='Expected the tokens of other clients and users to remain.')
+            self.failureResultOf(TokenResource(
+                self._TOKEN_FACTORY, self._PERSISTENT_STORAGE, DictTokenStorage(),
+                authTokenStorage, self._CLIENT_STORAGE, passwordManager=self._PASSWORD_MANAGER)
+                .revokeUserTokens('user2'), NotImplementedError)
+        finally:
+            setattr(TokenResource, '_OAuthTokenStorage', self._AUTH_TOKEN_STORAGE)
+
     def testUnsupportedGrantType(self):
         """ Test the rejection of a request with an unsupported grant type. """
         grantType = 'someGrantTypeThatIsNotSupported'
@@ -0,0 +1,172 @@
+import json
+
+from twisted.internet.defer import Deferred
+from twisted.web.server import NOT_DONE_YET
+
+from txoauth2.errors import InvalidTokenError, ServerError
+from txoauth2.imp import DictTokenStorage
+from txoauth2.token import TokenResource
+
+from tests import TwistedTestCase, TestTokenFactory, getTestPasswordClient, TestClientStorage, \
+    TestPasswordManager, TestPersistentStorage, DeferredWrapper, flushDeferredWrappers
+from tests.unit.testTokenResource import AbstractTokenResourceTest
+
+
+class TestTokenResourceDeferred(TwistedTestCase):
+    """ Test the token resource with storages, factories and managers that return Deferreds. """
+    _VALID_REFRESH_TOKEN = 'deferredRefreshToken'
+    _VALID_SCOPE = ['All', 'scope']
+    _VALID_CLIENT = getTestPasswordClient()
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestTokenResourceDeferred, cls).setUpClass()
+        cls._AUTH_TOKEN_STORAGE = DictTokenStorage()
+        cls._REFRESH_TOKEN_STORAGE = DictTokenStorage()
+        cls._TOKEN_FACTORY = TestTokenFactory()
+        cls._PERSISTENT_STORAGE = TestPersistentStorage()
+        cls._CLIENT_STORAGE = TestClientStorage()
+        cls._PASSWORD_MANAGER = TestPasswordManager()
+        cls._REFRESH_TOKEN_STORAGE.store(
+            cls._VALID_REFRESH_TOKEN, cls._VALID_CLIENT, cls._VALID_SCOPE)
+        cls._CLIENT_STORAGE.addClient(cls._VALID_CLIENT)
+        cls._WRAPPERS = [DeferredWrapper(wrapped) for wrapped in [
+            cls._TOKEN_FACTORY, cls._PERSISTENT_STORAGE, cls._REFRESH_TOKEN_STORAGE,
+            cls._AUTH_TOKEN_STORAGE, cls._CLIENT_STORAGE, cls._PASSWORD_MANAGER]]
+        tokenFactory, persistentStorage, refreshTokenStorage, authTokenStorage, clientStorage,\
+            passwordManager = cls._WRAPPERS
+        cls._TOKEN_RESOURCE = TokenResource(
+            tokenFactory, persistentStorage, refreshTokenStorage, authTokenStorage,
+            clientStorage, passwordManager=passwordManager)
+
+    @classmethod
+    def tearDownClass(cls):
+        setattr(TokenResource, '_OAuthTokenStorage', None)
+
+    def setUp(self):
+        self._TOKEN_FACTORY.reset(self)
+
+    def _render(self, request):
+        """
+        Render the request and flush all wrapped storages.
+        :param request: The request to the token resource.
+        :return: The json response of the token resource.
+        """
+        result = self._TOKEN_RESOURCE.render_POST(request)
+        self.assertEqual(NOT_DONE_YET, result,
+                         msg='Expected the token resource to return NOT_DONE_YET '
+                             'while waiting for the storages.')
+        self.assertFalse(request.finished, msg='Expected the token resource to not finish '
+                                               'the request before the storages returned.')
+        flushDeferredWrappers(*self._WRAPPERS)
+        self.assertTrue(request.finished, msg='Expected the token resource to finish '
+                                              'the request after the storages returned.')
+        return json.loads(request.getResponse().decode('utf-8'))
+
+    def testClientCredentialsGrant(self):
+        """ Test that a client credentials request is processed asynchronously. """
+        accessToken = 'deferredClientCredentialsAccessToken'
+        request = AbstractTokenResourceTest.generateValidTokenRequest(arguments={
+            'grant_type': 'client_credentials',
+            'scope': ' '.join(self._VALID_SCOPE),
+        }, authentication=self._VALID_CLIENT)
+        self._TOKEN_FACTORY.expectTokenRequest(accessToken, self._TOKEN_RESOURCE.authTokenLifeTime,
+                                               self._VALID_CLIENT, self._VALID_SCOPE)
+        response = self._render(request)
+        self._TOKEN_FACTORY.assertAllTokensRequested()
+        self.assertEqual(200, request.responseCode)
+        self.assertEqual(accessToken, response['access_token'],
+                         msg='The token resource returned a different access token than expected.')
+        self.assertTrue(self._AUTH_TOKEN_STORAGE.contains(accessToken),
+                        msg='Expected the token storage to contain the new access token.')
+
+    def testRefreshTokenGrant(self):
+        """ Test that a refresh token request is processed asynchronously. """
+        accessToken = 'deferredRefreshAccessToken'
+        request = AbstractTokenResourceTest.generateValidTokenRequest(arguments={
+            'grant_type': 'refresh_token',
+            'refresh_token': self._VALID_REFRESH_TOKEN
+        }, authentication=self._VALID_CLIENT)
+        self._TOKEN_FACTORY.expectTokenRequest(accessToken, self._TOKEN_RESOURCE.authTokenLifeTime,
+                                               self._VALID_CLIENT, self._VALID_SCOPE)
+        response = self._render(request)
+        self._TOKEN_FACTORY.assertAllTokensRequested()
+        self.assertEqual(200, request.responseCode)
+        self.assertEqual(accessToken, response['access_token'],
+                         msg='The token resource returned a different access token than expected.')
+        self.assertEqual(' '.join(self._VALID_SCOPE), response['scope'],
+                         msg='The token resource returned a different scope than expected.')
+
+    def testAuthorizationCodeGrant(self):
+        """ Test that an authorization code request is processed asynchronously. """
+        code = 'deferredAuthorizationCode'
+        accessToken = 'deferredAuthorizationCodeAccessToken'
+        refreshToken = 'deferredAuthorizationCodeRefreshToken'
+        self._PERSISTENT_STORAGE.put('code' + code, {
+            'client_id': self._VALID_CLIENT.id,
+            'redirect_uri': None,
+            'additional_data': None,
+            'scope': self._VALID_SCOPE
+        })
+        request = AbstractTokenResourceTest.generateValidTokenRequest(arguments={
+            'grant_type': 'authorization_code',
+            'code': code,
+        }, authentication=self._VALID_CLIENT)
+        self._TOKEN_FACTORY.expectTokenRequest(accessToken, self._TOKEN_RESOURCE.authTokenLifeTime,
+                                               self._VALID_CLIENT, self._VALID_SCOPE)
+        self._TOKEN_FACTORY.expectTokenRequest(refreshToken, None,
+                                               self._VALID_CLIENT, self._VALID_SCOPE)
+        response = self._render(request)
+        self._TOKEN_FACTORY.assertAllTokensRequested()
+        self.assertEqual(200, request.responseCode)
+        self.assertEqual(accessToken, response['access_token'],
+                         msg='The token resource returned a different access token than expected.')
+        self.assertEqual(refreshToken, response['refresh_token'],
+                         msg='The token resource returned a different refresh token than expected.')
+        self.assertTrue(self._REFRESH_TOKEN_STORAGE.contains(refreshToken),
+                        msg='Expected the refresh token storage to contain the new refresh token.')
+
+    def testInvalidPassword(self):
+        """ Test that an invalid password is rejected asynchronously. """
+        request = AbstractTokenResourceTest.generateValidTokenRequest(arguments={
+            'grant_type': 'password',
+            'username': b'someUser',
+            'password': b'somePassword',
+            'scope': ' '.join(self._VALID_SCOPE),
+        }, authentication=self._VALID_CLIENT)
+        self._PASSWORD_MANAGER.expectAuthenticateRequest(
+            b'someUser', TestPasswordManager.INVALID_PASSWORD)
+        response = self._render(request)
+        expectedError = InvalidTokenError('username or password')
+        self.assertEqual(expectedError.code, request.responseCode)
+        self.assertEqual(expectedError.message, response['error'],
+                         msg='Expected the token resource to reject an invalid password.')
+        self.assertTrue(self._PASSWORD_MANAGER.allPasswordsChecked(),
+                        msg='Expected the token resource to check the password.')
+
+    def testStorageFailure(self):
+        """ Test that an asynchronous failure of a storage results in a server error. """
+        getClientResult = Deferred()
+
+        class FailingClientStorage(TestClientStorage):
+            def getClient(self, clientId):
+                del clientId  # Unused
+                return getClientResult
+        tokenResource = TokenResource(
+            self._TOKEN_FACTORY, self._PERSISTENT_STORAGE, self._REFRESH_TOKEN_STORAGE,
+            self._AUTH_TOKEN_STORAGE, FailingClientStorage(),
+            passwordManager=self._PASSWORD_MANAGER)
+        request = AbstractTokenResourceTest.generateValidTokenRequest(arguments={
+            'grant_type': 'client_credentials',
+            'scope': ' '.join(self._VALID_SCOPE),
+        }, authentication=self._VALID_CLIENT)
+        self.assertEqual(NOT_DONE_YET, tokenResource.render_POST(request),
+                         msg='Expected the token resource to return NOT_DONE_YET '
+                             'while waiting for the client storage.')
+        getClientResult.errback(RuntimeError('Client storage is unavailable'))
+        self.assertTrue(request.finished, msg='Expected the token resource to finish '
+                                              'the request after the client storage failed.')
+        response = json.loads(request.getResponse().decode('utf-8'))
+        self.assertEqual(ServerError().code, request.responseCode)
+        self.assertEqual(ServerError().message, response['error'],
+                         msg='Expected the token resource to respond with a server error.')
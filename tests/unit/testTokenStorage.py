@@ -1,6 +1,13 @@
+import os
 import time
+import tempfile
 
-from txoauth2.imp import DictTokenStorage
+from twisted.internet.task import Clock
+
+from txoauth2.imp import DictTokenStorage, BucketedTokenStorage, BloomFilterTokenStorage, \
+    CachingTokenStorage, SnapshotTokenStorage, WriteBehindTokenStorage
+from txoauth2.scope import ScopeRegistry
+from txoauth2.token import TokenAccess
 
 from tests import TwistedTestCase, getTestPasswordClient
 
@@ -60,6 +67,33 @@ class AbstractTokenStorageTest(TwistedTestCase):
         self.assertRaises(KeyError, self._TOKEN_STORAGE.hasAccess,
                           'invalidToken', self._VALID_SCOPE)
 
+    def testCheckAccess(self):
+        """ Test that checkAccess reports the correct access state for a token and scope. """
+        try:
+            access = self._TOKEN_STORAGE.checkAccess(self._VALID_TOKEN, self._VALID_SCOPE)
+        except NotImplementedError:
+            return
+        self.assertEquals(TokenAccess.Granted, access,
+                          msg='Expected checkAccess to grant access for a valid token and scope.')
+        self.assertEquals(
+            TokenAccess.Granted,
+            self._TOKEN_STORAGE.checkAccess(self._VALID_TOKEN, self._VALID_SCOPE[0:1]),
+            msg='Expected checkAccess to grant access for a subset of the valid scopes.')
+        self.assertEquals(
+            TokenAccess.InsufficientScope,
+            self._TOKEN_STORAGE.checkAccess(self._VALID_TOKEN, self._VALID_SCOPE + ['invalid']),
+            msg='Expected checkAccess to report an insufficient scope for an invalid scope.')
+        self.assertEquals(
+            TokenAccess.Invalid, self._TOKEN_STORAGE.checkAccess('invalidToken', self._VALID_SCOPE),
+            msg='Expected checkAccess to report an invalid token for an unknown token.')
+        token = 'checkAccessExpiredToken'
+        self._TOKEN_STORAGE.store(token, self._DUMMY_CLIENT, self._VALID_SCOPE,
+                                  expireTime=time.time() + 0.1)
+        time.sleep(0.2)
+        self.assertEquals(
+            TokenAccess.Invalid, self._TOKEN_STORAGE.checkAccess(token, self._VALID_SCOPE),
+            msg='Expected checkAccess to report an invalid token for an expired token.')
+
     def testTokenClient(self):
         """ Test that the token storage returns the correct client id for a token. """
         self.assertEquals(
@@ -98,6 +132,29 @@ class AbstractTokenStorageTest(TwistedTestCase):
                               'that was stored with the token.')
         self.assertRaises(KeyError, self._TOKEN_STORAGE.getTokenAdditionalData, 'invalidToken')
 
+    def testGetTokenInfo(self):
+        """ Test that the token storage returns all information about a token in one call. """
+        token = 'tokenInfoToken'
+        expireTime = int(time.time()) + 600
+        self._TOKEN_STORAGE.store(token, self._DUMMY_CLIENT, self._VALID_SCOPE,
+                                  additionalData=self._VALID_ADDITIONAL_DATA, expireTime=expireTime)
+        try:
+            tokenInfo = self._TOKEN_STORAGE.getTokenInfo(token)
+        except NotImplementedError:
+            return
+        self.assertListEqual(self._VALID_SCOPE, tokenInfo['scope'],
+                             msg='Expected getTokenInfo to return the scope given to store.')
+        self.assertEquals(self._DUMMY_CLIENT.id, tokenInfo['client_id'],
+                          msg='Expected getTokenInfo to return the client id given to store.')
+        self.assertEquals(self._VALID_ADDITIONAL_DATA, tokenInfo['additional_data'],
+                          msg='Expected getTokenInfo to return the additional data given to store.')
+        self.assertEquals(expireTime, tokenInfo['expire_time'],
+                          msg='Expected getTokenInfo to return the expire time given to store.')
+        self.assertEquals(self._TOKEN_STORAGE.getTokenLifetime(token),
+                          int(time.time()) - tokenInfo['birth_time'],
+                          msg='Expected getTokenInfo to return the birth time of the token.')
+        self.assertRaises(KeyError, self._TOKEN_STORAGE.getTokenInfo, 'invalidToken')
+
     def testGetTokenLifetime(self):
         """ Test that the token storage correctly reports the lifetime of a token """
         token = 'lifetimeToken'
@@ -220,6 +277,10 @@ class AbstractTokenStorageTest(TwistedTestCase):
         self.assertRaises(KeyError, self._TOKEN_STORAGE.getTokenClient, expireTokens[2])
         self.assertRaises(KeyError, self._TOKEN_STORAGE.getTokenScope, expireTokens[2])
         self.assertRaises(KeyError, self._TOKEN_STORAGE.getTokenLifetime, expireTokens[2])
+        try:
+            self.assertRaises(KeyError, self._TOKEN_STORAGE.getTokenInfo, expireTokens[2])
+        except NotImplementedError:
+            pass
         self.assertTrue(
             self._TOKEN_STORAGE.contains(noExpireToken),
             msg='Expected the token storage to contain the token that will never expire.')
@@ -236,3 +297,160 @@ class DictTokenStorageTest(AbstractTokenStorageTest):
     @classmethod
     def setUpClass(cls):
         cls.setupTokenStorage(DictTokenStorage())
+
+    def testInternedValuesAreReleased(self):
+        """ Test that the interned client ids and scopes are only kept for stored tokens. """
+        tokenStorage = DictTokenStorage()
+        otherTokenStorage = DictTokenStorage()
+        for index in range(10):
+            tokenStorage.store('token' + str(index), self._DUMMY_CLIENT, ['scope' + str(index)])
+        tokenStorage.store('sharedToken', self._DUMMY_CLIENT, ['scope0'])
+        self.assertIs(tokenStorage.getTokenInfo('token0')['client_id'],
+                      tokenStorage.getTokenInfo('sharedToken')['client_id'],
+                      msg='Expected tokens of the same client to share the client id.')
+        self.assertFalse(otherTokenStorage.contains('token0'),
+                         msg='Expected token storages to not share their tokens.')
+        # noinspection PyProtectedMember
+        scopes = tokenStorage._scopes  # pylint: disable=protected-access
+        self.assertEqual(10, len(scopes))
+        for index in range(10):
+            tokenStorage.remove('token' + str(index))
+        self.assertEqual(1, len(scopes),
+                         msg='Expected the scopes of removed tokens to be released.')
+        tokenStorage.remove('sharedToken')
+        self.assertEqual(0, len(scopes),
+                         msg='Expected the scopes of removed tokens to be released.')
+
+
+class ScopeRegistryDictTokenStorageTest(AbstractTokenStorageTest):
+    """ Test the DictTokenStorage with a scope registry. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTokenStorage(DictTokenStorage(
+            scopeRegistry=ScopeRegistry(cls._VALID_SCOPE, frozen=True)))
+
+    def testUnregisteredScope(self):
+        """ Test that scopes with unregistered names are stored without registering them. """
+        scopeRegistry = ScopeRegistry(self._VALID_SCOPE)
+        tokenStorage = DictTokenStorage(scopeRegistry=scopeRegistry)
+        tokenStorage.store('token', self._DUMMY_CLIENT, ['All', 'unknown'])
+        self.assertIsNone(scopeRegistry.lookupMask(['unknown']),
+                          msg='Expected the token storage to not register scope names.')
+        self.assertListEqual(['All', 'unknown'], tokenStorage.getTokenScope('token'))
+        self.assertTrue(tokenStorage.hasAccess('token', ['unknown']))
+        self.assertEqual(TokenAccess.InsufficientScope,
+                         tokenStorage.checkAccess('token', ['Scope1']))
+        self.assertEqual(TokenAccess.Granted, tokenStorage.checkAccess('token', ['All']))
+        tokenStorage.store('token', self._DUMMY_CLIENT, ['All'])
+        self.assertFalse(tokenStorage.hasAccess('token', ['unknown']))
+
+
+class BloomFilterTokenStorageTest(AbstractTokenStorageTest):
+    """ Test the BloomFilterTokenStorage. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTokenStorage(BloomFilterTokenStorage(
+            BucketedTokenStorage(), capacity=100, generationLifetime=0.5))
+
+
+class CachingTokenStorageTest(AbstractTokenStorageTest):
+    """ Test the CachingTokenStorage. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTokenStorage(CachingTokenStorage(BucketedTokenStorage(), maxSize=5))
+
+
+class SnapshotTokenStorageTest(AbstractTokenStorageTest):
+    """
+    Test the SnapshotTokenStorage. The changes are never written to the disk,
+    because the clock is not advanced.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTokenStorage(SnapshotTokenStorage(
+            os.path.join(tempfile.gettempdir(), 'unusedTokens'), reactor=Clock()))
+
+
+class WriteBehindTokenStorageTest(AbstractTokenStorageTest):
+    """
+    Test the WriteBehindTokenStorage. Tokens are only written when a batch is full,
+    because the clock is not advanced, so most lookups are answered from the staging area.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTokenStorage(WriteBehindTokenStorage(
+            BucketedTokenStorage(), maxBatchSize=3, reactor=Clock()))
+
+
+class BucketedTokenStorageTest(AbstractTokenStorageTest):
+    """ Test the BucketedTokenStorage. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTokenStorage(BucketedTokenStorage(bucketSize=0.5))
+
+    def testRemoveByClientAndUser(self):
+        """ Test that all tokens of a client or a user can be removed. """
+        tokenStorage = BucketedTokenStorage(getUserId=lambda data: data['user'])
+        otherClient = getTestPasswordClient()
+        for token, client, user in [('token1', self._DUMMY_CLIENT, 'user1'),
+                                    ('token2', self._DUMMY_CLIENT, 'user2'),
+                                    ('token3', otherClient, 'user1'),
+                                    ('token4', otherClient, 'user2')]:
+            tokenStorage.store(token, client, self._VALID_SCOPE, {'user': user},
+                               expireTime=time.time() + 60)
+        tokenStorage.store('token2', otherClient, self._VALID_SCOPE, {'user': 'user2'})
+        self.assertListEqual(['token1'], tokenStorage.removeByClient(self._DUMMY_CLIENT.id),
+                             msg='Expected removeByClient to remove the tokens of the client.')
+        self.assertListEqual(['token2', 'token4'], sorted(tokenStorage.removeByUser('user2')),
+                             msg='Expected removeByUser to remove the tokens of the user.')
+        self.assertTrue(tokenStorage.contains('token3'),
+                        msg='Expected the tokens of other clients and users to remain.')
+        self.assertListEqual([], tokenStorage.removeByClient(self._DUMMY_CLIENT.id))
+        self.assertRaises(NotImplementedError, BucketedTokenStorage().removeByUser, 'user1')
+
+    def testBucketEviction(self):
+        """ Test that expired tokens are removed even if they are never accessed again. """
+        tokenStorage = BucketedTokenStorage(bucketSize=0.1)
+        for index in range(10):
+            tokenStorage.store('evictToken' + str(index), self._DUMMY_CLIENT, self._VALID_SCOPE,
+                               expireTime=time.time() + 0.1)
+        tokenStorage.store('lookupToken', self._DUMMY_CLIENT, self._VALID_SCOPE,
+                           expireTime=time.time() + 0.1)
+        tokenStorage.store('liveToken', self._DUMMY_CLIENT, self._VALID_SCOPE)
+        self.assertEquals(12, tokenStorage.getStatistics()['live_tokens'],
+                          msg='Expected the token storage to contain all stored tokens.')
+        time.sleep(0.35)
+        self.assertTrue(tokenStorage.contains('liveToken'),
+                        msg='Expected the token storage to contain the token that never expires.')
+        self.assertDictEqual({
+            'live_tokens': 1,
+            'expired_tokens': 0,
+            'evicted_tokens': 11
+        }, tokenStorage.getStatistics(), msg='Expected a lookup to drop the bucket '
+                                             'with the expired tokens.')
+        self.assertFalse(tokenStorage.contains('lookupToken'),
+                         msg='Expected the token storage to not contain an expired token.')
+
+    def testOverwriteWithExpiredToken(self):
+        """ Test that storing a token again with a past expire time removes the old token. """
+        tokenStorage = BucketedTokenStorage(bucketSize=0.1)
+        tokenStorage.store('token', self._DUMMY_CLIENT, self._VALID_SCOPE,
+                           expireTime=time.time() + 0.1)
+        tokenStorage.store('token', self._DUMMY_CLIENT, self._VALID_SCOPE,
+                           expireTime=time.time() - 1)
+        self.assertFalse(tokenStorage.contains('token'),
+                         msg='Expected the token storage to remove the overwritten token.')
+        time.sleep(0.25)
+        tokenStorage.store('otherToken', self._DUMMY_CLIENT, self._VALID_SCOPE)
+        self.assertRaises(KeyError, tokenStorage.remove, 'token')
+        self.assertDictEqual({
+            'live_tokens': 1,
+            'expired_tokens': 0,
+            'evicted_tokens': 0
+        }, tokenStorage.getStatistics())
@@ -0,0 +1,56 @@
+import threading
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, gatherResults
+
+from txoauth2.storage.worker import WorkerThreads
+
+from tests import TwistedTestCase
+
+
+class TestWorkerThreads(TwistedTestCase):
+    """ Test the WorkerThreads of the storages. """
+
+    @inlineCallbacks
+    def testRunInOrder(self):
+        """ Test that a single worker thread runs the functions in order. """
+        workerThreads = WorkerThreads('txoauth2-test', reactor=reactor)
+        self.assertFalse(workerThreads.isRunning,
+                         msg='Expected the thread to only be started when it is used.')
+        results = []
+        yield gatherResults([workerThreads.run(results.append, index) for index in range(20)])
+        self.assertTrue(workerThreads.isRunning, msg='Expected the thread to be started.')
+        self.assertListEqual(list(range(20)), results)
+        threadName = yield workerThreads.run(lambda: threading.current_thread().name)
+        self.assertNotEqual(threading.current_thread().name, threadName,
+                            msg='Expected the function to run in the worker thread.')
+        self.assertEqual('closed', (yield workerThreads.stop(lambda: 'closed')),
+                         msg='Expected stop to return the result of the last function.')
+        self.assertFalse(workerThreads.isRunning, msg='Expected the thread to be stopped.')
+
+    @inlineCallbacks
+    def testShutdownTrigger(self):
+        """ Test that the shutdown trigger is only registered while the threads are running. """
+        triggers = []
+
+        class TriggerReactor(object):
+            def addSystemEventTrigger(self, phase, eventType, function):
+                triggers.append((phase, eventType, function))
+                return len(triggers)
+
+            def removeSystemEventTrigger(self, triggerId):
+                triggers[triggerId - 1] = None
+
+            def __getattr__(self, name):
+                return getattr(reactor, name)
+
+        def onShutdown():
+            pass
+        workerThreads = WorkerThreads('txoauth2-test', onShutdown=onShutdown,
+                                      reactor=TriggerReactor())
+        self.assertListEqual([], triggers)
+        yield workerThreads.run(lambda: None)
+        self.assertListEqual([('during', 'shutdown', onShutdown)], triggers)
+        yield workerThreads.stop()
+        self.assertListEqual([None], triggers,
+                             msg='Expected the shutdown trigger to be removed on stop.')
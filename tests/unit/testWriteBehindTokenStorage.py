@@ -0,0 +1,198 @@
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.task import Clock
+
+from txoauth2.imp import WriteBehindTokenStorage, BucketedTokenStorage
+from txoauth2.token import TokenAccess
+
+from tests import TwistedTestCase, getTestPasswordClient, DeferredWrapper
+
+
+class TestWriteBehindTokenStorage(TwistedTestCase):
+    """ Test that the WriteBehindTokenStorage writes the stored tokens in batches. """
+    _CLIENT = getTestPasswordClient()
+
+    def setUp(self):
+        super(TestWriteBehindTokenStorage, self).setUp()
+        self._clock = Clock()
+        self._backend = DeferredWrapper(BucketedTokenStorage())
+        self._tokenStorage = WriteBehindTokenStorage(
+            self._backend, maxBatchSize=3, flushInterval=1, maxStagedTokens=5, reactor=self._clock)
+
+    def testStagedLookup(self):
+        """ Test that staged tokens are visible before they are written. """
+        self.assertIsNone(self._tokenStorage.store('token', self._CLIENT, ['All'], {'a': 1}),
+                          msg='Expected store to acknowledge the token immediately.')
+        self.assertFalse(self._backend.hasPendingCalls(),
+                         msg='Expected the token to not be written immediately.')
+        self.assertTrue(self._tokenStorage.contains('token'),
+                        msg='Expected contains to return True for a staged token.')
+        self.assertEqual(TokenAccess.Granted, self._tokenStorage.checkAccess('token', ['All']))
+        self.assertEqual(TokenAccess.InsufficientScope,
+                         self._tokenStorage.checkAccess('token', ['admin']))
+        self.assertEqual({'a': 1}, self._tokenStorage.getTokenInfo('token')['additional_data'])
+        self.assertEqual(self._CLIENT.id, self._tokenStorage.getTokenClient('token'))
+
+    def testFlushTriggers(self):
+        """ Test that the tokens are written when the batch is full or the interval passed. """
+        for index in range(3):
+            self._tokenStorage.store('token' + str(index), self._CLIENT, ['All'])
+        self.assertTrue(self._backend.hasPendingCalls(),
+                        msg='Expected a full batch to be written immediately.')
+        self._backend.flush()
+        self._tokenStorage.store('token3', self._CLIENT, ['All'])
+        self.assertFalse(self._backend.hasPendingCalls(),
+                         msg='Expected a partial batch to wait for the flush interval.')
+        self._clock.advance(1)
+        self._backend.flush()
+        statistics = self._tokenStorage.getStatistics()
+        self.assertEqual(2, statistics['batches'])
+        self.assertEqual(4, statistics['written_tokens'])
+        self.assertEqual(0, statistics['staged_tokens'])
+        for index in range(4):
+            result = self._tokenStorage.contains('token' + str(index))
+            self._backend.flush()
+            self.assertTrue(self.successResultOf(result),
+                            msg='Expected the written tokens to be in the wrapped storage.')
+
+    def testBackpressure(self):
+        """ Test that tokens are written through if the staging area is full. """
+        self._tokenStorage = WriteBehindTokenStorage(
+            self._backend, maxBatchSize=10, maxStagedTokens=2, reactor=self._clock)
+        self._tokenStorage.store('token1', self._CLIENT, ['All'])
+        self._tokenStorage.store('token2', self._CLIENT, ['All'])
+        result = self._tokenStorage.store('token3', self._CLIENT, ['All'])
+        self.assertIsInstance(result, Deferred, 'Expected store to return the result of '
+                                                'the wrapped storage if the staging area is full.')
+        self._backend.flush()
+        self.successResultOf(result)
+        self.assertEqual(1, self._tokenStorage.getStatistics()['write_throughs'])
+
+    def testRemove(self):
+        """ Test that staged tokens can be removed before and while they are written. """
+        self._tokenStorage.store('stagedToken', self._CLIENT, ['All'])
+        result = self._tokenStorage.remove('stagedToken')
+        self._backend.flush()
+        self.successResultOf(result)
+        result = self._tokenStorage.contains('stagedToken')
+        self._backend.flush()
+        self.assertFalse(self.successResultOf(result),
+                         msg='Expected a removed staged token to never be written.')
+        self._tokenStorage.store('writingToken', self._CLIENT, ['All'])
+        flushResult = self._tokenStorage.flush()
+        result = self._tokenStorage.remove('writingToken')
+        self._backend.flush()
+        self.successResultOf(flushResult)
+        self._backend.flush()
+        self.successResultOf(result)
+        result = self._tokenStorage.contains('writingToken')
+        self._backend.flush()
+        self.assertFalse(self.successResultOf(result),
+                         msg='Expected a token removed while it was written to be removed.')
+
+    def testRemoveByClient(self):
+        """ Test that staged tokens are written before the tokens of a client are removed. """
+        self._tokenStorage.store('token', self._CLIENT, ['All'])
+        result = self._tokenStorage.removeByClient(self._CLIENT.id)
+        self._backend.flush()
+        self._backend.flush()
+        self.assertListEqual(['token'], self.successResultOf(result))
+
+    def testRemoveForwardsToBackend(self):
+        """ Test that removing a staged token also removes an older version from the backend. """
+        self._tokenStorage.store('token', self._CLIENT, ['All'])
+        self.successResultOf(self._flush())
+        self._tokenStorage.store('token', self._CLIENT, ['admin'])
+        result = self._tokenStorage.remove('token')
+        self._backend.flush()
+        self.successResultOf(result)
+        result = self._tokenStorage.contains('token')
+        self._backend.flush()
+        self.assertFalse(self.successResultOf(result),
+                         msg='Expected the older version of the token to be removed.')
+
+    def testFailedWrite(self):
+        """ Test that tokens whose write failed stay staged and are written again. """
+        failures = [0]
+        store = self._backend.store
+
+        def failingStore(*args, **kwargs):
+            if failures[0] > 0:
+                failures[0] -= 1
+                return fail(IOError('Backend unavailable'))
+            return store(*args, **kwargs)
+        self._backend.store = failingStore
+        self._tokenStorage.store('token', self._CLIENT, ['All'])
+        failures[0] = 1
+        self.failureResultOf(self._tokenStorage.flush(), IOError)
+        statistics = self._tokenStorage.getStatistics()
+        self.assertEqual(1, statistics['failed_writes'])
+        self.assertEqual(1, statistics['staged_tokens'],
+                         msg='Expected the token to stay staged after a failed write.')
+        self.assertTrue(self._tokenStorage.contains('token'),
+                        msg='Expected the token to stay visible after a failed write.')
+        self._clock.advance(1)
+        self._backend.flush()
+        self.assertEqual(1, self._tokenStorage.getStatistics()['written_tokens'],
+                         msg='Expected the token to be written again after the retry interval.')
+        self._tokenStorage.store('otherToken', self._CLIENT, ['All'])
+        failures[0] = 1
+        self.failureResultOf(self._tokenStorage.close(), IOError)
+        self.assertEqual([], self._clock.getDelayedCalls(),
+                         msg='Expected close to not schedule a retry.')
+
+    def testFailedWriteOfOlderVersion(self):
+        """
+        Test that a failed write is not written again if the token
+        was stored again or removed while it was written.
+        """
+        backend = BucketedTokenStorage()
+        self._backend = DeferredWrapper(backend)
+        self._tokenStorage = WriteBehindTokenStorage(self._backend, reactor=self._clock)
+        store = backend.store
+        storedScopes = []
+
+        def failingStore(token, client, scope, **kwargs):
+            storedScopes.append(scope)
+            if scope == ['old']:
+                raise IOError('Backend unavailable')
+            return store(token, client, scope, **kwargs)
+        backend.store = failingStore
+        self._tokenStorage.store('token', self._CLIENT, ['old'])
+        flushResult = self._tokenStorage.flush()
+        self._tokenStorage.store('token', self._CLIENT, ['new'])
+        newFlushResult = self._tokenStorage.flush()
+        self._backend.flush()
+        self.failureResultOf(flushResult, IOError)
+        self.assertEqual([['old']], storedScopes,
+                         msg='Expected the newer version to wait for the older write.')
+        self._backend.flush()
+        self.successResultOf(newFlushResult)
+        self.assertEqual([['old'], ['new']], storedScopes,
+                         msg='Expected only the newer version to be written after the failure.')
+        self.assertEqual(['new'], backend.getTokenScope('token'))
+        self._clock.advance(1)
+        self.assertFalse(self._backend.hasPendingCalls(),
+                         msg='Expected the older version to not be written again.')
+        self._tokenStorage.store('removedToken', self._CLIENT, ['old'])
+        flushResult = self._tokenStorage.flush()
+        removeResults = [self._tokenStorage.remove('removedToken')]
+        self._tokenStorage.store('removedToken', self._CLIENT, ['new'])
+        removeResults.append(self._tokenStorage.remove('removedToken'))
+        self._backend.flush()
+        self.failureResultOf(flushResult, IOError)
+        self._backend.flush()
+        for removeResult in removeResults:
+            self.successResultOf(removeResult)
+        self._clock.advance(1)
+        self.assertFalse(self._backend.hasPendingCalls(),
+                         msg='Expected a removed token to not be written again.')
+        self.assertFalse(backend.contains('removedToken'))
+        self.assertEqual(0, self._tokenStorage.getStatistics()['staged_tokens'])
+
+    def _flush(self):
+        """
+        :return: The result of flushing the token storage and the wrapped storage.
+        """
+        result = self._tokenStorage.flush()
+        self._backend.flush()
+        return result
@@ -2,7 +2,8 @@
 # See LICENSE for details.
 from enum import Enum
 
-__all__ = ['isAuthorized', 'oauth2', 'clients', 'errors', 'imp', 'resource', 'token', 'GrantTypes']
+__all__ = ['isAuthorized', 'oauth2', 'clients', 'errors', 'imp', 'keyring', 'resource', 'scope',
+           'storage', 'token', 'GrantTypes']
 
 
 class GrantTypes(Enum):
@@ -1,5 +1,7 @@
 # Copyright (c) Sebastian Scholz
 # See LICENSE for details.
+import logging
+
 from functools import wraps
 try:
     from urlparse import urlparse, parse_qs
@@ -7,11 +9,13 @@ except ImportError:
     # noinspection PyUnresolvedReferences
     from urllib.parse import urlparse, parse_qs
 
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
 from twisted.web.server import NOT_DONE_YET
 
 from txoauth2.errors import MissingTokenError, InvalidTokenRequestError, InsecureConnectionError, \
-    InsufficientScopeRequestError, MultipleTokensError
-from txoauth2.token import TokenResource
+    InsufficientScopeRequestError, MultipleTokensError, ServerError
+from txoauth2.token import TokenResource, TokenAccess, checkAccess
+from txoauth2.util import getDeferredResult, renderDeferred
 
 
 def _getToken(request):
@@ -50,41 +54,73 @@ def isAuthorized(request, scope, allowInsecureRequestDebug=False):
     protocol, False is returned, an error is written to the request
     and the request is closed.
     You can not write to the request if this function returned False!
+
+    The methods of the token storage may return Deferreds. If one of them does not
+    return its result immediately, a Deferred is returned which fires with True or False
+    once the token has been validated. If the token storage fails asynchronously,
+    a server error is written to the request and the Deferred fires with False.
     :param request: The request.
     :param scope: The scope or list of scopes the token must grant access to.
     :param allowInsecureRequestDebug: Allow requests to originate from
            insecure connections. Only use for local testing!
-    :return: True, if the request is authorized, False otherwise.
+    :return: True, if the request is authorized, False otherwise,
+             or a Deferred that will fire with one of these values.
     """
-    error = None
     scope = scope if type(scope) == list else [scope]
+    result = _validateRequest(request, scope, allowInsecureRequestDebug)
+    result = getDeferredResult(result)
+    connectionLost = []
+
+    def handleResult(error):
+        if error is None:
+            return not connectionLost
+        if not connectionLost:
+            request.write(error.generate(request))
+            request.finish()
+        return False
+
+    def handleFailure(failure):
+        logging.getLogger('txOauth2').error(
+            'Caught exception while validating a token: ' + str(failure.value),
+            exc_info=(failure.type, failure.value, failure.getTracebackObject()))
+        return handleResult(ServerError())
+
+    if isinstance(result, Deferred):
+        request.notifyFinish().addErrback(connectionLost.append)
+        return result.addCallbacks(handleResult, handleFailure)
+    return handleResult(result)
+
+
+@inlineCallbacks
+def _validateRequest(request, scope, allowInsecureRequestDebug):
+    """
+    Validate the token in the request.
+    :param request: The request.
+    :param scope: The list of scopes the token must grant access to.
+    :param allowInsecureRequestDebug: Allow requests to originate from insecure connections.
+    :return: A Deferred which fires with None, if the request is authorized,
+             or with the error that should be send as a response otherwise.
+    """
     if not (allowInsecureRequestDebug or request.isSecure()):
-        error = InsecureConnectionError()
+        returnValue(InsecureConnectionError())
+    try:
+        requestToken = _getToken(request)
+    except ValueError:
+        returnValue(MultipleTokensError(scope))
+    if requestToken is None:
+        returnValue(MissingTokenError(scope))
+    try:
+        requestToken = requestToken.decode('utf-8')
+    except UnicodeDecodeError:
+        pass
     else:
-        try:
-            requestToken = _getToken(request)
-        except ValueError:
-            error = MultipleTokensError(scope)
-        else:
-            if requestToken is None:
-                error = MissingTokenError(scope)
-            else:
-                try:
-                    requestToken = requestToken.decode('utf-8')
-                except UnicodeDecodeError:
-                    pass
-                else:
-                    tokenStorage = TokenResource.getTokenStorageSingleton()
-                    if tokenStorage.contains(requestToken):
-                        if tokenStorage.hasAccess(requestToken, scope):
-                            return True
-                        else:
-                            error = InsufficientScopeRequestError(scope)
-            if error is None:
-                error = InvalidTokenRequestError(scope)
-    request.write(error.generate(request))
-    request.finish()
-    return False
+        access = yield checkAccess(
+            TokenResource.getTokenStorageSingleton(), requestToken, scope)
+        if access == TokenAccess.Granted:
+            returnValue(None)
+        elif access == TokenAccess.InsufficientScope:
+            returnValue(InsufficientScopeRequestError(scope))
+    returnValue(InvalidTokenRequestError(scope))
 
 
 def oauth2(scope, allowInsecureRequestDebug=False):
@@ -93,6 +129,8 @@ def oauth2(scope, allowInsecureRequestDebug=False):
     be a request object, with isAuthorized.
     If the request is authorized, the function is called,
     otherwise the request is closed and NOT_DONE_YET is returned.
+    If isAuthorized returns a Deferred, NOT_DONE_YET is returned and the result
+    of the function is written to the request once the token has been validated.
     :param scope: The scope or list of scopes the token must grant access to.
     :param allowInsecureRequestDebug: Allow requests to originate from
            insecure connections. Only use for local testing!
@@ -101,8 +139,14 @@ def oauth2(scope, allowInsecureRequestDebug=False):
     def decorator(func):
         @wraps(func)
         def wrapper(self, request, *args, **kwargs):
-            if not isAuthorized(request, scope, allowInsecureRequestDebug):
-                return NOT_DONE_YET
-            return func(self, request, *args, **kwargs)
+            def render(authorized):
+                if not authorized:
+                    return NOT_DONE_YET
+                return func(self, request, *args, **kwargs)
+            result = isAuthorized(request, scope, allowInsecureRequestDebug)
+            if isinstance(result, Deferred):
+                return renderDeferred(request, result.addCallback(render),
+                                      lambda req, failure: ServerError().generate(req))
+            return render(result)
         return wrapper
     return decorator
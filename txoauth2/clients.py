@@ -1,5 +1,7 @@
 # Copyright (c) Sebastian Scholz
 # See LICENSE for details.
+import sys
+
 from abc import abstractmethod, ABCMeta
 try:
     from urlparse import urlparse
@@ -16,6 +18,7 @@ class ClientStorage(object):
     """
     This class's purpose is to manage and give access
     to the clients that the server knows via their clientId.
+    The getClient and authenticateClient methods may return a Deferred which fires with the result.
     """
     __metaclass__ = ABCMeta
 
@@ -46,6 +49,16 @@ class ClientStorage(object):
         """
         raise NotImplementedError()
 
+    def removeClient(self, clientId):
+        """
+        Remove the client with the given clientId, e.g. because it was compromised.
+        Implementing this method is optional.
+        :raises KeyError: If no client with the given clientId is found.
+        :raises NotImplementedError: If the client storage does not support this method.
+        :param clientId: The client id of the client.
+        """
+        raise NotImplementedError()
+
 
 class Client(object):
     """
@@ -54,7 +67,10 @@ class Client(object):
     A client is an entity, which is given access to a scope by the user.
     He can use a grant type he is authorized to use to request an access token
     with which he can access resources on behalf of the user.
+    The attributes are stored in slots. Subclasses should declare their attributes
+    in __slots__, otherwise their compiled form (see compileClient) has an instance dict.
     """
+    __slots__ = ('id', 'redirectUris', 'authorizedGrantTypes')
 
     def __init__(self, clientId, redirectUris, authorizedGrantTypes):
         """
@@ -93,6 +109,27 @@ class Client(object):
         self.redirectUris = redirectUris
         self.authorizedGrantTypes = authorizedGrantTypes
 
+    def hasRedirectUri(self, redirectUri):
+        """
+        :param redirectUri: A redirect uri.
+        :return: True, if the redirect uri is one of the redirect uris of this client.
+        """
+        return redirectUri in self.redirectUris
+
+    def isGrantTypeAuthorized(self, grantType):
+        """
+        :param grantType: The value of a grant type.
+        :return: True, if this client is authorized to use the grant type.
+        """
+        return grantType in self.authorizedGrantTypes
+
+    def getParsedRedirectUri(self, redirectUri):
+        """
+        :param redirectUri: One of the redirect uris of this client.
+        :return: The components of the redirect uri as returned by urlparse.
+        """
+        return urlparse(redirectUri)
+
 
 class PublicClient(Client):
     """
@@ -100,6 +137,8 @@ class PublicClient(Client):
     credentials and thus are not required to authenticate themselves.
     See: https://tools.ietf.org/html/rfc6749#section-2.1
     """
+    __slots__ = ()
+
     def __init__(self, clientId, redirectUris, authorizedGrantTypes):
         super(PublicClient, self).__init__(clientId, redirectUris, authorizedGrantTypes)
 
@@ -109,6 +148,129 @@ class PasswordClient(Client):
     This is a confidential client which authenticates himself with a password/secret.
     See: https://tools.ietf.org/html/rfc6749#section-2.3.1
     """
+    __slots__ = ('secret',)
+
     def __init__(self, clientId, redirectUris, authorizedGrantTypes, secret):
         super(PasswordClient, self).__init__(clientId, redirectUris, authorizedGrantTypes)
         self.secret = secret
+
+
+try:
+    _intern = sys.intern
+except AttributeError:
+    _intern = intern  # pylint: disable=undefined-variable
+
+
+class _CompiledClient(object):
+    """
+    The base class of the compiled clients created by compileClient. All attributes
+    are stored in slots and can not be changed, the lookups use frozensets
+    and the redirect uris are parsed once.
+    """
+    __slots__ = ()
+    _attributeNames = ()
+    _clientClass = None
+
+    def __setattr__(self, name, value):
+        raise AttributeError('A compiled client can not be changed')
+
+    def __delattr__(self, name):
+        raise AttributeError('A compiled client can not be changed')
+
+    def hasRedirectUri(self, redirectUri):
+        return redirectUri in self._redirectUriSet
+
+    def isGrantTypeAuthorized(self, grantType):
+        return grantType in self._grantTypeSet
+
+    def getParsedRedirectUri(self, redirectUri):
+        parsedRedirectUri = self._parsedRedirectUris.get(redirectUri)
+        if parsedRedirectUri is None:
+            return urlparse(redirectUri)
+        return parsedRedirectUri
+
+
+_compiledClientClasses = {}
+
+
+def _getSlotNames(cls):
+    """
+    :param cls: A class.
+    :return: The names of the attributes which are stored in the slots of the class
+             and its base classes.
+    """
+    names = []
+    for baseClass in cls.__mro__:
+        slots = baseClass.__dict__.get('__slots__', ())
+        for name in (slots,) if isAnyStr(slots) else slots:
+            if name not in ('__dict__', '__weakref__') and name not in names:
+                names.append(name)
+    return names
+
+
+def compileClient(client):
+    """
+    Create the compiled form of a client, which can be returned by a ClientStorage
+    instead of the client. It is an instance of a subclass of the class of the client
+    with the same attributes, except that the redirect uris and the authorized grant types
+    are tuples. All attributes are stored in slots and can not be changed. The compiled
+    client has no instance dict, unless a class of the client does not declare __slots__.
+    The redirect uris and grant types are checked with frozensets,
+    the redirect uris are parsed once and the grant types are interned.
+    :param client: A client.
+    :return: The compiled form of the client.
+    """
+    if isinstance(client, _CompiledClient):
+        return client
+    clientClass = type(client)
+    attributes = getClientAttributes(client)
+    attributeNames = tuple(sorted(attributes))
+    compiledClass = _compiledClientClasses.get((clientClass, attributeNames))
+    if compiledClass is None:
+        inheritedSlots = _getSlotNames(clientClass)
+        compiledClass = type('Compiled' + clientClass.__name__, (_CompiledClient, clientClass), {
+            '__slots__': ('_redirectUriSet', '_grantTypeSet', '_parsedRedirectUris') + tuple(
+                name for name in attributeNames if name not in inheritedSlots),
+            '_attributeNames': attributeNames,
+            '_clientClass': clientClass
+        })
+        _compiledClientClasses[(clientClass, attributeNames)] = compiledClass
+    compiledClient = object.__new__(compiledClass)
+    grantTypes = tuple(_intern(grantType) for grantType in client.authorizedGrantTypes)
+    attributes.update({
+        'id': client.id,
+        'redirectUris': tuple(client.redirectUris),
+        'authorizedGrantTypes': grantTypes,
+        '_redirectUriSet': frozenset(client.redirectUris),
+        '_grantTypeSet': frozenset(grantTypes),
+        '_parsedRedirectUris': {uri: urlparse(uri) for uri in client.redirectUris}
+    })
+    for name, value in attributes.items():
+        object.__setattr__(compiledClient, name, value)
+    return compiledClient
+
+
+def getClientAttributes(client):
+    """
+    :param client: A client or a compiled client.
+    :return: A dict with the attributes of the client
+             except the id, the redirect uris and the authorized grant types.
+    """
+    if isinstance(client, _CompiledClient):
+        return {name: getattr(client, name) for name in client._attributeNames}
+    attributes = {name: getattr(client, name) for name in _getSlotNames(type(client))
+                  if hasattr(client, name)}
+    attributes.update(getattr(client, '__dict__', {}))
+    for name in ['id', 'redirectUris', 'authorizedGrantTypes']:
+        attributes.pop(name, None)
+    return attributes
+
+
+def getClientClass(client):
+    """
+    :param client: A client or a compiled client.
+    :return: The class of the client or the class the compiled client was created from.
+    """
+    if isinstance(client, _CompiledClient):
+        return client._clientClass
+    return type(client)
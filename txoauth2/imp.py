@@ -1,8 +1,16 @@
 # Copyright (c) Sebastian Scholz
 # See LICENSE for details.
+#
+# The storages that are not defined here are implemented in the modules of the txoauth2.storage
+# package and are imported here, so they can still be imported from this module.
 import os
+import hmac
+import json
 import time
+import base64
+import hashlib
 import inspect
+import logging
 
 from uuid import uuid4
 try:
@@ -10,13 +18,38 @@ try:
 except ImportError:
     from configparser import RawConfigParser
 
+from twisted.internet.defer import Deferred, maybeDeferred
+
 from txoauth2 import clients
-from txoauth2.clients import ClientStorage, Client
-from txoauth2.token import TokenFactory, TokenStorage
+from txoauth2.clients import ClientStorage, Client, compileClient, getClientAttributes, \
+    getClientClass
+from txoauth2.keyring import InvalidJWTError
+from txoauth2.scope import isScopeSubset
+from txoauth2.token import TokenFactory, TokenStorage, TokenAccess
+from txoauth2.storage.codec import JSONCodec
+from txoauth2.storage.journal import JournalClientStorage
+from txoauth2.storage.memory import DictTokenStorage, BucketedTokenStorage, \
+    DictPersistentStorage, DictConsentStorage
+from txoauth2.storage.redis import RedisError, RedisTokenStorage, RedisPersistentStorage
+from txoauth2.storage.snapshot import SnapshotTokenStorage
+from txoauth2.storage.sqlite import SQLiteTokenStorage, SQLitePersistentStorage, \
+    SQLiteCodeStorage, SQLiteConsentStorage, ReplayedKeyError
+from txoauth2.storage.wrappers import BloomFilterTokenStorage, CachingTokenStorage, \
+    WriteBehindTokenStorage
+
+__all__ = ['UUIDTokenFactory', 'PooledTokenFactory', 'HMACTokenFactory', 'JWTTokenFactory',
+           'HMACTokenStorage', 'ConfigParserClientStorage', 'JournalClientStorage', 'JSONCodec',
+           'DictTokenStorage', 'BucketedTokenStorage', 'SnapshotTokenStorage',
+           'DictPersistentStorage', 'DictConsentStorage', 'SQLiteTokenStorage',
+           'SQLitePersistentStorage', 'SQLiteCodeStorage', 'SQLiteConsentStorage',
+           'ReplayedKeyError', 'RedisError', 'RedisTokenStorage', 'RedisPersistentStorage',
+           'BloomFilterTokenStorage', 'CachingTokenStorage', 'WriteBehindTokenStorage']
 
 
 class UUIDTokenFactory(TokenFactory):
     """ A TokenFactory that generates UUID tokens. """
+    generatesValidTokens = True
+
     def generateToken(self, lifetime, client, scope, additionalData=None):
         """
         Generate an UUID toke.
@@ -29,23 +62,398 @@ class UUIDTokenFactory(TokenFactory):
         return str(uuid4())
 
 
+class PooledTokenFactory(TokenFactory):
+    """
+    A TokenFactory that hands out random tokens from a pool of pre-generated tokens.
+    The randomness for all tokens in the pool is drawn with a single call to os.urandom
+    and encoded with url safe base64, so the tokens only contain characters from
+    TokenResource.VALID_TOKEN_CHARS. When the pool runs low, it is refilled
+    by the reactor after the current request has been handled.
+    """
+    generatesValidTokens = True
+
+    def __init__(self, tokenLength=43, poolSize=1024, refillThreshold=None, reactor=None):
+        """
+        :raises ValueError: If the token length or the pool size is not positive.
+        :param tokenLength: The number of characters of a token. Each character
+                            carries 6 bits of randomness, so the default is about 256 bits.
+        :param poolSize: The number of tokens that are generated at once.
+        :param refillThreshold: The number of tokens left in the pool at which
+                                the pool is refilled. Defaults to a quarter of the pool size.
+        :param reactor: The reactor to use, defaults to the global reactor.
+        """
+        super(PooledTokenFactory, self).__init__()
+        if tokenLength <= 0 or poolSize <= 0:
+            raise ValueError('The token length and the pool size must be positive')
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._tokenLength = tokenLength
+        self._poolSize = poolSize
+        self._refillThreshold = poolSize // 4 if refillThreshold is None else refillThreshold
+        self._refillScheduled = False
+        self._pool = []
+        self._fillPool()
+
+    def generateToken(self, lifetime, client, scope, additionalData=None):
+        """
+        Take a random token from the pool.
+        :param lifetime: Unused.
+        :param client: Unused.
+        :param scope: Unused.
+        :param additionalData: Unused.
+        :return: A random token.
+        """
+        if not self._pool:
+            self._fillPool()
+        token = self._pool.pop()
+        if len(self._pool) <= self._refillThreshold and not self._refillScheduled:
+            self._refillScheduled = True
+            self._reactor.callLater(0, self._refillPool)
+        return token
+
+    def _refillPool(self):
+        """ Refill the pool in the background. """
+        self._refillScheduled = False
+        if len(self._pool) <= self._refillThreshold:
+            self._fillPool()
+
+    def _fillPool(self):
+        """ Generate poolSize new tokens and add them to the pool. """
+        numChars = self._poolSize * self._tokenLength
+        numBytes = (numChars * 3 + 3) // 4
+        numBytes += -numBytes % 3  # Avoid padding
+        randomChars = base64.urlsafe_b64encode(os.urandom(numBytes)).decode('ascii')
+        self._pool.extend(randomChars[index:index + self._tokenLength]
+                          for index in range(0, numChars, self._tokenLength))
+
+
+class HMACTokenFactory(TokenFactory):
+    """
+    A TokenFactory that generates self-contained tokens. Each token contains the client id,
+    the scope, the additional data and the expire time and is signed with a HMAC, so it can be
+    validated without a lookup in a database (see HMACTokenStorage). The generated tokens only
+    contain characters from TokenResource.VALID_TOKEN_CHARS.
+    The additional data must be serializable to json.
+    Note that the content of the tokens is not encrypted and can be read by the clients.
+    """
+    generatesValidTokens = True
+
+    def __init__(self, secret, digestmod=hashlib.sha256):
+        """
+        :raises ValueError: If the secret is empty.
+        :param secret: The secret key that is used to sign the tokens.
+        :param digestmod: The hash function for the HMAC.
+        """
+        super(HMACTokenFactory, self).__init__()
+        if not secret:
+            raise ValueError('The secret must not be empty')
+        if not isinstance(secret, bytes):
+            secret = secret.encode('utf-8')
+        self._hmac = hmac.new(secret, digestmod=digestmod)
+
+    def generateToken(self, lifetime, client, scope, additionalData=None):
+        """
+        Generate a signed token.
+        :param lifetime: The lifetime of the token in seconds or None.
+        :param client: The client the token is issued to.
+        :param scope: The scope the token grants access to.
+        :param additionalData: Additional data that is stored in the token.
+        :return: A signed token.
+        """
+        birthTime = int(time.time())
+        content = {
+            'c': client.id,
+            's': scope,
+            'b': birthTime,
+            'e': None if lifetime is None else birthTime + lifetime
+        }
+        if additionalData is not None:
+            content['d'] = additionalData
+        payload = self._encode(json.dumps(content, separators=(',', ':')).encode('utf-8'))
+        return payload + '.' + self._encode(self._sign(payload.encode('ascii')))
+
+    def decodeToken(self, token):
+        """
+        Verify the signature and the expire time of a token generated by this factory.
+        :raises KeyError: If the token is not valid or has expired.
+        :param token: The token.
+        :return: A dict containing the 'scope', the 'client_id', the 'additional_data',
+                 the 'birth_time' and the 'expire_time' of the token,
+                 like TokenStorage.getTokenInfo.
+        """
+        try:
+            payload, signature = token.split('.')
+            if not hmac.compare_digest(self._sign(payload.encode('ascii')),
+                                       self._decode(signature)):
+                raise KeyError('Invalid token signature')
+            content = json.loads(self._decode(payload).decode('utf-8'))
+        except (ValueError, TypeError):
+            raise KeyError('Invalid token')
+        if content['e'] is not None and time.time() > content['e']:
+            raise KeyError('Token expired')
+        return {
+            'scope': content['s'],
+            'client_id': content['c'],
+            'additional_data': content.get('d'),
+            'birth_time': content['b'],
+            'expire_time': content['e']
+        }
+
+    def _sign(self, data):
+        """
+        :param data: The data to sign.
+        :return: The HMAC of the data.
+        """
+        mac = self._hmac.copy()
+        mac.update(data)
+        return mac.digest()
+
+    @staticmethod
+    def _encode(data):
+        """
+        :param data: Some bytes.
+        :return: The data encoded as url safe base64 without padding.
+        """
+        return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+    @staticmethod
+    def _decode(data):
+        """
+        :param data: Url safe base64 without padding.
+        :return: The decoded bytes.
+        """
+        return base64.urlsafe_b64decode(data.encode('ascii') + b'=' * (-len(data) % 4))
+
+
+class JWTTokenFactory(TokenFactory):
+    """
+    A TokenFactory that generates JSON Web Tokens signed by a Keyring. The tokens contain
+    the 'client_id', the 'scope' as a space separated string, the issue time 'iat',
+    the expire time 'exp' and a unique 'jti' and optionally the 'iss', the 'aud'
+    and the additional data as 'data'. They can be validated with a HMACTokenStorage or,
+    by resource servers that only have the keyring, with Keyring.verify.
+    The additional data must be serializable to json.
+    """
+    generatesValidTokens = True
+
+    def __init__(self, keyring, issuer=None, audience=None):
+        """
+        :param keyring: The Keyring to sign and verify the tokens.
+        :param issuer: An optional issuer that is included in and required for all tokens.
+        :param audience: An optional audience that is included in and required for all tokens.
+        """
+        super(JWTTokenFactory, self).__init__()
+        self.keyring = keyring
+        self._issuer = issuer
+        self._audience = audience
+
+    def generateToken(self, lifetime, client, scope, additionalData=None):
+        """
+        Generate a signed JSON Web Token.
+        :param lifetime: The lifetime of the token in seconds or None.
+        :param client: The client the token is issued to.
+        :param scope: The scope the token grants access to.
+        :param additionalData: Additional data that is stored in the token.
+        :return: A signed JSON Web Token.
+        """
+        issueTime = int(time.time())
+        claims = {
+            'client_id': client.id,
+            'scope': ' '.join(scope),
+            'iat': issueTime,
+            'jti': uuid4().hex
+        }
+        if lifetime is not None:
+            claims['exp'] = issueTime + lifetime
+        if self._issuer is not None:
+            claims['iss'] = self._issuer
+        if self._audience is not None:
+            claims['aud'] = self._audience
+        if additionalData is not None:
+            claims['data'] = additionalData
+        return self.keyring.sign(claims)
+
+    def decodeToken(self, token):
+        """
+        Verify a token generated by this factory.
+        :raises KeyError: If the token is not valid or has expired.
+        :param token: The token.
+        :return: A dict containing the 'scope', the 'client_id', the 'additional_data',
+                 the 'birth_time' and the 'expire_time' of the token,
+                 like TokenStorage.getTokenInfo.
+        """
+        try:
+            claims = self.keyring.verify(token, audience=self._audience, issuer=self._issuer)
+            return {
+                'scope': claims['scope'].split(),
+                'client_id': claims['client_id'],
+                'additional_data': claims.get('data'),
+                'birth_time': claims['iat'],
+                'expire_time': claims.get('exp')
+            }
+        except (InvalidJWTError, KeyError, AttributeError):
+            raise KeyError('Invalid token')
+
+
+class HMACTokenStorage(TokenStorage):
+    """
+    A token storage for tokens generated by a HMACTokenFactory or a JWTTokenFactory.
+    The tokens are validated by verifying their signature and expire time, so no database
+    is needed. Pass it as the authTokenStorage to the TokenResource to validate access tokens
+    in isAuthorized and the oauth2 decorator without a lookup.
+    Because the tokens are self-contained, they can only be removed before they expire
+    if a revocationStorage is given. The revocationStorage is a TokenStorage that stores
+    the removed tokens until they expire and which is checked for every token.
+    """
+    def __init__(self, tokenFactory, revocationStorage=None):
+        """
+        :param tokenFactory: The HMACTokenFactory or JWTTokenFactory that generated the tokens.
+        :param revocationStorage: An optional TokenStorage to store revoked tokens.
+        """
+        super(HMACTokenStorage, self).__init__()
+        self._tokenFactory = tokenFactory
+        self._revocationStorage = revocationStorage
+
+    def contains(self, token):
+        try:
+            tokenInfo = self.getTokenInfo(token)
+        except KeyError:
+            return False
+        result = self._apply(tokenInfo, lambda _: True)
+        if isinstance(result, Deferred):
+            result.addErrback(self._onRevoked, False)
+        return result
+
+    def hasAccess(self, token, scope):
+        return self._apply(self.getTokenInfo(token),
+                           lambda tokenInfo: isScopeSubset(scope, tokenInfo['scope']))
+
+    def checkAccess(self, token, scope):
+        def checkScope(tokenInfo):
+            if isScopeSubset(scope, tokenInfo['scope']):
+                return TokenAccess.Granted
+            return TokenAccess.InsufficientScope
+        try:
+            tokenInfo = self.getTokenInfo(token)
+        except KeyError:
+            return TokenAccess.Invalid
+        result = self._apply(tokenInfo, checkScope)
+        if isinstance(result, Deferred):
+            result.addErrback(self._onRevoked, TokenAccess.Invalid)
+        return result
+
+    def getTokenAdditionalData(self, token):
+        return self._apply(self.getTokenInfo(token), lambda tokenInfo: tokenInfo['additional_data'])
+
+    def getTokenScope(self, token):
+        return self._apply(self.getTokenInfo(token), lambda tokenInfo: tokenInfo['scope'])
+
+    def getTokenClient(self, token):
+        return self._apply(self.getTokenInfo(token), lambda tokenInfo: tokenInfo['client_id'])
+
+    def getTokenLifetime(self, token):
+        return self._apply(self.getTokenInfo(token),
+                           lambda tokenInfo: int(time.time()) - tokenInfo['birth_time'])
+
+    def getTokenInfo(self, token):
+        tokenInfo = self._tokenFactory.decodeToken(token)
+        if self._revocationStorage is None:
+            return tokenInfo
+
+        def checkRevoked(revoked):
+            if revoked:
+                raise KeyError('Token revoked')
+            return tokenInfo
+        return maybeDeferred(self._revocationStorage.contains, token).addCallback(checkRevoked)
+
+    def store(self, token, client, scope, additionalData=None, expireTime=None):
+        """
+        The tokens are self-contained, so this only verifies
+        that the token was generated for the given client and scope.
+        :raises ValueError: If the token was not generated by the token factory
+                            for the client and scope.
+        """
+        if not isinstance(scope, list):
+            scope = [scope]
+        try:
+            tokenInfo = self._tokenFactory.decodeToken(token)
+        except KeyError:
+            raise ValueError('The token was not generated by the token factory')
+        if tokenInfo['client_id'] != client.id or tokenInfo['scope'] != scope:
+            raise ValueError('The token was generated for a different client or scope')
+
+    def remove(self, token):
+        """
+        Revoke the token by storing it in the revocationStorage until it expires.
+        :raises KeyError: If the token is not valid.
+        :raises NotImplementedError: If no revocationStorage was given.
+        """
+        if self._revocationStorage is None:
+            raise NotImplementedError('Tokens can only be removed with a revocationStorage')
+        tokenInfo = self._tokenFactory.decodeToken(token)
+        return self._revocationStorage.store(
+            token, Client(tokenInfo['client_id'], [], []), tokenInfo['scope'],
+            expireTime=tokenInfo['expire_time'])
+
+    @staticmethod
+    def _apply(result, function):
+        """
+        :param result: A result or a Deferred.
+        :param function: A function to call with the result.
+        :return: The return value of the function or a Deferred which fires with it.
+        """
+        if isinstance(result, Deferred):
+            return result.addCallback(function)
+        return function(result)
+
+    @staticmethod
+    def _onRevoked(failure, invalidResult):
+        """
+        :param failure: The failure of a token lookup.
+        :param invalidResult: The result to return if the token was revoked.
+        :return: The invalidResult, if the failure was caused by a KeyError.
+        """
+        failure.trap(KeyError)
+        return invalidResult
+
+
 class ConfigParserClientStorage(ClientStorage):
-    """ A ClientStorage using a ConfigParser. """
+    """
+    A ClientStorage using a ConfigParser. The parsed clients are cached,
+    so getClient returns the same client object until the client is changed by addClient
+    or the config file is reloaded. If a reload interval is given, the modification time
+    of the config file is checked periodically and the file is read again if it changed.
+    If compileClients is True, the compiled form of the clients is returned (see compileClient).
+    """
     _configParser = None
     path = None
 
-    def __init__(self, path):
+    def __init__(self, path, reloadInterval=None, reactor=None, compileClients=False):
         """
         Initialize a new SimpleClientStorage which loads and stores
         it's clients from the given path.
         :param path: Path to a config file to load and store clients.
+        :param reloadInterval: The interval in seconds in which to check whether the config file
+                               has changed or None to only reload it when reload is called.
+        :param reactor: The reactor to use, defaults to the global reactor.
+        :param compileClients: Whether to return the compiled form of the clients.
         """
         super(ConfigParserClientStorage, self).__init__()
-        self._configParser = RawConfigParser()
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
         self.path = path
-        self._configParser.read(path)
-        self._clientClasses = [cls[1] for cls in inspect.getmembers(clients)
-                               if inspect.isclass(cls[1]) and issubclass(cls[1], Client)]
+        self._compileClients = compileClients
+        self._clients = {}
+        self._fileSignature = None
+        self._readConfig()
+        self._clientClasses = {cls[0]: cls[1] for cls in inspect.getmembers(clients)
+                               if inspect.isclass(cls[1]) and issubclass(cls[1], Client)}
+        self._reloadInterval = reloadInterval
+        self._reloadCall = None
+        if reloadInterval is not None:
+            self._reloadCall = reactor.callLater(reloadInterval, self._reloadPeriodically)
 
     def getClient(self, clientId):
         """
@@ -55,6 +463,64 @@ class ConfigParserClientStorage(ClientStorage):
         :param clientId: The id of the client.
         :return: A client object.
         """
+        client = self._clients.get(clientId)
+        if client is None:
+            client = self._parseClient(clientId)
+            self._clients[clientId] = client
+        return client
+
+    def reload(self):
+        """
+        Read the config file again, if its modification time or size has changed.
+        :return: True, if the config file was read again.
+        """
+        if self._getFileSignature() == self._fileSignature:
+            return False
+        self._readConfig()
+        return True
+
+    def close(self):
+        """ Stop checking the config file for changes. """
+        if self._reloadCall is not None:
+            if self._reloadCall.active():
+                self._reloadCall.cancel()
+            self._reloadCall = None
+
+    def _reloadPeriodically(self):
+        """ Reload the config file if it has changed and schedule the next check. """
+        try:
+            self.reload()
+        except Exception as error:  # pylint: disable=broad-except
+            logging.getLogger('txOauth2').error(
+                'Failed to reload the client storage: ' + str(error), exc_info=1)
+        self._reloadCall = self._reactor.callLater(self._reloadInterval, self._reloadPeriodically)
+
+    def _getFileSignature(self):
+        """
+        :return: The modification time and size of the config file or None, if it does not exist.
+        """
+        try:
+            fileStat = os.stat(self.path)
+        except OSError:
+            return None
+        return fileStat.st_mtime, fileStat.st_size
+
+    def _readConfig(self):
+        """ Read the config file and drop all cached clients. """
+        fileSignature = self._getFileSignature()
+        configParser = RawConfigParser()
+        configParser.read(self.path)
+        self._configParser = configParser
+        self._fileSignature = fileSignature
+        self._clients = {}
+
+    def _parseClient(self, clientId):
+        """
+        Create a client object from the section of the client in the config file.
+        :raises KeyError: If no client with the given client id exists.
+        :param clientId: The id of the client.
+        :return: A client object.
+        """
         sectionName = 'client_' + clientId
         if not isinstance(sectionName, str):  # clientId is unicode
             sectionName = sectionName.encode('utf-8')
@@ -62,17 +528,17 @@ class ConfigParserClientStorage(ClientStorage):
         if not self._configParser.has_section(sectionName):
             raise KeyError('No client with id "{id}" exists'.format(id=clientId))
         clientType = self._configParser.get(sectionName, 'type')
-        for cls in self._clientClasses:
-            if cls.__name__ == clientType:
-                clientClass = cls
-                break
-        else:
+        clientClass = self._clientClasses.get(clientType)
+        if clientClass is None:
             raise ValueError('Unable to find client class ' + clientType)
         redirectUris = self._configParser.get(sectionName, 'redirect_uris').split()
         authorizedGrantTypes = self._configParser.get(sectionName, 'authorized_grant_types').split()
         kwargs = {key: value for key, value in self._configParser.items(sectionName)
                   if key not in ['type', 'redirect_uris', 'authorized_grant_types']}
-        return clientClass(clientId, redirectUris, authorizedGrantTypes, **kwargs)
+        client = clientClass(clientId, redirectUris, authorizedGrantTypes, **kwargs)
+        if self._compileClients:
+            client = compileClient(client)
+        return client
 
     def addClient(self, client):
         """
@@ -84,82 +550,15 @@ class ConfigParserClientStorage(ClientStorage):
         sectionName = 'client_' + client.id
         if not self._configParser.has_section(sectionName):
             self._configParser.add_section(sectionName)
-        self._configParser.set(sectionName, 'type', client.__class__.__name__)
+        self._configParser.set(sectionName, 'type', getClientClass(client).__name__)
         self._configParser.set(sectionName, 'redirect_uris', ' '.join(client.redirectUris))
         self._configParser.set(sectionName, 'authorized_grant_types',
                                ' '.join(client.authorizedGrantTypes))
-        for name, value in client.__dict__.items():
-            if name not in ['id', 'redirectUris', 'authorizedGrantTypes']:
-                self._configParser.set(sectionName, name, value)
+        for name, value in getClientAttributes(client).items():
+            self._configParser.set(sectionName, name, value)
         if not os.path.exists(os.path.dirname(self.path)):
             os.makedirs(os.path.dirname(self.path))
         with open(self.path, 'w') as configFile:
             self._configParser.write(configFile)
-
-
-class DictTokenStorage(TokenStorage):
-    """
-    This token storage does not implement any type of persistence and tokens will therefore
-    not survive a server restart. This implementation should probably only be used for testing.
-    """
-    _tokens = {}
-
-    def contains(self, token):
-        if token not in self._tokens:
-            return False
-        return not self._checkExpire(token)
-
-    def hasAccess(self, token, scope):
-        if self._checkExpire(token):
-            raise KeyError('Token expired')
-        for scopeItem in scope:
-            if scopeItem not in self._tokens[token]['scope']:
-                return False
-        return True
-
-    def getTokenAdditionalData(self, token):
-        self._checkExpire(token)
-        return self._tokens[token]['data']
-
-    def getTokenScope(self, token):
-        self._checkExpire(token)
-        return self._tokens[token]['scope']
-
-    def getTokenClient(self, token):
-        self._checkExpire(token)
-        return self._tokens[token]['client']
-
-    def getTokenLifetime(self, token):
-        self._checkExpire(token)
-        return int(time.time()) - self._tokens[token]['birthTime']
-
-    def store(self, token, client, scope, additionalData=None, expireTime=None):
-        if not isinstance(token, str):
-            raise ValueError('Token parameter is not a string')
-        if not isinstance(scope, list):
-            scope = [scope]
-        if expireTime is not None and expireTime <= time.time():
-            return
-        self._tokens[token] = {
-            'data': additionalData,
-            'birthTime': int(time.time()),
-            'expireTime': expireTime,
-            'scope': scope,
-            'client': client.id
-        }
-
-    def remove(self, token):
-        del self._tokens[token]
-
-    def _checkExpire(self, token):
-        """
-        Check if a token has expired and remove it if necessary.
-        :raises KeyError: If the token is not in the token storage.
-        :param token: The token to check.
-        :return: True if the token has expired.
-        """
-        expireTime = self._tokens[token]['expireTime']
-        if expireTime is not None and time.time() > expireTime:
-            del self._tokens[token]
-            return True
-        return False
+        self._clients.pop(client.id, None)
+        self._fileSignature = self._getFileSignature()
@@ -0,0 +1,169 @@
+# Copyright (c) Sebastian Scholz
+# See LICENSE for details.
+#
+# This module only depends on the standard library and does not need a reactor,
+# so resource servers can use it to verify the tokens without running Twisted.
+import hmac
+import json
+import time
+import base64
+import hashlib
+
+
+class InvalidJWTError(ValueError):
+    """ Raised if a JSON Web Token is malformed, has an invalid signature or has expired. """
+
+
+class Keyring(object):
+    """
+    A set of keys to sign and verify JSON Web Tokens (JWT) with HS256, HS384 or HS512.
+    Each key is identified by its key id (kid), which is included in the header of the tokens
+    it signs. This allows to rotate the signing key: A new key is added and used for signing,
+    while the old key is kept to verify the tokens that were signed with it until they expire.
+    The HMAC object of each key is created once when the key is added,
+    so verifying a token does not need to derive the key again.
+    """
+    ALGORITHMS = {
+        'HS256': hashlib.sha256,
+        'HS384': hashlib.sha384,
+        'HS512': hashlib.sha512
+    }
+
+    def __init__(self):
+        super(Keyring, self).__init__()
+        self._keys = {}
+        self._signingKeyId = None
+        self._signingHeader = None
+
+    @property
+    def signingKeyId(self):
+        """ :return: The id of the key that is used to sign new tokens or None. """
+        return self._signingKeyId
+
+    def addKey(self, keyId, secret, algorithm='HS256', sign=True):
+        """
+        Add a key to the keyring.
+        :raises ValueError: If the algorithm is not supported or the secret is empty.
+        :param keyId: The id of the key.
+        :param secret: The secret of the key.
+        :param algorithm: The algorithm to use with this key.
+        :param sign: Whether to use this key to sign new tokens.
+        """
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError('Unsupported algorithm: ' + algorithm)
+        if not secret:
+            raise ValueError('The secret must not be empty')
+        if not isinstance(secret, bytes):
+            secret = secret.encode('utf-8')
+        self._keys[keyId] = (algorithm, hmac.new(secret, digestmod=self.ALGORITHMS[algorithm]))
+        if sign or self._signingKeyId is None:
+            self.setSigningKey(keyId)
+
+    def setSigningKey(self, keyId):
+        """
+        Use the key with the given id to sign new tokens.
+        :raises KeyError: If no key with the id is in the keyring.
+        :param keyId: The id of the key.
+        """
+        algorithm = self._keys[keyId][0]
+        self._signingKeyId = keyId
+        self._signingHeader = self._encodeJson({'alg': algorithm, 'typ': 'JWT', 'kid': keyId})
+
+    def removeKey(self, keyId):
+        """
+        Remove a key from the keyring. Tokens signed with this key will no longer be valid.
+        :raises KeyError: If no key with the id is in the keyring.
+        :raises ValueError: If the key is used to sign new tokens.
+        :param keyId: The id of the key.
+        """
+        if keyId == self._signingKeyId:
+            raise ValueError('The signing key can not be removed')
+        del self._keys[keyId]
+
+    def sign(self, claims):
+        """
+        Create a JSON Web Token signed with the signing key.
+        :raises ValueError: If the keyring contains no key.
+        :param claims: A dict with the claims of the token.
+        :return: The token.
+        """
+        if self._signingKeyId is None:
+            raise ValueError('The keyring contains no signing key')
+        signingInput = self._signingHeader + '.' + self._encodeJson(claims)
+        signature = self._sign(self._keys[self._signingKeyId][1], signingInput)
+        return signingInput + '.' + self._encode(signature)
+
+    def verify(self, token, audience=None, issuer=None, leeway=0):
+        """
+        Verify the signature and the expire time of a JSON Web Token.
+        :raises InvalidJWTError: If the token is malformed, signed with an unknown key,
+                                 has an invalid signature or has expired or if the audience
+                                 or issuer does not match.
+        :param token: The token.
+        :param audience: If not None, the audience that the token must be issued for.
+        :param issuer: If not None, the issuer that must have issued the token.
+        :param leeway: The number of seconds a token is still accepted after it expired.
+        :return: The claims of the token.
+        """
+        try:
+            header, payload, signature = token.split('.')
+            headerData = json.loads(self._decode(header).decode('utf-8'))
+            algorithm, key = self._keys[headerData['kid']]
+            if headerData['alg'] != algorithm:
+                raise InvalidJWTError('The algorithm does not match the key')
+            if not hmac.compare_digest(self._sign(key, header + '.' + payload),
+                                       self._decode(signature)):
+                raise InvalidJWTError('Invalid signature')
+            claims = json.loads(self._decode(payload).decode('utf-8'))
+        except InvalidJWTError:
+            raise
+        except (ValueError, TypeError, KeyError):
+            raise InvalidJWTError('Malformed token or unknown key')
+        if not isinstance(claims, dict):
+            raise InvalidJWTError('Malformed token')
+        if 'exp' in claims and time.time() > claims['exp'] + leeway:
+            raise InvalidJWTError('The token has expired')
+        if audience is not None:
+            tokenAudience = claims.get('aud')
+            if not isinstance(tokenAudience, list):
+                tokenAudience = [tokenAudience]
+            if audience not in tokenAudience:
+                raise InvalidJWTError('The token was issued for a different audience')
+        if issuer is not None and issuer != claims.get('iss'):
+            raise InvalidJWTError('The token was issued by a different issuer')
+        return claims
+
+    @staticmethod
+    def _sign(key, signingInput):
+        """
+        :param key: The precomputed HMAC object of the key.
+        :param signingInput: The encoded header and payload.
+        :return: The signature.
+        """
+        mac = key.copy()
+        mac.update(signingInput.encode('ascii'))
+        return mac.digest()
+
+    @classmethod
+    def _encodeJson(cls, data):
+        """
+        :param data: Data that can be serialized to json.
+        :return: The data serialized to json and encoded as url safe base64 without padding.
+        """
+        return cls._encode(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+    @staticmethod
+    def _encode(data):
+        """
+        :param data: Some bytes.
+        :return: The data encoded as url safe base64 without padding.
+        """
+        return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+    @staticmethod
+    def _decode(data):
+        """
+        :param data: Url safe base64 without padding.
+        :return: The decoded bytes.
+        """
+        return base64.urlsafe_b64decode(data.encode('ascii') + b'=' * (-len(data) % 4))
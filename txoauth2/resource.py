@@ -1,22 +1,26 @@
 # Copyright (c) Sebastian Scholz
 # See LICENSE for details.
-import logging
 import time
+import base64
+import logging
 
 from uuid import uuid4
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 try:
     from urllib import urlencode
-    from urlparse import urlparse
 except ImportError:
     # noinspection PyUnresolvedReferences
-    from urllib.parse import urlparse, urlencode
+    from urllib.parse import urlencode
 
+from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 
 from txoauth2 import GrantTypes
-from txoauth2.util import addToUrl
+from txoauth2.keyring import InvalidJWTError
+from txoauth2.scope import isScopeSubset
+from txoauth2.util import addToUrl, getDeferredResult, renderDeferred, isAnyStr
 from .errors import MissingParameterError, InsecureConnectionError, InvalidRedirectUriError, \
     UserDeniesAuthorization, UnsupportedResponseTypeError, \
     UnauthorizedClientError, ServerError, AuthorizationError, MalformedParameterError, \
@@ -36,6 +40,46 @@ class InsecureRedirectUriError(RuntimeError):
     pass
 
 
+class ConsentStorage(object):
+    """
+    A storage for the scopes that users have consented to grant to clients.
+    The scopes are stored by their scope names, so a stored consent keeps its meaning
+    independent of the order in which scope names are registered in a ScopeRegistry.
+    All methods may return a Deferred which fires with the result.
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def addConsent(self, userId, clientId, scope):
+        """
+        Remember that the user consented to grant the scope to the client,
+        in addition to the scope the user already consented to.
+        :param userId: The id of the user.
+        :param clientId: The id of the client.
+        :param scope: A list of scope names.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def getConsent(self, userId, clientId):
+        """
+        :param userId: The id of the user.
+        :param clientId: The id of the client.
+        :return: The sorted list of the scope names the user consented to grant
+                 to the client, which is empty, if the user never consented.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def removeConsent(self, userId, clientId=None):
+        """
+        Forget the consent of the user for the client.
+        :param userId: The id of the user.
+        :param clientId: The id of the client or None to forget the consent for all clients.
+        """
+        raise NotImplementedError()
+
+
 class OAuth2(Resource, object):
     """
     This resource handles the authorization process by the user.
@@ -66,6 +110,19 @@ class OAuth2(Resource, object):
         authorization token in the url parameters, which the client can use to access
         the resources indicated by the scope.
 
+    The token factory, the storages and onAuthenticate may return Deferreds.
+    In this case the request is processed asynchronously without blocking the reactor.
+
+    If a dataKeyKeyring is given, the data of an authorization request is not stored
+    in the persistent storage. Instead, it is signed with the keyring and handed to
+    onAuthenticate as the dataKey, so requests that are never completed cause no writes.
+    Used data keys are remembered in memory until they expire, so each data key can only
+    be used once per server process. If multiple servers share the authorization
+    endpoint, all requests of one authorization must be handled by the same server.
+
+    If a consentStorage is given, the consent of a user is remembered when grantAccess is called
+    with a consentUserId. If getConsentUserId returns the id of a user that has already
+    consented to the requested scope, onPriorConsent is called instead of onAuthenticate.
     """
     __metaclass__ = ABCMeta
     acceptedGrantTypes = [GrantTypes.AuthorizationCode.value, GrantTypes.Implicit.value]
@@ -73,6 +130,10 @@ class OAuth2(Resource, object):
     authTokenLifeTime = 3600
     allowInsecureRequestDebug = False
     defaultScope = None
+    scopeRegistry = None
+    dataKeyKeyring = None
+    consentStorage = None
+    _DATA_KEY_USE = 'txoauth2_authorization_request'
     _tokenFactory = None
     _persistentStorage = None
     _clientStorage = None
@@ -80,7 +141,8 @@ class OAuth2(Resource, object):
 
     def __init__(self, tokenFactory, persistentStorage, clientStorage,
                  requestDataLifeTime=3600, authTokenLifeTime=3600, allowInsecureRequestDebug=False,
-                 grantTypes=None, authTokenStorage=None, defaultScope=None):
+                 grantTypes=None, authTokenStorage=None, defaultScope=None, scopeRegistry=None,
+                 dataKeyKeyring=None, consentStorage=None):
         """
         Creates a new OAuth2 Resource.
 
@@ -99,6 +161,12 @@ class OAuth2(Resource, object):
                                  Must be the same as the one passed to the token resource.
         :param defaultScope: A list of scopes that should be used as a default
                              for authorization requests if they don't provide one.
+        :param scopeRegistry: An optional ScopeRegistry used to check whether the scope passed
+                              to grantAccess is a subset of the requested scope.
+        :param dataKeyKeyring: An optional Keyring to sign the data of authorization requests
+                               with instead of storing it in the persistent storage.
+        :param consentStorage: An optional ConsentStorage to remember the consent of users.
+                               Requires onPriorConsent to be overridden.
         """
         super(OAuth2, self).__init__()
         self._tokenFactory = tokenFactory
@@ -121,6 +189,16 @@ class OAuth2(Resource, object):
             self.acceptedGrantTypes = grantTypes
         if defaultScope is not None:
             self.defaultScope = defaultScope
+        if scopeRegistry is not None:
+            self.scopeRegistry = scopeRegistry
+        if dataKeyKeyring is not None:
+            self.dataKeyKeyring = dataKeyKeyring
+        if consentStorage is not None:
+            self.consentStorage = consentStorage
+        if self.consentStorage is not None and getattr(self.onPriorConsent, '__func__', None) \
+                is getattr(OAuth2.onPriorConsent, '__func__', OAuth2.onPriorConsent):
+            raise ValueError('A consent storage requires onPriorConsent to be overridden')
+        self._usedDataKeys = OrderedDict()
         if GrantTypes.Implicit.value in self.acceptedGrantTypes and self._authTokenStorage is None:
             raise ValueError('The token storage can not be None '
                              'when the implicit authorization flow is enabled')
@@ -130,7 +208,7 @@ class OAuth2(Resource, object):
         """
         Create an OAuth2 Resource with the tokenFactory, the persistentStorage
         and the clientStorage of the tokenResource. The allowInsecureRequestDebug
-        flag is also copied.
+        flag and the scopeRegistry are also copied.
         If a subPath is given, the tokenResource is added as a child to the new
         OAuth2 Resource at the subPath.
 
@@ -144,7 +222,8 @@ class OAuth2(Resource, object):
             'authTokenLifeTime': tokenResource.authTokenLifeTime,
             'allowInsecureRequestDebug': tokenResource.allowInsecureRequestDebug,
             'authTokenStorage': tokenResource.getTokenStorageSingleton(),
-            'defaultScope': tokenResource.defaultScope
+            'defaultScope': tokenResource.defaultScope,
+            'scopeRegistry': tokenResource.scopeRegistry
         }
         keywordArgs.update(kwargs)
         oAuth2Resource = cls(tokenResource.tokenFactory, tokenResource.persistentStorage,
@@ -164,95 +243,164 @@ class OAuth2(Resource, object):
         :param request: The GET request.
         :return: A response or NOT_DONE_YET
         """
+        return renderDeferred(request, self._handleGetRequest(request),
+                              lambda req, failure: ServerError().generate(req))
+
+    @inlineCallbacks
+    def _handleGetRequest(self, request):
+        """
+        Handle a GET request. The client storage, the persistent storage and
+        onAuthenticate may return Deferreds, in which case the request
+        is processed asynchronously.
+
+        :param request: The GET request.
+        :return: A Deferred which fires with the response or NOT_DONE_YET.
+        """
         if b'client_id' not in request.args:
-            return MissingParameterError('client_id').generate(request)
+            returnValue(MissingParameterError('client_id').generate(request))
         if len(request.args[b'client_id']) != 1:
-            return MultipleParameterError('client_id').generate(request)
+            returnValue(MultipleParameterError('client_id').generate(request))
         try:
             clientId = request.args[b'client_id'][0].decode('utf-8')
         except UnicodeDecodeError:
-            return MalformedParameterError('client_id').generate(request)
+            returnValue(MalformedParameterError('client_id').generate(request))
         try:
-            client = self._clientStorage.getClient(clientId)
+            client = yield self._clientStorage.getClient(clientId)
         except KeyError:
-            return InvalidParameterError('client_id').generate(request)
+            returnValue(InvalidParameterError('client_id').generate(request))
         if b'redirect_uri' not in request.args:
             if len(client.redirectUris) != 1:
-                return MissingParameterError('redirect_uri').generate(request)
+                returnValue(MissingParameterError('redirect_uri').generate(request))
             redirectUri = client.redirectUris[0]
         elif len(request.args[b'redirect_uri']) != 1:
-            return MultipleParameterError('redirect_uri').generate(request)
+            returnValue(MultipleParameterError('redirect_uri').generate(request))
         else:
             try:
                 redirectUri = request.args[b'redirect_uri'][0].decode('utf-8')
             except UnicodeDecodeError:
-                return MalformedParameterError('redirect_uri').generate(request)
-        if redirectUri not in client.redirectUris:
-            return InvalidRedirectUriError().generate(request)
+                returnValue(MalformedParameterError('redirect_uri').generate(request))
+        if not client.hasRedirectUri(redirectUri):
+            returnValue(InvalidRedirectUriError().generate(request))
         try:
             errorInFragment = request.args[b'response_type'][0].decode('utf-8') == 'token'
         except (UnicodeDecodeError, KeyError, IndexError):
             errorInFragment = False
         if b'state' in request.args and len(request.args[b'state']) != 1:
-            return MultipleParameterError('state').generate(request, redirectUri, errorInFragment)
+            returnValue(MultipleParameterError('state').generate(
+                request, redirectUri, errorInFragment))
         state = request.args.get(b'state', [None])[0]
         if not self.allowInsecureRequestDebug and not request.isSecure():
-            return InsecureConnectionError(state).generate(request, redirectUri, errorInFragment)
+            returnValue(InsecureConnectionError(state).generate(
+                request, redirectUri, errorInFragment))
         if b'response_type' not in request.args:
-            return MissingParameterError('response_type', state=state)\
-                .generate(request, redirectUri, errorInFragment)
+            returnValue(MissingParameterError('response_type', state=state).generate(
+                request, redirectUri, errorInFragment))
         elif len(request.args[b'response_type']) != 1:
-            return MultipleParameterError('response_type', state=state)\
-                .generate(request, redirectUri, errorInFragment)
+            returnValue(MultipleParameterError('response_type', state=state).generate(
+                request, redirectUri, errorInFragment))
         try:
             responseType = request.args[b'response_type'][0].decode('utf-8')
         except UnicodeDecodeError:
-            return MalformedParameterError('response_type', state)\
-                .generate(request, redirectUri, errorInFragment)
+            returnValue(MalformedParameterError('response_type', state).generate(
+                request, redirectUri, errorInFragment))
         errorInFragment = responseType == 'token'
         if b'scope' not in request.args:
             if self.defaultScope is None:
-                return MissingParameterError('scope', state=state)\
-                    .generate(request, redirectUri, errorInFragment)
+                returnValue(MissingParameterError('scope', state=state).generate(
+                    request, redirectUri, errorInFragment))
             scope = self.defaultScope
         elif len(request.args[b'scope']) != 1:
-            return MultipleParameterError('scope', state=state)\
-                .generate(request, redirectUri, errorInFragment)
+            returnValue(MultipleParameterError('scope', state=state).generate(
+                request, redirectUri, errorInFragment))
         else:
             try:
                 scope = request.args[b'scope'][0].decode('utf-8').split()
             except UnicodeDecodeError:
-                return InvalidScopeError(request.args[b'scope'][0], state=state)\
-                    .generate(request, redirectUri, errorInFragment)
+                returnValue(InvalidScopeError(request.args[b'scope'][0], state=state).generate(
+                    request, redirectUri, errorInFragment))
         grantType = responseType
         if responseType == 'code':
             grantType = GrantTypes.AuthorizationCode.value
         elif responseType == 'token':
             grantType = GrantTypes.Implicit.value
         if grantType not in self.acceptedGrantTypes:
-            return UnsupportedResponseTypeError(responseType, state)\
-                .generate(request, redirectUri, errorInFragment)
-        if grantType not in client.authorizedGrantTypes:
-            return UnauthorizedClientError(responseType, state)\
-                .generate(request, redirectUri, errorInFragment)
-        dataKey = 'request' + str(uuid4())
-        self._persistentStorage.put(dataKey, {
+            returnValue(UnsupportedResponseTypeError(responseType, state).generate(
+                request, redirectUri, errorInFragment))
+        if not client.isGrantTypeAuthorized(grantType):
+            returnValue(UnauthorizedClientError(responseType, state).generate(
+                request, redirectUri, errorInFragment))
+        data = {
             'response_type': grantType,
             'redirect_uri':  None if b'redirect_uri' not in request.args else redirectUri,
             'client_id': client.id,
             'scope': scope,
             'state': state
-        }, expireTime=int(time.time()) + self.requestDataLifetime)
+        }
+        expireTime = int(time.time()) + self.requestDataLifetime
+        if self.dataKeyKeyring is None:
+            dataKey = 'request' + str(uuid4())
+            yield self._persistentStorage.put(dataKey, data, expireTime=expireTime)
+        else:
+            dataKey = self._encodeDataKey(data, expireTime)
         try:
-            result = self.onAuthenticate(request, client, grantType, scope,
-                                         redirectUri, state, dataKey)
+            result = yield self._authenticate(request, client, grantType, scope,
+                                              redirectUri, state, dataKey)
         except Exception as error:
             logging.getLogger('txOauth2').error('Caught exception in onAuthenticate: ' + str(error),
                                                 exc_info=1)
-            return ServerError(state).generate(request, redirectUri, errorInFragment)
+            returnValue(ServerError(state).generate(request, redirectUri, errorInFragment))
         if isinstance(result, AuthorizationError):
-            return result.generate(request, redirectUri, errorInFragment)
-        return result
+            returnValue(result.generate(request, redirectUri, errorInFragment))
+        returnValue(result)
+
+    @inlineCallbacks
+    def _authenticate(self, request, client, responseType, scope, redirectUri, state, dataKey):
+        """
+        Call onPriorConsent, if the user of the request has already consented
+        to the non-empty scope, otherwise call onAuthenticate.
+        See onAuthenticate for the parameters.
+        :return: A Deferred which fires with the result of onPriorConsent or onAuthenticate.
+        """
+        if self.consentStorage is not None and scope:
+            userId = yield self.getConsentUserId(request)
+            if userId is not None:
+                consentScope = yield self.consentStorage.getConsent(userId, client.id)
+                if consentScope and isScopeSubset(scope, consentScope):
+                    try:
+                        result = yield self.onPriorConsent(
+                            request, client, responseType, scope, redirectUri, state,
+                            dataKey, userId)
+                    except InsecureRedirectUriError:
+                        pass  # Let the user confirm the insecure redirect uri.
+                    else:
+                        returnValue(result)
+        result = yield self.onAuthenticate(
+            request, client, responseType, scope, redirectUri, state, dataKey)
+        returnValue(result)
+
+    def getConsentUserId(self, request):
+        """
+        Called during a valid GET request to this OAuth2 resource, if a consent storage is used.
+        Override this method to return the id of the logged in user that sent the request,
+        e.g. from the session. The default implementation returns None.
+        :param request: The GET request.
+        :return: The id of the user, None if the user is unknown, or a Deferred.
+        """
+        return None
+
+    def onPriorConsent(self, request, client, responseType, scope, redirectUri, state, dataKey,
+                       userId):
+        """
+        Called instead of onAuthenticate, if the user has already consented to grant
+        the requested scope to the client. This method must be overridden if a consent storage
+        is used. It should call grantAccess with the same additionalData that binds the tokens
+        to the user as after onAuthenticate, e.g. with the userId.
+        If this method raises an InsecureRedirectUriError, onAuthenticate is called.
+        See onAuthenticate for the other parameters.
+        :param userId: The id of the user returned by getConsentUserId.
+        :return: A response or NOT_DONE_YET or a Deferred which fires with one of them.
+        """
+        raise NotImplementedError()
 
     @abstractmethod
     def onAuthenticate(self, request, client, responseType, scope, redirectUri, state, dataKey):
@@ -286,7 +434,7 @@ class OAuth2(Resource, object):
         :param state: The state that was send by the client.
         :param dataKey: This key is tied to this request
                         and must be passed to denyAccess or grantAccess.
-        :return: A response or NOT_DONE_YET
+        :return: A response or NOT_DONE_YET or a Deferred which fires with one of them.
         """
         raise NotImplementedError()
 
@@ -300,21 +448,35 @@ class OAuth2(Resource, object):
         The request will be closed and can't be written
         to after this function returns.
 
+        If the persistent storage returns a Deferred that has not yet fired, a Deferred
+        is returned instead, which fires with NOT_DONE_YET once the request has been
+        closed or fails with one of the exceptions listed below.
+
         :raises InvalidDataKeyError: If the given data key is invalid or expired.
         :param request: The request made by the user.
         :param dataKey: The data key that was given to onAuthenticate.
-        :return: NOT_DONE_YET
+        :return: NOT_DONE_YET or a Deferred.
+        """
+        return getDeferredResult(self._denyAccess(request, dataKey))
+
+    @inlineCallbacks
+    def _denyAccess(self, request, dataKey):
+        """
+        See denyAccess.
+        :param request: The request made by the user.
+        :param dataKey: The data key that was given to onAuthenticate.
+        :return: A Deferred which fires with NOT_DONE_YET.
         """
         try:
-            data = self._persistentStorage.pop(dataKey)
+            data = yield self._popRequestData(dataKey)
         except KeyError:
             raise InvalidDataKeyError(dataKey)
         errorInFragment = data['response_type'] == GrantTypes.Implicit.value
-        return UserDeniesAuthorization(data['state'])\
-            .generate(request, data['redirect_uri'], errorInFragment)
+        returnValue(UserDeniesAuthorization(data['state'])
+                    .generate(request, data['redirect_uri'], errorInFragment))
 
     def grantAccess(self, request, dataKey, scope=None, codeLifeTime=120, additionalData=None,
-                    allowInsecureRedirectUri=False):
+                    allowInsecureRedirectUri=False, consentUserId=None):
         """
         The user grants access to the list of scopes. This list may
         contain less values than the original list passed to onAuthenticate.
@@ -325,6 +487,11 @@ class OAuth2(Resource, object):
         The request will be closed and can't be written
         to after this function returns.
 
+        If the persistent storage, the client storage, the token factory or the token storage
+        return a Deferred that has not yet fired, a Deferred is returned instead, which fires
+        with NOT_DONE_YET once the request has been closed or fails with one of the exceptions
+        listed below.
+
         :raises InvalidDataKeyError: If the given data key is invalid or expired.
         :raises InsecureRedirectUriError: If the given data key is invalid or expired.
         :raises ValueError: If the data key belongs to a request with a custom response type.
@@ -339,44 +506,63 @@ class OAuth2(Resource, object):
                                with the generated tokens.
         :param allowInsecureRedirectUri: If false, this method will throw a InsecureRedirectUriError
                                          if the redirect uri does not use TLS (https).
-        :return: NOT_DONE_YET
+        :param consentUserId: If not None and a consent storage is used, remember that
+                              this user consented to grant the scope to the client.
+        :return: NOT_DONE_YET or a Deferred.
+        """
+        return getDeferredResult(self._grantAccess(
+            request, dataKey, scope, codeLifeTime, additionalData, allowInsecureRedirectUri,
+            consentUserId))
+
+    @inlineCallbacks
+    def _grantAccess(self, request, dataKey, scope, codeLifeTime, additionalData,
+                     allowInsecureRedirectUri, consentUserId):
+        """
+        See grantAccess.
+        :param request: The request made by the user.
+        :param dataKey: The data key that was given to onAuthenticate.
+        :param scope: The scope the user grants the client access to.
+        :param codeLifeTime: The lifetime of the generated code.
+        :param additionalData: Additional data associated with the generated tokens.
+        :param allowInsecureRedirectUri: Whether to allow a redirect uri without TLS.
+        :param consentUserId: The id of the user whose consent should be remembered or None.
+        :return: A Deferred which fires with NOT_DONE_YET.
         """
         try:
-            data = self._persistentStorage.pop(dataKey)
+            data = yield self._popRequestData(dataKey)
         except KeyError:
             raise InvalidDataKeyError(dataKey)
         state = data['state']
         responseType = data['response_type']
         errorInFragment = responseType == GrantTypes.Implicit.value
         if responseType not in [GrantTypes.AuthorizationCode.value, GrantTypes.Implicit.value]:
-            self._persistentStorage.put(
-                dataKey, data, expireTime=int(time.time()) + self.requestDataLifetime)
+            yield self._restoreRequestData(dataKey, data)
             raise ValueError(responseType)
         redirectUri = data['redirect_uri']
         try:
-            client = self._clientStorage.getClient(data['client_id'])
+            client = yield self._clientStorage.getClient(data['client_id'])
         except KeyError:
-            return InvalidParameterError('client_id')\
-                .generate(request, redirectUri, errorInFragment)
+            returnValue(InvalidParameterError('client_id')
+                        .generate(request, redirectUri, errorInFragment))
         if redirectUri is None:
             redirectUri = client.redirectUris[0]
         if not self.allowInsecureRequestDebug and not request.isSecure():
-            return InsecureConnectionError(state).generate(request, redirectUri, errorInFragment)
-        if not allowInsecureRedirectUri and urlparse(redirectUri).scheme != 'https':
-            self._persistentStorage.put(
-                dataKey, data, expireTime=int(time.time()) + self.requestDataLifetime)
+            returnValue(InsecureConnectionError(state)
+                        .generate(request, redirectUri, errorInFragment))
+        if not allowInsecureRedirectUri and \
+                client.getParsedRedirectUri(redirectUri).scheme != 'https':
+            yield self._restoreRequestData(dataKey, data)
             raise InsecureRedirectUriError()
         if scope is not None:
-            for acceptedScope in scope:
-                if acceptedScope not in data['scope']:
-                    return InvalidScopeError(scope, state)\
-                        .generate(request, redirectUri, errorInFragment)
+            if not isScopeSubset(scope, data['scope'], self.scopeRegistry):
+                returnValue(InvalidScopeError(scope, state)
+                            .generate(request, redirectUri, errorInFragment))
         else:
             scope = data['scope']
         if responseType == GrantTypes.AuthorizationCode.value:
-            code = self._tokenFactory.generateToken(
-                client, codeLifeTime, scope, additionalData=additionalData)
-            self._persistentStorage.put('code' + code, {
+            code = yield self._tokenFactory.generateToken(
+                codeLifeTime, client, scope, additionalData=additionalData)
+            yield self._persistentStorage.put('code' + code, {
                 'client_id': client.id,
                 'redirect_uri': redirectUri,
                 'additional_data': additionalData,
@@ -384,13 +570,70 @@ class OAuth2(Resource, object):
             }, expireTime=int(time.time()) + codeLifeTime)
             redirectUri = addToUrl(redirectUri, query={'state': state, 'code': code})
         else:
-            token = self._tokenFactory.generateToken(
+            token = yield self._tokenFactory.generateToken(
                 self.authTokenLifeTime, client, scope, additionalData=additionalData)
-            self._authTokenStorage.store(token, client, scope, additionalData=additionalData,
-                                         expireTime=int(time.time()) + self.authTokenLifeTime)
+            yield self._authTokenStorage.store(
+                token, client, scope, additionalData=additionalData,
+                expireTime=int(time.time()) + self.authTokenLifeTime)
             redirectUri = addToUrl(redirectUri, fragment={
                 'state': state, 'access_token': token, 'token_type': 'Bearer',
                 'expires_in': self.authTokenLifeTime, 'scope': ' '.join(scope)})
+        if consentUserId is not None and self.consentStorage is not None:
+            yield self.consentStorage.addConsent(consentUserId, client.id, scope)
         request.redirect(redirectUri)
         request.finish()
-        return NOT_DONE_YET
+        returnValue(NOT_DONE_YET)
+
+    def _encodeDataKey(self, data, expireTime):
+        """
+        Sign the data of an authorization request with the dataKeyKeyring.
+        :param data: The data of the authorization request.
+        :param expireTime: The time at which the data key expires.
+        :return: The data key.
+        """
+        claims = dict(data, jti=str(uuid4()), exp=expireTime, use=self._DATA_KEY_USE)
+        if data['state'] is not None:
+            claims['state'] = base64.urlsafe_b64encode(data['state']).decode('ascii')
+        return self.dataKeyKeyring.sign(claims)
+
+    def _popRequestData(self, dataKey):
+        """
+        Get the data of the authorization request that the data key belongs to.
+        A data key can only be used once.
+        :raises KeyError: If the data key is invalid, expired or has already been used.
+        :param dataKey: The data key that was given to onAuthenticate.
+        :return: The data of the authorization request or a Deferred which fires with it.
+        """
+        if self.dataKeyKeyring is None:
+            return self._persistentStorage.pop(dataKey)
+        if not isAnyStr(dataKey):
+            raise KeyError(dataKey)
+        try:
+            claims = self.dataKeyKeyring.verify(dataKey)
+        except InvalidJWTError:
+            raise KeyError(dataKey)
+        if claims.get('use') != self._DATA_KEY_USE or 'jti' not in claims \
+                or 'exp' not in claims:
+            raise KeyError(dataKey)
+        now = time.time()
+        while self._usedDataKeys and next(iter(self._usedDataKeys.values())) < now:
+            self._usedDataKeys.popitem(last=False)
+        if claims['jti'] in self._usedDataKeys:
+            raise KeyError(dataKey)
+        self._usedDataKeys[claims['jti']] = claims['exp']
+        if claims['state'] is not None:
+            claims['state'] = base64.urlsafe_b64decode(claims['state'].encode('ascii'))
+        return claims
+
+    def _restoreRequestData(self, dataKey, data):
+        """
+        Allow the data key to be used again after the authorization request could not be handled.
+        :param dataKey: The data key that was given to onAuthenticate.
+        :param data: The data of the authorization request.
+        :return: None or a Deferred.
+        """
+        if self.dataKeyKeyring is None:
+            return self._persistentStorage.put(
+                dataKey, data, expireTime=int(time.time()) + self.requestDataLifetime)
+        self._usedDataKeys.pop(data['jti'], None)
+        return None
@@ -0,0 +1,134 @@
+# Copyright (c) Sebastian Scholz
+# See LICENSE for details.
+
+
+class ScopeRegistry(object):
+    """
+    A registry that maps scope names to bit positions. This allows to represent a scope
+    (a list of scope names) as an integer bitmask and to check whether a scope
+    is a subset of another scope with a single bitwise operation.
+
+    A registry can be passed to the token storages that support it, to the TokenResource
+    and to the OAuth2 resource. Note that a scope that is converted to a bitmask and back
+    is returned in the order in which its scope names were registered.
+
+    Scope names are usually sent by clients, so a registry that should not grow with every
+    unknown scope name can be frozen once all known scope names are registered.
+    The storages and resources only look up scope names and never register them.
+    """
+
+    def __init__(self, scopes=None, frozen=False):
+        """
+        :param scopes: An optional list of scope names to register in that order.
+        :param frozen: Whether to freeze the registry after registering the scopes.
+        """
+        super(ScopeRegistry, self).__init__()
+        self._scopeBits = {}
+        self._scopeNames = []
+        self._frozen = False
+        if scopes is not None:
+            for scopeName in scopes:
+                self.register(scopeName)
+        self._frozen = frozen
+
+    @property
+    def frozen(self):
+        """
+        :return: True, if no more scope names can be registered.
+        """
+        return self._frozen
+
+    def freeze(self):
+        """ Prevent the registration of any more scope names. """
+        self._frozen = True
+
+    def register(self, scopeName):
+        """
+        Register a scope name, if it is not already registered.
+        :raises ValueError: If the scope name is not registered and the registry is frozen.
+        :param scopeName: The name of the scope.
+        :return: The bitmask representing the scope name.
+        """
+        bit = self._scopeBits.get(scopeName)
+        if bit is None:
+            if self._frozen:
+                raise ValueError('Unknown scope name: ' + repr(scopeName))
+            bit = 1 << len(self._scopeNames)
+            self._scopeBits[scopeName] = bit
+            self._scopeNames.append(scopeName)
+        return bit
+
+    def toMask(self, scope):
+        """
+        Convert a scope into a bitmask. Unknown scope names are registered.
+        :raises ValueError: If a scope name is not registered and the registry is frozen.
+        :param scope: A list of scope names.
+        :return: The bitmask representing the scope.
+        """
+        mask = 0
+        for scopeName in scope:
+            mask |= self.register(scopeName)
+        return mask
+
+    def lookupMask(self, scope):
+        """
+        Convert a scope into a bitmask without registering unknown scope names.
+        :param scope: A list of scope names.
+        :return: The bitmask representing the scope or None,
+                 if one of the scope names is not registered.
+        """
+        mask = 0
+        for scopeName in scope:
+            bit = self._scopeBits.get(scopeName)
+            if bit is None:
+                return None
+            mask |= bit
+        return mask
+
+    def toScope(self, mask):
+        """
+        :param mask: A bitmask returned by toMask or lookupMask.
+        :return: The list of scope names represented by the bitmask.
+        """
+        scope = []
+        while mask:
+            lowestBit = mask & -mask
+            scope.append(self._scopeNames[lowestBit.bit_length() - 1])
+            mask ^= lowestBit
+        return scope
+
+    @staticmethod
+    def grantsAccess(grantedMask, requestedMask):
+        """
+        :param grantedMask: The bitmask of the scope that is granted.
+        :param requestedMask: The bitmask of the requested scope or None.
+        :return: True, if the requested scope is a subset of the granted scope.
+        """
+        return requestedMask is not None and requestedMask & ~grantedMask == 0
+
+    def isSubset(self, scope, ofScope):
+        """
+        :param scope: A list of scope names.
+        :param ofScope: Another list of scope names.
+        :return: True, if all scope names in scope are also in ofScope.
+        """
+        requestedMask = self.lookupMask(scope)
+        grantedMask = self.lookupMask(ofScope)
+        if requestedMask is None or grantedMask is None:
+            return isScopeSubset(scope, ofScope)
+        return self.grantsAccess(grantedMask, requestedMask)
+
+
+def isScopeSubset(scope, ofScope, scopeRegistry=None):
+    """
+    :param scope: A list of scope names.
+    :param ofScope: Another list of scope names.
+    :param scopeRegistry: An optional ScopeRegistry to compare the scopes as bitmasks.
+    :return: True, if all scope names in scope are also in ofScope.
+    """
+    if scopeRegistry is not None:
+        return scopeRegistry.isSubset(scope, ofScope)
+    for scopeName in scope:
+        if scopeName not in ofScope:
+            return False
+    return True
@@ -0,0 +1,4 @@
+# Copyright (c) Sebastian Scholz
+# See LICENSE for details.
+
+__all__ = ['codec', 'journal', 'memory', 'redis', 'snapshot', 'sqlite', 'worker', 'wrappers']
@@ -0,0 +1,52 @@
+# Copyright (c) Sebastian Scholz
+# See LICENSE for details.
+import json
+import base64
+
+
+class JSONCodec(object):
+    """
+    The default codec of the storages that write the additional data of tokens or the data
+    of a persistent storage to the disk or to a server. Values are encoded as JSON, so reading
+    data written by someone else can not execute code. Byte strings are encoded as
+    {"__bytes__": "<base64>"} and tuples are decoded as lists.
+    Any object with the same encode and decode methods can be given to the storages instead,
+    e.g. to support other types.
+    """
+    _BYTES_KEY = '__bytes__'
+
+    def encode(self, value):
+        """
+        :raises TypeError: If the value can not be encoded.
+        :param value: The value to encode.
+        :return: The encoded value as bytes.
+        """
+        return json.dumps(value, default=self._encodeObject, separators=(',', ':'))\
+            .encode('utf-8')
+
+    def decode(self, data):
+        """
+        :raises ValueError: If the data is not a valid encoded value.
+        :param data: A value encoded by encode.
+        :return: The decoded value.
+        """
+        return json.loads(bytes(data).decode('utf-8'), object_hook=self._decodeObject)
+
+    def _encodeObject(self, value):
+        """
+        :raises TypeError: If the value can not be encoded.
+        :param value: A value that is not supported by JSON.
+        :return: A JSON object representing the value.
+        """
+        if isinstance(value, bytes):
+            return {self._BYTES_KEY: base64.b64encode(value).decode('ascii')}
+        raise TypeError('Unable to encode a value of type ' + type(value).__name__)
+
+    def _decodeObject(self, jsonObject):
+        """
+        :param jsonObject: A decoded JSON object.
+        :return: The value represented by the JSON object.
+        """
+        if len(jsonObject) == 1 and self._BYTES_KEY in jsonObject:
+            return base64.b64decode(jsonObject[self._BYTES_KEY])
+        return jsonObject
@@ -0,0 +1,251 @@
+# Copyright (c) Sebastian Scholz
+# See LICENSE for details.
+import os
+import json
+import inspect
+import logging
+
+from twisted.internet.defer import gatherResults, succeed
+
+from txoauth2 import clients
+from txoauth2.clients import Client, ClientStorage, compileClient, getClientAttributes, \
+    getClientClass
+from txoauth2.storage.worker import WorkerThreads
+from txoauth2.util import unwrapFirstError
+
+
+class JournalClientStorage(ClientStorage):
+    """
+    A ClientStorage that keeps all clients in memory and persists changes in a journal.
+    addClient and removeClient change the clients in memory and the change is appended
+    to the journal at path + '.journal' within flushInterval seconds by a worker thread.
+    Once the journal contains compactThreshold records, all clients are written to a snapshot
+    at path + '.snapshot' and the journal is truncated. Each client is encoded once when it is
+    added, so the reactor thread only copies a list of encoded clients for a snapshot.
+
+    Both files contain one JSON object per line. On creation, they are read in a single
+    streaming pass. Changes that were not yet flushed to the journal are lost on a crash.
+    If compileClients is True, the compiled form of the clients is kept (see compileClient).
+    """
+    def __init__(self, path, flushInterval=1, compactThreshold=10000, reactor=None,
+                 compileClients=False):
+        """
+        :raises ValueError: If the snapshot is corrupted.
+        :param path: The path prefix of the snapshot and the journal.
+        :param flushInterval: The maximum number of seconds a change is kept in memory
+                              before it is appended to the journal.
+        :param compactThreshold: The number of records in the journal
+                                 after which a snapshot is written.
+        :param reactor: The reactor to use, defaults to the global reactor.
+        :param compileClients: Whether to keep and return the compiled form of the clients.
+        """
+        super(JournalClientStorage, self).__init__()
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._snapshotPath = path + '.snapshot'
+        self._journalPath = path + '.journal'
+        self._flushInterval = flushInterval
+        self._compactThreshold = compactThreshold
+        self._compileClients = compileClients
+        self._clientClasses = {cls[0]: cls[1] for cls in inspect.getmembers(clients)
+                               if inspect.isclass(cls[1]) and issubclass(cls[1], Client)}
+        self._clients = {}
+        self._records = {}
+        self._numJournalRecords = 0
+        self._pendingRecords = []
+        self._flushCall = None
+        self._journalFile = None
+        self._workerThread = WorkerThreads(
+            'txoauth2-journal', onShutdown=self.close, reactor=reactor)
+        self._restore()
+
+    def getClient(self, clientId):
+        """
+        Return a client object which represents the client
+        with the given client id.
+        :raises KeyError: If no client with the given client id exists.
+        :param clientId: The id of the client.
+        :return: A client object.
+        """
+        try:
+            return self._clients[clientId]
+        except KeyError:
+            raise KeyError('No client with id "{id}" exists'.format(id=clientId))
+
+    def addClient(self, client):
+        """
+        Add a new or update an existing client.
+        :raises ValueError: If the client can not be encoded.
+        :param client: The client to update or add.
+        """
+        try:
+            record = json.dumps({
+                'id': client.id,
+                'type': getClientClass(client).__name__,
+                'redirect_uris': list(client.redirectUris),
+                'authorized_grant_types': list(client.authorizedGrantTypes),
+                'attributes': getClientAttributes(client)
+            }, separators=(',', ':'), sort_keys=True).encode('utf-8') + b'\n'
+        except TypeError as error:
+            raise ValueError('Unable to encode the client: ' + str(error))
+        if self._compileClients:
+            client = compileClient(client)
+        self._clients[client.id] = client
+        self._records[client.id] = record
+        self._addRecord(record)
+
+    def removeClient(self, clientId):
+        self.getClient(clientId)
+        del self._clients[clientId]
+        del self._records[clientId]
+        self._addRecord(json.dumps({'id': clientId, 'removed': True},
+                                   separators=(',', ':')).encode('utf-8') + b'\n')
+
+    def flush(self):
+        """
+        Append all pending changes to the journal and write a snapshot,
+        if the journal has reached the compact threshold.
+        :return: A Deferred which fires once the changes were written to the disk.
+        """
+        if self._numJournalRecords >= self._compactThreshold:
+            return self.compact()
+        return self._appendPending()
+
+    def compact(self):
+        """
+        Append all pending changes to the journal, write a snapshot of all clients
+        and truncate the journal.
+        :return: A Deferred which fires once the snapshot was written to the disk
+                 or fails with the first error.
+        """
+        appended = self._appendPending()
+        self._numJournalRecords = 0
+        return gatherResults([
+            appended, self._workerThread.run(self._writeSnapshot, list(self._records.values()))
+        ], consumeErrors=True).addCallbacks(lambda _: None, unwrapFirstError)
+
+    def close(self):
+        """
+        Append all pending changes to the journal and stop the worker thread.
+        :return: A Deferred which fires once the storage is closed.
+        """
+        if not self._workerThread.isRunning and not self._pendingRecords:
+            return succeed(None)
+        return gatherResults([self.flush(), self._workerThread.stop(self._closeJournal)],
+                             consumeErrors=True).addCallbacks(lambda _: None, unwrapFirstError)
+
+    def _restore(self):
+        """
+        Read the snapshot and replay the journal. An incomplete
+        record at the end of the journal is removed.
+        """
+        for path in [self._snapshotPath, self._journalPath]:
+            if not os.path.exists(path):
+                continue
+            validSize = 0
+            with open(path, 'rb') as clientFile:
+                for line in clientFile:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('Incomplete record')
+                        self._restoreRecord(line)
+                    except (ValueError, KeyError, TypeError):
+                        if path == self._snapshotPath:
+                            raise ValueError('The client snapshot is corrupted')
+                        break
+                    validSize += len(line)
+                    if path == self._journalPath:
+                        self._numJournalRecords += 1
+            if path == self._journalPath and validSize < os.path.getsize(path):
+                with open(path, 'r+b') as journalFile:
+                    journalFile.truncate(validSize)
+
+    def _restoreRecord(self, record):
+        """
+        Apply a record from the snapshot or the journal.
+        :raises ValueError: If the record is malformed.
+        :raises KeyError: If the record is missing a field.
+        :param record: The encoded record.
+        """
+        data = json.loads(record.decode('utf-8'))
+        clientId = data['id']
+        if data.get('removed', False):
+            self._clients.pop(clientId, None)
+            self._records.pop(clientId, None)
+            return
+        clientClass = self._clientClasses.get(data['type'])
+        if clientClass is None:
+            raise ValueError('Unable to find client class ' + data['type'])
+        client = clientClass(clientId, data['redirect_uris'], data['authorized_grant_types'],
+                             **data['attributes'])
+        if self._compileClients:
+            client = compileClient(client)
+        self._clients[clientId] = client
+        self._records[clientId] = record
+
+    def _addRecord(self, record):
+        """
+        Queue a record for the journal.
+        :param record: The encoded record.
+        """
+        self._pendingRecords.append(record)
+        self._numJournalRecords += 1
+        if self._flushCall is None:
+            self._flushCall = self._reactor.callLater(self._flushInterval, self._onFlushTimer)
+
+    def _onFlushTimer(self):
+        """ Write the pending changes and log a failure. """
+        self.flush().addErrback(
+            lambda failure: logging.getLogger('txOauth2').error(
+                'Failed to write the client journal: %s', failure.getErrorMessage()))
+
+    def _appendPending(self):
+        """
+        Append all pending records to the journal.
+        :return: A Deferred which fires once the records were written to the disk.
+        """
+        if self._flushCall is not None and self._flushCall.active():
+            self._flushCall.cancel()
+        self._flushCall = None
+        records, self._pendingRecords = self._pendingRecords, []
+        if not records:
+            return succeed(None)
+        return self._workerThread.run(self._appendToJournal, records)
+
+    def _appendToJournal(self, records):
+        """
+        Append records to the journal. Must only be called from the worker thread.
+        :param records: A list of encoded records.
+        """
+        if not records:
+            return
+        if self._journalFile is None:
+            self._journalFile = open(self._journalPath, 'ab')
+        self._journalFile.write(b''.join(records))
+        self._journalFile.flush()
+        os.fsync(self._journalFile.fileno())
+
+    def _writeSnapshot(self, records):
+        """
+        Write a snapshot to a temporary file, replace the old snapshot with it and truncate
+        the journal. Must only be called from the worker thread.
+        :param records: A list of the encoded records of all clients.
+        """
+        temporaryPath = self._snapshotPath + '.tmp'
+        with open(temporaryPath, 'wb') as snapshotFile:
+            for start in range(0, len(records), 10000):
+                snapshotFile.write(b''.join(records[start:start + 10000]))
+            snapshotFile.flush()
+            os.fsync(snapshotFile.fileno())
+        getattr(os, 'replace', os.rename)(temporaryPath, self._snapshotPath)
+        self._closeJournal()
+        with open(self._journalPath, 'wb') as journalFile:
+            journalFile.flush()
+            os.fsync(journalFile.fileno())
+
+    def _closeJournal(self):
+        """ Close the journal. Must only be called from the worker thread. """
+        if self._journalFile is not None:
+            self._journalFile.close()
+            self._journalFile = None
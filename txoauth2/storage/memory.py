@@ -0,0 +1,546 @@
+# Copyright (c) Sebastian Scholz
+# See LICENSE for details.
+import time
+import heapq
+
+from txoauth2.resource import ConsentStorage
+from txoauth2.token import PersistentStorage, TokenAccess, TokenStorage
+
+
+class _TokenRecord(object):
+    """
+    The data that the DictTokenStorage stores alongside a token. The scope is stored as
+    an interned tuple (or as a bitmask, if all its names are registered in the ScopeRegistry
+    of the storage) and the client id
+    is interned, so tokens with the same client or scope share these objects. This takes about
+    200 bytes per token (excluding the token itself) compared to about 520 bytes when storing
+    a dict with a scope list per token, as measured by benchmarks/tokenStorageMemory.py
+    on CPython 3.11.
+    """
+    __slots__ = ('client', 'scope', 'data', 'birthTime', 'expireTime')
+
+    def __init__(self, client, scope, data, birthTime, expireTime):
+        self.client = client
+        self.scope = scope
+        self.data = data
+        self.birthTime = birthTime
+        self.expireTime = expireTime
+
+
+class _InternTable(object):
+    """
+    Maps equal values to one shared instance while they are in use. A value is kept until
+    it was released as often as it was interned, so the table only holds the values
+    of the stored tokens.
+    """
+    __slots__ = ('_entries',)
+
+    def __init__(self):
+        self._entries = {}
+
+    def intern(self, value):
+        """
+        :param value: A hashable value.
+        :return: The shared instance that is equal to the value.
+        """
+        entry = self._entries.get(value)
+        if entry is None:
+            self._entries[value] = [value, 1]
+            return value
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, value):
+        """
+        Release a value that was returned by intern.
+        :param value: The interned value.
+        """
+        entry = self._entries.get(value)
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._entries[value]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DictTokenStorage(TokenStorage):
+    """
+    This token storage does not implement any type of persistence and tokens will therefore
+    not survive a server restart. This implementation should probably only be used for testing.
+    The tokens are indexed by their client and, if getUserId is given, by their user,
+    so removeByClient and removeByUser only need to visit the removed tokens.
+    """
+    def __init__(self, scopeRegistry=None, getUserId=None):
+        """
+        :param scopeRegistry: An optional ScopeRegistry. If given, the scope of each token whose
+                              scope names are all registered is stored as a bitmask and scope
+                              checks are done with a single bitwise operation. The returned
+                              scopes are then ordered in the order in which the scope names
+                              were registered. The storage never registers scope names,
+                              other scopes are stored as tuples.
+        :param getUserId: An optional function that returns the id of the user
+                          of a token or None when called with its additional data.
+                          It is required for removeByUser.
+        """
+        super(DictTokenStorage, self).__init__()
+        self._tokens = {}
+        self._clientIndex = {}
+        self._userIndex = {}
+        self._clientIds = _InternTable()
+        self._scopes = _InternTable()
+        self._scopeRegistry = scopeRegistry
+        self._getUserId = getUserId
+
+    def contains(self, token):
+        if token not in self._tokens:
+            return False
+        return not self._checkExpire(token)
+
+    def hasAccess(self, token, scope):
+        if self._checkExpire(token):
+            raise KeyError('Token expired')
+        tokenScope = self._tokens[token].scope
+        if not isinstance(tokenScope, tuple):
+            return self._scopeRegistry.grantsAccess(
+                tokenScope, self._scopeRegistry.lookupMask(scope))
+        for scopeItem in scope:
+            if scopeItem not in tokenScope:
+                return False
+        return True
+
+    def checkAccess(self, token, scope):
+        if token not in self._tokens or self._checkExpire(token):
+            return TokenAccess.Invalid
+        tokenScope = self._tokens[token].scope
+        if not isinstance(tokenScope, tuple):
+            if self._scopeRegistry.grantsAccess(
+                    tokenScope, self._scopeRegistry.lookupMask(scope)):
+                return TokenAccess.Granted
+            return TokenAccess.InsufficientScope
+        for scopeItem in scope:
+            if scopeItem not in tokenScope:
+                return TokenAccess.InsufficientScope
+        return TokenAccess.Granted
+
+    def getTokenAdditionalData(self, token):
+        self._checkExpire(token)
+        return self._tokens[token].data
+
+    def getTokenScope(self, token):
+        self._checkExpire(token)
+        return self._toScopeList(self._tokens[token].scope)
+
+    def getTokenClient(self, token):
+        self._checkExpire(token)
+        return self._tokens[token].client
+
+    def getTokenLifetime(self, token):
+        self._checkExpire(token)
+        return int(time.time()) - self._tokens[token].birthTime
+
+    def getTokenInfo(self, token):
+        if self._checkExpire(token):
+            raise KeyError('Token expired')
+        record = self._tokens[token]
+        return {
+            'scope': self._toScopeList(record.scope),
+            'client_id': record.client,
+            'additional_data': record.data,
+            'birth_time': record.birthTime,
+            'expire_time': record.expireTime
+        }
+
+    def store(self, token, client, scope, additionalData=None, expireTime=None):
+        if not isinstance(token, str):
+            raise ValueError('Token parameter is not a string')
+        if not isinstance(scope, list):
+            scope = [scope]
+        if token in self._tokens:
+            self._deleteToken(token)
+        if expireTime is not None and expireTime <= time.time():
+            return
+        self._addRecord(token, _TokenRecord(
+            client.id, self._toStoredScope(scope), additionalData, int(time.time()), expireTime))
+
+    def remove(self, token):
+        self._deleteToken(token)
+
+    def removeByClient(self, clientId):
+        tokens = list(self._clientIndex.get(clientId, ()))
+        for token in tokens:
+            self.remove(token)
+        return tokens
+
+    def removeByUser(self, userId):
+        if self._getUserId is None:
+            raise NotImplementedError('The user of a token can only be determined '
+                                      'if the token storage was created with getUserId')
+        tokens = list(self._userIndex.get(userId, ()))
+        for token in tokens:
+            self.remove(token)
+        return tokens
+
+    def _getTokenUser(self, additionalData):
+        """
+        :param additionalData: The additional data of a token.
+        :return: The id of the user of the token or None.
+        """
+        if self._getUserId is None:
+            return None
+        return self._getUserId(additionalData)
+
+    def _deleteToken(self, token):
+        """
+        Delete a token and remove it from the client and user index.
+        :raises KeyError: If the token is not in the token storage.
+        :param token: The token.
+        """
+        record = self._tokens.pop(token)
+        self._clientIds.release(record.client)
+        if isinstance(record.scope, tuple):
+            self._scopes.release(record.scope)
+        self._removeFromIndex(self._clientIndex, record.client, token)
+        userId = self._getTokenUser(record.data)
+        if userId is not None:
+            self._removeFromIndex(self._userIndex, userId, token)
+
+    @staticmethod
+    def _addToIndex(index, key, token):
+        """
+        :param index: The client or user index.
+        :param key: The client or user id.
+        :param token: The token to add to the index.
+        """
+        tokens = index.get(key)
+        if tokens is None:
+            tokens = index[key] = set()
+        tokens.add(token)
+
+    @staticmethod
+    def _removeFromIndex(index, key, token):
+        """
+        :param index: The client or user index.
+        :param key: The client or user id.
+        :param token: The token to remove from the index.
+        """
+        tokens = index.get(key)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del index[key]
+
+    def _addRecord(self, token, record):
+        """
+        Add the record of a token and add the token to the client and user index.
+        The client id and the scope of the record are replaced by their interned instances.
+        :param token: The token, which must not be in the token storage.
+        :param record: The record of the token.
+        """
+        record.client = self._clientIds.intern(record.client)
+        if isinstance(record.scope, tuple):
+            record.scope = self._scopes.intern(record.scope)
+        self._tokens[token] = record
+        self._addToIndex(self._clientIndex, record.client, token)
+        userId = self._getTokenUser(record.data)
+        if userId is not None:
+            self._addToIndex(self._userIndex, userId, token)
+
+    def _toStoredScope(self, scope):
+        """
+        :param scope: The scope as a list of scope names.
+        :return: The scope as stored in a token record.
+        """
+        if self._scopeRegistry is not None:
+            mask = self._scopeRegistry.lookupMask(scope)
+            if mask is not None:
+                return mask
+        return tuple(scope)
+
+    def _toScopeList(self, storedScope):
+        """
+        :param storedScope: The scope as stored in a token record.
+        :return: The scope as a list of scope names.
+        """
+        if not isinstance(storedScope, tuple):
+            return self._scopeRegistry.toScope(storedScope)
+        return list(storedScope)
+
+    def _checkExpire(self, token):
+        """
+        Check if a token has expired and remove it if necessary.
+        :raises KeyError: If the token is not in the token storage.
+        :param token: The token to check.
+        :return: True if the token has expired.
+        """
+        expireTime = self._tokens[token].expireTime
+        if expireTime is not None and time.time() > expireTime:
+            self._deleteToken(token)
+            return True
+        return False
+
+
+class BucketedTokenStorage(DictTokenStorage):
+    """
+    An in memory token storage that groups tokens with an expire time into buckets
+    of bucketSize seconds. As time advances, whole buckets of expired tokens are dropped,
+    so the memory usage stays proportional to the number of live tokens, even if expired
+    tokens are never looked up again. Like the DictTokenStorage, tokens will not survive
+    a server restart.
+    Expired buckets are dropped whenever a token is stored or looked up.
+    """
+    def __init__(self, bucketSize=60, scopeRegistry=None, getUserId=None):
+        """
+        :param bucketSize: The time span in seconds covered by one expiry bucket.
+        :param scopeRegistry: An optional ScopeRegistry, see DictTokenStorage.
+        :param getUserId: An optional function to determine the user of a token,
+                          see DictTokenStorage.
+        """
+        super(BucketedTokenStorage, self).__init__(
+            scopeRegistry=scopeRegistry, getUserId=getUserId)
+        if bucketSize <= 0:
+            raise ValueError('The bucket size must be positive')
+        self._bucketSize = bucketSize
+        self._buckets = {}
+        self._bucketHeap = []
+        self._expiredTokens = 0
+        self._evictedTokens = 0
+
+    def store(self, token, client, scope, additionalData=None, expireTime=None):
+        self._dropExpiredBuckets()
+        super(BucketedTokenStorage, self).store(
+            token, client, scope, additionalData=additionalData, expireTime=expireTime)
+
+    def getStatistics(self):
+        """
+        :return: A dict with the number of 'live_tokens' currently stored,
+                 the number of 'expired_tokens' that were removed because they
+                 were found to be expired on access and the number of 'evicted_tokens'
+                 that were removed together with their expiry bucket.
+        """
+        return {
+            'live_tokens': len(self._tokens),
+            'expired_tokens': self._expiredTokens,
+            'evicted_tokens': self._evictedTokens
+        }
+
+    def _addRecord(self, token, record):
+        super(BucketedTokenStorage, self)._addRecord(token, record)
+        if record.expireTime is not None:
+            bucket = int(record.expireTime // self._bucketSize)
+            if bucket not in self._buckets:
+                self._buckets[bucket] = set()
+                heapq.heappush(self._bucketHeap, bucket)
+            self._buckets[bucket].add(token)
+
+    def _deleteToken(self, token):
+        expireTime = self._tokens[token].expireTime
+        if expireTime is not None:
+            bucket = self._buckets.get(int(expireTime // self._bucketSize))
+            if bucket is not None:
+                bucket.discard(token)
+        super(BucketedTokenStorage, self)._deleteToken(token)
+
+    def _checkExpire(self, token):
+        expireTime = self._tokens[token].expireTime
+        self._dropExpiredBuckets()
+        if token not in self._tokens:  # The token was evicted together with its bucket.
+            return True
+        if expireTime is not None and time.time() > expireTime:
+            self.remove(token)
+            self._expiredTokens += 1
+            return True
+        return False
+
+    def _dropExpiredBuckets(self):
+        """ Remove all buckets whose tokens have all expired. """
+        currentBucket = int(time.time() // self._bucketSize)
+        while self._bucketHeap and self._bucketHeap[0] < currentBucket:
+            for token in self._buckets.pop(heapq.heappop(self._bucketHeap)):
+                self._deleteToken(token)
+                self._evictedTokens += 1
+
+
+class DictPersistentStorage(PersistentStorage):
+    """
+    A PersistentStorage that keeps the data in memory. Expired data is reclaimed
+    by a hierarchical timing wheel that is driven by the reactor clock, so data that is
+    never popped, like the data of abandoned authorization requests, does not accumulate.
+
+    The wheel has numLevels levels of wheelSize slots. A slot on level n covers
+    tickDuration * wheelSize ** n seconds. Each entry is placed in the slot of the lowest
+    level that can hold its expiration time and moves down one level whenever the slot
+    is reached, so storing, popping and reclaiming an entry takes amortized constant time.
+    Entries that expire after the range of the highest level are placed in its last
+    slot and rescheduled from there. The wheel is only advanced while it contains entries.
+
+    The expire times are compared with reactor.seconds(), which are the seconds
+    since the epoch for all real reactors.
+    """
+
+    def __init__(self, tickDuration=1, wheelSize=64, numLevels=4, reactor=None):
+        """
+        :raises ValueError: If the tick duration is not positive, the wheel size
+                            is smaller than 2 or the number of levels is smaller than 1.
+        :param tickDuration: The resolution of the wheel in seconds. Expired data is
+                             reclaimed at most this many seconds after it expires.
+        :param wheelSize: The number of slots on each level of the wheel.
+        :param numLevels: The number of levels of the wheel.
+        :param reactor: The reactor to use, defaults to the global reactor.
+        """
+        super(DictPersistentStorage, self).__init__()
+        if tickDuration <= 0 or wheelSize < 2 or numLevels < 1:
+            raise ValueError('Invalid timing wheel configuration')
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._tickDuration = tickDuration
+        self._wheelSize = wheelSize
+        self._slotSpans = [wheelSize ** level for level in range(numLevels)]
+        self._wheels = [[set() for _ in range(wheelSize)] for _ in range(numLevels)]
+        self._entries = {}
+        self._numScheduledEntries = 0
+        self._currentTick = 0
+        self._tickCall = None
+        self._numExpired = 0
+        self._numPopped = 0
+
+    def put(self, key, data, expireTime=None):
+        self._removeEntry(key)
+        if expireTime is None:
+            self._entries[key] = [data, None, None]
+            return
+        now = self._reactor.seconds()
+        if expireTime <= now:
+            self._numExpired += 1
+            return
+        if self._tickCall is None:
+            self._currentTick = int(now // self._tickDuration)
+            self._tickCall = self._reactor.callLater(self._tickDuration, self._onTick)
+        entry = [data, expireTime, None]
+        self._entries[key] = entry
+        self._numScheduledEntries += 1
+        self._schedule(key, entry)
+
+    def pop(self, key):
+        entry = self._removeEntry(key)
+        if entry is None:
+            raise KeyError(key)
+        if entry[1] is not None and self._reactor.seconds() > entry[1]:
+            self._numExpired += 1
+            raise KeyError(key)
+        self._numPopped += 1
+        return entry[0]
+
+    def getStatistics(self):
+        """
+        :return: A dictionary with the number of live entries, the number of entries
+                 that expire, the number of entries which expired or were reclaimed
+                 and the number of entries that were popped.
+        """
+        return {
+            'live_entries': len(self._entries),
+            'expiring_entries': self._numScheduledEntries,
+            'expired_entries': self._numExpired,
+            'popped_entries': self._numPopped,
+        }
+
+    def close(self):
+        """ Stop advancing the timing wheel. """
+        if self._tickCall is not None:
+            if self._tickCall.active():
+                self._tickCall.cancel()
+            self._tickCall = None
+
+    def _removeEntry(self, key):
+        """
+        Remove the entry of the key from the storage and from its slot
+        and stop the wheel, if no expiring entries are left.
+        :param key: The key of the entry.
+        :return: The removed entry or None, if no entry was stored with the key.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[2] is not None:
+            entry[2].discard(key)
+            entry[2] = None
+            self._numScheduledEntries -= 1
+            if self._numScheduledEntries == 0:
+                self.close()
+        return entry
+
+    def _schedule(self, key, entry):
+        """
+        Place the entry of the key in the slot of the lowest level which covers its expire time.
+        :param key: The key of the entry.
+        :param entry: The entry, a list of the data, the expire time and the slot.
+        """
+        expireTick = max(int(entry[1] // self._tickDuration) + 1, self._currentTick)
+        delta = expireTick - self._currentTick
+        level = 0
+        while level < len(self._slotSpans) - 1 and \
+                delta >= self._slotSpans[level] * self._wheelSize:
+            level += 1
+        slotSpan = self._slotSpans[level]
+        if delta >= slotSpan * self._wheelSize:
+            expireTick = self._currentTick + slotSpan * self._wheelSize - 1
+        slot = self._wheels[level][(expireTick // slotSpan) % self._wheelSize]
+        slot.add(key)
+        entry[2] = slot
+
+    def _onTick(self):
+        """ Advance the wheel up to the current time and reclaim all expired entries. """
+        targetTick = int(self._reactor.seconds() // self._tickDuration)
+        while self._currentTick < targetTick and self._numScheduledEntries > 0:
+            self._advance()
+        if self._numScheduledEntries > 0:
+            self._tickCall = self._reactor.callLater(self._tickDuration, self._onTick)
+        else:
+            self._tickCall = None
+
+    def _advance(self):
+        """
+        Advance the wheel by one tick. The slots of the higher levels which are reached
+        are moved down first, then all entries in the reached slot of the lowest level expire.
+        """
+        self._currentTick += 1
+        tick = self._currentTick
+        for level in range(len(self._slotSpans) - 1, 0, -1):
+            slotSpan = self._slotSpans[level]
+            if tick % slotSpan == 0:
+                slot = self._wheels[level][(tick // slotSpan) % self._wheelSize]
+                keys = list(slot)
+                slot.clear()
+                for key in keys:
+                    self._schedule(key, self._entries[key])
+        slot = self._wheels[0][tick % self._wheelSize]
+        for key in slot:
+            del self._entries[key]
+        self._numExpired += len(slot)
+        self._numScheduledEntries -= len(slot)
+        slot.clear()
+
+
+class DictConsentStorage(ConsentStorage):
+    """ A ConsentStorage that keeps the consent of the users in memory. """
+
+    def __init__(self):
+        super(DictConsentStorage, self).__init__()
+        self._consent = {}
+
+    def addConsent(self, userId, clientId, scope):
+        userConsent = self._consent.setdefault(userId, {})
+        userConsent[clientId] = userConsent.get(clientId, frozenset()).union(scope)
+
+    def getConsent(self, userId, clientId):
+        return sorted(self._consent.get(userId, {}).get(clientId, ()))
+
+    def removeConsent(self, userId, clientId=None):
+        if clientId is None:
+            self._consent.pop(userId, None)
+            return
+        userConsent = self._consent.get(userId)
+        if userConsent is not None:
+            userConsent.pop(clientId, None)
+            if not userConsent:
+                del self._consent[userId]
@@ -0,0 +1,512 @@
+# Copyright (c) Sebastian Scholz
+# See LICENSE for details.
+import time
+
+from collections import deque
+
+from twisted.internet.defer import Deferred, fail, gatherResults, succeed
+from twisted.internet.endpoints import connectProtocol
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+
+from txoauth2.scope import isScopeSubset
+from txoauth2.storage.codec import JSONCodec
+from txoauth2.token import PersistentStorage, TokenAccess, TokenStorage
+from txoauth2.util import isAnyStr
+
+
+class RedisError(Exception):
+    """ An error reply of a Redis server. """
+
+
+class _IncompleteReply(Exception):
+    """ Raised if the received data does not yet contain a complete reply. """
+
+
+def _parseRedisReply(data, offset):
+    """
+    Parse a reply in the Redis serialization protocol (RESP).
+    :raises _IncompleteReply: If the data does not contain a complete reply.
+    :raises ValueError: If the data is not a valid reply.
+    :param data: The received data.
+    :param offset: The offset in the data at which the reply starts.
+    :return: The reply and the offset after the reply. Error replies are returned as RedisErrors.
+    """
+    end = data.find(b'\r\n', offset)
+    if end == -1:
+        raise _IncompleteReply()
+    replyType = data[offset:offset + 1]
+    line = data[offset + 1:end]
+    offset = end + 2
+    if replyType == b'+':
+        return line, offset
+    if replyType == b'-':
+        return RedisError(line.decode('utf-8', 'replace')), offset
+    if replyType == b':':
+        return int(line), offset
+    if replyType == b'$':
+        length = int(line)
+        if length < 0:
+            return None, offset
+        if len(data) < offset + length + 2:
+            raise _IncompleteReply()
+        return data[offset:offset + length], offset + length + 2
+    if replyType == b'*':
+        count = int(line)
+        if count < 0:
+            return None, offset
+        items = []
+        for _ in range(count):
+            item, offset = _parseRedisReply(data, offset)
+            items.append(item)
+        return items, offset
+    raise ValueError('Invalid reply type: ' + repr(replyType))
+
+
+class _RedisProtocol(Protocol):
+    """
+    A minimal client for the Redis serialization protocol. Commands are pipelined,
+    they are sent immediately without waiting for the replies to previous commands.
+    """
+    def __init__(self, onConnectionLost):
+        """
+        :param onConnectionLost: A function that is called with this protocol
+                                 when the connection is lost.
+        """
+        self._buffer = b''
+        self._pendingReplies = deque()
+        self._onConnectionLost = onConnectionLost
+        self._disconnectWaiters = []
+
+    @property
+    def numPendingReplies(self):
+        """ :return: The number of commands that were sent but not yet answered. """
+        return len(self._pendingReplies)
+
+    def sendCommands(self, commands):
+        """
+        Send the commands in a single write.
+        :param commands: A list of commands, each a sequence of arguments.
+        :return: A list of Deferreds which fire with the replies to the commands.
+        """
+        deferreds = []
+        for _ in commands:
+            deferred = Deferred()
+            self._pendingReplies.append(deferred)
+            deferreds.append(deferred)
+        self.transport.write(b''.join(self._encodeCommand(command) for command in commands))
+        return deferreds
+
+    def disconnect(self):
+        """
+        Close the connection.
+        :return: A Deferred which fires once the connection is closed.
+        """
+        waiter = Deferred()
+        self._disconnectWaiters.append(waiter)
+        self.transport.loseConnection()
+        return waiter
+
+    def dataReceived(self, data):
+        self._buffer += data
+        offset = 0
+        while self._pendingReplies:
+            try:
+                reply, offset = _parseRedisReply(self._buffer, offset)
+            except _IncompleteReply:
+                break
+            except ValueError:
+                self.transport.loseConnection()
+                return
+            deferred = self._pendingReplies.popleft()
+            if isinstance(reply, RedisError):
+                deferred.errback(reply)
+            else:
+                deferred.callback(reply)
+        self._buffer = self._buffer[offset:]
+
+    def connectionLost(self, reason=None):
+        pendingReplies, self._pendingReplies = self._pendingReplies, deque()
+        self._onConnectionLost(self)
+        for deferred in pendingReplies:
+            deferred.errback(reason)
+        waiters, self._disconnectWaiters = self._disconnectWaiters, []
+        for waiter in waiters:
+            waiter.callback(None)
+
+    @staticmethod
+    def _encodeCommand(command):
+        """
+        :param command: A sequence of arguments. Strings are encoded as utf-8.
+        :return: The command encoded as an array of bulk strings.
+        """
+        parts = [b'*' + str(len(command)).encode('ascii') + b'\r\n']
+        for argument in command:
+            if isinstance(argument, int):
+                argument = str(argument).encode('ascii')
+            elif not isinstance(argument, bytes):
+                argument = argument.encode('utf-8')
+            parts.extend([b'$', str(len(argument)).encode('ascii'), b'\r\n', argument, b'\r\n'])
+        return b''.join(parts)
+
+
+class _RedisConnectionPool(object):
+    """
+    A pool of up to poolSize connections to a Redis server. A command is sent over an idle
+    connection or, if all connections are busy and the pool is full,
+    pipelined over the connection with the fewest pending replies.
+    """
+    def __init__(self, endpoint, poolSize):
+        """
+        :raises ValueError: If the pool size is not positive.
+        :param endpoint: The client endpoint of the Redis server.
+        :param poolSize: The maximum number of connections.
+        """
+        super(_RedisConnectionPool, self).__init__()
+        if poolSize < 1:
+            raise ValueError('The pool size must be positive')
+        self._endpoint = endpoint
+        self._poolSize = poolSize
+        self._connections = []
+        self._numConnecting = 0
+        self._connectionWaiters = []
+        self._closed = False
+
+    def execute(self, *command):
+        """
+        :param command: The arguments of the command.
+        :return: A Deferred which fires with the reply to the command.
+        """
+        return self._getConnection().addCallback(
+            lambda connection: connection.sendCommands([command])[0])
+
+    def executeTransaction(self, *commands):
+        """
+        Execute the commands in a MULTI/EXEC transaction, sent in a single write.
+        :param commands: The commands, each a sequence of arguments.
+        :return: A Deferred which fires with the list of replies to the commands.
+        """
+        def sendTransaction(connection):
+            deferreds = connection.sendCommands([(b'MULTI',)] + list(commands) + [(b'EXEC',)])
+            for deferred in deferreds[:-1]:
+                deferred.addErrback(lambda _: None)  # The error is also reported by EXEC
+            return deferreds[-1].addCallback(self._checkTransactionReplies)
+        return self._getConnection().addCallback(sendTransaction)
+
+    def close(self):
+        """
+        Close all connections.
+        :return: A Deferred which fires once all connections are closed.
+        """
+        self._closed = True
+        waiters, self._connectionWaiters = self._connectionWaiters, []
+        for waiter in waiters:
+            waiter.errback(RuntimeError('The connection pool is closed'))
+        return gatherResults([connection.disconnect() for connection in list(self._connections)])
+
+    @staticmethod
+    def _checkTransactionReplies(replies):
+        """
+        :raises RedisError: If the transaction was aborted or a command failed.
+        :param replies: The reply to EXEC.
+        :return: The replies of the commands in the transaction.
+        """
+        if replies is None:
+            raise RedisError('The transaction was aborted')
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def _getConnection(self):
+        """
+        :return: A Deferred which fires with the connection to use for the next command.
+        """
+        if self._closed:
+            return fail(RuntimeError('The connection pool is closed'))
+        leastBusy = None
+        for connection in self._connections:
+            if leastBusy is None or connection.numPendingReplies < leastBusy.numPendingReplies:
+                leastBusy = connection
+        if leastBusy is not None and leastBusy.numPendingReplies == 0:
+            return succeed(leastBusy)
+        if len(self._connections) + self._numConnecting < self._poolSize:
+            self._numConnecting += 1
+            return connectProtocol(self._endpoint, _RedisProtocol(self._onConnectionLost))\
+                .addBoth(self._onConnected)
+        if leastBusy is not None:
+            return succeed(leastBusy)
+        waiter = Deferred()
+        self._connectionWaiters.append(waiter)
+        return waiter
+
+    def _onConnected(self, result):
+        """
+        Add a new connection to the pool and pass it to the commands waiting for a connection.
+        :param result: The new connection or a Failure.
+        :return: The result.
+        """
+        self._numConnecting -= 1
+        waiters, self._connectionWaiters = self._connectionWaiters, []
+        if isinstance(result, Failure):
+            for waiter in waiters:
+                waiter.errback(result)
+        elif self._closed:
+            result.disconnect()
+            return fail(RuntimeError('The connection pool is closed'))
+        else:
+            self._connections.append(result)
+            for waiter in waiters:
+                waiter.callback(result)
+        return result
+
+    def _onConnectionLost(self, connection):
+        """
+        Remove a closed connection from the pool.
+        :param connection: The connection that was closed.
+        """
+        if connection in self._connections:
+            self._connections.remove(connection)
+
+
+class RedisTokenStorage(TokenStorage):
+    """
+    A token storage that stores the tokens in a Redis server, so they can be shared between
+    multiple servers. Each token is stored as a hash and the expire time of a token is set
+    as the expire time of its key, so expired tokens are removed by the Redis server.
+    Commands are sent over a pool of connections and pipelined. All methods return Deferreds.
+    The additional data of the tokens is encoded with the codec.
+
+    The tokens of each client and user are indexed in a sorted set under the key
+    keyPrefix + 'index:client:' + clientId respectively keyPrefix + 'index:user:' + userId,
+    scored by their expire time. Expired entries are pruned whenever a token is stored
+    for the client or user and when its tokens are removed.
+    """
+    def __init__(self, endpoint, keyPrefix='txoauth2:token:', poolSize=4, getUserId=None,
+                 codec=None):
+        """
+        :param endpoint: A client endpoint to connect to the Redis server,
+                         e.g. TCP4ClientEndpoint(reactor, 'localhost', 6379).
+        :param keyPrefix: The prefix for the keys of the tokens. This allows to store
+                          access and refresh tokens in the same Redis database.
+        :param poolSize: The maximum number of connections to the Redis server.
+        :param getUserId: An optional function that returns the id of the user
+                          of a token or None when called with its additional data.
+                          It is required for removeByUser.
+        :param codec: The codec for the additional data of the tokens, defaults to a JSONCodec.
+        """
+        super(RedisTokenStorage, self).__init__()
+        self._keyPrefix = keyPrefix
+        self._getUserId = getUserId
+        self._codec = JSONCodec() if codec is None else codec
+        self._pool = _RedisConnectionPool(endpoint, poolSize)
+
+    def contains(self, token):
+        return self._pool.execute(b'EXISTS', self._keyPrefix + token).addCallback(
+            lambda reply: reply == 1)
+
+    def hasAccess(self, token, scope):
+        return self._getTokenField(token, b'scope').addCallback(
+            lambda tokenScope: isScopeSubset(scope, tokenScope.decode('utf-8').split()))
+
+    def checkAccess(self, token, scope):
+        def checkScope(tokenScope):
+            if tokenScope is None:
+                return TokenAccess.Invalid
+            if isScopeSubset(scope, tokenScope.decode('utf-8').split()):
+                return TokenAccess.Granted
+            return TokenAccess.InsufficientScope
+        return self._pool.execute(b'HGET', self._keyPrefix + token, b'scope')\
+            .addCallback(checkScope)
+
+    def getTokenAdditionalData(self, token):
+        return self._getTokenField(token, b'additional_data').addCallback(self._codec.decode)
+
+    def getTokenScope(self, token):
+        return self._getTokenField(token, b'scope').addCallback(
+            lambda tokenScope: tokenScope.decode('utf-8').split())
+
+    def getTokenClient(self, token):
+        return self._getTokenField(token, b'client_id').addCallback(
+            lambda clientId: clientId.decode('utf-8'))
+
+    def getTokenLifetime(self, token):
+        return self._getTokenField(token, b'birth_time').addCallback(
+            lambda birthTime: int(time.time()) - int(birthTime))
+
+    def getTokenInfo(self, token):
+        return self._pool.execute(b'HGETALL', self._keyPrefix + token)\
+            .addCallback(self._parseTokenInfo)
+
+    def store(self, token, client, scope, additionalData=None, expireTime=None):
+        if not isinstance(token, str):
+            raise ValueError('Token parameter is not a string')
+        if not isinstance(scope, list):
+            scope = [scope]
+        if expireTime is not None and expireTime <= time.time():
+            return succeed(None)
+        key = self._keyPrefix + token
+        userId = None if self._getUserId is None else self._getUserId(additionalData)
+        storeCommand = (b'HSET', key, b'client_id', client.id, b'scope', ' '.join(scope),
+                        b'additional_data', self._codec.encode(additionalData),
+                        b'birth_time', int(time.time()),
+                        b'expire_time', b'' if expireTime is None else repr(expireTime),
+                        b'user_id', b'' if userId is None else self._encodeIndexId(userId))
+        if expireTime is None:
+            commands = [storeCommand, (b'PERSIST', key)]
+            score = b'+inf'
+        else:
+            commands = [storeCommand, (b'PEXPIREAT', key, int(expireTime * 1000))]
+            score = int(expireTime * 1000)
+        indexKeys = [self._getIndexKey(b'client', client.id)]
+        if userId is not None:
+            indexKeys.append(self._getIndexKey(b'user', userId))
+        for indexKey in indexKeys:
+            commands.append((b'ZADD', indexKey, score, token))
+            commands.append((b'ZREMRANGEBYSCORE', indexKey, b'-inf', int(time.time() * 1000)))
+        return self._pool.executeTransaction(*commands).addCallback(lambda _: None)
+
+    def remove(self, token):
+        key = self._keyPrefix + token
+
+        def removeToken(fields):
+            clientId, userId = fields
+            if clientId is None:
+                raise KeyError('Token not found')
+            commands = [(b'DEL', key), (b'ZREM', self._getIndexKey(b'client', clientId), token)]
+            if userId:
+                commands.append((b'ZREM', self._getIndexKey(b'user', userId), token))
+            return self._pool.executeTransaction(*commands)
+        return self._pool.execute(b'HMGET', key, b'client_id', b'user_id')\
+            .addCallback(removeToken).addCallback(lambda _: None)
+
+    def removeByClient(self, clientId):
+        return self._removeIndexedTokens(self._getIndexKey(b'client', clientId))
+
+    def removeByUser(self, userId):
+        if self._getUserId is None:
+            raise NotImplementedError('The user of a token can only be determined '
+                                      'if the token storage was created with getUserId')
+        return self._removeIndexedTokens(self._getIndexKey(b'user', userId))
+
+    def close(self):
+        """
+        Close all connections to the Redis server.
+        :return: A Deferred which fires once all connections are closed.
+        """
+        return self._pool.close()
+
+    def _getIndexKey(self, indexType, indexId):
+        """
+        :param indexType: Either b'client' or b'user'.
+        :param indexId: The id of the client or user.
+        :return: The key of the sorted set that indexes the tokens of the client or user.
+        """
+        return self._keyPrefix.encode('utf-8') + b'index:' + indexType + b':' + \
+            self._encodeIndexId(indexId)
+
+    @staticmethod
+    def _encodeIndexId(indexId):
+        """
+        :param indexId: The id of a client or user, e.g. a string or an integer.
+        :return: The id encoded as utf-8.
+        """
+        if isinstance(indexId, bytes):
+            return indexId
+        if not isAnyStr(indexId):
+            indexId = str(indexId)
+        return indexId if isinstance(indexId, bytes) else indexId.encode('utf-8')
+
+    def _removeIndexedTokens(self, indexKey):
+        """
+        Delete the live tokens in an index and remove them and all expired tokens from it.
+        Tokens that are added to the index concurrently stay in the index.
+        :param indexKey: The key of the index.
+        :return: A Deferred which fires with a list of the deleted tokens.
+        """
+        now = int(time.time() * 1000)
+
+        def removeTokens(tokens):
+            tokens = [token.decode('utf-8') for token in tokens]
+            commands = [(b'DEL', self._keyPrefix + token) for token in tokens]
+            if tokens:
+                commands.append((b'ZREM', indexKey) + tuple(tokens))
+            commands.append((b'ZREMRANGEBYSCORE', indexKey, b'-inf', now))
+            return self._pool.executeTransaction(*commands).addCallback(
+                lambda replies: [token for token, reply in zip(tokens, replies) if reply == 1])
+        return self._pool.execute(b'ZRANGEBYSCORE', indexKey, b'(' + str(now).encode('ascii'),
+                                  b'+inf').addCallback(removeTokens)
+
+    def _getTokenField(self, token, field):
+        """
+        :param token: The token.
+        :param field: The name of the field of the token hash.
+        :return: A Deferred which fires with the value of the field
+                 or fails with a KeyError, if the token is not in the token storage.
+        """
+        def checkValue(value):
+            if value is None:
+                raise KeyError('Token not found')
+            return value
+        return self._pool.execute(b'HGET', self._keyPrefix + token, field)\
+            .addCallback(checkValue)
+
+    def _parseTokenInfo(self, reply):
+        """
+        :raises KeyError: If the token is not in the token storage.
+        :param reply: The reply to HGETALL.
+        :return: The information about the token as returned by getTokenInfo.
+        """
+        if not reply:
+            raise KeyError('Token not found')
+        fields = dict(zip(reply[::2], reply[1::2]))
+        expireTime = fields[b'expire_time']
+        return {
+            'scope': fields[b'scope'].decode('utf-8').split(),
+            'client_id': fields[b'client_id'].decode('utf-8'),
+            'additional_data': self._codec.decode(fields[b'additional_data']),
+            'birth_time': int(fields[b'birth_time']),
+            'expire_time': float(expireTime) if expireTime else None
+        }
+
+
+class RedisPersistentStorage(PersistentStorage):
+    """
+    A persistent storage that stores the data in a Redis server. Like the RedisTokenStorage,
+    the expire time is set as the expire time of the key and all methods return Deferreds.
+    The data is encoded with the codec.
+    """
+    def __init__(self, endpoint, keyPrefix='txoauth2:data:', poolSize=4, codec=None):
+        """
+        :param endpoint: A client endpoint to connect to the Redis server.
+        :param keyPrefix: The prefix for the keys of the data.
+        :param poolSize: The maximum number of connections to the Redis server.
+        :param codec: The codec for the data, defaults to a JSONCodec.
+        """
+        super(RedisPersistentStorage, self).__init__()
+        self._keyPrefix = keyPrefix
+        self._codec = JSONCodec() if codec is None else codec
+        self._pool = _RedisConnectionPool(endpoint, poolSize)
+
+    def put(self, key, data, expireTime=None):
+        key = self._keyPrefix + key
+        commands = [(b'SET', key, self._codec.encode(data))]
+        if expireTime is not None:
+            commands.append((b'PEXPIREAT', key, int(expireTime * 1000)))
+        return self._pool.executeTransaction(*commands).addCallback(lambda _: None)
+
+    def pop(self, key):
+        def checkValue(replies):
+            if replies[0] is None:
+                raise KeyError(key)
+            return self._codec.decode(replies[0])
+        prefixedKey = self._keyPrefix + key
+        return self._pool.executeTransaction((b'GET', prefixedKey), (b'DEL', prefixedKey))\
+            .addCallback(checkValue)
+
+    def close(self):
+        """
+        Close all connections to the Redis server.
+        :return: A Deferred which fires once all connections are closed.
+        """
+        return self._pool.close()
@@ -0,0 +1,325 @@
+# Copyright (c) Sebastian Scholz
+# See LICENSE for details.
+import gc
+import os
+import time
+import struct
+import logging
+
+from twisted.internet.defer import succeed, gatherResults
+
+from txoauth2.storage.codec import JSONCodec
+from txoauth2.storage.memory import BucketedTokenStorage, _TokenRecord
+from txoauth2.storage.worker import WorkerThreads
+from txoauth2.util import unwrapFirstError
+
+
+_TOKEN_FILE_MAGIC = b'TXO2TOK2'
+
+
+_TOKEN_FILE_RECORD = struct.Struct('<BIIIIqd')
+
+
+_TOKEN_FILE_STORE = 1
+
+
+_TOKEN_FILE_REMOVE = 2
+
+
+_TOKEN_FILE_NO_EXPIRE_TIME = -1.0
+
+
+def _encodeTokenFileRecord(kind, token, clientId=u'', scope=u'', data=b'', birthTime=0,
+                           expireTime=None):
+    """
+    Encode a record of a token snapshot or change log. Each record consists of a fixed size
+    header with the lengths of the variable size fields, followed by these fields.
+    :param kind: Either _TOKEN_FILE_STORE or _TOKEN_FILE_REMOVE.
+    :param token: The token.
+    :param clientId: The id of the client of the token.
+    :param scope: The scope of the token as a space separated string.
+    :param data: The encoded additional data of the token or b'' if it has none.
+    :param birthTime: The time the token was created.
+    :param expireTime: The time the token expires or None.
+    :return: The encoded record.
+    """
+    token = token.encode('utf-8')
+    clientId = clientId.encode('utf-8')
+    scope = scope.encode('utf-8')
+    return _TOKEN_FILE_RECORD.pack(
+        kind, len(token), len(clientId), len(scope), len(data), birthTime,
+        _TOKEN_FILE_NO_EXPIRE_TIME if expireTime is None else expireTime) \
+        + token + clientId + scope + data
+
+
+def _writeTokenFile(path, blocks):
+    """
+    Write a token snapshot or change log to a temporary file and rename it to the path,
+    so a crash never leaves a partially written file behind.
+    :param path: The path to the file.
+    :param blocks: An iterable of blocks of encoded records.
+    """
+    temporaryPath = path + '.tmp'
+    with open(temporaryPath, 'wb') as tokenFile:
+        tokenFile.write(_TOKEN_FILE_MAGIC)
+        for block in blocks:
+            tokenFile.write(block)
+        tokenFile.flush()
+        os.fsync(tokenFile.fileno())
+    getattr(os, 'replace', os.rename)(temporaryPath, path)
+
+
+def _readTokenFileRecords(path, decode, chunkSize=1 << 20):
+    """
+    Read the records of a token snapshot or change log in a single streaming pass.
+    An incomplete record at the end of the file, e.g. after a crash during a write, is ignored.
+    A file that is shorter than the header is treated as empty.
+    :raises ValueError: If the file is not a token snapshot or change log.
+    :param path: The path to the file.
+    :param decode: The function to decode the additional data of a token.
+    :param chunkSize: The number of bytes to read at once.
+    :return: A generator of tuples, each containing the kind, the token, the utf-8 encoded
+             client id, the utf-8 encoded space separated scope, the decoded additional data,
+             the birth time, the expire time and the offset in the file after the record.
+    """
+    headerSize = _TOKEN_FILE_RECORD.size
+    unpackHeader = _TOKEN_FILE_RECORD.unpack_from
+    with open(path, 'rb') as recordFile:
+        magic = recordFile.read(len(_TOKEN_FILE_MAGIC))
+        if len(magic) < len(_TOKEN_FILE_MAGIC) and _TOKEN_FILE_MAGIC.startswith(magic):
+            return
+        if magic != _TOKEN_FILE_MAGIC:
+            raise ValueError('Not a token file: ' + path)
+        buffer = b''
+        bufferOffset = len(_TOKEN_FILE_MAGIC)
+        position = 0
+        while True:
+            chunk = recordFile.read(chunkSize)
+            if not chunk:
+                return
+            buffer = buffer[position:] + chunk
+            bufferOffset += position
+            position = 0
+            bufferSize = len(buffer)
+            while position + headerSize <= bufferSize:
+                kind, tokenSize, clientSize, scopeSize, dataSize, birthTime, expireTime = \
+                    unpackHeader(buffer, position)
+                start = position + headerSize
+                end = start + tokenSize + clientSize + scopeSize + dataSize
+                if end > bufferSize:
+                    break
+                token = buffer[start:start + tokenSize].decode('utf-8')
+                start += tokenSize
+                clientId = buffer[start:start + clientSize]
+                start += clientSize
+                scope = buffer[start:start + scopeSize]
+                start += scopeSize
+                data = decode(buffer[start:end]) if dataSize else None
+                position = end
+                yield (kind, token, clientId, scope, data, birthTime,
+                       None if expireTime == _TOKEN_FILE_NO_EXPIRE_TIME else expireTime,
+                       bufferOffset + position)
+
+
+class SnapshotTokenStorage(BucketedTokenStorage):
+    """
+    An in memory token storage like the BucketedTokenStorage, whose tokens survive a restart.
+    Every change is appended to a change log at path + '.log' every flushInterval seconds and
+    all tokens are written to a compact binary snapshot at path + '.snapshot' every
+    snapshotInterval seconds, after which the change log is truncated. Both files are written
+    by a single worker thread, so the reactor thread only copies the token dict for a snapshot.
+    The additional data of the tokens is encoded with the codec.
+
+    On creation, the snapshot and the change log are read in a single streaming pass.
+    Changes that were not yet flushed to the change log are lost on a crash.
+    Run benchmarks/tokenStorageRestore.py to measure the restore time.
+    """
+    def __init__(self, path, snapshotInterval=300, flushInterval=1, bucketSize=60,
+                 scopeRegistry=None, getUserId=None, reactor=None, codec=None):
+        """
+        :raises ValueError: If the snapshot or change log is corrupted.
+        :param path: The path prefix of the snapshot and the change log.
+        :param snapshotInterval: The number of seconds between two snapshots.
+        :param flushInterval: The maximum number of seconds a change is kept in memory
+                              before it is appended to the change log.
+        :param bucketSize: The time span in seconds covered by one expiry bucket.
+        :param scopeRegistry: An optional ScopeRegistry, see DictTokenStorage.
+        :param getUserId: An optional function to determine the user of a token,
+                          see DictTokenStorage.
+        :param reactor: The reactor to use, defaults to the global reactor.
+        :param codec: The codec for the additional data of the tokens, defaults to a JSONCodec.
+        """
+        super(SnapshotTokenStorage, self).__init__(
+            bucketSize=bucketSize, scopeRegistry=scopeRegistry, getUserId=getUserId)
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._codec = JSONCodec() if codec is None else codec
+        self._snapshotPath = path + '.snapshot'
+        self._logPath = path + '.log'
+        self._snapshotInterval = snapshotInterval
+        self._flushInterval = flushInterval
+        self._pendingChanges = []
+        self._flushCall = None
+        self._logFile = None
+        self._workerThread = WorkerThreads(
+            'txoauth2-snapshot', onShutdown=self.close, reactor=reactor)
+        self._isRestoring = True
+        gcEnabled = gc.isenabled()
+        gc.disable()  # The restored records contain no cycles, so don't scan them repeatedly.
+        try:
+            self._restore()
+        finally:
+            self._isRestoring = False
+            if gcEnabled:
+                gc.enable()
+        self._snapshotCall = reactor.callLater(snapshotInterval, self._onSnapshotTimer)
+
+    def store(self, token, client, scope, additionalData=None, expireTime=None):
+        existed = token in self._tokens
+        super(SnapshotTokenStorage, self).store(
+            token, client, scope, additionalData=additionalData, expireTime=expireTime)
+        if not self._isRestoring and (existed or token in self._tokens):
+            self._addChange(token, self._tokens.get(token))
+
+    def remove(self, token):
+        super(SnapshotTokenStorage, self).remove(token)
+        if not self._isRestoring:
+            self._addChange(token, None)
+
+    def flush(self):
+        """
+        Append all pending changes to the change log.
+        :return: A Deferred which fires once the changes were written to the disk.
+        """
+        if self._flushCall is not None and self._flushCall.active():
+            self._flushCall.cancel()
+        self._flushCall = None
+        changes, self._pendingChanges = self._pendingChanges, []
+        return self._workerThread.run(self._appendToLog, changes)
+
+    def snapshot(self):
+        """
+        Write a snapshot of all tokens and truncate the change log.
+        :return: A Deferred which fires once the snapshot was written to the disk.
+        """
+        self.flush()
+        return self._workerThread.run(self._writeSnapshot, list(self._tokens.items()))
+
+    def close(self):
+        """
+        Append all pending changes to the change log and stop the worker thread.
+        :return: A Deferred which fires once the storage is closed.
+        """
+        if self._snapshotCall.active():
+            self._snapshotCall.cancel()
+        if not self._workerThread.isRunning and not self._pendingChanges:
+            return succeed(None)
+        return gatherResults([self.flush(), self._workerThread.stop(self._closeLog)],
+                             consumeErrors=True).addCallbacks(lambda _: None, unwrapFirstError)
+
+    def _restore(self):
+        """
+        Read the snapshot and replay the change log. The records are added directly
+        and each distinct client id and scope is only decoded once, which is about twice
+        as fast as storing each token.
+        """
+        now = time.time()
+        clientIds = {}
+        scopes = {}
+        for path in [self._snapshotPath, self._logPath]:
+            if not os.path.exists(path):
+                continue
+            validSize = len(_TOKEN_FILE_MAGIC)
+            for kind, token, clientId, scope, data, birthTime, expireTime, validSize in \
+                    _readTokenFileRecords(path, self._codec.decode):
+                if token in self._tokens:
+                    self.remove(token)
+                if kind == _TOKEN_FILE_REMOVE or (expireTime is not None and expireTime <= now):
+                    continue
+                storedClientId = clientIds.get(clientId)
+                if storedClientId is None:
+                    storedClientId = clientIds[clientId] = clientId.decode('utf-8')
+                storedScope = scopes.get(scope)
+                if storedScope is None:
+                    storedScope = self._toStoredScope(scope.decode('utf-8').split())
+                    scopes[scope] = storedScope
+                self._addRecord(token, _TokenRecord(
+                    storedClientId, storedScope, data, birthTime, expireTime))
+            if path == self._logPath and validSize < os.path.getsize(path):
+                with open(path, 'r+b') as logFile:
+                    logFile.truncate(validSize)
+
+    def _addChange(self, token, record):
+        """
+        Queue a change for the change log.
+        :param token: The token that was stored or removed.
+        :param record: The record of a stored token or None for a removed token.
+        """
+        self._pendingChanges.append((token, record))
+        if self._flushCall is None:
+            self._flushCall = self._reactor.callLater(self._flushInterval, self._onFlushTimer)
+
+    def _onFlushTimer(self):
+        """ Append the pending changes to the change log and log a failure. """
+        self.flush().addErrback(
+            lambda failure: logging.getLogger('txOauth2').error(
+                'Failed to write the token change log: %s', failure.getErrorMessage()))
+
+    def _onSnapshotTimer(self):
+        """ Write a snapshot and schedule the next one. """
+        self.snapshot().addErrback(
+            lambda failure: logging.getLogger('txOauth2').error(
+                'Failed to write a token snapshot: %s', failure.getErrorMessage()))
+        self._snapshotCall = self._reactor.callLater(
+            self._snapshotInterval, self._onSnapshotTimer)
+
+    def _encodeRecord(self, token, record):
+        """
+        :param token: A token.
+        :param record: The record of the token.
+        :return: The encoded store record for the token.
+        """
+        return _encodeTokenFileRecord(
+            _TOKEN_FILE_STORE, token, record.client, ' '.join(self._toScopeList(record.scope)),
+            b'' if record.data is None else self._codec.encode(record.data),
+            record.birthTime, record.expireTime)
+
+    def _appendToLog(self, changes):
+        """
+        Append changes to the change log. Must only be called from the worker thread.
+        :param changes: A list of tokens and their records or None for removed tokens.
+        """
+        if not changes:
+            return
+        if self._logFile is None:
+            if not os.path.exists(self._logPath) or \
+                    os.path.getsize(self._logPath) < len(_TOKEN_FILE_MAGIC):
+                _writeTokenFile(self._logPath, [])
+            self._logFile = open(self._logPath, 'ab')
+        self._logFile.write(b''.join(
+            _encodeTokenFileRecord(_TOKEN_FILE_REMOVE, token) if record is None
+            else self._encodeRecord(token, record) for token, record in changes))
+        self._logFile.flush()
+        os.fsync(self._logFile.fileno())
+
+    def _writeSnapshot(self, items):
+        """
+        Write a snapshot, replace the old snapshot with it and replace the change log
+        with an empty one. Must only be called from the worker thread.
+        :param items: A list of all tokens and their records.
+        """
+        now = time.time()
+        _writeTokenFile(self._snapshotPath, (
+            b''.join(self._encodeRecord(token, record)
+                     for token, record in items[start:start + 10000]
+                     if record.expireTime is None or record.expireTime > now)
+            for start in range(0, len(items), 10000)))
+        self._closeLog()
+        _writeTokenFile(self._logPath, [])
+
+    def _closeLog(self):
+        """ Close the change log. Must only be called from the worker thread. """
+        if self._logFile is not None:
+            self._logFile.close()
+            self._logFile = None
@@ -0,0 +1,669 @@
+# Copyright (c) Sebastian Scholz
+# See LICENSE for details.
+import re
+import time
+import sqlite3
+import logging
+import threading
+
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.python.failure import Failure
+
+from txoauth2.resource import ConsentStorage
+from txoauth2.scope import isScopeSubset
+from txoauth2.storage.codec import JSONCodec
+from txoauth2.storage.worker import WorkerThreads
+from txoauth2.token import PersistentStorage, TokenAccess, TokenStorage
+
+
+class _SQLiteDatabase(object):
+    """
+    A SQLite database in write-ahead log mode. Writes are executed by a single writer thread
+    and committed in groups: All writes that are queued while the writer thread is busy
+    are executed in one transaction, so a burst of writes only requires a single sync
+    to the disk. Reads are executed by a separate pool of reader threads with one connection
+    each, so they don't wait for the writes and only see committed data.
+    """
+    _TABLE_NAME_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+    def __init__(self, path, schema, reactor=None, readThreads=2):
+        """
+        :param path: The path to the database file.
+        :param schema: A list of SQL statements to execute after opening the database.
+        :param reactor: The reactor to use, defaults to the global reactor.
+        :param readThreads: The maximum number of threads that execute reads.
+        """
+        super(_SQLiteDatabase, self).__init__()
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._path = path
+        self._schema = schema
+        self._connection = None
+        self._pendingWrites = []
+        self._isWriting = False
+        self._idleWaiters = []
+        self._closed = False
+        self._readConnections = []
+        self._readConnectionsLock = threading.Lock()
+        self._threadLocal = threading.local()
+        self._writerThread = WorkerThreads(
+            'txoauth2-sqlite', onShutdown=self.close, reactor=reactor)
+        self._readerThreads = WorkerThreads(
+            'txoauth2-sqlite-read', onShutdown=self.close, maxThreads=readThreads, reactor=reactor)
+
+    @classmethod
+    def checkTableName(cls, tableName):
+        """
+        :raises ValueError: If the table name is not a valid SQL identifier.
+        :param tableName: The name of a table.
+        :return: The table name.
+        """
+        if cls._TABLE_NAME_PATTERN.match(tableName) is None:
+            raise ValueError('Invalid table name: ' + tableName)
+        return tableName
+
+    def runQuery(self, function, *args):
+        """
+        Run a function that reads from the database in a reader thread.
+        :param function: A function that takes a cursor and the given args.
+        :param args: Additional arguments for the function.
+        :return: A Deferred which fires with the result of the function.
+        """
+        if self._closed:
+            return fail(RuntimeError('The database is closed'))
+        return self._readerThreads.run(self._runQuery, function, args)
+
+    def runWrite(self, function, *args):
+        """
+        Queue a function that writes to the database. It will be executed in the worker thread
+        together with all other queued functions in a single transaction.
+        :param function: A function that takes a cursor and the given args.
+        :param args: Additional arguments for the function.
+        :return: A Deferred which fires with the result of the function
+                 after the transaction was committed.
+        """
+        if self._closed:
+            return fail(RuntimeError('The database is closed'))
+        deferred = Deferred()
+        self._pendingWrites.append((function, args, deferred))
+        if not self._isWriting:
+            self._isWriting = True
+            self._reactor.callLater(0, self._commitPendingWrites)
+        return deferred
+
+    def close(self):
+        """
+        Commit all queued writes, close the database and stop the worker thread.
+        :return: A Deferred which fires once the database is closed.
+        """
+        if self._closed:
+            return succeed(None)
+        self._closed = True
+        waiter = Deferred()
+        if self._isWriting:
+            self._idleWaiters.append(waiter)
+        else:
+            waiter.callback(None)
+        waiter.addCallback(lambda _: self._writerThread.stop(self._closeConnection))
+        waiter.addBoth(self._stopReaderThreads)
+        return waiter
+
+    def _stopReaderThreads(self, result):
+        """
+        Stop the reader threads and close their connections.
+        :param result: The result of closing the connection of the writer thread.
+        :return: The result.
+        """
+        self._readerThreads.stop()
+        for connection in self._readConnections:
+            connection.close()
+        self._readConnections = []
+        return result
+
+    def _openConnection(self):
+        """
+        :return: A new connection to the database in write-ahead log mode.
+        """
+        connection = sqlite3.connect(self._path, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        for statement in self._schema:
+            connection.execute(statement)
+        return connection
+
+    def _getConnection(self):
+        """
+        Must only be called from the writer thread.
+        :return: The connection to the database, which is opened on first use.
+        """
+        if self._connection is None:
+            self._connection = self._openConnection()
+        return self._connection
+
+    def _getReadConnection(self):
+        """
+        Must only be called from a reader thread.
+        :return: The connection of the current reader thread, which is opened on first use.
+        """
+        connection = getattr(self._threadLocal, 'connection', None)
+        if connection is None:
+            connection = self._threadLocal.connection = self._openConnection()
+            with self._readConnectionsLock:
+                self._readConnections.append(connection)
+        return connection
+
+    def _closeConnection(self):
+        """ Close the connection to the database. Must only be called from the writer thread. """
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _runQuery(self, function, args):
+        """
+        Run a function in a reader thread.
+        :param function: A function that takes a cursor and the given args.
+        :param args: Additional arguments for the function.
+        :return: The result of the function.
+        """
+        return function(self._getReadConnection().cursor(), *args)
+
+    def _commitPendingWrites(self):
+        """ Execute all queued writes in the worker thread in a single transaction. """
+        batch, self._pendingWrites = self._pendingWrites, []
+        deferred = self._writerThread.run(
+            self._executeBatch, [(function, args) for function, args, _ in batch])
+        deferred.addBoth(self._onBatchCommitted, [writeDeferred for _, _, writeDeferred in batch])
+
+    def _executeBatch(self, batch):
+        """
+        Execute the functions in a single transaction. Must only be called from the writer thread.
+        Each function is executed within a savepoint, so a failing function
+        does not affect the others.
+        :param batch: A list of functions and their arguments.
+        :return: A list of tuples, each containing a flag indicating the success
+                 of a function and its result or the failure.
+        """
+        cursor = self._getConnection().cursor()
+        results = []
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            for function, args in batch:
+                cursor.execute('SAVEPOINT write')
+                try:
+                    results.append((True, function(cursor, *args)))
+                except Exception:  # pylint: disable=broad-except
+                    results.append((False, Failure()))
+                    cursor.execute('ROLLBACK TO write')
+                cursor.execute('RELEASE write')
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        return results
+
+    def _onBatchCommitted(self, results, deferreds):
+        """
+        Fire the Deferreds of the committed writes and commit the writes
+        that were queued in the meantime.
+        :param results: The results of the batch or a Failure, if the transaction failed.
+        :param deferreds: The Deferreds of the writes in the batch.
+        """
+        if isinstance(results, Failure):
+            for deferred in deferreds:
+                deferred.errback(results)
+        else:
+            for (success, result), deferred in zip(results, deferreds):
+                if success:
+                    deferred.callback(result)
+                else:
+                    deferred.errback(result)
+        if self._pendingWrites:
+            self._commitPendingWrites()
+        else:
+            self._isWriting = False
+            waiters, self._idleWaiters = self._idleWaiters, []
+            for waiter in waiters:
+                waiter.callback(None)
+
+
+class SQLiteTokenStorage(TokenStorage):
+    """
+    A token storage that stores the tokens in a SQLite database, so they survive
+    a server restart and can be shared between processes. The database is accessed
+    from a worker thread and all methods return Deferreds. The expire times are indexed
+    and expired tokens are deleted periodically. Tokens that are stored while a previous
+    write is committed are committed together in one transaction.
+    The additional data of the tokens is encoded with the codec.
+    The client id and the user id of the tokens are indexed for removeByClient and removeByUser.
+    """
+    cleanupInterval = 60
+
+    def __init__(self, path, tableName='tokens', reactor=None, getUserId=None, codec=None):
+        """
+        :raises ValueError: If the table name is not a valid SQL identifier.
+        :param path: The path to the database file.
+        :param tableName: The name of the table to store the tokens in. This allows to store
+                          access and refresh tokens in different tables of the same database.
+        :param reactor: The reactor to use, defaults to the global reactor.
+        :param getUserId: An optional function that returns the id of the user
+                          of a token or None when called with its additional data.
+                          It is required for removeByUser.
+        :param codec: The codec for the additional data of the tokens, defaults to a JSONCodec.
+        """
+        super(SQLiteTokenStorage, self).__init__()
+        self._tableName = _SQLiteDatabase.checkTableName(tableName)
+        self._getUserId = getUserId
+        self._codec = JSONCodec() if codec is None else codec
+        self._lastCleanup = 0
+        self._database = _SQLiteDatabase(path, [
+            'CREATE TABLE IF NOT EXISTS {table} (token TEXT PRIMARY KEY, '
+            'client_id TEXT NOT NULL, user_id TEXT, scope TEXT NOT NULL, additional_data BLOB, '
+            'birth_time INTEGER NOT NULL, expire_time REAL)'.format(table=tableName),
+            'CREATE INDEX IF NOT EXISTS {table}_expire_time ON {table} (expire_time)'
+            .format(table=tableName),
+            'CREATE INDEX IF NOT EXISTS {table}_client_id ON {table} (client_id)'
+            .format(table=tableName),
+            'CREATE INDEX IF NOT EXISTS {table}_user_id ON {table} (user_id)'
+            .format(table=tableName)
+        ], reactor=reactor)
+
+    def contains(self, token):
+        return self._database.runQuery(self._selectTokenInfo, token).addCallbacks(
+            lambda _: True, self._onLookupFailure, errbackArgs=(False,))
+
+    def hasAccess(self, token, scope):
+        return self._database.runQuery(self._selectTokenInfo, token).addCallback(
+            lambda tokenInfo: isScopeSubset(scope, tokenInfo['scope']))
+
+    def checkAccess(self, token, scope):
+        return self._database.runQuery(self._selectTokenInfo, token).addCallbacks(
+            lambda tokenInfo: TokenAccess.Granted if isScopeSubset(scope, tokenInfo['scope'])
+            else TokenAccess.InsufficientScope,
+            self._onLookupFailure, errbackArgs=(TokenAccess.Invalid,))
+
+    def getTokenAdditionalData(self, token):
+        return self.getTokenInfo(token).addCallback(lambda tokenInfo: tokenInfo['additional_data'])
+
+    def getTokenScope(self, token):
+        return self.getTokenInfo(token).addCallback(lambda tokenInfo: tokenInfo['scope'])
+
+    def getTokenClient(self, token):
+        return self.getTokenInfo(token).addCallback(lambda tokenInfo: tokenInfo['client_id'])
+
+    def getTokenLifetime(self, token):
+        return self.getTokenInfo(token).addCallback(
+            lambda tokenInfo: int(time.time()) - tokenInfo['birth_time'])
+
+    def getTokenInfo(self, token):
+        return self._database.runQuery(self._selectTokenInfo, token)
+
+    def store(self, token, client, scope, additionalData=None, expireTime=None):
+        if not isinstance(token, str):
+            raise ValueError('Token parameter is not a string')
+        if not isinstance(scope, list):
+            scope = [scope]
+        if expireTime is not None and expireTime <= time.time():
+            return succeed(None)
+        if time.time() - self._lastCleanup > self.cleanupInterval:
+            self._lastCleanup = time.time()
+            self._database.runWrite(self._deleteExpiredTokens).addErrback(
+                lambda failure: logging.getLogger('txOauth2').error(
+                    'Failed to delete expired tokens: %s', failure.getErrorMessage()))
+        userId = None if self._getUserId is None else self._getUserId(additionalData)
+        if additionalData is not None:
+            additionalData = sqlite3.Binary(self._codec.encode(additionalData))
+        return self._database.runWrite(
+            self._insertToken, token, client.id, userId, ' '.join(scope),
+            additionalData, int(time.time()), expireTime)
+
+    def remove(self, token):
+        return self._database.runWrite(self._deleteToken, token)
+
+    def removeByClient(self, clientId):
+        return self._database.runWrite(self._deleteTokensBy, 'client_id', clientId)
+
+    def removeByUser(self, userId):
+        if self._getUserId is None:
+            raise NotImplementedError('The user of a token can only be determined '
+                                      'if the token storage was created with getUserId')
+        return self._database.runWrite(self._deleteTokensBy, 'user_id', userId)
+
+    def close(self):
+        """
+        Commit all pending writes and close the database.
+        :return: A Deferred which fires once the database is closed.
+        """
+        return self._database.close()
+
+    @staticmethod
+    def _onLookupFailure(failure, invalidResult):
+        """
+        :param failure: The failure of a token lookup.
+        :param invalidResult: The result to return if the token was not found.
+        :return: The invalidResult, if the failure was caused by a KeyError.
+        """
+        failure.trap(KeyError)
+        return invalidResult
+
+    def _selectTokenInfo(self, cursor, token):
+        """
+        :raises KeyError: If the token is not in the token storage or has expired.
+        :param cursor: A database cursor.
+        :param token: The token.
+        :return: The information about the token as returned by getTokenInfo.
+        """
+        cursor.execute('SELECT client_id, scope, additional_data, birth_time, expire_time '
+                       'FROM {table} WHERE token = ? AND (expire_time IS NULL OR expire_time > ?)'
+                       .format(table=self._tableName), (token, time.time()))
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError('Token not found')
+        return {
+            'scope': row[1].split(),
+            'client_id': row[0],
+            'additional_data': None if row[2] is None else self._codec.decode(row[2]),
+            'birth_time': row[3],
+            'expire_time': row[4]
+        }
+
+    def _insertToken(self, cursor, token, clientId, userId, scope, additionalData, birthTime,
+                     expireTime):
+        """
+        Insert or replace a token.
+        :param cursor: A database cursor.
+        :param token: The token.
+        :param clientId: The id of the client.
+        :param userId: The id of the user or None.
+        :param scope: The scope as a space separated string.
+        :param additionalData: The encoded additional data or None.
+        :param birthTime: The time the token was created.
+        :param expireTime: The time the token expires or None.
+        """
+        cursor.execute('INSERT OR REPLACE INTO {table} (token, client_id, user_id, scope, '
+                       'additional_data, birth_time, expire_time) VALUES (?, ?, ?, ?, ?, ?, ?)'
+                       .format(table=self._tableName),
+                       (token, clientId, userId, scope, additionalData, birthTime, expireTime))
+
+    def _deleteToken(self, cursor, token):
+        """
+        :raises KeyError: If the token is not in the token storage.
+        :param cursor: A database cursor.
+        :param token: The token to delete.
+        """
+        cursor.execute('DELETE FROM {table} WHERE token = ?'.format(table=self._tableName),
+                       (token,))
+        if cursor.rowcount == 0:
+            raise KeyError('Token not found')
+
+    def _deleteTokensBy(self, cursor, column, value):
+        """
+        Delete all tokens of a client or user. Both selecting and deleting
+        the tokens use the index of the column.
+        :param cursor: A database cursor.
+        :param column: The indexed column, either 'client_id' or 'user_id'.
+        :param value: The id of the client or user.
+        :return: A list of the deleted tokens.
+        """
+        cursor.execute('SELECT token FROM {table} WHERE {column} = ?'.format(
+            table=self._tableName, column=column), (value,))
+        tokens = [row[0] for row in cursor.fetchall()]
+        cursor.execute('DELETE FROM {table} WHERE {column} = ?'.format(
+            table=self._tableName, column=column), (value,))
+        return tokens
+
+    def _deleteExpiredTokens(self, cursor):
+        """
+        Delete all expired tokens.
+        :param cursor: A database cursor.
+        """
+        cursor.execute('DELETE FROM {table} WHERE expire_time <= ?'.format(
+            table=self._tableName), (time.time(),))
+
+
+class SQLitePersistentStorage(PersistentStorage):
+    """
+    A persistent storage that stores the data in a SQLite database. Like the
+    SQLiteTokenStorage, the database is accessed from a worker thread, all methods return
+    Deferreds and writes are committed in groups. The data is encoded with the codec.
+    """
+    cleanupInterval = 60
+
+    def __init__(self, path, tableName='persistent_data', reactor=None, codec=None):
+        """
+        :raises ValueError: If the table name is not a valid SQL identifier.
+        :param path: The path to the database file.
+        :param tableName: The name of the table to store the data in.
+        :param reactor: The reactor to use, defaults to the global reactor.
+        :param codec: The codec for the data, defaults to a JSONCodec.
+        """
+        super(SQLitePersistentStorage, self).__init__()
+        self._tableName = _SQLiteDatabase.checkTableName(tableName)
+        self._codec = JSONCodec() if codec is None else codec
+        self._lastCleanup = 0
+        self._database = _SQLiteDatabase(path, self._getSchema(), reactor=reactor)
+
+    def put(self, key, data, expireTime=None):
+        if time.time() - self._lastCleanup > self.cleanupInterval:
+            self._lastCleanup = time.time()
+            self._database.runWrite(self._deleteExpiredData).addErrback(
+                lambda failure: logging.getLogger('txOauth2').error(
+                    'Failed to delete expired data: %s', failure.getErrorMessage()))
+        return self._database.runWrite(
+            self._insertData, key, sqlite3.Binary(self._codec.encode(data)), expireTime)
+
+    def pop(self, key):
+        return self._database.runWrite(self._popData, key)
+
+    def close(self):
+        """
+        Commit all pending writes and close the database.
+        :return: A Deferred which fires once the database is closed.
+        """
+        return self._database.close()
+
+    def _getSchema(self):
+        """
+        :return: The SQL statements that create the tables of this storage.
+        """
+        return [
+            'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, '
+            'data BLOB NOT NULL, expire_time REAL)'.format(table=self._tableName),
+            'CREATE INDEX IF NOT EXISTS {table}_expire_time ON {table} (expire_time)'
+            .format(table=self._tableName)
+        ]
+
+    def _insertData(self, cursor, key, data, expireTime):
+        """
+        Insert or replace the data stored with the key.
+        :param cursor: A database cursor.
+        :param key: The key of the data.
+        :param data: The encoded data.
+        :param expireTime: The time the data expires or None.
+        """
+        cursor.execute('INSERT OR REPLACE INTO {table} (key, data, expire_time) VALUES (?, ?, ?)'
+                       .format(table=self._tableName), (key, data, expireTime))
+
+    def _popData(self, cursor, key):
+        """
+        Delete the data stored with the key.
+        :raises KeyError: If no data was stored with the key or if the data has expired.
+        :param cursor: A database cursor.
+        :param key: The key of the data.
+        :return: The data that was stored with the key.
+        """
+        cursor.execute('SELECT data FROM {table} WHERE key = ? AND '
+                       '(expire_time IS NULL OR expire_time >= ?)'.format(table=self._tableName),
+                       (key, time.time()))
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError(key)
+        cursor.execute('DELETE FROM {table} WHERE key = ?'.format(table=self._tableName), (key,))
+        return self._codec.decode(row[0])
+
+    def _deleteExpiredData(self, cursor):
+        """
+        Delete all expired data.
+        :param cursor: A database cursor.
+        """
+        cursor.execute('DELETE FROM {table} WHERE expire_time <= ?'.format(
+            table=self._tableName), (time.time(),))
+
+
+class ReplayedKeyError(KeyError):
+    """ Raised by the SQLiteCodeStorage if data is popped again shortly after it was popped. """
+
+
+class SQLiteCodeStorage(SQLitePersistentStorage):
+    """
+    A SQLitePersistentStorage for authorization codes that can be shared by multiple
+    worker processes on the same host. Each pop is a single compare-and-delete statement
+    that only deletes the data if it has not expired. It runs in an immediate transaction
+    that is committed before the Deferred fires, so each code is redeemed by exactly
+    one process. Popped keys are recorded in a replay log for replayLogLifetime seconds,
+    popping them again fails with a ReplayedKeyError instead of a plain KeyError.
+    """
+    _SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+    def __init__(self, path, tableName='authorization_codes', replayLogLifetime=600,
+                 reactor=None, codec=None):
+        """
+        :raises ValueError: If the table name is not a valid SQL identifier.
+        :param path: The path to the database file.
+        :param tableName: The name of the table to store the data in.
+        :param replayLogLifetime: The number of seconds a popped key stays in the replay log.
+        :param reactor: The reactor to use, defaults to the global reactor.
+        :param codec: The codec for the data, defaults to a JSONCodec.
+        """
+        self._replayLogLifetime = replayLogLifetime
+        super(SQLiteCodeStorage, self).__init__(
+            path, tableName=tableName, reactor=reactor, codec=codec)
+
+    def _getSchema(self):
+        return super(SQLiteCodeStorage, self)._getSchema() + [
+            'CREATE TABLE IF NOT EXISTS {table}_replay_log (key TEXT PRIMARY KEY, '
+            'pop_time REAL NOT NULL)'.format(table=self._tableName),
+            'CREATE INDEX IF NOT EXISTS {table}_replay_log_pop_time ON {table}_replay_log '
+            '(pop_time)'.format(table=self._tableName)
+        ]
+
+    def _popData(self, cursor, key):
+        """
+        Delete the data stored with the key, if it has not expired, and add the key
+        to the replay log.
+        :raises ReplayedKeyError: If the key is in the replay log.
+        :raises KeyError: If no data was stored with the key or if the data has expired.
+        :param cursor: A database cursor.
+        :param key: The key of the data.
+        :return: The data that was stored with the key.
+        """
+        now = time.time()
+        if self._SUPPORTS_RETURNING:
+            cursor.execute('DELETE FROM {table} WHERE key = ? AND (expire_time IS NULL OR '
+                           'expire_time >= ?) RETURNING data'.format(table=self._tableName),
+                           (key, now))
+            row = cursor.fetchone()
+        else:
+            cursor.execute('SELECT data FROM {table} WHERE key = ? AND (expire_time IS NULL OR '
+                           'expire_time >= ?)'.format(table=self._tableName), (key, now))
+            row = cursor.fetchone()
+            if row is not None:
+                cursor.execute('DELETE FROM {table} WHERE key = ?'.format(
+                    table=self._tableName), (key,))
+        if row is None:
+            cursor.execute('SELECT 1 FROM {table}_replay_log WHERE key = ? AND pop_time >= ?'
+                           .format(table=self._tableName), (key, now - self._replayLogLifetime))
+            if cursor.fetchone() is not None:
+                logging.getLogger('txOauth2').warning('Replay of a popped key detected')
+                raise ReplayedKeyError(key)
+            raise KeyError(key)
+        data = bytes(row[0])
+        cursor.execute('INSERT OR REPLACE INTO {table}_replay_log (key, pop_time) VALUES (?, ?)'
+                       .format(table=self._tableName), (key, now))
+        return self._codec.decode(data)
+
+    def _deleteExpiredData(self, cursor):
+        """
+        Delete all expired data and all keys that are older than the replay log lifetime.
+        :param cursor: A database cursor.
+        """
+        super(SQLiteCodeStorage, self)._deleteExpiredData(cursor)
+        cursor.execute('DELETE FROM {table}_replay_log WHERE pop_time < ?'.format(
+            table=self._tableName), (time.time() - self._replayLogLifetime,))
+
+
+class SQLiteConsentStorage(ConsentStorage):
+    """
+    A ConsentStorage that stores the consent of the users in a SQLite database.
+    Like the SQLiteTokenStorage, the database is accessed from a worker thread
+    and all methods return Deferreds. The scope is stored as its sorted,
+    space separated scope names.
+    """
+
+    def __init__(self, path, tableName='consent', reactor=None):
+        """
+        :raises ValueError: If the table name is not a valid SQL identifier.
+        :param path: The path to the database file.
+        :param tableName: The name of the table to store the consent in.
+        :param reactor: The reactor to use, defaults to the global reactor.
+        """
+        super(SQLiteConsentStorage, self).__init__()
+        self._tableName = _SQLiteDatabase.checkTableName(tableName)
+        self._database = _SQLiteDatabase(path, [
+            'CREATE TABLE IF NOT EXISTS {table} (user_id TEXT NOT NULL, client_id TEXT NOT NULL, '
+            'scope TEXT NOT NULL, PRIMARY KEY (user_id, client_id))'.format(table=tableName)
+        ], reactor=reactor)
+
+    def addConsent(self, userId, clientId, scope):
+        return self._database.runWrite(self._addConsent, userId, clientId, list(scope))
+
+    def getConsent(self, userId, clientId):
+        return self._database.runQuery(self._getConsent, userId, clientId)
+
+    def removeConsent(self, userId, clientId=None):
+        return self._database.runWrite(self._removeConsent, userId, clientId)
+
+    def close(self):
+        """
+        Commit all pending writes and close the database.
+        :return: A Deferred which fires once the database is closed.
+        """
+        return self._database.close()
+
+    def _addConsent(self, cursor, userId, clientId, scope):
+        """
+        Add the scope to the consent of the user for the client.
+        :param cursor: A database cursor.
+        :param userId: The id of the user.
+        :param clientId: The id of the client.
+        :param scope: A list of scope names.
+        """
+        scope = sorted(set(scope).union(self._getConsent(cursor, userId, clientId)))
+        cursor.execute('INSERT OR REPLACE INTO {table} (user_id, client_id, scope) '
+                       'VALUES (?, ?, ?)'.format(table=self._tableName),
+                       (userId, clientId, ' '.join(scope)))
+
+    def _getConsent(self, cursor, userId, clientId):
+        """
+        :param cursor: A database cursor.
+        :param userId: The id of the user.
+        :param clientId: The id of the client.
+        :return: The sorted list of the scope names of the consent of the user for the client.
+        """
+        cursor.execute('SELECT scope FROM {table} WHERE user_id = ? AND client_id = ?'
+                       .format(table=self._tableName), (userId, clientId))
+        row = cursor.fetchone()
+        return [] if row is None else row[0].split()
+
+    def _removeConsent(self, cursor, userId, clientId):
+        """
+        Delete the consent of the user for the client or for all clients.
+        :param cursor: A database cursor.
+        :param userId: The id of the user.
+        :param clientId: The id of the client or None.
+        """
+        if clientId is None:
+            cursor.execute('DELETE FROM {table} WHERE user_id = ?'.format(
+                table=self._tableName), (userId,))
+        else:
+            cursor.execute('DELETE FROM {table} WHERE user_id = ? AND client_id = ?'.format(
+                table=self._tableName), (userId, clientId))
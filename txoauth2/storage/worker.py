@@ -0,0 +1,79 @@
+# Copyright (c) Sebastian Scholz
+# See LICENSE for details.
+from twisted.internet.defer import succeed
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+
+class WorkerThreads(object):
+    """
+    A pool of worker threads for a storage which is started when it is first used.
+    With a single thread, the functions are executed in the order in which they were passed
+    to run. While the threads are running, onShutdown is called when the reactor shuts down,
+    so the storage can write its pending changes and stop the threads.
+    """
+    def __init__(self, name, onShutdown=None, maxThreads=1, reactor=None):
+        """
+        :param name: The name of the threads.
+        :param onShutdown: An optional function to call during the shutdown of the reactor.
+                           It may return a Deferred to delay the shutdown.
+        :param maxThreads: The maximum number of threads.
+        :param reactor: The reactor to use, defaults to the global reactor.
+        """
+        super(WorkerThreads, self).__init__()
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._name = name
+        self._onShutdown = onShutdown
+        self._maxThreads = maxThreads
+        self._threadPool = None
+        self._shutdownTrigger = None
+
+    @property
+    def isRunning(self):
+        """ Whether or not the threads have been started and not yet stopped. """
+        return self._threadPool is not None
+
+    def run(self, function, *args):
+        """
+        Run a function in a worker thread and start the threads, if they are not running.
+        :param function: The function.
+        :param args: The arguments for the function.
+        :return: A Deferred which fires with the result of the function.
+        """
+        if self._threadPool is None:
+            self._threadPool = ThreadPool(
+                minthreads=0, maxthreads=self._maxThreads, name=self._name)
+            self._threadPool.start()
+            if self._onShutdown is not None:
+                self._shutdownTrigger = self._reactor.addSystemEventTrigger(
+                    'during', 'shutdown', self._onShutdown)
+        return deferToThreadPool(self._reactor, self._threadPool, function, *args)
+
+    def stop(self, function=None, *args):
+        """
+        Stop the threads once all functions that were passed to run have been executed.
+        :param function: An optional last function to run in a worker thread,
+                         if the threads are running.
+        :param args: The arguments for the function.
+        :return: A Deferred which fires with the result of the function
+                 once the threads have been stopped.
+        """
+        result = succeed(None) if function is None or self._threadPool is None \
+            else self.run(function, *args)
+        if self._shutdownTrigger is not None:
+            self._reactor.removeSystemEventTrigger(self._shutdownTrigger)
+            self._shutdownTrigger = None
+        return result.addBoth(self._stopThreadPool)
+
+    def _stopThreadPool(self, result):
+        """
+        Stop the threads. This waits for the functions which are still queued.
+        :param result: The result of the last function.
+        :return: The result.
+        """
+        if self._threadPool is not None:
+            self._threadPool.stop()
+            self._threadPool = None
+        return result
@@ -0,0 +1,877 @@
+# Copyright (c) Sebastian Scholz
+# See LICENSE for details.
+import copy
+import math
+import time
+import hashlib
+import logging
+
+from collections import OrderedDict
+
+from twisted.internet.defer import Deferred, gatherResults, maybeDeferred, succeed
+from twisted.python.failure import Failure
+
+from txoauth2.scope import isScopeSubset
+from txoauth2.token import TokenAccess, TokenStorage, checkAccess
+from txoauth2.util import unwrapFirstError, getDeferredResult
+
+
+class _BloomFilter(object):
+    """ A Bloom filter with a fixed number of bits and hash functions. """
+    __slots__ = ('_bits', '_numBits', '_numHashes', '_numSetBits', 'numItems')
+
+    def __init__(self, numBits, numHashes):
+        """
+        :param numBits: The number of bits of the filter.
+        :param numHashes: The number of hash functions.
+        """
+        self._bits = bytearray((numBits + 7) // 8)
+        self._numBits = numBits
+        self._numHashes = numHashes
+        self._numSetBits = 0
+        self.numItems = 0
+
+    @property
+    def falsePositiveRate(self):
+        """ The rate of unknown items that pass the filter, derived from its set bits. """
+        return (self._numSetBits / float(self._numBits)) ** self._numHashes
+
+    def getIndices(self, token):
+        """
+        Derive the bit indices of a token by double hashing.
+        :param token: The token.
+        :return: The indices of the bits that represent the token.
+        """
+        if not isinstance(token, bytes):
+            token = token.encode('utf-8')
+        digest = hashlib.sha256(token).hexdigest()
+        hash1 = int(digest[:16], 16)
+        hash2 = int(digest[16:32], 16) | 1
+        return [(hash1 + index * hash2) % self._numBits for index in range(self._numHashes)]
+
+    def add(self, indices):
+        """
+        :param indices: The indices of the bits that represent the item to add.
+        """
+        for index in indices:
+            mask = 1 << (index & 7)
+            if not self._bits[index >> 3] & mask:
+                self._bits[index >> 3] |= mask
+                self._numSetBits += 1
+        self.numItems += 1
+
+    def mightContain(self, indices):
+        """
+        :param indices: The indices of the bits that represent an item.
+        :return: False, if the item was definitely not added to this filter.
+        """
+        for index in indices:
+            if not self._bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+
+class BloomFilterTokenStorage(TokenStorage):
+    """
+    A wrapper around another token storage that keeps a Bloom filter of all stored tokens,
+    so lookups of tokens that were definitely never stored are answered without accessing
+    the wrapped token storage. This protects the token storage from floods of invalid tokens.
+    isAuthorized rejects such tokens with an InvalidTokenRequestError as usual.
+
+    Tokens are added to a filter for the time span (of generationLifetime seconds)
+    in which they expire, or to a permanent filter if they do not expire. The filters of
+    past time spans are dropped, so expired tokens leave the filter. Removed tokens stay
+    in their filter until it is dropped, the wrapped storage then answers their lookups.
+    Because the permanent filter is never dropped, all lookups are passed to the wrapped
+    storage once its false positive rate exceeds maxFalsePositiveRate,
+    until it is rebuilt with rebuildPermanentFilter.
+
+    Because all tokens must be stored through this wrapper, it must not be used with
+    a persistent or shared token storage, unless all tokens that are already
+    in the token storage are added with addKnownToken.
+    """
+    def __init__(self, tokenStorage, capacity=100000, falsePositiveRate=0.001,
+                 generationLifetime=3600, maxFalsePositiveRate=None):
+        """
+        :raises ValueError: If the capacity, the false positive rates
+                            or the generation lifetime is invalid.
+        :param tokenStorage: The token storage to wrap.
+        :param capacity: The expected number of tokens per filter.
+        :param falsePositiveRate: The target rate of unknown tokens that pass the filter
+                                  when a filter contains capacity tokens.
+        :param generationLifetime: The time span in seconds covered by one filter.
+        :param maxFalsePositiveRate: The false positive rate of the permanent filter
+                                     above which it is no longer used,
+                                     defaults to ten times the falsePositiveRate.
+        """
+        super(BloomFilterTokenStorage, self).__init__()
+        if maxFalsePositiveRate is None:
+            maxFalsePositiveRate = min(1.0, falsePositiveRate * 10)
+        if capacity <= 0 or not 0 < falsePositiveRate < 1 or generationLifetime <= 0 or \
+                not falsePositiveRate <= maxFalsePositiveRate <= 1:
+            raise ValueError('Invalid Bloom filter parameters')
+        self._maxFalsePositiveRate = maxFalsePositiveRate
+        self._tokenStorage = tokenStorage
+        self._numBits = int(math.ceil(-capacity * math.log(falsePositiveRate) / math.log(2) ** 2))
+        self._numHashes = max(1, int(round(self._numBits / float(capacity) * math.log(2))))
+        self._capacity = capacity
+        self._generationLifetime = generationLifetime
+        self._generations = {}
+        self._rejectedLookups = 0
+        self._passedLookups = 0
+        self._falsePositives = 0
+
+    def contains(self, token):
+        if not self._mightContain(token):
+            return False
+        return self._observe(self._tokenStorage.contains(token), lambda found: not found)
+
+    def hasAccess(self, token, scope):
+        if not self._mightContain(token):
+            raise KeyError('Token not found')
+        return self._tokenStorage.hasAccess(token, scope)
+
+    def checkAccess(self, token, scope):
+        if not self._mightContain(token):
+            return TokenAccess.Invalid
+        return self._observe(getDeferredResult(checkAccess(self._tokenStorage, token, scope)),
+                             lambda access: access == TokenAccess.Invalid)
+
+    def getTokenAdditionalData(self, token):
+        if not self._mightContain(token):
+            raise KeyError('Token not found')
+        return self._tokenStorage.getTokenAdditionalData(token)
+
+    def getTokenScope(self, token):
+        if not self._mightContain(token):
+            raise KeyError('Token not found')
+        return self._tokenStorage.getTokenScope(token)
+
+    def getTokenClient(self, token):
+        if not self._mightContain(token):
+            raise KeyError('Token not found')
+        return self._tokenStorage.getTokenClient(token)
+
+    def getTokenLifetime(self, token):
+        if not self._mightContain(token):
+            raise KeyError('Token not found')
+        return self._tokenStorage.getTokenLifetime(token)
+
+    def getTokenInfo(self, token):
+        if not self._mightContain(token):
+            raise KeyError('Token not found')
+        return self._tokenStorage.getTokenInfo(token)
+
+    def store(self, token, client, scope, additionalData=None, expireTime=None):
+        if not isinstance(token, str):
+            raise ValueError('Token parameter is not a string')
+        self.addKnownToken(token, expireTime)
+        return self._tokenStorage.store(
+            token, client, scope, additionalData=additionalData, expireTime=expireTime)
+
+    def remove(self, token):
+        return self._tokenStorage.remove(token)
+
+    def removeByClient(self, clientId):
+        return self._tokenStorage.removeByClient(clientId)
+
+    def removeByUser(self, userId):
+        return self._tokenStorage.removeByUser(userId)
+
+    def addKnownToken(self, token, expireTime=None):
+        """
+        Add a token to the filter without storing it in the wrapped token storage.
+        This allows to add the tokens that were stored in a persistent token storage
+        before this wrapper was created.
+        :param token: The token.
+        :param expireTime: The time the token expires or None.
+        """
+        self._dropExpiredGenerations()
+        if expireTime is not None and expireTime <= time.time():
+            return
+        generation = None if expireTime is None else int(expireTime // self._generationLifetime)
+        bloomFilter = self._generations.get(generation)
+        if bloomFilter is None:
+            bloomFilter = _BloomFilter(self._numBits, self._numHashes)
+            self._generations[generation] = bloomFilter
+        bloomFilter.add(bloomFilter.getIndices(token))
+
+    def rebuildPermanentFilter(self, tokens):
+        """
+        Replace the permanent filter with a new filter that only contains the given tokens.
+        This allows to remove the removed tokens without an expire time from the filter,
+        e.g. once it is saturated.
+        :param tokens: All tokens without an expire time in the wrapped token storage.
+        """
+        bloomFilter = _BloomFilter(self._numBits, self._numHashes)
+        for token in tokens:
+            bloomFilter.add(bloomFilter.getIndices(token))
+        if bloomFilter.numItems:
+            self._generations[None] = bloomFilter
+        else:
+            self._generations.pop(None, None)
+
+    def getStatistics(self):
+        """
+        :return: A dict with the 'capacity' of each filter, the 'filter_bytes' used by each
+                 filter, the number of 'hash_functions', the number of 'filters', the number
+                 of 'stored_tokens' in all filters, the 'expected_false_positive_rate' of the
+                 fullest filter, the number of 'rejected_lookups' which were answered by the
+                 filters, the number of 'passed_lookups' which were passed to the wrapped token
+                 storage, the number of 'false_positives' among them which the wrapped
+                 token storage did not know and whether the permanent filter is 'saturated'.
+        """
+        self._dropExpiredGenerations()
+        maxItems = max([bloomFilter.numItems for bloomFilter in self._generations.values()] or [0])
+        return {
+            'capacity': self._capacity,
+            'filter_bytes': (self._numBits + 7) // 8,
+            'hash_functions': self._numHashes,
+            'filters': len(self._generations),
+            'stored_tokens': sum(bloomFilter.numItems
+                                 for bloomFilter in self._generations.values()),
+            'expected_false_positive_rate':
+                (1 - math.exp(-self._numHashes * maxItems / float(self._numBits)))
+                ** self._numHashes,
+            'rejected_lookups': self._rejectedLookups,
+            'passed_lookups': self._passedLookups,
+            'false_positives': self._falsePositives,
+            'saturated': self._isSaturated()
+        }
+
+    def _mightContain(self, token):
+        """
+        :param token: The token.
+        :return: False, if the token was definitely never stored or has expired.
+        """
+        self._dropExpiredGenerations()
+        if self._isSaturated():
+            self._passedLookups += 1
+            return True
+        indices = None
+        for bloomFilter in self._generations.values():
+            if indices is None:
+                indices = bloomFilter.getIndices(token)
+            if bloomFilter.mightContain(indices):
+                self._passedLookups += 1
+                return True
+        self._rejectedLookups += 1
+        return False
+
+    def _observe(self, result, isMiss):
+        """
+        Count the lookups that passed the filters but were not found in the wrapped storage.
+        :param result: The result of the wrapped storage or a Deferred.
+        :param isMiss: A function that returns True if the result indicates an unknown token.
+        :return: The result.
+        """
+        def countFalsePositive(value):
+            if isMiss(value):
+                self._falsePositives += 1
+            return value
+        if isinstance(result, Deferred):
+            return result.addCallback(countFalsePositive)
+        return countFalsePositive(result)
+
+    def _isSaturated(self):
+        """
+        :return: True, if the permanent filter exceeds the maximum false positive rate.
+        """
+        bloomFilter = self._generations.get(None)
+        return bloomFilter is not None and \
+            bloomFilter.falsePositiveRate > self._maxFalsePositiveRate
+
+    def _dropExpiredGenerations(self):
+        """ Drop the filters whose tokens have all expired. """
+        currentGeneration = int(time.time() // self._generationLifetime)
+        for generation in [generation for generation in self._generations
+                           if generation is not None and generation < currentGeneration]:
+            del self._generations[generation]
+
+
+class CachingTokenStorage(TokenStorage):
+    """
+    A wrapper around another token storage that caches the information of recently used tokens
+    in memory, so isAuthorized can validate hot tokens without accessing the wrapped storage.
+    The wrapped storage must implement getTokenInfo, otherwise all calls are passed through.
+
+    The cache holds at most maxSize tokens and evicts the least recently used token first.
+    A cached token is used for at most timeToLive seconds and never after it expires.
+    Tokens that are removed or stored through this wrapper are dropped from the cache
+    immediately, but a token that is removed from the wrapped storage by someone else
+    (e.g. another server that shares the storage) is accepted for up to timeToLive seconds.
+    The returned scopes, additional data and token information are copies of the cached ones,
+    so changing them does not change the cache.
+    """
+    def __init__(self, tokenStorage, maxSize=10000, timeToLive=60):
+        """
+        :raises ValueError: If the maximum size or the time to live is invalid.
+        :param tokenStorage: The token storage to wrap.
+        :param maxSize: The maximum number of tokens in the cache.
+        :param timeToLive: The maximum number of seconds a token is served from the cache.
+        """
+        super(CachingTokenStorage, self).__init__()
+        if maxSize <= 0 or timeToLive <= 0:
+            raise ValueError('Invalid cache parameters')
+        self._tokenStorage = tokenStorage
+        self._maxSize = maxSize
+        self._timeToLive = timeToLive
+        self._cache = OrderedDict()
+        self._pendingLookups = {}
+        self._hits = 0
+        self._misses = 0
+        self._passThroughs = 0
+        self._evictions = 0
+
+    def contains(self, token):
+        try:
+            tokenInfo = self._lookupTokenInfo(token)
+        except KeyError:
+            return False
+        except NotImplementedError:
+            return self._tokenStorage.contains(token)
+        return self._apply(tokenInfo, lambda _: True, False)
+
+    def hasAccess(self, token, scope):
+        try:
+            tokenInfo = self._lookupTokenInfo(token)
+        except NotImplementedError:
+            return self._tokenStorage.hasAccess(token, scope)
+        return self._apply(tokenInfo, lambda info: isScopeSubset(scope, info['scope']))
+
+    def checkAccess(self, token, scope):
+        def checkScope(tokenInfo):
+            if isScopeSubset(scope, tokenInfo['scope']):
+                return TokenAccess.Granted
+            return TokenAccess.InsufficientScope
+        try:
+            tokenInfo = self._lookupTokenInfo(token)
+        except KeyError:
+            return TokenAccess.Invalid
+        except NotImplementedError:
+            return getDeferredResult(checkAccess(self._tokenStorage, token, scope))
+        return self._apply(tokenInfo, checkScope, TokenAccess.Invalid)
+
+    def getTokenAdditionalData(self, token):
+        try:
+            tokenInfo = self._lookupTokenInfo(token)
+        except NotImplementedError:
+            return self._tokenStorage.getTokenAdditionalData(token)
+        return self._apply(tokenInfo, lambda info: copy.deepcopy(info['additional_data']))
+
+    def getTokenScope(self, token):
+        try:
+            tokenInfo = self._lookupTokenInfo(token)
+        except NotImplementedError:
+            return self._tokenStorage.getTokenScope(token)
+        return self._apply(tokenInfo, lambda info: list(info['scope']))
+
+    def getTokenClient(self, token):
+        try:
+            tokenInfo = self._lookupTokenInfo(token)
+        except NotImplementedError:
+            return self._tokenStorage.getTokenClient(token)
+        return self._apply(tokenInfo, lambda info: info['client_id'])
+
+    def getTokenLifetime(self, token):
+        try:
+            tokenInfo = self._lookupTokenInfo(token)
+        except NotImplementedError:
+            return self._tokenStorage.getTokenLifetime(token)
+        return self._apply(tokenInfo, lambda info: int(time.time()) - info['birth_time'])
+
+    def getTokenInfo(self, token):
+        return self._apply(self._lookupTokenInfo(token), self._copyTokenInfo)
+
+    def store(self, token, client, scope, additionalData=None, expireTime=None):
+        self.invalidate(token)
+        return self._tokenStorage.store(
+            token, client, scope, additionalData=additionalData, expireTime=expireTime)
+
+    def remove(self, token):
+        self.invalidate(token)
+        return self._tokenStorage.remove(token)
+
+    def removeByClient(self, clientId):
+        return self._invalidateAll(self._tokenStorage.removeByClient(clientId))
+
+    def removeByUser(self, userId):
+        return self._invalidateAll(self._tokenStorage.removeByUser(userId))
+
+    def invalidate(self, token):
+        """
+        Drop a token from the cache, so the next lookup is answered by the wrapped storage.
+        A lookup of the token that is still in progress will not add it to the cache.
+        :param token: The token.
+        """
+        self._cache.pop(token, None)
+        self._pendingLookups.pop(token, None)
+
+    def clear(self):
+        """ Drop all tokens from the cache. """
+        self._cache.clear()
+        self._pendingLookups.clear()
+
+    def getStatistics(self):
+        """
+        :return: A dict with the number of 'cached_tokens', the 'max_size' of the cache,
+                 the number of 'hits' that were answered from the cache, the number of 'misses'
+                 that were passed to the wrapped token storage, the number of 'pass_throughs'
+                 that were passed to the wrapped token storage because it does not implement
+                 getTokenInfo and the number of 'evictions' of tokens that were dropped
+                 because the cache was full.
+        """
+        return {
+            'cached_tokens': len(self._cache),
+            'max_size': self._maxSize,
+            'hits': self._hits,
+            'misses': self._misses,
+            'pass_throughs': self._passThroughs,
+            'evictions': self._evictions
+        }
+
+    def _lookupTokenInfo(self, token):
+        """
+        Get the information of a token from the cache or from the wrapped storage.
+        Concurrent asynchronous lookups of the same token share one lookup in the wrapped storage.
+        :raises KeyError: If the token was not found in the wrapped storage.
+        :raises NotImplementedError: If the wrapped storage does not implement getTokenInfo.
+        :param token: The token.
+        :return: The token information like TokenStorage.getTokenInfo or a Deferred.
+        """
+        entry = self._cache.pop(token, None)
+        if entry is not None and entry[0] > time.time():
+            self._cache[token] = entry  # Mark as most recently used.
+            self._hits += 1
+            return entry[1]
+        waiters = self._pendingLookups.get(token)
+        if waiters is not None:
+            self._misses += 1
+            result = Deferred()
+            waiters.append(result)
+            return result
+        try:
+            tokenInfo = self._tokenStorage.getTokenInfo(token)
+        except NotImplementedError:
+            self._passThroughs += 1
+            raise
+        self._misses += 1
+        if not isinstance(tokenInfo, Deferred):
+            self._addToCache(token, tokenInfo)
+            return tokenInfo
+        waiters = []
+        self._pendingLookups[token] = waiters
+
+        def onResult(result):
+            if self._pendingLookups.get(token) is waiters:
+                del self._pendingLookups[token]
+                if not isinstance(result, Failure):
+                    self._addToCache(token, result)
+            for waiter in waiters:
+                if isinstance(result, Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+            return result
+        return tokenInfo.addBoth(onResult)
+
+    def _invalidateAll(self, removedTokens):
+        """
+        Drop the tokens that were removed from the wrapped storage from the cache.
+        :param removedTokens: A list of the removed tokens or a Deferred.
+        :return: The list of the removed tokens or a Deferred.
+        """
+        def invalidateTokens(tokens):
+            for token in tokens:
+                self.invalidate(token)
+            return tokens
+        if isinstance(removedTokens, Deferred):
+            return removedTokens.addCallback(invalidateTokens)
+        return invalidateTokens(removedTokens)
+
+    def _addToCache(self, token, tokenInfo):
+        """
+        Add the information of a token to the cache and evict the least recently used tokens.
+        :param token: The token.
+        :param tokenInfo: The token information like TokenStorage.getTokenInfo.
+        """
+        now = time.time()
+        cacheExpireTime = now + self._timeToLive
+        if tokenInfo.get('expire_time') is not None:
+            cacheExpireTime = min(cacheExpireTime, tokenInfo['expire_time'])
+        if cacheExpireTime <= now:
+            return
+        tokenInfo = self._copyTokenInfo(tokenInfo)
+        tokenInfo['scope'] = tuple(tokenInfo['scope'])
+        self._cache[token] = (cacheExpireTime, tokenInfo)
+        while len(self._cache) > self._maxSize:
+            self._cache.popitem(last=False)
+            self._evictions += 1
+
+    @staticmethod
+    def _copyTokenInfo(tokenInfo):
+        """
+        :param tokenInfo: The token information like TokenStorage.getTokenInfo.
+        :return: A copy of the token information that shares no mutable values with it.
+        """
+        tokenInfo = dict(tokenInfo)
+        tokenInfo['scope'] = list(tokenInfo['scope'])
+        tokenInfo['additional_data'] = copy.deepcopy(tokenInfo['additional_data'])
+        return tokenInfo
+
+    @staticmethod
+    def _apply(result, function, missingResult=None):
+        """
+        :param result: A token information or a Deferred.
+        :param function: A function to call with the token information.
+        :param missingResult: If not None, the result to return for an unknown token
+                              instead of failing with a KeyError.
+        :return: The return value of the function or a Deferred which fires with it.
+        """
+        if not isinstance(result, Deferred):
+            return function(result)
+        result.addCallback(function)
+        if missingResult is not None:
+            def onMissing(failure):
+                failure.trap(KeyError)
+                return missingResult
+            result.addErrback(onMissing)
+        return result
+
+
+class _StagedToken(object):
+    """ A token that was stored in a WriteBehindTokenStorage but not yet written. """
+    __slots__ = ('client', 'scope', 'data', 'birthTime', 'expireTime')
+
+    def __init__(self, client, scope, data, birthTime, expireTime):
+        self.client = client
+        self.scope = scope
+        self.data = data
+        self.birthTime = birthTime
+        self.expireTime = expireTime
+
+
+class WriteBehindTokenStorage(TokenStorage):
+    """
+    A wrapper around another token storage that acknowledges stored tokens immediately
+    and writes them to the wrapped storage in batches. A batch is written once it contains
+    maxBatchSize tokens or flushInterval seconds after its first token was stored.
+    All tokens of a batch are passed to the wrapped storage at once, so storages that
+    group their writes, like the SQLiteTokenStorage and the RedisTokenStorage, write them
+    in a single transaction or pipeline.
+
+    Until a token has been written, lookups of it are answered from the staging area,
+    so the tokens are immediately visible on this server. If the staging area holds
+    maxStagedTokens tokens, new tokens are written through and store returns the result
+    of the wrapped storage, which slows down the TokenResource until the backlog is written.
+    Tokens whose write fails stay staged and are written again retryInterval seconds later,
+    unless they were stored again or removed in the meantime. Only one write or removal
+    of a token is passed to the wrapped storage at a time, later changes of the token
+    wait for it to finish, so the wrapped storage never ends up with an older version.
+    Tokens that are staged when the server stops are lost, so close should be called
+    before the reactor stops, e.g. via a 'before' 'shutdown' system event trigger.
+    """
+    def __init__(self, tokenStorage, maxBatchSize=100, flushInterval=0.05, maxStagedTokens=10000,
+                 reactor=None, retryInterval=1):
+        """
+        :raises ValueError: If one of the limits is not positive.
+        :param tokenStorage: The token storage to wrap.
+        :param maxBatchSize: The number of staged tokens that triggers a write.
+        :param flushInterval: The maximum number of seconds a token is staged before it is written.
+        :param maxStagedTokens: The maximum number of tokens that are staged or being written.
+        :param reactor: The reactor to use, defaults to the global reactor.
+        :param retryInterval: The number of seconds after which tokens whose write failed
+                              are written again.
+        """
+        super(WriteBehindTokenStorage, self).__init__()
+        if maxBatchSize <= 0 or flushInterval < 0 or maxStagedTokens <= 0 or retryInterval < 0:
+            raise ValueError('Invalid write behind parameters')
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._tokenStorage = tokenStorage
+        self._maxBatchSize = maxBatchSize
+        self._flushInterval = flushInterval
+        self._maxStagedTokens = maxStagedTokens
+        self._retryInterval = retryInterval
+        self._pendingTokens = OrderedDict()
+        self._writingTokens = {}
+        self._pendingRemovals = set()
+        self._flushCall = None
+        self._batches = 0
+        self._writtenTokens = 0
+        self._failedWrites = 0
+        self._writeThroughs = 0
+
+    def contains(self, token):
+        stagedToken = self._getStagedToken(token)
+        if stagedToken is None:
+            return self._tokenStorage.contains(token)
+        return True
+
+    def hasAccess(self, token, scope):
+        stagedToken = self._getStagedToken(token)
+        if stagedToken is None:
+            return self._tokenStorage.hasAccess(token, scope)
+        return isScopeSubset(scope, stagedToken.scope)
+
+    def checkAccess(self, token, scope):
+        stagedToken = self._getStagedToken(token)
+        if stagedToken is None:
+            return getDeferredResult(checkAccess(self._tokenStorage, token, scope))
+        if isScopeSubset(scope, stagedToken.scope):
+            return TokenAccess.Granted
+        return TokenAccess.InsufficientScope
+
+    def getTokenAdditionalData(self, token):
+        stagedToken = self._getStagedToken(token)
+        if stagedToken is None:
+            return self._tokenStorage.getTokenAdditionalData(token)
+        return stagedToken.data
+
+    def getTokenScope(self, token):
+        stagedToken = self._getStagedToken(token)
+        if stagedToken is None:
+            return self._tokenStorage.getTokenScope(token)
+        return list(stagedToken.scope)
+
+    def getTokenClient(self, token):
+        stagedToken = self._getStagedToken(token)
+        if stagedToken is None:
+            return self._tokenStorage.getTokenClient(token)
+        return stagedToken.client.id
+
+    def getTokenLifetime(self, token):
+        stagedToken = self._getStagedToken(token)
+        if stagedToken is None:
+            return self._tokenStorage.getTokenLifetime(token)
+        return int(time.time()) - stagedToken.birthTime
+
+    def getTokenInfo(self, token):
+        stagedToken = self._getStagedToken(token)
+        if stagedToken is None:
+            return self._tokenStorage.getTokenInfo(token)
+        return {
+            'scope': list(stagedToken.scope),
+            'client_id': stagedToken.client.id,
+            'additional_data': stagedToken.data,
+            'birth_time': stagedToken.birthTime,
+            'expire_time': stagedToken.expireTime
+        }
+
+    def store(self, token, client, scope, additionalData=None, expireTime=None):
+        if not isinstance(token, str):
+            raise ValueError('Token parameter is not a string')
+        if not isinstance(scope, list):
+            scope = [scope]
+        if token not in self._pendingTokens and token not in self._writingTokens and \
+                len(self._pendingTokens) + len(self._writingTokens) >= self._maxStagedTokens:
+            self._writeThroughs += 1
+            return self._tokenStorage.store(
+                token, client, scope, additionalData=additionalData, expireTime=expireTime)
+        self._pendingTokens[token] = _StagedToken(
+            client, list(scope), additionalData, int(time.time()), expireTime)
+        if len(self._pendingTokens) >= self._maxBatchSize:
+            self._onFlushTimer()
+        elif self._flushCall is None:
+            self._flushCall = self._reactor.callLater(self._flushInterval, self._onFlushTimer)
+        return None
+
+    def remove(self, token):
+        if token not in self._pendingTokens and token not in self._writingTokens:
+            return self._tokenStorage.remove(token)
+        return self._removeStagedToken(token)
+
+    def removeByClient(self, clientId):
+        return self.flush().addCallback(lambda _: self._tokenStorage.removeByClient(clientId))
+
+    def removeByUser(self, userId):
+        return self.flush().addCallback(lambda _: self._tokenStorage.removeByUser(userId))
+
+    def flush(self):
+        """
+        Write all staged tokens to the wrapped storage.
+        :return: A Deferred which fires once all staged tokens were written
+                 or fails with the error of the first failed write.
+        """
+        writes = [self._waitForWrite(token) for token in list(self._writingTokens)]
+        if self._pendingTokens:
+            writes.append(self._writeBatch())
+        if not writes:
+            return succeed(None)
+        return gatherResults(writes, consumeErrors=True).addCallbacks(
+            lambda _: None, unwrapFirstError)
+
+    def close(self):
+        """
+        Write all staged tokens to the wrapped storage and stop the timers.
+        Tokens whose write fails are not written again.
+        :return: A Deferred which fires once all staged tokens were written
+                 or fails with the error of the first failed write.
+        """
+        result = self.flush()
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        return result.addBoth(self._cancelRetry)
+
+    def getStatistics(self):
+        """
+        :return: A dict with the number of 'staged_tokens' that are not yet written, the number
+                 of written 'batches', the number of 'written_tokens', the number of
+                 'failed_writes' and the number of 'write_throughs' of tokens that were
+                 written directly, because the staging area was full.
+        """
+        return {
+            'staged_tokens': len(self._pendingTokens) + len(self._writingTokens),
+            'batches': self._batches,
+            'written_tokens': self._writtenTokens,
+            'failed_writes': self._failedWrites,
+            'write_throughs': self._writeThroughs
+        }
+
+    def _getStagedToken(self, token):
+        """
+        :param token: The token.
+        :return: The staged token or None, if the token is not staged.
+        """
+        stagedToken = self._pendingTokens.get(token)
+        if stagedToken is None:
+            writing = self._writingTokens.get(token)
+            if writing is None or writing[0] is None:
+                return None
+            stagedToken = writing[0]
+        if stagedToken.expireTime is not None and time.time() > stagedToken.expireTime:
+            return None
+        return stagedToken
+
+    def _waitForWrite(self, token):
+        """
+        :param token: A token that is being written or removed.
+        :return: A Deferred which fires once the write or removal of the token and of
+                 the changes of the token that were made in the meantime have finished
+                 or fails with the error of the last of them.
+        """
+        waiter = Deferred()
+        self._writingTokens[token][1].append(waiter)
+        return waiter
+
+    def _removeStagedToken(self, token):
+        """
+        Remove a staged token from the staging area and from the wrapped storage,
+        which might hold an older version of the token or not know the token at all.
+        A token that is being written is removed once the write has finished.
+        :param token: The token.
+        :return: A Deferred which fires once the token was removed.
+        """
+        self._pendingTokens.pop(token, None)
+        writing = self._writingTokens.get(token)
+        if writing is None:
+            return self._startRemoval(token, [])
+        if writing[0] is not None:
+            self._pendingRemovals.add(token)
+        return self._waitForWrite(token)
+
+    def _startRemoval(self, token, waiters):
+        """
+        Remove a token from the wrapped storage.
+        :param token: The token.
+        :param waiters: The Deferreds to fire once the token was removed.
+        :return: A Deferred which fires once the token was removed.
+        """
+        def ignoreUnknownToken(failure):
+            failure.trap(KeyError)
+        self._writingTokens[token] = (None, waiters)
+        return maybeDeferred(self._tokenStorage.remove, token).addErrback(ignoreUnknownToken)\
+            .addBoth(self._onWritten, token, None)
+
+    def _startWrite(self, token, stagedToken, waiters):
+        """
+        Write a staged token to the wrapped storage.
+        :param token: The token.
+        :param stagedToken: The staged token.
+        :param waiters: The Deferreds to fire once the token was written.
+        :return: A Deferred which fires once the token was written.
+        """
+        self._writingTokens[token] = (stagedToken, waiters)
+        return maybeDeferred(
+            self._tokenStorage.store, token, stagedToken.client, stagedToken.scope,
+            additionalData=stagedToken.data, expireTime=stagedToken.expireTime)\
+            .addBoth(self._onWritten, token, stagedToken)
+
+    def _onFlushTimer(self):
+        """ Write all pending tokens, failed writes are logged and retried by _onWritten. """
+        self._writeBatch().addErrback(lambda _: None)
+
+    def _cancelRetry(self, result):
+        """
+        Cancel the retry of failed writes that was scheduled while closing.
+        :param result: The result of the flush.
+        :return: The result.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        return result
+
+    def _writeBatch(self):
+        """
+        Pass all pending tokens to the wrapped storage, except those that are still
+        being written or removed. They are written once that has finished.
+        :return: A Deferred which fires once all tokens of the batch were written
+                 or fails with a FirstError if a write failed.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        batch, self._pendingTokens = self._pendingTokens, OrderedDict()
+        for token in [token for token in batch if token in self._writingTokens]:
+            self._pendingTokens[token] = batch.pop(token)
+        if not batch:
+            return succeed(None)
+        self._batches += 1
+        return gatherResults([self._startWrite(token, stagedToken, [])
+                              for token, stagedToken in batch.items()], consumeErrors=True)
+
+    def _onWritten(self, result, token, stagedToken):
+        """
+        Finish the write or removal of a token and start the next change of the token,
+        if it was stored again or removed in the meantime. Otherwise, notify the waiters.
+        If a write failed, the token is staged again and written after the retry interval,
+        unless it was stored again, removed or has expired in the meantime.
+        :param result: The result of the store or remove call or a Failure.
+        :param token: The token.
+        :param stagedToken: The staged token that was written or None, if it was removed.
+        :return: The result.
+        """
+        waiters = self._writingTokens.pop(token)[1]
+        hasNewerVersion = token in self._pendingTokens
+        if stagedToken is not None:
+            if isinstance(result, Failure):
+                self._failedWrites += 1
+                logging.getLogger('txOauth2').error(
+                    'Failed to write a staged token: %s', result.getErrorMessage())
+                if not hasNewerVersion and token not in self._pendingRemovals and \
+                        (stagedToken.expireTime is None or stagedToken.expireTime > time.time()):
+                    self._pendingTokens[token] = stagedToken
+                    if self._flushCall is None:
+                        self._flushCall = self._reactor.callLater(
+                            self._retryInterval, self._onFlushTimer)
+            else:
+                self._writtenTokens += 1
+        if token in self._pendingRemovals:
+            self._pendingRemovals.discard(token)
+            self._startRemoval(token, waiters).addErrback(lambda _: None)
+        elif hasNewerVersion:
+            self._startWrite(token, self._pendingTokens.pop(token), waiters)\
+                .addErrback(lambda _: None)
+        else:
+            for waiter in waiters:
+                if isinstance(result, Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(None)
+        return result
@@ -5,20 +5,31 @@ import time
 import json
 
 from abc import ABCMeta, abstractmethod
+from enum import Enum
+from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.web.resource import Resource
 
 from txoauth2 import GrantTypes
 from txoauth2.clients import PublicClient
+from txoauth2.scope import isScopeSubset
+from txoauth2.util import renderDeferred
 from .errors import InsecureConnectionError, MissingParameterError, InvalidParameterError, \
     InvalidTokenError, InvalidScopeError, UnsupportedGrantTypeError, OK, MultipleParameterError, \
     MultipleClientCredentialsError, OAuth2Error, InvalidClientIdError, DifferentRedirectUriError, \
     UnauthorizedClientError, MalformedParameterError, MultipleClientAuthenticationError, \
-    NoClientAuthenticationError, MalformedRequestError
+    NoClientAuthenticationError, MalformedRequestError, ServerError
 
 
 class TokenFactory(object):
-    """ A factory that can generate tokens. """
+    """
+    A factory that can generate tokens.
+    The generateToken method may return a Deferred which fires with the new token.
+    A factory that guarantees that its tokens only contain characters from
+    TokenResource.VALID_TOKEN_CHARS can set generatesValidTokens to True,
+    the TokenResource will then not validate the generated tokens.
+    """
     __metaclass__ = ABCMeta
+    generatesValidTokens = False
 
     @abstractmethod
     def generateToken(self, lifetime, client, scope, additionalData=None):
@@ -36,8 +47,20 @@ class TokenFactory(object):
         raise NotImplementedError()
 
 
+class TokenAccess(Enum):
+    """ The possible results of TokenStorage.checkAccess. """
+    Invalid = 'invalid'
+    InsufficientScope = 'insufficient_scope'
+    Granted = 'granted'
+
+
 class TokenStorage(object):
-    """ An object that stores and manages tokens. """
+    """
+    An object that stores and manages tokens.
+    All methods may return a Deferred which fires with the result instead of returning
+    the result directly, in which case the token storage is accessed without blocking.
+    Errors should then be reported by failing the Deferred with the documented exception.
+    """
     __metaclass__ = ABCMeta
 
     @abstractmethod
@@ -62,6 +85,22 @@ class TokenStorage(object):
         """
         raise NotImplementedError()
 
+    def checkAccess(self, token, scope):
+        """
+        Check in one call whether the token is stored in this token storage and
+        grants access to the given list of scopes. Implementing this method is optional,
+        but it allows isAuthorized to replace the calls to contains and hasAccess
+        with a single lookup.
+
+        :raises NotImplementedError: If the token storage does not support this method.
+        :param token: The token to validate.
+        :param scope: The scopes the token must grant access to.
+        :return: TokenAccess.Invalid if the token is not stored in this token storage or has
+                 expired, TokenAccess.InsufficientScope if the token does not grant access to
+                 the scopes and TokenAccess.Granted otherwise.
+        """
+        raise NotImplementedError()
+
     @abstractmethod
     def getTokenAdditionalData(self, token):
         """
@@ -104,6 +143,22 @@ class TokenStorage(object):
         """
         raise NotImplementedError()
 
+    def getTokenInfo(self, token):
+        """
+        Get all information that was passed to store together with the given token in one call.
+        Implementing this method is optional, but it allows the TokenResource to replace
+        the individual calls to getTokenScope, getTokenClient, getTokenAdditionalData,
+        contains and getTokenLifetime with a single lookup.
+
+        :raises KeyError: If the token was not found in the token storage or has expired.
+        :raises NotImplementedError: If the token storage does not support this method.
+        :param token: A token.
+        :return: A dict containing the 'scope', the 'client_id', the 'additional_data',
+                 the 'birth_time' and the optional 'expire_time' of the token.
+                 The times are in seconds since the epoch.
+        """
+        raise NotImplementedError()
+
     @abstractmethod
     def store(self, token, client, scope, additionalData=None, expireTime=None):
         """
@@ -134,11 +189,63 @@ class TokenStorage(object):
         """
         raise NotImplementedError()
 
+    def removeByClient(self, clientId):
+        """
+        Remove all tokens that were stored for the given client, e.g. because the client
+        was compromised. Implementing this method is optional, but it allows the TokenResource
+        to revoke the tokens of a client without scanning all tokens.
+
+        :raises NotImplementedError: If the token storage does not support this method.
+        :param clientId: The id of the client.
+        :return: A list of the removed tokens.
+        """
+        raise NotImplementedError()
+
+    def removeByUser(self, userId):
+        """
+        Remove all tokens that were stored for the given user. The token storage determines
+        the user of a token from the additional data that was stored alongside it.
+        Implementing this method is optional, but it allows the TokenResource
+        to revoke the tokens of a user without scanning all tokens.
+
+        :raises NotImplementedError: If the token storage does not support this method
+                                     or can not determine the user of a token.
+        :param userId: The id of the user.
+        :return: A list of the removed tokens.
+        """
+        raise NotImplementedError()
+
+
+@inlineCallbacks
+def checkAccess(tokenStorage, token, scope):
+    """
+    Check if the token grants access to the scope. Uses checkAccess of the token storage
+    if it is supported and falls back to contains and hasAccess otherwise.
+    :param tokenStorage: The token storage.
+    :param token: The token to check.
+    :param scope: The list of scopes the token must grant access to.
+    :return: A Deferred which fires with the TokenAccess result.
+    """
+    storageCheckAccess = getattr(tokenStorage, 'checkAccess', None)
+    if storageCheckAccess is not None:
+        try:
+            access = yield storageCheckAccess(token, scope)
+        except NotImplementedError:
+            pass
+        else:
+            returnValue(access)
+    if not (yield tokenStorage.contains(token)):
+        returnValue(TokenAccess.Invalid)
+    if (yield tokenStorage.hasAccess(token, scope)):
+        returnValue(TokenAccess.Granted)
+    returnValue(TokenAccess.InsufficientScope)
+
 
 class PersistentStorage(object):
     """
     A key value storage that can store data between a call to OAuth2.grantAccess
     and the corresponding POST request to the TokenResource from the client.
+    All methods may return a Deferred which fires with the result.
     """
     __metaclass__ = ABCMeta
 
@@ -173,6 +280,7 @@ class UserPasswordManager(object):
     A password manager that can authenticate a resource owner with a username and password.
     This is only used in the Resource Owner Password Credentials Grant.
     See https://tools.ietf.org/html/rfc6749#section-4.3
+    The authenticate method may return a Deferred which fires with the result.
     """
     __metaclass__ = ABCMeta
 
@@ -211,6 +319,9 @@ class TokenResource(Resource, object):
        2. The client generates a POST request to this resource,
           passing the refresh token as an argument.
        3. This resource creates and stores another access token and returns it.
+
+    The token factory, the storages and the password manager may return Deferreds.
+    In this case the request is processed asynchronously without blocking the reactor.
     """
     VALID_TOKEN_CHARS = string.digits + string.ascii_letters + '-._~+/'
     tokenFactory = None
@@ -223,13 +334,14 @@ class TokenResource(Resource, object):
     authTokenLifeTime = 3600
     minRefreshTokenLifeTime = 1209600  # = 14 days
     defaultScope = None
+    scopeRegistry = None
     acceptedGrantTypes = [GrantTypes.RefreshToken.value, GrantTypes.AuthorizationCode.value,
                           GrantTypes.ClientCredentials.value, GrantTypes.Password.value]
 
     def __init__(self, tokenFactory, persistentStorage, refreshTokenStorage, authTokenStorage,
                  clientStorage, authTokenLifeTime=3600, minRefreshTokenLifeTime=1209600,
                  passwordManager=None, allowInsecureRequestDebug=False, grantTypes=None,
-                 defaultScope=None):
+                 defaultScope=None, scopeRegistry=None):
         """
         Create a new TokenResource.
         The given authTokenStorage will be used to check tokens when
@@ -252,6 +364,8 @@ class TokenResource(Resource, object):
                                           Do NOT use in production!
         :param grantTypes: The grant types that are enabled for this authorization endpoint.
         :param defaultScope: The default scope for tokens if a request does not contain any.
+        :param scopeRegistry: An optional ScopeRegistry used to check whether a requested scope
+                              is a subset of the scope of a refresh token.
         """
         super(TokenResource, self).__init__()
         self.allowedMethods = [b'POST']
@@ -264,6 +378,7 @@ class TokenResource(Resource, object):
         self.authTokenLifeTime = authTokenLifeTime
         self.minRefreshTokenLifeTime = minRefreshTokenLifeTime
         self.defaultScope = defaultScope
+        self.scopeRegistry = scopeRegistry
         TokenResource._OAuthTokenStorage = authTokenStorage
         if grantTypes is not None:
             if GrantTypes.Implicit in grantTypes:
@@ -284,149 +399,196 @@ class TokenResource(Resource, object):
         :param request: The POST request.
         :return: A response or NOT_DONE_YET
         """
+        return renderDeferred(request, self._handlePostRequest(request),
+                              lambda req, failure: ServerError().generate(req))
+
+    @inlineCallbacks
+    def _handlePostRequest(self, request):
+        """
+        Handle a POST request. The storages, the token factory and the password manager
+        may return Deferreds, in which case the request is processed asynchronously.
+
+        :param request: The POST request.
+        :return: A Deferred which fires with the response or NOT_DONE_YET.
+        """
         if not self.allowInsecureRequestDebug and not request.isSecure():
-            return InsecureConnectionError().generate(request)
+            returnValue(InsecureConnectionError().generate(request))
         contentTypeHeader = request.getHeader(b'Content-Type')
         if contentTypeHeader is None or\
                 not contentTypeHeader.startswith(b'application/x-www-form-urlencoded'):
             message = 'The Content-Type must be "application/x-www-form-urlencoded"'
-            return MalformedRequestError(message).generate(request)
+            returnValue(MalformedRequestError(message).generate(request))
         if b'grant_type' not in request.args:
-            return MissingParameterError(name='grant_type').generate(request)
+            returnValue(MissingParameterError(name='grant_type').generate(request))
         if len(request.args[b'grant_type']) != 1:
-            return MultipleParameterError('grant_type').generate(request)
+            returnValue(MultipleParameterError('grant_type').generate(request))
         try:
             grantType = request.args[b'grant_type'][0].decode('utf-8')
         except UnicodeDecodeError:
-            return InvalidParameterError('grant_type').generate(request)
+            returnValue(InvalidParameterError('grant_type').generate(request))
         if grantType not in self.acceptedGrantTypes:
-            return UnsupportedGrantTypeError(grantType).generate(request)
+            returnValue(UnsupportedGrantTypeError(grantType).generate(request))
         # noinspection PyTypeChecker
         if grantType not in [stdGrantType.value for stdGrantType in GrantTypes]:
-            return self.onCustomGrantTypeRequest(request, grantType)
-        client = self._authenticateClient(request)
+            returnValue(self.onCustomGrantTypeRequest(request, grantType))
+        client = yield self._authenticateClient(request)
         if isinstance(client, OAuth2Error):
-            return client.generate(request)
-        if grantType not in client.authorizedGrantTypes:
-            return UnauthorizedClientError(grantType).generate(request)
+            returnValue(client.generate(request))
+        if not client.isGrantTypeAuthorized(grantType):
+            returnValue(UnauthorizedClientError(grantType).generate(request))
         if grantType == GrantTypes.RefreshToken.value:
             if b'refresh_token' not in request.args:
-                return MissingParameterError('refresh_token').generate(request)
+                returnValue(MissingParameterError('refresh_token').generate(request))
             if len(request.args[b'refresh_token']) != 1:
-                return MultipleParameterError('refresh_token').generate(request)
+                returnValue(MultipleParameterError('refresh_token').generate(request))
             try:
                 refreshToken = request.args[b'refresh_token'][0].decode('utf-8')
-                tokenScope = self.refreshTokenStorage.getTokenScope(refreshToken)
-                additionalData = self.refreshTokenStorage.getTokenAdditionalData(refreshToken)
-                clientId = self.refreshTokenStorage.getTokenClient(refreshToken)
+                tokenInfo = yield self._getRefreshTokenInfo(refreshToken)
             except (KeyError, UnicodeDecodeError):
-                return InvalidTokenError('refresh token').generate(request)
-            if clientId != client.id:
-                return InvalidTokenError('refresh token').generate(request)
+                returnValue(InvalidTokenError('refresh token').generate(request))
+            tokenScope = tokenInfo['scope']
+            additionalData = tokenInfo['additional_data']
+            if tokenInfo['client_id'] != client.id:
+                returnValue(InvalidTokenError('refresh token').generate(request))
             if b'scope' in request.args:
                 if len(request.args[b'scope']) != 1:
-                    return MultipleParameterError('scope').generate(request)
+                    returnValue(MultipleParameterError('scope').generate(request))
                 try:
                     scope = request.args[b'scope'][0].decode('utf-8').split()
                 except UnicodeDecodeError:
-                    return InvalidScopeError(request.args[b'scope'][0]).generate(request)
-                for requestedScope in scope:
-                    if requestedScope not in tokenScope:
-                        return InvalidScopeError(scope).generate(request)
+                    returnValue(InvalidScopeError(request.args[b'scope'][0]).generate(request))
+                if not isScopeSubset(scope, tokenScope, self.scopeRegistry):
+                    returnValue(InvalidScopeError(scope).generate(request))
             else:
                 scope = tokenScope
-            if not self.refreshTokenStorage.contains(refreshToken):
-                return InvalidTokenError('refresh token').generate(request)
             try:
-                accessToken = self._storeNewAccessToken(client, scope, additionalData)
+                accessToken = yield self._storeNewAccessToken(client, scope, additionalData)
             except ValueError:
-                return InvalidScopeError(scope).generate(request)
+                returnValue(InvalidScopeError(scope).generate(request))
             newRefreshToken = None
-            if self._shouldExpireRefreshToken(refreshToken):
-                self.refreshTokenStorage.remove(refreshToken)
-                newRefreshToken = self._storeNewRefreshToken(client, scope, additionalData)
-            return self._buildResponse(request, accessToken, scope, newRefreshToken)
+            if self._shouldExpireRefreshToken(tokenInfo):
+                yield self.refreshTokenStorage.remove(refreshToken)
+                newRefreshToken = yield self._storeNewRefreshToken(client, scope, additionalData)
+            returnValue(self._buildResponse(request, accessToken, scope, newRefreshToken))
         elif grantType == GrantTypes.AuthorizationCode.value:
             redirectUri = None
             if b'code' not in request.args:
-                return MissingParameterError('code').generate(request)
+                returnValue(MissingParameterError('code').generate(request))
             if len(request.args[b'code']) != 1:
-                return MultipleParameterError('code').generate(request)
+                returnValue(MultipleParameterError('code').generate(request))
             if b'redirect_uri' in request.args:
                 if len(request.args[b'redirect_uri']) != 1:
-                    return MultipleParameterError('redirect_uri').generate(request)
+                    returnValue(MultipleParameterError('redirect_uri').generate(request))
                 try:
                     redirectUri = request.args[b'redirect_uri'][0].decode('utf-8')
                 except UnicodeDecodeError:
-                    return InvalidParameterError('redirect_uri').generate(request)
+                    returnValue(InvalidParameterError('redirect_uri').generate(request))
             try:
-                data = self.persistentStorage.pop('code' + request.args[b'code'][0].decode('utf-8'))
+                data = yield self.persistentStorage.pop(
+                    'code' + request.args[b'code'][0].decode('utf-8'))
             except (KeyError, UnicodeDecodeError):
-                return InvalidTokenError('authorization code').generate(request)
+                returnValue(InvalidTokenError('authorization code').generate(request))
             if data['client_id'] != client.id:
-                return InvalidTokenError('authorization code').generate(request)
+                returnValue(InvalidTokenError('authorization code').generate(request))
             if data['redirect_uri'] is not None:
                 if redirectUri is None:
-                    return MissingParameterError('redirect_uri').generate(request)
+                    returnValue(MissingParameterError('redirect_uri').generate(request))
                 if data['redirect_uri'] != redirectUri:
-                    return DifferentRedirectUriError().generate(request)
+                    returnValue(DifferentRedirectUriError().generate(request))
             additionalData = data['additional_data']
             scope = data['scope']
-            accessToken = self._storeNewAccessToken(client, scope, additionalData)
+            accessToken = yield self._storeNewAccessToken(client, scope, additionalData)
             refreshToken = None
             if self.authTokenLifeTime is not None:
-                refreshToken = self._storeNewRefreshToken(client, scope, additionalData)
-            return self._buildResponse(request, accessToken, scope, refreshToken)
+                refreshToken = yield self._storeNewRefreshToken(client, scope, additionalData)
+            returnValue(self._buildResponse(request, accessToken, scope, refreshToken))
         elif grantType == GrantTypes.ClientCredentials.value:
             if isinstance(client, PublicClient):
-                return UnauthorizedClientError(grantType).generate(request)
+                returnValue(UnauthorizedClientError(grantType).generate(request))
             if b'scope' in request.args:
                 if len(request.args[b'scope']) != 1:
-                    return MultipleParameterError('scope').generate(request)
+                    returnValue(MultipleParameterError('scope').generate(request))
                 try:
                     scope = request.args[b'scope'][0].decode('utf-8').split()
                 except UnicodeDecodeError:
-                    return InvalidScopeError(request.args[b'scope'][0]).generate(request)
+                    returnValue(InvalidScopeError(request.args[b'scope'][0]).generate(request))
             else:
                 if self.defaultScope is None:
-                    return MissingParameterError('scope').generate(request)
+                    returnValue(MissingParameterError('scope').generate(request))
                 scope = self.defaultScope
             try:
-                accessToken = self._storeNewAccessToken(client, scope, None)
+                accessToken = yield self._storeNewAccessToken(client, scope, None)
             except ValueError:
-                return InvalidScopeError(scope).generate(request)
-            return self._buildResponse(request, accessToken, scope)
+                returnValue(InvalidScopeError(scope).generate(request))
+            returnValue(self._buildResponse(request, accessToken, scope))
         elif grantType == GrantTypes.Password.value:
             for name in [b'username', b'password']:
                 if name not in request.args:
-                    return MissingParameterError(name.decode('utf-8')).generate(request)
+                    returnValue(MissingParameterError(name.decode('utf-8')).generate(request))
                 if len(request.args[name]) != 1:
-                    return MultipleParameterError(name.decode('utf-8')).generate(request)
+                    returnValue(MultipleParameterError(name.decode('utf-8')).generate(request))
             username = request.args[b'username'][0]
             password = request.args[b'password'][0]
             if b'scope' in request.args:
                 if len(request.args[b'scope']) != 1:
-                    return MultipleParameterError('scope').generate(request)
+                    returnValue(MultipleParameterError('scope').generate(request))
                 try:
                     scope = request.args[b'scope'][0].decode('utf-8').split()
                 except UnicodeDecodeError:
-                    return InvalidScopeError(request.args[b'scope'][0]).generate(request)
+                    returnValue(InvalidScopeError(request.args[b'scope'][0]).generate(request))
             else:
                 if self.defaultScope is None:
-                    return MissingParameterError('scope').generate(request)
+                    returnValue(MissingParameterError('scope').generate(request))
                 scope = self.defaultScope
-            if not self.passwordManager.authenticate(username, password):
-                return InvalidTokenError('username or password').generate(request)
+            if not (yield self.passwordManager.authenticate(username, password)):
+                returnValue(InvalidTokenError('username or password').generate(request))
             try:
-                accessToken = self._storeNewAccessToken(client, scope, None)
+                accessToken = yield self._storeNewAccessToken(client, scope, None)
             except ValueError:
-                return InvalidScopeError(scope).generate(request)
+                returnValue(InvalidScopeError(scope).generate(request))
             refreshToken = None
             if self.authTokenLifeTime is not None:
-                refreshToken = self._storeNewRefreshToken(client, scope, None)
-            return self._buildResponse(request, accessToken, scope, refreshToken)
+                refreshToken = yield self._storeNewRefreshToken(client, scope, None)
+            returnValue(self._buildResponse(request, accessToken, scope, refreshToken))
         else:
-            return UnsupportedGrantTypeError(grantType).generate(request)
+            returnValue(UnsupportedGrantTypeError(grantType).generate(request))
+
+    def revokeClientTokens(self, clientId):
+        """
+        Revoke all refresh and access tokens that were issued to a client,
+        e.g. because the client was compromised.
+        :param clientId: The id of the client.
+        :return: A Deferred which fires with a list of the revoked tokens or fails with a
+                 NotImplementedError, if a token storage does not support removeByClient.
+        """
+        return self._revokeTokens('removeByClient', clientId)
+
+    def revokeUserTokens(self, userId):
+        """
+        Revoke all refresh and access tokens that were issued on behalf of a user.
+        :param userId: The id of the user, as determined by the token storages.
+        :return: A Deferred which fires with a list of the revoked tokens or fails with a
+                 NotImplementedError, if a token storage does not support removeByUser.
+        """
+        return self._revokeTokens('removeByUser', userId)
+
+    @inlineCallbacks
+    def _revokeTokens(self, methodName, identifier):
+        """
+        Remove the tokens from the refresh token storage first,
+        so no new access tokens can be issued while the access tokens are removed.
+        :param methodName: The name of the token storage method that removes the tokens.
+        :param identifier: The argument for the method.
+        :return: A list of the removed tokens.
+        """
+        tokenStorages = [self.getTokenStorageSingleton()]
+        if self.refreshTokenStorage is not None and \
+                self.refreshTokenStorage is not tokenStorages[0]:
+            tokenStorages.insert(0, self.refreshTokenStorage)
+        revokedTokens = []
+        for tokenStorage in tokenStorages:
+            revokedTokens.extend((yield getattr(tokenStorage, methodName)(identifier)))
+        returnValue(revokedTokens)
 
     # noinspection PyMethodMayBeStatic
     def onCustomGrantTypeRequest(self, request, grantType):
@@ -440,14 +602,46 @@ class TokenResource(Resource, object):
         """
         return UnsupportedGrantTypeError(grantType).generate(request)
 
-    def _shouldExpireRefreshToken(self, refreshToken):
+    @inlineCallbacks
+    def _getRefreshTokenInfo(self, refreshToken):
+        """
+        Look up all information about a refresh token. Uses getTokenInfo of the refresh token
+        storage if it is supported and falls back to the individual lookups otherwise.
+        :raises KeyError: If the refresh token is not valid.
+        :param refreshToken: A refresh token.
+        :return: A Deferred which fires with the token information as returned by getTokenInfo.
         """
-        :param refreshToken: A valid refresh token.
+        getTokenInfo = getattr(self.refreshTokenStorage, 'getTokenInfo', None)
+        if getTokenInfo is not None:
+            try:
+                tokenInfo = yield getTokenInfo(refreshToken)
+            except NotImplementedError:
+                pass
+            else:
+                returnValue(tokenInfo)
+        tokenScope = yield self.refreshTokenStorage.getTokenScope(refreshToken)
+        additionalData = yield self.refreshTokenStorage.getTokenAdditionalData(refreshToken)
+        clientId = yield self.refreshTokenStorage.getTokenClient(refreshToken)
+        if not (yield self.refreshTokenStorage.contains(refreshToken)):
+            raise KeyError('Token expired')
+        tokenLifetime = yield self.refreshTokenStorage.getTokenLifetime(refreshToken)
+        returnValue({
+            'scope': tokenScope,
+            'client_id': clientId,
+            'additional_data': additionalData,
+            'birth_time': int(time.time()) - tokenLifetime,
+            'expire_time': None
+        })
+
+    def _shouldExpireRefreshToken(self, tokenInfo):
+        """
+        :param tokenInfo: The information about a valid refresh token.
         :return: Whether or not to expire the refresh token.
         """
-        tokenLifetime = self.refreshTokenStorage.getTokenLifetime(refreshToken)
+        tokenLifetime = int(time.time()) - tokenInfo['birth_time']
         return tokenLifetime >= self.minRefreshTokenLifeTime
 
+    @inlineCallbacks
     def _storeNewRefreshToken(self, client, scope, additionalData):
         """
         Create and store a new refresh token.
@@ -455,17 +649,16 @@ class TokenResource(Resource, object):
         :param client: The client the refresh token belongs to.
         :param scope: The scope of the refresh token.
         :param additionalData: Additional data of the refresh token.
-        :return: The new refresh token.
+        :return: A Deferred which fires with the new refresh token.
         """
-        refreshToken = self.tokenFactory.generateToken(
+        refreshToken = yield self.tokenFactory.generateToken(
             None, client, scope=scope, additionalData=additionalData)
-        if not self.isValidToken(refreshToken):
-            raise ValueError('Generated token is invalid: {token}'
-                             .format(token=refreshToken))
-        self.refreshTokenStorage.store(refreshToken, client, scope=scope,
-                                       additionalData=additionalData)
-        return refreshToken
+        self._checkGeneratedToken(refreshToken)
+        yield self.refreshTokenStorage.store(refreshToken, client, scope=scope,
+                                             additionalData=additionalData)
+        returnValue(refreshToken)
 
+    @inlineCallbacks
     def _storeNewAccessToken(self, client, scope, additionalData):
         """
         Create and store a new access token.
@@ -473,19 +666,29 @@ class TokenResource(Resource, object):
         :param client: The client the access token belongs to.
         :param scope: The scope of the access token.
         :param additionalData: Additional data of the access token.
-        :return: The new access token.
+        :return: A Deferred which fires with the new access token.
         """
-        accessToken = self.tokenFactory.generateToken(
+        accessToken = yield self.tokenFactory.generateToken(
             self.authTokenLifeTime, client, scope=scope, additionalData=additionalData)
-        if not self.isValidToken(accessToken):
-            raise ValueError('Generated token is invalid: {token}'.format(token=accessToken))
+        self._checkGeneratedToken(accessToken)
         expireTime = None
         if self.authTokenLifeTime is not None:
             expireTime = time.time() + self.authTokenLifeTime
-        self.getTokenStorageSingleton().store(
+        yield self.getTokenStorageSingleton().store(
             accessToken, client, scope=scope,
             additionalData=additionalData, expireTime=expireTime)
-        return accessToken
+        returnValue(accessToken)
+
+    def _checkGeneratedToken(self, token):
+        """
+        Check that a token generated by the token factory is valid,
+        unless the token factory guarantees to generate valid tokens.
+        :raises ValueError: If the token is invalid.
+        :param token: The generated token.
+        """
+        if not getattr(self.tokenFactory, 'generatesValidTokens', False) and \
+                not self.isValidToken(token):
+            raise ValueError('Generated token is invalid: {token}'.format(token=token))
 
     def _buildResponse(self, request, accessToken, scope, refreshToken=None):
         """
@@ -513,34 +716,36 @@ class TokenResource(Resource, object):
         request.setResponseCode(OK)
         return json.dumps(result).encode('utf-8')
 
+    @inlineCallbacks
     def _authenticateClient(self, request):
         """
         Identify and authenticate a client by the credentials in the request.
         :param request: The request.
-        :return: The authenticated client or an OAuth2Error.
+        :return: A Deferred which fires with the authenticated client or an OAuth2Error.
         """
         clientCredentials = self._getClientCredentials(request)
         if isinstance(clientCredentials, OAuth2Error):
-            return clientCredentials
+            returnValue(clientCredentials)
         clientId, secret = clientCredentials
         if clientId is None:
-            return NoClientAuthenticationError()
+            returnValue(NoClientAuthenticationError())
         try:
             clientId = clientId.decode('utf-8')
         except UnicodeDecodeError:
-            return MalformedParameterError('client_id')
+            returnValue(MalformedParameterError('client_id'))
         if secret is not None:
             try:
                 secret = secret.decode('utf-8')
             except UnicodeDecodeError:
-                return MalformedParameterError('client_secret')
+                returnValue(MalformedParameterError('client_secret'))
         try:
-            client = self.clientStorage.getClient(clientId)
+            client = yield self.clientStorage.getClient(clientId)
         except KeyError:
-            return InvalidClientIdError()
+            returnValue(InvalidClientIdError())
         if isinstance(client, PublicClient):
-            return client
-        return self.clientStorage.authenticateClient(client, request, secret)
+            returnValue(client)
+        client = yield self.clientStorage.authenticateClient(client, request, secret)
+        returnValue(client)
 
     @staticmethod
     def _getClientCredentials(request):
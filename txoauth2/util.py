@@ -1,6 +1,11 @@
 # Copyright (c) Sebastian Scholz
 # See LICENSE for details.
 import sys
+import logging
+
+from twisted.internet.defer import Deferred, FirstError
+from twisted.python.failure import Failure
+from twisted.web.server import NOT_DONE_YET
 
 try:
     from urllib import urlencode
@@ -38,3 +43,68 @@ def addToUrl(url, query=None, fragment=None):
     if fragment is not None:
         urlParts[5] = urlencode(fragment)
     return urlunparse(urlParts)
+
+
+def getDeferredResult(deferred):
+    """
+    Extract the result of a Deferred, if it has already fired.
+    This allows code that supports asynchronous storages to stay
+    synchronous when all involved storages return their results directly.
+    :raises Exception: The exception the Deferred failed with, if it has already failed.
+    :param deferred: A Deferred or any other value.
+    :return: The result of the Deferred if it has already fired, the Deferred otherwise.
+             Any other value is returned unchanged.
+    """
+    if not isinstance(deferred, Deferred) or not deferred.called or deferred.paused:
+        return deferred
+    results = []
+    deferred.addBoth(results.append)
+    result = results[0]
+    if isinstance(result, Failure):
+        result.raiseException()
+    return result
+
+
+def renderDeferred(request, deferred, onFailure):
+    """
+    Convert the result of a render function that may be a Deferred into a render result.
+    If the Deferred has already fired, its result is returned directly. Otherwise, NOT_DONE_YET
+    is returned and the result is written to the request once the Deferred fires.
+    :param request: The request that is rendered.
+    :param deferred: A Deferred which will fire with the render result or a render result.
+    :param onFailure: A function that will get called with the request and the failure if the
+                      Deferred fails asynchronously. It must return a render result.
+    :return: The render result or NOT_DONE_YET.
+    """
+    result = getDeferredResult(deferred)
+    if not isinstance(result, Deferred):
+        return result
+    connectionLost = []
+    request.notifyFinish().addErrback(connectionLost.append)
+
+    def writeResult(renderResult):
+        if connectionLost or renderResult is NOT_DONE_YET:
+            return
+        request.write(renderResult)
+        request.finish()
+
+    def handleFailure(failure):
+        if connectionLost:
+            return
+        logging.getLogger('txOauth2').error(
+            'Caught exception while rendering a request: ' + str(failure.value),
+            exc_info=(failure.type, failure.value, failure.getTracebackObject()))
+        writeResult(onFailure(request, failure))
+
+    result.addCallbacks(writeResult, handleFailure)
+    return NOT_DONE_YET
+
+
+def unwrapFirstError(failure):
+    """
+    :param failure: The failure of Deferreds gathered with gatherResults.
+    :return: The failure of the first Deferred that failed.
+    """
+    while failure.check(FirstError):
+        failure = failure.value.subFailure
+    return failure